@@ -1,16 +1,40 @@
 name = "pykneer"
 
-from . import sitk_functions
-from . import elastix_transformix
-from . import find_reference_for_nb
-from . import find_reference_functions
-from . import find_reference_random_gen
-from . import morphology_for_nb
-from . import morphology_functions
-from . import preprocessing_for_nb
-from . import pykneer_io
-from . import relaxometry_for_nb
-from . import relaxometry_functions
-from . import segmentation_sa_for_nb
-from . import segmentation_quality_for_nb
-from . import cylinder_fitting
+# Modules are imported when first used (e.g. pykneer.morphology_for_nb or from pykneer import morphology_for_nb),
+# so that "import pykneer" and the processes of multiprocessing.Pool() import only the modules they need
+import importlib
+
+submodules = ["sitk_functions",
+              "cli",
+              "cohort_manifest",
+              "elastix_transformix",
+              "find_reference_for_nb",
+              "find_reference_functions",
+              "find_reference_random_gen",
+              "instrumentation",
+              "job_queue",
+              "lazy_image_io",
+              "morphology_for_nb",
+              "morphology_functions",
+              "prefetch_io",
+              "preprocessing_for_nb",
+              "pykneer_io",
+              "relaxometry_for_nb",
+              "relaxometry_functions",
+              "segmentation_sa_for_nb",
+              "segmentation_ma_for_nb",
+              "segmentation_quality_for_nb",
+              "thumbnail_cache",
+              "cylinder_fitting"]
+
+__all__ = submodules
+
+
+def __getattr__(submodule_name):
+    if submodule_name in submodules:
+        return importlib.import_module("." + submodule_name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, submodule_name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + submodules)
@@ -0,0 +1,403 @@
+# Serena Bonaretti, 2018
+
+"""
+Module with the command line interface of pyKNEEr, to run the pipeline steps without notebooks (e.g. on batch nodes)
+The steps are the same as in the notebooks and use the same input files. The visualizations are not executed.
+
+Usage:
+    pykneer preprocessing        image_list_preprocessing.txt            --cores 4
+    pykneer segmentation         image_list_newsubject.txt               --cores 4 --modality newsubject
+    pykneer segmentation_ma      image_list_multiatlas.txt               --cores 4 --atlases 5 --fusion weighted
+    pykneer morphology           image_list_morphology.txt               --cores 4 --thickness-algorithm 1
+    pykneer relaxometry_fitting  image_list_relaxometry_fitting.txt      --cores 4 --method exp --align
+    pykneer relaxometry_EPG      image_list_relaxometry_EPG.txt          --cores 4
+    pykneer segmentation_quality image_list_segmentation_quality.txt     --cores 4
+Options for all the commands:
+    --stages: run only some steps (e.g. --stages warp_bone_mask warp_cartilage_mask). --list-stages shows the steps
+    --dry-run: reads the input file and prints the steps and the images, without running them
+    --progress: file for progress messages in json format, one line per event (- for the standard output; in this case,
+      all the other messages, also of the pool processes and of elastix, are sent to the standard error)
+    --timing-log: file for the time and resources of each image and step (see instrumentation.py)
+The input file can also be a cohort manifest (.csv, see cohort_manifest.py), except for segmentation_ma, which needs the atlases of
+its input file. Then --subjects and --status select the subjects, and the status of the subjects is set to the command when all the steps ran
+
+Functions:
+    - preprocessing_stages
+    - segmentation_stages
+    - segmentation_ma_stages
+    - morphology_stages
+    - relaxometry_fitting_stages
+    - relaxometry_EPG_stages
+    - segmentation_quality_stages
+    - run_pipeline
+    - main
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+# pyKNEER imports
+# ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
+if __package__ is None or __package__ == '':
+    # uses current directory visibility
+    import cohort_manifest as cm
+    import instrumentation as instr
+    import pykneer_io      as io
+else:
+    # uses current package visibility
+    from . import cohort_manifest as cm
+    from . import instrumentation as instr
+    from . import pykneer_io      as io
+
+
+def import_module(module_name):
+
+    # modules of the steps are imported only when the steps run (--help and --dry-run are fast)
+    if __package__ is None or __package__ == '':
+        return __import__(module_name)
+    import importlib
+    return importlib.import_module("." + module_name, __package__)
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# PIPELINES -----------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+# Each function returns the list of steps as (name, function). Functions take image_data and the command line arguments
+
+def preprocessing_stages(args):
+
+    prep   = import_module("preprocessing_for_nb")
+    stages = [("read_dicom_stack",    lambda image_data: prep.read_dicom_stack  (image_data, args.cores)),
+              ("print_dicom_header",  lambda image_data: prep.print_dicom_header(image_data, args.cores)),
+              ("orientation_to_rai",  lambda image_data: prep.orientation_to_rai(image_data, args.cores)),
+              ("flip_rl",             lambda image_data: prep.flip_rl           (image_data, args.cores)),
+              ("origin_to_zero",      lambda image_data: prep.origin_to_zero    (image_data, args.cores))]
+    if args.intensity_standardization == 1:
+        stages = stages + [("field_correction",          lambda image_data: prep.field_correction         (image_data, args.cores)),
+                           ("rescale_to_range",          lambda image_data: prep.rescale_to_range         (image_data, args.cores)),
+                           ("edge_preserving_smoothing", lambda image_data: prep.edge_preserving_smoothing(image_data, args.cores))]
+
+    return stages
+
+
+def segmentation_stages(args):
+
+    segm   = import_module("segmentation_sa_for_nb")
+    stages = [("prepare_reference",                lambda image_data: segm.prepare_reference               (image_data)),
+              ("register_bone_to_reference",       lambda image_data: segm.register_bone_to_reference      (image_data, args.cores)),
+              ("invert_bone_transformations",      lambda image_data: segm.invert_bone_transformations     (image_data, args.cores)),
+              ("warp_bone_mask",                   lambda image_data: segm.warp_bone_mask                  (image_data, args.cores)),
+              ("register_cartilage_to_reference",  lambda image_data: segm.register_cartilage_to_reference (image_data, args.cores)),
+              ("invert_cartilage_transformations", lambda image_data: segm.invert_cartilage_transformations(image_data, args.cores)),
+              ("warp_cartilage_mask",              lambda image_data: segm.warp_cartilage_mask             (image_data, args.cores))]
+
+    return stages
+
+
+def segmentation_ma_stages(args):
+
+    ma     = import_module("segmentation_ma_for_nb")
+    stages = [("build_atlas_index",    lambda image_data: ma.build_atlas_index   (image_data, args.cores)),
+              ("preselect_atlases",    lambda image_data: ma.preselect_atlases   (image_data, args.atlases, args.cores)),
+              ("prepare_atlases",      lambda image_data: ma.prepare_atlases     (image_data, args.cores)),
+              ("segment_with_atlases", lambda image_data: ma.segment_with_atlases(image_data, args.cores)),
+              ("fuse_labels",          lambda image_data: ma.fuse_labels         (image_data, args.fusion, args.cores))]
+
+    return stages
+
+
+def morphology_stages(args):
+
+    morph = import_module("morphology_for_nb")
+
+    def calculate_thickness(image_data):
+        morph.algorithm(image_data, args.thickness_algorithm)
+        morph.calculate_thickness(image_data, args.cores)
+
+    def thickness_table(image_data):
+        # file names of the thickness depend on the algorithm
+        morph.algorithm(image_data, args.thickness_algorithm)
+        morph.show_thickness_table(image_data, args.thickness_table)
+
+    stages = [("separate_cartilage_surfaces", lambda image_data: morph.separate_cartilage_surfaces(image_data, args.cores)),
+              ("calculate_thickness",         calculate_thickness),
+              ("thickness_table",             thickness_table),
+              ("calculate_volume",            lambda image_data: morph.calculate_volume (image_data, args.cores)),
+              ("volume_table",                lambda image_data: morph.show_volume_table(image_data, args.volume_table))]
+
+    return stages
+
+
+def relaxometry_fitting_stages(args):
+
+    rel    = import_module("relaxometry_for_nb")
+    stages = []
+    if args.align == 1:
+        stages.append(("align_acquisitions", lambda image_data: rel.align_acquisitions(image_data, args.cores)))
+    stages = stages + [("calculate_fitting_maps", lambda image_data: rel.calculate_fitting_maps(image_data, args.cores)),
+                       ("fitting_table",          lambda image_data: rel.show_fitting_table    (image_data, args.table))]
+
+    return stages
+
+
+def relaxometry_EPG_stages(args):
+
+    rel    = import_module("relaxometry_for_nb")
+    stages = [("calculate_t2_maps", lambda image_data: rel.calculate_t2_maps(image_data, args.cores)),
+              ("t2_table",          lambda image_data: rel.show_t2_table    (image_data, args.table))]
+
+    return stages
+
+
+def segmentation_quality_stages(args):
+
+    sq = import_module("segmentation_quality_for_nb")
+
+    def compute_quality(image_data):
+        quality = sq.compute_quality(image_data, args.cores)
+        sq.quality_table(quality, args.table)
+
+    stages = [("compute_quality", compute_quality)]
+
+    return stages
+
+
+def load_image_data(args):
+
+    # cohort manifest (see cohort_manifest.py), with optional selection of subjects
+    if args.input_file_name.endswith(".csv"):
+        if args.command == "segmentation_ma":
+            print("----------------------------------------------------------------------------------------")
+            print("ERROR: segmentation_ma does not read cohort manifests. Use an input file with the atlases (r) and the images (m)")
+            print("----------------------------------------------------------------------------------------")
+            return {}
+        args.manifest = cm.load_manifest(args.input_file_name)
+        if args.manifest is None:
+            return {}
+        args.records = args.manifest.select(args.subjects, args.status)
+        if args.command == "relaxometry_fitting":
+            return args.manifest.all_image_data(args.command, args.records, method_flag=args.method_flag, registration_flag=args.align)
+        elif args.command == "segmentation":
+            return args.manifest.all_image_data(args.command, args.records, registration_type=args.modality)
+        return args.manifest.all_image_data(args.command, args.records)
+
+    # same input files as the notebooks
+    if args.command == "preprocessing":
+        return io.load_image_data_preprocessing(args.input_file_name)
+    elif args.command == "segmentation":
+        return io.load_image_data_segmentation(args.modality, args.input_file_name)
+    elif args.command == "segmentation_ma":
+        return io.load_image_data_segmentation_ma(args.input_file_name)
+    elif args.command == "morphology":
+        return io.load_image_data_morphology(args.input_file_name)
+    elif args.command == "relaxometry_fitting":
+        return io.load_image_data_fitting(args.input_file_name, args.method_flag, args.align)
+    elif args.command == "relaxometry_EPG":
+        return io.load_image_data_EPG(args.input_file_name)
+    elif args.command == "segmentation_quality":
+        return io.load_image_data_segmentation_quality(args.input_file_name)
+
+
+pipelines = {"preprocessing"        : preprocessing_stages,
+             "segmentation"         : segmentation_stages,
+             "segmentation_ma"      : segmentation_ma_stages,
+             "morphology"           : morphology_stages,
+             "relaxometry_fitting"  : relaxometry_fitting_stages,
+             "relaxometry_EPG"      : relaxometry_EPG_stages,
+             "segmentation_quality" : segmentation_quality_stages}
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# PROGRESS ------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+class progress_writer:
+
+    """
+    Writes one line in json format per event (pipeline and step start and end)
+    """
+
+    def __init__(self, file_name, command):
+
+        self.command = command
+        self.file    = None
+        if file_name == "-":
+            # keep the standard output for progress messages, and send all the other messages to the standard error
+            # (dup2 also redirects the output of the pool processes and of elastix, which inherit the file descriptor)
+            sys.stdout.flush()
+            self.file = os.fdopen(os.dup(1), "w")
+            os.dup2(2, 1)
+        elif file_name is not None:
+            self.file = open(file_name, "a")
+
+    def write(self, event, **fields):
+
+        if self.file is None:
+            return
+        record = {"event"   : event,
+                  "command" : self.command,
+                  "host"    : socket.gethostname(),
+                  "pid"     : os.getpid(),
+                  "time"    : time.strftime("%Y-%m-%dT%H:%M:%S")}
+        record.update(fields)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+
+        if self.file is not None:
+            self.file.close()
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# RUN -----------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def run_pipeline(args):
+
+    """
+    Runs the steps of a pipeline. Returns the exit code: 0 if all the steps ran, 1 if a step failed, 2 for wrong input
+    """
+
+    # steps
+    stages      = pipelines[args.command](args)
+    stage_names = [name for name, function in stages]
+    if args.list_stages:
+        for name in stage_names:
+            print (name)
+        return 0
+    if args.stages is not None:
+        for name in args.stages:
+            if name not in stage_names:
+                print ("----------------------------------------------------------------------------------------")
+                print ("ERROR: The step %s does not exist. Steps of %s are: %s" % (name, args.command, ", ".join(stage_names)))
+                print ("----------------------------------------------------------------------------------------")
+                return 2
+        stages = [(name, function) for name, function in stages if name in args.stages]
+
+    progress = progress_writer(args.progress, args.command)
+    try:
+        # read input file
+        image_data = load_image_data(args)
+        if image_data is None or len(image_data) == 0:
+            progress.write("pipeline_end", status="error", message="input file not loaded: " + args.input_file_name)
+            return 2
+        subjects = [instr.get_subject([image_data[i]]) for i in range(0, len(image_data))]
+
+        # only show what would run
+        if args.dry_run:
+            print ("-> Steps: " + ", ".join([name for name, function in stages]))
+            print ("-> Images (%d): " % len(subjects) + ", ".join(subjects))
+            progress.write("dry_run", stages=[name for name, function in stages], subjects=subjects)
+            return 0
+
+        # measurements of each image and step
+        if args.timing_log is not None:
+            instr.set_timing_log(args.timing_log)
+
+        progress.write("pipeline_start", input_file_name=os.path.abspath(args.input_file_name), n_of_images=len(subjects),
+                       n_of_cores=args.cores, stages=[name for name, function in stages])
+        pipeline_start_time = time.time()
+        for s in range(0, len(stages)):
+            name, function = stages[s]
+            print ("-> Step %d of %d: %s" % (s + 1, len(stages), name), flush = True)
+            progress.write("stage_start", stage=name, stage_index=s + 1, n_of_stages=len(stages))
+            start_time = time.time()
+            try:
+                function(image_data)
+            except Exception as error:
+                progress.write("stage_end", stage=name, status="error", message=type(error).__name__ + ": " + str(error),
+                               elapsed_s=round(time.time() - start_time, 2))
+                progress.write("pipeline_end", status="error", elapsed_s=round(time.time() - pipeline_start_time, 2))
+                print ("----------------------------------------------------------------------------------------")
+                print ("ERROR: The step %s failed: %s" % (name, str(error)))
+                print ("----------------------------------------------------------------------------------------")
+                return 1
+            sys.stdout.flush()
+            progress.write("stage_end", stage=name, status="ok", elapsed_s=round(time.time() - start_time, 2))
+
+        # status of the subjects in the manifest: last step run
+        if args.manifest is not None:
+            args.manifest.set_status([record.subject_id for record in args.records], args.command)
+            args.manifest.write()
+
+        progress.write("pipeline_end", status="ok", elapsed_s=round(time.time() - pipeline_start_time, 2))
+        print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - pipeline_start_time), (time.time() - pipeline_start_time)/60))
+    finally:
+        progress.close()
+
+    return 0
+
+
+def parse_arguments(argv):
+
+    # options of all the commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("input_file_name",                                          help="input file, as in the notebooks, or cohort manifest (.csv)")
+    common.add_argument("--subjects",         nargs="+", default=None,              help="manifest only: run only these subject ids")
+    common.add_argument("--status",           nargs="+", default=None,              help="manifest only: run only the subjects with this status")
+    common.add_argument("-n", "--cores",      type=int, default=1,                  help="number of processes (default: 1)")
+    common.add_argument("--stages",           nargs="+", default=None,              help="run only these steps (in the pipeline order)")
+    common.add_argument("--list-stages",      action="store_true",                  help="print the steps and exit")
+    common.add_argument("--dry-run",          action="store_true",                  help="read the input file, print steps and images, and exit")
+    common.add_argument("--progress",         default=None,                         help="file for progress messages in json format (- for the standard output)")
+    common.add_argument("--timing-log",       default=None,                         help="file for time and resources of each image and step")
+
+    parser      = argparse.ArgumentParser(prog="pykneer", description="pyKNEEr pipeline steps without notebooks")
+    subparsers  = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    command = subparsers.add_parser("preprocessing", parents=[common], help="preprocessing.ipynb")
+    command.add_argument("--intensity-standardization", type=int, choices=[0, 1], default=1)
+
+    command = subparsers.add_parser("segmentation", parents=[common], help="segmentation_sa.ipynb")
+    command.add_argument("--modality", choices=["newsubject", "longitudinal", "multimodal"], default="newsubject")
+
+    command = subparsers.add_parser("segmentation_ma", parents=[common], help="multi-atlas segmentation (segmentation_ma_for_nb.py)")
+    command.add_argument("--atlases", type=int, default=5, help="number of preselected atlases for each image (default: 5)")
+    command.add_argument("--fusion",  choices=["majority", "weighted"], default="weighted")
+
+    command = subparsers.add_parser("morphology", parents=[common], help="morphology.ipynb")
+    command.add_argument("--thickness-algorithm", type=int, choices=[1, 2], default=1,
+                         help="1 for nearest neighbor on bone-cartilage surface, 2 for nearest neighbor on articular surface")
+    command.add_argument("--thickness-table", default="thickness.csv")
+    command.add_argument("--volume-table",    default="volume.csv")
+
+    command = subparsers.add_parser("relaxometry_fitting", parents=[common], help="relaxometry_fitting.ipynb")
+    command.add_argument("--method", choices=["lin", "exp"], default="exp")
+    command.add_argument("--align",  type=int, choices=[0, 1], default=1, help="1 to rigidly register the acquisitions")
+    command.add_argument("--table",  default="fitting.csv")
+
+    command = subparsers.add_parser("relaxometry_EPG", parents=[common], help="relaxometry_EPG.ipynb")
+    command.add_argument("--table",  default="EPG.csv")
+
+    command = subparsers.add_parser("segmentation_quality", parents=[common], help="segmentation_quality.ipynb")
+    command.add_argument("--table",  default="quality.csv")
+
+    args = parser.parse_args(argv)
+    args.manifest = None
+    args.records  = None
+
+    # as in the notebook: 0 = linear, 1 = exponential
+    if args.command == "relaxometry_fitting":
+        args.method_flag = 0 if args.method == "lin" else 1
+
+    return args
+
+
+def main(argv=None):
+
+    args = parse_arguments(argv)
+    if args.cores < 1:
+        print ("ERROR: The number of cores must be at least 1")
+        return 2
+
+    return run_pipeline(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
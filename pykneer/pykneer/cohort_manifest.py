@@ -0,0 +1,417 @@
+# Serena Bonaretti, 2018
+
+"""
+Module with the cohort manifest, an alternative to the input files of the notebooks for large cohorts.
+A manifest is a .csv file with one row per subject. Lines starting with # at the beginning of the file contain
+the folders (and the reference name), as "# key = value":
+    # preprocessed_folder = /data/cohort/preprocessed/
+    # segmented_folder    = /data/cohort/segmented/
+    subject_id,status,moving_name,mask_name
+    01,new,01_DESS_prep.mha,01_DESS_prep_fc.mha
+Columns used by each step (other columns are kept and ignored):
+    - preprocessing:        original_folder; image_folder_file_name, laterality
+    - segmentation:         reference_folder, preprocessed_folder, reference_name; moving_name
+    - segmentation_quality: segmented_folder, ground_truth_folder; segmented_name, ground_truth_name
+    - morphology:           segmented_folder; mask_name
+    - relaxometry_EPG:      preprocessed_folder, segmented_folder; i1_file_name, i2_file_name, mask_file_name
+    - relaxometry_fitting:  preprocessed_folder, segmented_folder; acquisition_file_names (separated by ;),
+                            bone_mask_file_name, cart_mask_file_name
+Loading reads only the .csv file. Subjects are indexed by id and status, image_data are created only for the selected
+subjects (with the same names as the load_image_data_* functions of pykneer_io.py), and input files are checked with
+one listing per folder.
+
+Usage:
+    cohort     = cohort_manifest.load_manifest("cohort.csv")
+    subjects   = cohort.select(status="new")
+    image_data = cohort.all_image_data("morphology", subjects)
+
+Functions and classes:
+    - subject_record (class)
+    - manifest (class)
+    - load_manifest
+"""
+
+import csv
+import os
+
+# pyKNEER imports
+# ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
+if __package__ is None or __package__ == '':
+    # uses current directory visibility
+    import pykneer_io as io
+else:
+    # uses current package visibility
+    from . import pykneer_io as io
+
+
+# steps with their folders (in the header) and columns
+step_folders = {"preprocessing"        : ["original_folder"],
+                "segmentation"         : ["reference_folder", "preprocessed_folder"],
+                "segmentation_quality" : ["segmented_folder", "ground_truth_folder"],
+                "morphology"           : ["segmented_folder"],
+                "relaxometry_EPG"      : ["preprocessed_folder", "segmented_folder"],
+                "relaxometry_fitting"  : ["preprocessed_folder", "segmented_folder"]}
+step_columns = {"preprocessing"        : ["image_folder_file_name", "laterality"],
+                "segmentation"         : ["moving_name"],
+                "segmentation_quality" : ["segmented_name", "ground_truth_name"],
+                "morphology"           : ["mask_name"],
+                "relaxometry_EPG"      : ["i1_file_name", "i2_file_name", "mask_file_name"],
+                "relaxometry_fitting"  : ["acquisition_file_names", "bone_mask_file_name", "cart_mask_file_name"]}
+
+# separator of multiple file names in one column
+list_separator = ";"
+
+
+class subject_record:
+
+    """
+    One row of the manifest: subject_id, status, and the other columns in fields
+    """
+
+    __slots__ = ["subject_id", "status", "fields"]
+
+    def __init__(self, subject_id, status, fields):
+
+        self.subject_id = subject_id
+        self.status     = status
+        self.fields     = fields
+
+    def __getitem__(self, column):
+
+        return self.fields[column]
+
+    def __repr__(self):
+
+        return "subject_record(%r, %r)" % (self.subject_id, self.status)
+
+
+class manifest:
+
+    """
+    Subjects of a cohort, indexed by id and by status
+    Methods:
+        - add_subject
+        - select
+        - set_status
+        - write
+        - missing_files
+        - image_data
+        - all_image_data
+    """
+
+    def __init__(self, file_name=None, folders=None, columns=None):
+
+        self.file_name       = file_name
+        self.folders         = {} if folders is None else folders
+        self.columns         = [] if columns is None else list(columns)
+        self.records         = []
+        self.by_id           = {}
+        self.by_status       = {} # status -> {subject_id : record}
+        self.folder_listings = {}
+
+    def add_subject(self, subject_id, status="new", **fields):
+
+        subject_id = str(subject_id)
+        if subject_id in self.by_id:
+            print("----------------------------------------------------------------------------------------")
+            print("ERROR: The subject %s is already in the manifest" % (subject_id) )
+            print("----------------------------------------------------------------------------------------")
+            return None
+        for column in fields:
+            if column not in self.columns:
+                self.columns.append(column)
+        record = subject_record(subject_id, status, fields)
+        self.records.append(record)
+        self.by_id[subject_id] = record
+        self.by_status.setdefault(status, {})[subject_id] = record
+
+        return record
+
+    def select(self, subject_ids=None, status=None):
+
+        """
+        Returns the records with the given ids (in the given order) and/or status (one status or a list)
+        """
+
+        if subject_ids is None and status is None:
+            return list(self.records)
+
+        # status: from the index
+        if status is not None:
+            statuses = [status] if isinstance(status, str) else status
+            records  = []
+            for s in statuses:
+                records.extend(self.by_status.get(s, {}).values())
+            if subject_ids is None:
+                return records
+            subject_ids = set([str(subject_id) for subject_id in subject_ids])
+            return [record for record in records if record.subject_id in subject_ids]
+
+        # ids: from the index
+        records = []
+        for subject_id in subject_ids:
+            if str(subject_id) not in self.by_id:
+                print("----------------------------------------------------------------------------------------")
+                print("ERROR: The subject %s is not in the manifest" % (subject_id) )
+                print("----------------------------------------------------------------------------------------")
+                continue
+            records.append(self.by_id[str(subject_id)])
+
+        return records
+
+    def set_status(self, subject_ids, status):
+
+        for subject_id in subject_ids:
+            record = self.by_id[str(subject_id)]
+            if record.status == status:
+                continue
+            del self.by_status[record.status][record.subject_id]
+            record.status = status
+            self.by_status.setdefault(status, {})[record.subject_id] = record
+
+    def write(self, file_name=None):
+
+        """
+        Writes the manifest (to a temporary file renamed at the end, so that the manifest is never half-written)
+        """
+
+        if file_name is None:
+            file_name = self.file_name
+        tmp_file_name = file_name + ".tmp" + str(os.getpid())
+        with open(tmp_file_name, "w", newline="") as f:
+            for key in self.folders:
+                f.write("# %s = %s\n" % (key, self.folders[key]))
+            writer = csv.writer(f)
+            writer.writerow(["subject_id", "status"] + self.columns)
+            for record in self.records:
+                writer.writerow([record.subject_id, record.status] + [record.fields.get(column, "") for column in self.columns])
+        os.replace(tmp_file_name, file_name)
+        self.file_name = file_name
+
+    # --- folders and input files ---------------------------------------------------------------------------------------
+
+    def folder(self, key):
+
+        folder_div = io.folder_divider()
+        folder     = self.folders.get(key, "")
+        if len(folder) > 0 and not folder.endswith(folder_div):
+            folder = folder + folder_div
+
+        return folder
+
+    def file_exists(self, folder, name):
+
+        # one listing per folder (names can contain subfolders)
+        file_name           = os.path.join(folder, name)
+        parent, entry       = os.path.split(file_name)
+        if parent not in self.folder_listings:
+            try:
+                self.folder_listings[parent] = set(os.listdir(parent))
+            except OSError:
+                self.folder_listings[parent] = set()
+
+        return entry in self.folder_listings[parent]
+
+    def input_files(self, step, record):
+
+        # (folder, file name) of the input files of a subject for a step
+        if step == "preprocessing":
+            return [(self.folder("original_folder"),     record["image_folder_file_name"])]
+        elif step == "segmentation":
+            return [(self.folder("preprocessed_folder"), record["moving_name"])]
+        elif step == "segmentation_quality":
+            return [(self.folder("segmented_folder"),    record["segmented_name"]),
+                    (self.folder("ground_truth_folder"), record["ground_truth_name"])]
+        elif step == "morphology":
+            return [(self.folder("segmented_folder"),    record["mask_name"])]
+        elif step == "relaxometry_EPG":
+            image_name_root, image_ext = os.path.splitext(record["i1_file_name"])
+            return [(self.folder("preprocessed_folder"), record["i1_file_name"]),
+                    (self.folder("preprocessed_folder"), image_name_root + ".txt"),
+                    (self.folder("preprocessed_folder"), record["i2_file_name"]),
+                    (self.folder("segmented_folder"),    record["mask_file_name"])]
+        elif step == "relaxometry_fitting":
+            files = []
+            for acquisition_file_name in record["acquisition_file_names"].split(list_separator):
+                image_name_root, image_ext = os.path.splitext(acquisition_file_name)
+                files.append((self.folder("preprocessed_folder"), acquisition_file_name))
+                files.append((self.folder("preprocessed_folder"), image_name_root + ".txt"))
+            return files + [(self.folder("segmented_folder"), record["bone_mask_file_name"]),
+                            (self.folder("segmented_folder"), record["cart_mask_file_name"])]
+
+    def missing_files(self, step, records=None, refresh=True):
+
+        """
+        Returns the input files of the records that do not exist, reading each folder once
+        """
+
+        if refresh:
+            self.folder_listings = {}
+        if records is None:
+            records = self.records
+
+        missing = []
+        if step == "segmentation" and not self.file_exists(self.folder("reference_folder"), self.folders.get("reference_name", "")):
+            missing.append(self.folder("reference_folder") + self.folders.get("reference_name", ""))
+        for record in records:
+            for folder, name in self.input_files(step, record):
+                if not self.file_exists(folder, name):
+                    missing.append(folder + name)
+
+        return missing
+
+    # --- image_data -------------------------------------------------------------------------------------------------------
+
+    def image_data(self, step, record, registration_type="newsubject", method_flag=1, registration_flag=1):
+
+        """
+        Creates the image_data of one subject for a step, as the load_image_data_* functions of pykneer_io.py
+        """
+
+        if step == "preprocessing":
+            return io.preprocessing_image_data(self.folder("original_folder"), io.sibling_folder(self.folder("original_folder"), "preprocessed"),
+                                               record["image_folder_file_name"], record["laterality"])
+        elif step == "segmentation":
+            moving_folder = self.folder("preprocessed_folder")
+            return io.segmentation_image_data(registration_type, self.folder("reference_folder"), self.folders["reference_name"],
+                                              moving_folder, record["moving_name"],
+                                              io.sibling_folder(moving_folder, "registered"), io.sibling_folder(moving_folder, "segmented"))
+        elif step == "segmentation_quality":
+            return io.segmentation_quality_image_data(self.folder("segmented_folder"), self.folder("ground_truth_folder"),
+                                                      record["segmented_name"], record["ground_truth_name"])
+        elif step == "morphology":
+            return io.morphology_image_data(self.folder("segmented_folder"), io.sibling_folder(self.folder("segmented_folder"), "morphology"),
+                                            record["mask_name"])
+        elif step == "relaxometry_EPG":
+            return io.EPG_image_data(self.folder("preprocessed_folder"), self.folder("segmented_folder"),
+                                     io.sibling_folder(self.folder("preprocessed_folder"), "relaxometry"),
+                                     record["i1_file_name"], record["i2_file_name"], record["mask_file_name"])
+        elif step == "relaxometry_fitting":
+            acquisition_file_names = record["acquisition_file_names"].split(list_separator)
+            info_file_names        = [os.path.splitext(file_name)[0] + ".txt" for file_name in acquisition_file_names]
+            return io.fitting_image_data(self.folder("preprocessed_folder"), self.folder("segmented_folder"),
+                                         io.sibling_folder(self.folder("preprocessed_folder"), "relaxometry"),
+                                         acquisition_file_names, info_file_names,
+                                         record["bone_mask_file_name"], record["cart_mask_file_name"], method_flag, registration_flag)
+
+    def all_image_data(self, step, records=None, registration_type="newsubject", method_flag=1, registration_flag=1, check_flag=1):
+
+        """
+        Creates the image_data of the records for a step (all_image_data of the notebooks). Returns {} if files are missing
+        """
+
+        if step not in step_folders:
+            print("----------------------------------------------------------------------------------------")
+            print("ERROR: The step %s does not exist. Steps are: %s" % (step, ", ".join(step_folders.keys())) )
+            print("----------------------------------------------------------------------------------------")
+            return {}
+        if records is None:
+            records = self.records
+
+        # folders and columns
+        for key in step_folders[step]:
+            if not os.path.isdir(self.folder(key)):
+                print("----------------------------------------------------------------------------------------")
+                print("ERROR: The folder %s (%s) does not exist" % (self.folder(key), key) )
+                print("----------------------------------------------------------------------------------------")
+                return {}
+        for column in step_columns[step]:
+            if column not in self.columns:
+                print("----------------------------------------------------------------------------------------")
+                print("ERROR: The manifest does not have the column %s" % (column) )
+                print("----------------------------------------------------------------------------------------")
+                return {}
+
+        # input files
+        if check_flag == 1:
+            missing = self.missing_files(step, records)
+            if len(missing) > 0:
+                print("----------------------------------------------------------------------------------------")
+                print("ERROR: %d files do not exist, e.g. %s" % (len(missing), missing[0]) )
+                print("----------------------------------------------------------------------------------------")
+                return {}
+
+        # output folders
+        if step == "preprocessing":
+            output_folders = [io.sibling_folder(self.folder("original_folder"), "preprocessed")]
+        elif step == "segmentation":
+            output_folders = [io.sibling_folder(self.folder("preprocessed_folder"), "registered"),
+                              io.sibling_folder(self.folder("preprocessed_folder"), "segmented")]
+        elif step == "morphology":
+            output_folders = [io.sibling_folder(self.folder("segmented_folder"), "morphology")]
+        elif step == "relaxometry_EPG" or step == "relaxometry_fitting":
+            output_folders = [io.sibling_folder(self.folder("preprocessed_folder"), "relaxometry")]
+        else:
+            output_folders = []
+        for folder in output_folders:
+            if not os.path.isdir(folder):
+                os.mkdir(folder)
+                print("-> folder %s created" % (folder) )
+
+        all_image_data = []
+        for record in records:
+            image_data = self.image_data(step, record, registration_type, method_flag, registration_flag)
+            if len(image_data) == 0:
+                return {}
+            all_image_data.append(image_data)
+        if step == "segmentation" and registration_type == "longitudinal":
+            io.link_longitudinal_visits(all_image_data)
+
+        print ("-> information loaded for " + str(len(all_image_data)) + " subjects")
+
+        return all_image_data
+
+
+def load_manifest(file_name):
+
+    """
+    Reads a manifest .csv file. Returns None if the file does not exist or is not a manifest
+    """
+
+    if not os.path.isfile(file_name):
+        print("----------------------------------------------------------------------------------------")
+        print("ERROR: The file %s does not exist" % (file_name) )
+        print("----------------------------------------------------------------------------------------")
+        return None
+
+    with open(file_name, newline="") as f:
+        lines = f.read().splitlines()
+
+    # folders in the header
+    folders = {}
+    n_of_header_lines = 0
+    for line in lines:
+        if not line.startswith("#"):
+            break
+        n_of_header_lines = n_of_header_lines + 1
+        if "=" in line:
+            key, value = line[1:].split("=", 1)
+            folders[key.strip()] = value.strip()
+
+    # table
+    rows = csv.reader(lines[n_of_header_lines:])
+    header = next(rows, None)
+    if header is None or header[0:2] != ["subject_id", "status"]:
+        print("----------------------------------------------------------------------------------------")
+        print("ERROR: The first columns of %s must be subject_id and status" % (file_name) )
+        print("----------------------------------------------------------------------------------------")
+        return None
+
+    cohort  = manifest(file_name, folders, header[2:])
+    columns = header[2:]
+    for row in rows:
+        # if there are empty lines
+        if len(row) == 0:
+            continue
+        row = [value.strip() for value in row]
+        record = subject_record(row[0], row[1], dict(zip(columns, row[2:])))
+        if record.subject_id in cohort.by_id:
+            print("----------------------------------------------------------------------------------------")
+            print("ERROR: The subject %s is twice in %s" % (record.subject_id, file_name) )
+            print("----------------------------------------------------------------------------------------")
+            return None
+        cohort.records.append(record)
+        cohort.by_id[record.subject_id] = record
+        cohort.by_status.setdefault(record.status, {})[record.subject_id] = record
+
+    return cohort
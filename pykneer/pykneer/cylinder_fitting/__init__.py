@@ -1,6 +1,11 @@
 from .fitting import fit
 
-from .visualize import show_fit
-from .visualize import show_G_distribution
-
 from .analysis import fitting_rmsd
+
+
+# the visualization functions import matplotlib, which is slow to import: they are imported when first used
+def __getattr__(name):
+    if name in ("show_fit", "show_G_distribution"):
+        from . import visualize
+        return getattr(visualize, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.optimize import minimize
 
 def direction(theta, phi):
     '''Return the direction vector of a cylinder defined
@@ -19,9 +18,8 @@ def skew_matrix(w):
                      [-w[1], w[0], 0]])
 
 def calc_A(Ys):
-    '''Return the matrix A from a list of Y vectors.'''
-    return sum(np.dot(np.reshape(Y, (3,1)), np.reshape(Y, (1, 3)))
-            for Y in Ys)
+    '''Return the matrix A from an (n, 3) array of Y vectors.'''
+    return np.dot(np.transpose(Ys), Ys)
 
 def calc_A_hat(A, S):
     '''Return the A_hat matrix of A given the skew matrix S'''
@@ -29,48 +27,52 @@ def calc_A_hat(A, S):
 
 def preprocess_data(Xs_raw):
     '''Translate the center of mass (COM) of the data to the origin.
-    Return the prossed data and the shift of the COM'''
-    n = len(Xs_raw)
-    Xs_raw_mean = sum(X for X in Xs_raw) / n
+    Return the prossed data as an (n, 3) array and the shift of the COM'''
+    Xs_raw = np.asarray(Xs_raw, dtype=float)
+    Xs_raw_mean = np.mean(Xs_raw, axis=0)
 
-    return [X - Xs_raw_mean for X in Xs_raw], Xs_raw_mean
+    return Xs_raw - Xs_raw_mean, Xs_raw_mean
 
-def G(w, Xs):
-    '''Calculate the G function given a cylinder direction w and a
-    list of data points Xs to be fitted.'''
-    n = len(Xs)
+def calc_Ys(w, Xs):
+    '''Return the projections Y of the data points Xs on the plane
+    perpendicular to w, and their squared norms.'''
     P = projection_matrix(w)
-    Ys = [np.dot(P, X) for X in Xs]
+    Ys = np.dot(Xs, P) # P is symmetric
+    Ys_sq = np.einsum('ij,ij->i', Ys, Ys)
+
+    return Ys, Ys_sq
+
+def G(w, Xs):
+    '''Calculate the G function given a cylinder direction w and an
+    (n, 3) array of data points Xs to be fitted.'''
+    Ys, Ys_sq = calc_Ys(w, Xs)
     A = calc_A(Ys)
     A_hat = calc_A_hat(A, skew_matrix(w))
 
-    
-    u = sum(np.dot(Y, Y) for Y in Ys) / n
-    v = np.dot(A_hat, sum(np.dot(Y, Y) * Y for Y in Ys)) / np.trace(np.dot(A_hat, A))
+    u = np.mean(Ys_sq)
+    v = np.dot(A_hat, np.dot(Ys_sq, Ys)) / np.trace(np.dot(A_hat, A))
 
-    return sum((np.dot(Y, Y) - u - 2 * np.dot(Y, v)) ** 2 for Y in Ys)
+    return np.sum((Ys_sq - u - 2 * np.dot(Ys, v)) ** 2)
 
 def C(w, Xs):
     '''Calculate the cylinder center given the cylinder direction and 
-    a list of data points.
+    an (n, 3) array of data points.
     '''
-    n = len(Xs)
-    P = projection_matrix(w)
-    Ys = [np.dot(P, X) for X in Xs]
+    Ys, Ys_sq = calc_Ys(w, Xs)
     A = calc_A(Ys)
     A_hat = calc_A_hat(A, skew_matrix(w))
 
-    return np.dot(A_hat, sum(np.dot(Y, Y) * Y for Y in Ys)) / np.trace(np.dot(A_hat, A))
+    return np.dot(A_hat, np.dot(Ys_sq, Ys)) / np.trace(np.dot(A_hat, A))
 
 def r(w, Xs):
-    '''Calculate the radius given the cylinder direction and a list
-    of data points.
+    '''Calculate the radius given the cylinder direction and an (n, 3)
+    array of data points.
     '''
-    n = len(Xs)
     P = projection_matrix(w)
     c = C(w, Xs)
+    Ds = c - Xs
 
-    return np.sqrt(sum(np.dot(c - X, np.dot(P, c - X)) for X in Xs) / n)
+    return np.sqrt(np.mean(np.einsum('ij,ij->i', Ds, np.dot(Ds, P))))
 
 def fit(data, guess_angles=None):
     '''Fit a list of data points to a cylinder surface. The algorithm implemented
@@ -88,6 +90,8 @@ def fit(data, guess_angles=None):
         Radius of the cylinder
         Fitting error (G function)
     '''
+    from scipy.optimize import minimize
+
     Xs, t = preprocess_data(data)  
 
     # Set the start points
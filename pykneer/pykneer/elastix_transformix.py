@@ -8,7 +8,9 @@ For each instance, the common methods are :
     - t_rigid, t_similarity, and t_spline warp the reference mask to the moving image using the inverted tranformation
 Other functions in the abstract class are: 
     - prepare_reference 
+    - crop_levelset 
     - modify_transformation 
+    - run_registration (longitudinal registrations initialized with the transformations of the previous visit)
 The instance bone also has the function: 
     - vf_spline used to find the reference bone (see find_reference.py)
     
@@ -20,7 +22,6 @@ import os
 import subprocess
 import SimpleITK as sitk
 
-import pkg_resources
 import platform
 import subprocess
 
@@ -28,12 +29,19 @@ import subprocess
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
 if __package__ is None or __package__ == '':
     # uses current directory visibility
+    import instrumentation as instr
     import sitk_functions  as sitkf
 else:
     # uses current package visibility
+    from . import instrumentation as instr
     from . import sitk_functions  as sitkf
 
 
+# warm start of longitudinal registrations: accepted if the final metric is not worse than the one of the last registration
+# from scratch of the knee by more than this fraction (the metric is mutual information, which decreases when the registration improves)
+warm_start_tolerance = 0.05
+
+
 # ---------------------------------------------------------------------------------------------------------------------------
 # ABSTRACT CLASS FOR REGISTRATION -------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
@@ -90,17 +98,29 @@ class registration(ABC):
 
         # dilate mask
         if not os.path.isfile(reference_mask_dil_name):
-            mask    = sitk.ReadImage(reference_mask_name)
+            mask    = sitkf.read_mask(reference_mask_name)
             maskDil = sitkf.dilate_mask(mask, radius)
             sitk.WriteImage(maskDil, reference_mask_dil_name)
 
         # convert mask from binary to levelset for warping
         if not os.path.isfile(reference_mask_levelset_name):
-            mask   = sitk.ReadImage(reference_mask_name)
+            mask   = sitkf.read_mask(reference_mask_name)
             maskLS = sitkf.binary2levelset(mask)
             sitk.WriteImage(maskLS, reference_mask_levelset_name)
 
 
+    def crop_levelset(self, file_name):
+
+        """
+        Crops a warped level set to the narrow band around the contour, so that the next warping reads and interpolates
+        a small image. Transformix gives the DefaultPixelValue -4 (see modify_transformation) to the points outside the band
+        """
+
+        mask_LS = sitk.ReadImage(file_name)
+        mask_LS = sitkf.crop_levelset(mask_LS)
+        sitk.WriteImage(mask_LS, file_name)
+
+
     def modify_transformation(self, image_data, transformation): 
         """
         It creates a new parameter file to calculate the inverted transformation
@@ -157,6 +177,51 @@ class registration(ABC):
         f.close()
 
 
+    def run_registration(self, image_data, transformation, cmd, params):
+
+        """
+        Runs the elastix command cmd (without parameter file) for the transformation ("rigid" or "spline") with the parameter file params
+        In longitudinal registrations, a visit after the first one starts from the transformation of the previous visit (-t0) with
+        the parameter file of the warm start, which has fewer resolutions and iterations. If elastix fails or the final metric is worse
+        than the one of the last registration from scratch of the knee (not of the previous visit, which can be a warm start itself,
+        so that the tolerance would add up over the visits), the registration is repeated from scratch with params
+        """
+
+        anatomy       = image_data["current_anatomy"]
+        output_folder = image_data["registered_sub_folder"]
+        elastix_path  = image_data["elastix_folder"]
+        metric_name   = image_data[anatomy + transformation + "_metric_name"]
+
+        # transformation and metric of the previous visit
+        previous_folder         = image_data.get("previous_registered_sub_folder", "")
+        initial_transformation  = previous_folder + image_data[anatomy + transformation + "_transf_name"]
+        previous_metric_name    = previous_folder + metric_name
+        if image_data["registration_type"] == "longitudinal" and previous_folder != "" and os.path.isfile(initial_transformation) \
+           and os.path.isfile(previous_metric_name):
+
+            # warm start
+            full_metric = read_full_metric(previous_metric_name)
+            clear_iteration_info(output_folder)
+            instr.run_subprocess(cmd + ["-p",  os.path.abspath(image_data["param_file_" + transformation + "_warm"]),
+                                        "-t0", os.path.abspath(initial_transformation)], cwd=elastix_path)
+            metric = read_final_metric(output_folder)
+            if os.path.exists(output_folder + "result.0.mha") and metric is not None \
+               and metric <= full_metric + warm_start_tolerance * abs(full_metric):
+                write_metric(output_folder + metric_name, metric, "warm", full_metric)
+                return
+            print ("-> %s: %s %s warm start worse than the last registration from scratch (metric %s vs. %.6f), registering from scratch"
+                   % (image_data["moving_root"], anatomy, transformation, metric, full_metric), flush = True)
+            if os.path.exists(output_folder + "result.0.mha"):
+                os.remove(output_folder + "result.0.mha")
+
+        # registration from scratch
+        clear_iteration_info(output_folder)
+        instr.run_subprocess(cmd + ["-p", os.path.abspath(params)], cwd=elastix_path)
+        metric = read_final_metric(output_folder)
+        if metric is not None:
+            write_metric(output_folder + metric_name, metric, "full", metric)
+
+
 
 # ---------------------------------------------------------------------------------------------------------------------------
 # BONE ----------------------------------------------------------------------------------------------------------------------
@@ -187,10 +252,8 @@ class bone (registration):
         cmd = [complete_elastix_path, "-f",     os.path.abspath(complete_reference_name),
                                       "-fMask", os.path.abspath(complete_reference_mask_dil_name),
                                       "-m",     os.path.abspath(complete_moving_name),
-                                      "-p",     os.path.abspath(params),
                                       "-out",   os.path.abspath(output_folder)]
-
-        subprocess.run(cmd, cwd=elastix_path)
+        self.run_registration(image_data, "rigid", cmd, params)
 
         # check if the registration worked
         # if the registration did not work
@@ -247,7 +310,7 @@ class bone (registration):
                                       "-m",     os.path.abspath(complete_moving_name),
                                       "-p",     os.path.abspath(params),
                                       "-out",   os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["registered_sub_folder"] + "result.0.mha"):
@@ -287,9 +350,8 @@ class bone (registration):
         cmd = [complete_elastix_path, "-f",     os.path.abspath(complete_reference_name),
                                       "-fMask", os.path.abspath(complete_reference_mask_dil_name),
                                       "-m",     os.path.abspath(complete_moving_name),
-                                      "-p",     os.path.abspath(params),
                                       "-out",   os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        self.run_registration(image_data, "spline", cmd, params)
 
         # change output names
         if not os.path.exists(image_data["registered_sub_folder"] + "result.0.mha"):
@@ -329,7 +391,7 @@ class bone (registration):
                                       "-p",     os.path.abspath(params),
                                       "-out",   os.path.abspath(output_folder),
                                       "-t0",    os.path.abspath(transformation)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "TransformParameters.0.txt"):
@@ -365,7 +427,7 @@ class bone (registration):
                                       "-p",     os.path.abspath(params),
                                       "-out",   os.path.abspath(output_folder),
                                       "-t0",    os.path.abspath(transformation)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "TransformParameters.0.txt"):
@@ -400,7 +462,7 @@ class bone (registration):
                                       "-p",     os.path.abspath(params),
                                       "-out",   os.path.abspath(output_folder),
                                       "-t0",    os.path.abspath(transformation)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "TransformParameters.0.txt"):
@@ -435,7 +497,7 @@ class bone (registration):
                                           "-tp",  os.path.abspath(transformation),
                                           "-out", os.path.abspath(output_folder)]
         elastix_path              = image_data["elastix_folder"]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "result.mha"):
@@ -467,7 +529,7 @@ class bone (registration):
         cmd = [complete_transformix_path, "-in",  os.path.abspath(mask_to_warp),
                                           "-tp",  os.path.abspath(transformation),
                                           "-out", os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "result.mha"):
@@ -479,6 +541,9 @@ class bone (registration):
         if not os.path.exists(image_data["i_registered_sub_folder"] + image_data[anatomy + "m_similarity_name"]):
             raise FileNotFoundError (image_data["i_registered_sub_folder"] + image_data[anatomy + "m_similarity_name"] + " not written in bone.t_similarity()")
 
+        # keep only the narrow band of the level set as input of the next warping
+        self.crop_levelset(image_data["i_registered_sub_folder"] + image_data[anatomy + "m_similarity_name"])
+
 
     def t_spline(self, image_data):
 
@@ -499,7 +564,7 @@ class bone (registration):
         cmd = [complete_transformix_path, "-in",  os.path.abspath(mask_to_warp),
                                           "-tp",  os.path.abspath(transformation),
                                           "-out", os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output name
         if not os.path.exists(image_data["i_registered_sub_folder"] + "result.mha"):
@@ -511,6 +576,9 @@ class bone (registration):
         if not os.path.exists(image_data["i_registered_sub_folder"] + image_data[anatomy + "m_spline_name"]):
             raise FileNotFoundError (image_data["i_registered_sub_folder"] + image_data[anatomy + "m_spline_name"] + " not written in bone.t_spline()")
 
+        # keep only the narrow band of the level set as input of the next warping
+        self.crop_levelset(image_data["i_registered_sub_folder"] + image_data[anatomy + "m_spline_name"])
+
 
 
     def vf_spline(self, image_data):
@@ -529,7 +597,7 @@ class bone (registration):
         cmd = [complete_transformix_path, "-def", "all",
                                           "-tp",  os.path.abspath(transformation),
                                           "-out", os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output name
         if not os.path.exists(image_data["registered_sub_folder"] + "deformationField.mha"):
@@ -578,9 +646,8 @@ class cartilage (registration):
         cmd = [complete_elastix_path, "-f",     os.path.abspath(complete_reference_name),
                                       "-fMask", os.path.abspath(complete_reference_mask_dil_name),
                                       "-m",     os.path.abspath(complete_moving_name),
-                                      "-p",     os.path.abspath(params),
                                       "-out",   os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        self.run_registration(image_data, "spline", cmd, params)
 
         # change output names
         if not os.path.exists(image_data["registered_sub_folder"] + "result.0.mha"):
@@ -626,7 +693,7 @@ class cartilage (registration):
                                       "-p",     os.path.abspath(params),
                                       "-out",   os.path.abspath(output_folder),
                                       "-t0",    os.path.abspath(transformation)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "TransformParameters.0.txt"):
@@ -661,7 +728,7 @@ class cartilage (registration):
         cmd = [complete_transformix_path, "-in",  os.path.abspath(mask_to_warp),
                                           "-tp",  os.path.abspath(transformation),
                                           "-out", os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "result.mha"):
@@ -696,7 +763,7 @@ class cartilage (registration):
         cmd = [complete_transformix_path, "-in",  os.path.abspath(mask_to_warp),
                                           "-tp",  os.path.abspath(transformation),
                                           "-out", os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "result.mha"):
@@ -708,6 +775,9 @@ class cartilage (registration):
         print ("in cartilage.t_similarity", flush = True)
         if not os.path.exists(image_data["i_registered_sub_folder"] + image_data[anatomy + "m_similarity_name"]):
             raise FileNotFoundError (image_data["i_registered_sub_folder"] + image_data[anatomy + "m_similarity_name"] + " not written in cartilage.t_similarity()")
+
+        # keep only the narrow band of the level set as input of the next warping
+        self.crop_levelset(image_data["i_registered_sub_folder"] + image_data[anatomy + "m_similarity_name"])
  
 
     def t_spline(self, image_data):
@@ -729,7 +799,7 @@ class cartilage (registration):
         cmd = [complete_transformix_path, "-in",  os.path.abspath(mask_to_warp),
                                           "-tp",  os.path.abspath(transformation),
                                           "-out", os.path.abspath(output_folder)]
-        subprocess.run(cmd, cwd=elastix_path)
+        instr.run_subprocess(cmd, cwd=elastix_path)
 
         # change output names
         if not os.path.exists(image_data["i_registered_sub_folder"] + "result.mha"):
@@ -742,16 +812,85 @@ class cartilage (registration):
         if not os.path.exists(image_data["i_registered_sub_folder"] + image_data[anatomy + "m_spline_name"]):
             raise FileNotFoundError (image_data["i_registered_sub_folder"] + image_data[anatomy + "m_spline_name"] + " not written in cartilage.t_spline()")
 
+        # keep only the narrow band of the level set as input of the next warping
+        self.crop_levelset(image_data["i_registered_sub_folder"] + image_data[anatomy + "m_spline_name"])
+
 
     def vf_spline(self):
         pass
 
 
+# ---------------------------------------------------------------------------------------------------------------------------
+# METRIC OF THE REGISTRATIONS -----------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+def clear_iteration_info(output_folder):
+
+    # remove the iteration files of the previous elastix run in the folder (e.g. of a registration with more resolutions)
+    for file_name in os.listdir(output_folder):
+        if file_name.startswith("IterationInfo.") and file_name.endswith(".txt"):
+            os.remove(output_folder + file_name)
+
+
+def read_final_metric(output_folder, n_of_iterations=10):
+
+    """
+    Returns the final metric of the elastix run in output_folder, from the iteration file of the last resolution.
+    The metric is averaged over the last n_of_iterations iterations, because samples change at each iteration.
+    Returns None if there are no iterations
+    """
+
+    # iteration file of the last resolution (IterationInfo.0.R<resolution>.txt)
+    resolutions = {}
+    for file_name in os.listdir(output_folder):
+        parts = file_name.split(".")
+        if len(parts) == 4 and parts[0] == "IterationInfo" and parts[2].startswith("R") and parts[2][1:].isdigit():
+            resolutions[int(parts[2][1:])] = file_name
+    if len(resolutions) == 0:
+        return None
+
+    # second column is the metric (the first line is the header)
+    metric = []
+    for line in open(output_folder + resolutions[max(resolutions)]):
+        values = line.split()
+        if len(values) > 1 and values[0].isdigit():
+            metric.append(float(values[1]))
+    if len(metric) == 0:
+        return None
+
+    return sum(metric[-n_of_iterations:]) / len(metric[-n_of_iterations:])
+
+
+def write_metric(file_name, metric, start, full_metric):
+
+    # metric, how the registration started ("warm" or "full"), and metric of the last registration from scratch of the knee
+    f = open(file_name, "w")
+    f.write("%.6f %s %.6f\n" % (metric, start, full_metric))
+    f.close()
+
+
+def read_metric(file_name):
+
+    return float(open(file_name).read().split()[0])
+
+
+def read_full_metric(file_name):
+
+    # metric of the last registration from scratch of the knee (files with two values have only the metric of the visit)
+    values = open(file_name).read().split()
+    if len(values) > 2:
+        return float(values[2])
+    return float(values[0])
+
+
+
 # ---------------------------------------------------------------------------------------------------------------------------
 # TESTING POSSIBLE ERRORS ---------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
 def test_elastix():
 
+    # imported here because it is slow to import
+    import pkg_resources
+
     sys = platform.system()
     
     # get the folder depending on the OS
@@ -1,9 +1,9 @@
 # Serena Bonaretti, 2018
 
-import matplotlib.pyplot as plt
 import numpy as np
 import time
 
+# plotting (matplotlib) is imported in the function that uses it, so that the module is imported faster
 
 # pyKNEER imports 
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
@@ -59,6 +59,8 @@ def find_reference(all_image_data, n_of_processes):
 
 def plot_convergence(reference_names, min_distances):
 
+    import matplotlib.pyplot as plt
+
     # delete elements with "None" (allocation in "findReference")
     reference_names = list(filter(None.__ne__, reference_names))
     min_distances   = list(filter(None.__ne__, min_distances))
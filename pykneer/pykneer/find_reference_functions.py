@@ -12,11 +12,15 @@ import SimpleITK as sitk
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
 if __package__ is None or __package__ == '':
     # uses current directory visibility
+    import instrumentation as instr
     import elastix_transformix
+    import sitk_functions  as sitkf
 
 else:
     # uses current package visibility
+    from . import instrumentation as instr
     from . import elastix_transformix
+    from . import sitk_functions  as sitkf
 
 
 
@@ -113,6 +117,7 @@ def prepare_reference(all_image_data, reference_names, iteration_no):
 
 
 
+@instr.timed
 def calculate_vector_fields_s(image_data):
 
     # get the system for folderDiv
@@ -143,10 +148,10 @@ def find_reference_as_minimum_distance_to_average(all_image_data, reference_name
 
     fieldFolder = all_image_data[0]["reference_folder"]
 
-    # allocate an empty field (with first field characteristisc) and convert to numpy matrix
+    # allocate an empty field (with first field characteristisc, from its header) and convert to numpy matrix
     image_data        = all_image_data[0]
-    firstField        = sitk.ReadImage(fieldFolder + image_data["vector_field_name"])
-    average_field     = sitk.Image(firstField.GetSize(),sitk.sitkVectorFloat32)
+    firstField        = sitkf.read_image_geometry(fieldFolder + image_data["vector_field_name"])
+    average_field     = sitk.Image(firstField["size"],sitk.sitkVectorFloat32)
     average_field_py  = sitk.GetArrayFromImage(average_field)
 
     # calculate average field
@@ -167,9 +172,9 @@ def find_reference_as_minimum_distance_to_average(all_image_data, reference_name
 
     # back to sitk
     average_field = sitk.GetImageFromArray(average_field_py)
-    average_field.SetSpacing  (firstField.GetSpacing  ())
-    average_field.SetOrigin   (firstField.GetOrigin   ())
-    average_field.SetDirection(firstField.GetDirection())
+    average_field.SetSpacing  (firstField["spacing"  ])
+    average_field.SetOrigin   (firstField["origin"   ])
+    average_field.SetDirection(firstField["direction"])
 
     # write the average field
 #    average_fieldFileName = firstImage["registered_folder"] + "average_field_" + str(iteration_no) + ".mha"
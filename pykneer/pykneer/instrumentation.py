@@ -0,0 +1,376 @@
+# Serena Bonaretti, 2018
+
+"""
+Module with the timing and resource measurements of the pipeline steps.
+The functions _s of the modules _for_nb (one image per call) are decorated with timed. When the environment variable
+PYKNEER_TIMING_LOG contains a file name, each call appends one line in json format to that file, with:
+    - stage and subject (image name)
+    - wall time, cpu time of the process, and cpu time of the subprocesses run with run_subprocess (elastix and transformix)
+    - peak memory (RSS) of the process during the call, and largest peak memory of the subprocesses run during the call
+    - bytes read and written (also by the subprocesses)
+    - status ("ok" or the error)
+Processes of multiprocessing.Pool() write to the same file, so the log contains all the images of a step.
+When the variable is not set, the functions run without measurements.
+Measurements of memory and bytes use /proc (Linux). On other systems, peak memory is the peak of the process so far
+(not measured on Windows) and bytes are not measured. Subprocesses are measured while they run and with os.wait4 (not on Windows).
+Cpu time and bytes are counters of the whole process: when prefetch_io.py reads the images of the next subject in a background
+thread, its cpu time and bytes are added to the current subject.
+Functions _s called by other functions _s (e.g. segment_with_atlas_s) are logged with "nested" true. Only the outermost call resets
+the peak memory, so the peak memory of a nested call is the peak since the outermost call started.
+
+Functions:
+    - set_timing_log
+    - run_subprocess
+    - timed (decorator)
+    - read_timing_log
+    - timing_summary
+    - find_stragglers
+"""
+
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+# resource is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# environment variable with the name of the log file (inherited by the processes of multiprocessing.Pool())
+timing_log_variable = "PYKNEER_TIMING_LOG"
+
+# keys of image_data that identify the image, in order of preference
+subject_keys = ["image_name_root", "moving_root", "mask_name", "segmented_name"]
+
+# timed calls running in the current thread (outermost first). Each call collects cpu time and peak memory of its subprocesses
+calls = threading.local()
+
+
+def set_timing_log(file_name):
+
+    """
+    Sets the log file for the measurements of the following steps. Use None to stop the measurements
+    It has to be called before the steps, so that the processes of the pool inherit it
+    """
+
+    if file_name is None or file_name == "":
+        os.environ.pop(timing_log_variable, None)
+    else:
+        os.environ[timing_log_variable] = os.path.abspath(file_name)
+        print ("-> Timing log: " + os.environ[timing_log_variable])
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# MEASUREMENTS --------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def max_rss_to_mb(max_rss):
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == "darwin":
+        return max_rss / 1024 / 1024
+    return max_rss / 1024
+
+
+def reset_peak_rss():
+
+    # on Linux, writing 5 to clear_refs sets the peak memory (VmHWM) to the current memory
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss():
+
+    # peak memory in MB from /proc, otherwise from getrusage (peak since the process started)
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    if resource is None:
+        return float("nan")
+    return max_rss_to_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def running_calls():
+
+    if not hasattr(calls, "stack"):
+        calls.stack = []
+    return calls.stack
+
+
+def read_process_peak_rss(pid):
+
+    # peak memory in MB of a running subprocess from /proc (None if not available or if the subprocess ended)
+    try:
+        with open("/proc/%d/status" % pid) as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+def run_subprocess(cmd, poll_interval=0.02, **kwargs):
+
+    """
+    Runs a command as subprocess.run(cmd, **kwargs) (without capturing the output) and returns a subprocess.CompletedProcess
+    Cpu time and peak memory of the subprocess are added to the timed calls that are running
+    The peak memory is read from /proc while the subprocess runs (ru_maxrss of a subprocess can be the memory of this process
+    before exec). Without /proc, it is ru_maxrss
+    """
+
+    process = subprocess.Popen(cmd, **kwargs)
+
+    # without os.wait4 (Windows), the subprocess is not measured
+    if not hasattr(os, "wait4"):
+        return subprocess.CompletedProcess(cmd, process.wait())
+
+    # wait for this subprocess only, sampling its peak memory, and get its resource usage
+    peak = None
+    try:
+        while True:
+            current_peak = read_process_peak_rss(process.pid)
+            if current_peak is not None:
+                peak = max(peak or 0.0, current_peak)
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            time.sleep(poll_interval)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if peak is None:
+        peak = max_rss_to_mb(usage.ru_maxrss)
+    for call in running_calls():
+        call["children_cpu_s"]       = call["children_cpu_s"] + usage.ru_utime + usage.ru_stime
+        call["children_peak_rss_mb"] = max(call["children_peak_rss_mb"] or 0.0, peak)
+
+    return subprocess.CompletedProcess(cmd, process.returncode)
+
+
+def read_io_counters():
+
+    # rchar and wchar: bytes read and written by system calls (including the page cache)
+    # read_bytes and write_bytes: bytes read and written from and to the disk
+    # the counters include the subprocesses that ended
+    counters = {}
+    try:
+        with open("/proc/self/io") as file:
+            for line in file:
+                key, value = line.split(":")
+                counters[key.strip()] = int(value)
+    except (OSError, ValueError):
+        pass
+
+    return counters
+
+
+def get_subject(args):
+
+    # the first argument of the functions _s is image_data
+    if len(args) > 0 and isinstance(args[0], dict):
+        for key in subject_keys:
+            if key in args[0]:
+                return str(args[0][key])
+
+    return ""
+
+
+def write_record(file_name, record):
+
+    # one write() in append mode, so that lines of different processes are not mixed
+    line = (json.dumps(record) + "\n").encode("utf-8")
+    try:
+        file = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(file, line)
+        finally:
+            os.close(file)
+    except OSError as error:
+        print ("-> Timing log not written: " + str(error), flush = True)
+
+
+def timed(function):
+
+    """
+    Decorator of the functions _s. The stage is the module name without _for_nb (or _functions) and the function name without _s
+    (e.g. preprocessing.field_correction)
+    """
+
+    module = function.__module__.split(".")[-1]
+    for suffix in ["_for_nb", "_functions"]:
+        if module.endswith(suffix):
+            module = module[0:-len(suffix)]
+    name   = function.__name__
+    if name.endswith("_s"):
+        name = name[0:-2]
+    stage  = module + "." + name
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+
+        # no measurements
+        file_name = os.environ.get(timing_log_variable, "")
+        if file_name == "":
+            return function(*args, **kwargs)
+
+        # measurements at the beginning (the peak memory is reset only by the outermost call)
+        stack      = running_calls()
+        nested     = len(stack) > 0
+        if nested:
+            peak_reset = stack[0]["peak_reset"]
+        else:
+            peak_reset = reset_peak_rss()
+        call       = {"peak_reset" : peak_reset, "children_cpu_s" : 0.0, "children_peak_rss_mb" : None}
+        stack.append(call)
+        io_start   = read_io_counters()
+        start_date = time.time()
+        cpu_start  = time.process_time()
+        wall_start = time.perf_counter()
+
+        status = "ok"
+        try:
+            return function(*args, **kwargs)
+        except BaseException as error:
+            status = type(error).__name__ + ": " + str(error)
+            raise
+        finally:
+            # measurements at the end
+            wall_time = time.perf_counter() - wall_start
+            cpu_time  = time.process_time() - cpu_start
+            io_end    = read_io_counters()
+            stack.pop()
+
+            children_peak = call["children_peak_rss_mb"]
+            record = {"stage"                : stage,
+                      "subject"              : get_subject(args),
+                      "host"                 : platform.node(),
+                      "pid"                  : os.getpid(),
+                      "start"                : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(start_date)),
+                      "wall_s"               : round(wall_time, 4),
+                      "cpu_s"                : round(cpu_time, 4),
+                      "children_cpu_s"       : round(call["children_cpu_s"], 4),
+                      "peak_rss_mb"          : round(read_peak_rss(), 2),
+                      "peak_rss_since_start" : not peak_reset,
+                      "children_peak_rss_mb" : None if children_peak is None else round(children_peak, 2),
+                      "nested"               : nested,
+                      "status"               : status}
+            for key in ["rchar", "wchar", "read_bytes", "write_bytes"]:
+                if key in io_start and key in io_end:
+                    record[key] = io_end[key] - io_start[key]
+            write_record(file_name, record)
+
+    return wrapper
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# SUMMARY -------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def read_timing_log(file_name=None):
+
+    """
+    Reads the log into a pandas dataframe (one row per call). Default file name is the one in PYKNEER_TIMING_LOG
+    """
+
+    import pandas as pd
+
+    if file_name is None:
+        file_name = os.environ.get(timing_log_variable, "")
+    if not os.path.isfile(file_name):
+        print ("----------------------------------------------------------------------------------------")
+        print ("ERROR: The timing log %s does not exist" % (file_name))
+        print ("----------------------------------------------------------------------------------------")
+        return pd.DataFrame()
+
+    records = []
+    with open(file_name) as file:
+        for line in file:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # line of a process that was killed while writing
+                continue
+
+    return pd.DataFrame(records)
+
+
+def timing_summary(file_name=None):
+
+    """
+    Prints and returns a table with one row per stage: number of images, total, mean, and maximum wall time,
+    the slowest image, cpu times, peak memory of the process and of the subprocesses, and MB read and written
+    """
+
+    import pandas as pd
+
+    log = read_timing_log(file_name)
+    if log.empty:
+        return log
+
+    for key in ["rchar", "wchar", "children_peak_rss_mb"]:
+        if key not in log:
+            log[key] = float("nan")
+
+    rows = []
+    for stage, group in log.groupby("stage", sort=False):
+        slowest = group["wall_s"].idxmax()
+        rows.append({"stage"                : stage,
+                     "n_of_images"          : len(group),
+                     "n_of_errors"          : int((group["status"] != "ok").sum()),
+                     "total_wall_s"         : group["wall_s"].sum(),
+                     "mean_wall_s"          : group["wall_s"].mean(),
+                     "max_wall_s"           : group["wall_s"].max(),
+                     "slowest_subject"      : group.loc[slowest, "subject"],
+                     "total_cpu_s"          : group["cpu_s"].sum(),
+                     "total_children_cpu_s" : group["children_cpu_s"].sum(),
+                     "max_peak_rss_mb"      : group["peak_rss_mb"].max(),
+                     "max_children_rss_mb"  : group["children_peak_rss_mb"].max(),
+                     "read_mb"              : group["rchar"].sum() / 1024 / 1024,
+                     "written_mb"           : group["wchar"].sum() / 1024 / 1024})
+
+    summary = pd.DataFrame(rows).round(2)
+    summary.index = pd.RangeIndex(1, len(summary) + 1)
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print (summary)
+
+    return summary
+
+
+def find_stragglers(file_name=None, factor=2.0):
+
+    """
+    Returns the calls whose wall time is larger than factor times the median wall time of their stage
+    """
+
+    log = read_timing_log(file_name)
+    if log.empty:
+        return log
+
+    median     = log.groupby("stage")["wall_s"].transform("median")
+    stragglers = log[log["wall_s"] > factor * median].copy()
+    stragglers["times_median"] = (stragglers["wall_s"] / median[stragglers.index]).round(2)
+
+    return stragglers.sort_values("times_median", ascending=False)
@@ -0,0 +1,446 @@
+# Serena Bonaretti, 2018
+
+"""
+Module with a job queue on a shared file system, to run the functions _s of the modules _for_nb on several computers
+(nodes of a cluster) instead of the processes of multiprocessing.Pool() of one computer.
+Each job is one image_data (one image) and the name of the function _s. Jobs are files in the queue folder:
+    pending/  jobs waiting             <job_id>.<attempt>.job
+    running/  jobs claimed by a worker <job_id>.<attempt>.<worker_id>.job
+    done/     jobs completed           <job_id>.job (the value returned by the function is in results/<job_id>.result)
+    failed/   jobs failed max_attempts times, with the errors in <job_id>.<attempt>.err
+A worker claims a job by renaming it from pending/ to running/ (rename is atomic, so only one worker gets the job), and
+updates the modification time of the file (heartbeat) while the function runs. Jobs whose heartbeat is older than
+stale_timeout (e.g. the node died) are moved back to pending/ by the other workers. Clocks of the nodes must be synchronized.
+
+Usage:
+    - submit the jobs (e.g. from the notebook):
+      job_ids = job_queue.submit(queue_folder, segmentation_sa_for_nb.warp_bone_mask_s, all_image_data)
+    - start the workers on the nodes:
+      python -m pykneer.job_queue worker queue_folder
+    - wait for the jobs and get the results:
+      results = job_queue.wait_for_jobs(queue_folder, job_ids)
+    or all at once with local processes as workers: results = job_queue.map_jobs(queue_folder, function, all_image_data, 4)
+
+Functions:
+    - submit
+    - claim_job
+    - run_job
+    - requeue_stale_jobs
+    - run_worker
+    - queue_status
+    - collect_results
+    - wait_for_jobs
+    - map_jobs
+"""
+
+import argparse
+import importlib
+import multiprocessing
+import os
+import pickle
+import re
+import socket
+import sys
+import threading
+import time
+import traceback
+
+# pyKNEER imports
+# ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
+if __package__ is None or __package__ == '':
+    # uses current directory visibility
+    import instrumentation as instr
+else:
+    # uses current package visibility
+    from . import instrumentation as instr
+
+
+# subfolders of the queue folder
+queue_subfolders = ["pending", "running", "done", "failed", "results", "tmp"]
+
+# default times (seconds)
+heartbeat_interval_default = 30
+stale_timeout_default      = 300
+poll_interval_default      = 5
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# FILES ---------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def clean_name(name):
+
+    # job and worker ids are part of file names, with "." as separator
+    return re.sub("[^A-Za-z0-9_-]", "_", name)
+
+
+def create_queue_folders(queue_folder):
+
+    for subfolder in queue_subfolders:
+        folder = os.path.join(queue_folder, subfolder)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+
+def write_atomic(queue_folder, file_name, content):
+
+    # write to tmp/ and rename, so that other nodes never read a half-written file
+    tmp_file_name = os.path.join(queue_folder, "tmp", clean_name(socket.gethostname()) + "_" + str(os.getpid()) + "_" + os.path.basename(file_name))
+    with open(tmp_file_name, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file_name, file_name)
+
+
+def parse_job_file_name(file_name):
+
+    # returns job_id, attempt (None in done/ and failed/), and worker_id (None in pending/, done/, and failed/)
+    parts     = os.path.splitext(os.path.basename(file_name))[0].split(".")
+    attempt   = int(parts[1]) if len(parts) > 1 else None
+    worker_id = parts[2]      if len(parts) > 2 else None
+
+    return parts[0], attempt, worker_id
+
+
+def list_jobs(queue_folder, subfolder):
+
+    folder = os.path.join(queue_folder, subfolder)
+    if not os.path.isdir(folder):
+        return []
+    return sorted([file_name for file_name in os.listdir(folder) if file_name.endswith(".job")])
+
+
+def move_job(queue_folder, file_name, subfolder, new_file_name):
+
+    # returns False when another worker moved the job first
+    try:
+        os.rename(file_name, os.path.join(queue_folder, subfolder, new_file_name))
+        return True
+    except OSError:
+        return False
+
+
+def write_error(queue_folder, job_id, attempt, message):
+
+    write_atomic(queue_folder, os.path.join(queue_folder, "failed", "%s.%d.err" % (job_id, attempt)), message.encode("utf-8"))
+
+
+def retry_or_fail(queue_folder, file_name, job_id, attempt, max_attempts):
+
+    # back to pending/ with the next attempt, or to failed/
+    if attempt + 1 < max_attempts:
+        return move_job(queue_folder, file_name, "pending", "%s.%d.job" % (job_id, attempt + 1))
+    return move_job(queue_folder, file_name, "failed", "%s.job" % (job_id))
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# SUBMIT --------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def submit(queue_folder, function, all_image_data):
+
+    """
+    Adds one job per image_data. Returns the job ids, in the order of all_image_data.
+    Jobs already in the queue (pending, running, or done) are not added again and failed jobs are added again,
+    so a submission can be repeated after an interruption
+    """
+
+    create_queue_folders(queue_folder)
+
+    # jobs already in the queue
+    existing_ids = set()
+    for subfolder in ["pending", "running", "done"]:
+        existing_ids.update([parse_job_file_name(file_name)[0] for file_name in list_jobs(queue_folder, subfolder)])
+
+    job_ids = []
+    for i in range(0, len(all_image_data)):
+        job_id = clean_name("%s_%06d_%s" % (function.__name__, i, instr.get_subject([all_image_data[i]])))
+        job_ids.append(job_id)
+        if job_id in existing_ids:
+            continue
+        # jobs that failed are run again
+        failed_file_name = os.path.join(queue_folder, "failed", "%s.job" % (job_id))
+        if os.path.isfile(failed_file_name):
+            os.remove(failed_file_name)
+        # a job is the function name and the image_data
+        job = {"job_id"        : job_id,
+               "module_name"   : function.__module__,
+               "function_name" : function.__name__,
+               "image_data"    : all_image_data[i]}
+        write_atomic(queue_folder, os.path.join(queue_folder, "pending", "%s.0.job" % (job_id)), pickle.dumps(job))
+
+    print ("-> %d jobs submitted to %s" % (len(job_ids), queue_folder))
+
+    return job_ids
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# WORKER --------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+class heartbeat(threading.Thread):
+
+    """
+    Updates the modification time of the running job file every interval seconds, until stop() or the file is moved
+    """
+
+    def __init__(self, file_name, interval):
+
+        threading.Thread.__init__(self, daemon=True)
+        self.file_name  = file_name
+        self.interval   = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+
+        while not self.stop_event.wait(self.interval):
+            try:
+                now = time.time()
+                os.utime(self.file_name, (now, now))
+            except OSError:
+                # the job was requeued by another worker
+                return
+
+    def stop(self):
+
+        self.stop_event.set()
+        self.join()
+
+
+def claim_job(queue_folder, worker_id):
+
+    """
+    Moves the first pending job to running/. Returns the name of the running file, or None when there are no pending jobs
+    """
+
+    for file_name in list_jobs(queue_folder, "pending"):
+        job_id, attempt, _ = parse_job_file_name(file_name)
+        running_file_name  = "%s.%d.%s.job" % (job_id, attempt, worker_id)
+        if move_job(queue_folder, os.path.join(queue_folder, "pending", file_name), "running", running_file_name):
+            running_file_name = os.path.join(queue_folder, "running", running_file_name)
+            # heartbeat starts from the claim (rename keeps the modification time of the submission)
+            now = time.time()
+            os.utime(running_file_name, (now, now))
+            return running_file_name
+
+    return None
+
+
+def run_job(queue_folder, running_file_name, heartbeat_interval=heartbeat_interval_default, max_attempts=3):
+
+    """
+    Runs the function of a claimed job, saves the returned value, and moves the job to done/ (or pending/ or failed/ on error).
+    Returns True if the function ran without errors
+    """
+
+    job_id, attempt, worker_id = parse_job_file_name(running_file_name)
+
+    beat = heartbeat(running_file_name, heartbeat_interval)
+    beat.start()
+    try:
+        with open(running_file_name, "rb") as f:
+            job = pickle.load(f)
+        module   = importlib.import_module(job["module_name"])
+        function = getattr(module, job["function_name"])
+        result   = function(job["image_data"])
+    except Exception:
+        beat.stop()
+        print ("----------------------------------------------------------------------------------------")
+        print ("ERROR: The job %s failed on worker %s" % (job_id, worker_id))
+        print ("----------------------------------------------------------------------------------------")
+        write_error(queue_folder, job_id, attempt, "worker: %s\n%s" % (worker_id, traceback.format_exc()))
+        retry_or_fail(queue_folder, running_file_name, job_id, attempt, max_attempts)
+        return False
+    beat.stop()
+
+    # result first, then done/ (if the worker dies in between, the job runs again)
+    write_atomic(queue_folder, os.path.join(queue_folder, "results", "%s.result" % (job_id)), pickle.dumps(result))
+    if not move_job(queue_folder, running_file_name, "done", "%s.job" % (job_id)):
+        # heartbeat was too late and the job was requeued: the result is the same, so the job is not run again
+        for subfolder in ["pending", "running"]:
+            for file_name in list_jobs(queue_folder, subfolder):
+                if parse_job_file_name(file_name)[0] == job_id:
+                    move_job(queue_folder, os.path.join(queue_folder, subfolder, file_name), "done", "%s.job" % (job_id))
+
+    return True
+
+
+def requeue_stale_jobs(queue_folder, stale_timeout=stale_timeout_default, max_attempts=3):
+
+    """
+    Moves running jobs without heartbeat for stale_timeout seconds back to pending/ (or to failed/ after max_attempts).
+    Returns the number of jobs moved
+    """
+
+    n_of_requeued = 0
+    now           = time.time()
+    for file_name in list_jobs(queue_folder, "running"):
+        running_file_name = os.path.join(queue_folder, "running", file_name)
+        try:
+            age = now - os.stat(running_file_name).st_mtime
+        except OSError:
+            continue
+        if age < stale_timeout:
+            continue
+        job_id, attempt, worker_id = parse_job_file_name(file_name)
+        if retry_or_fail(queue_folder, running_file_name, job_id, attempt, max_attempts):
+            write_error(queue_folder, job_id, attempt, "worker: %s\nno heartbeat for %d seconds\n" % (worker_id, age))
+            print ("-> Job %s of worker %s requeued (no heartbeat for %d seconds)" % (job_id, worker_id, age))
+            n_of_requeued = n_of_requeued + 1
+
+    return n_of_requeued
+
+
+def run_worker(queue_folder, worker_id=None, heartbeat_interval=heartbeat_interval_default, stale_timeout=stale_timeout_default,
+               max_attempts=3, poll_interval=poll_interval_default, wait=True):
+
+    """
+    Runs pending jobs until the queue is empty. With wait=True, the worker also waits for the jobs running on other workers,
+    to requeue them if they stop heartbeating. Returns the number of jobs run by this worker
+    """
+
+    create_queue_folders(queue_folder)
+    if worker_id is None:
+        worker_id = socket.gethostname() + "-" + str(os.getpid())
+    worker_id = clean_name(worker_id)
+
+    n_of_jobs  = 0
+    start_time = time.time()
+    while True:
+        requeue_stale_jobs(queue_folder, stale_timeout, max_attempts)
+        running_file_name = claim_job(queue_folder, worker_id)
+        if running_file_name is not None:
+            run_job(queue_folder, running_file_name, heartbeat_interval, max_attempts)
+            n_of_jobs = n_of_jobs + 1
+            continue
+        if not wait or len(list_jobs(queue_folder, "running")) == 0:
+            break
+        time.sleep(poll_interval)
+
+    print ("-> Worker %s ran %d jobs in %.2f seconds" % (worker_id, n_of_jobs, time.time() - start_time))
+
+    return n_of_jobs
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# RESULTS -------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def queue_status(queue_folder):
+
+    """
+    Returns the number of jobs in pending/, running/, done/, and failed/
+    """
+
+    status = {}
+    for subfolder in ["pending", "running", "done", "failed"]:
+        status[subfolder] = len(list_jobs(queue_folder, subfolder))
+
+    return status
+
+
+def collect_results(queue_folder, job_ids):
+
+    """
+    Returns the values returned by the functions, in the order of job_ids (None for jobs not done)
+    """
+
+    results = []
+    for job_id in job_ids:
+        result_file_name = os.path.join(queue_folder, "results", "%s.result" % (job_id))
+        if os.path.isfile(os.path.join(queue_folder, "done", "%s.job" % (job_id))) and os.path.isfile(result_file_name):
+            with open(result_file_name, "rb") as f:
+                results.append(pickle.load(f))
+        else:
+            results.append(None)
+
+    return results
+
+
+def wait_for_jobs(queue_folder, job_ids, poll_interval=poll_interval_default, stale_timeout=stale_timeout_default, max_attempts=3):
+
+    """
+    Waits until all the jobs are done or failed (and requeues stale jobs meanwhile). Returns the results, as collect_results
+    """
+
+    while True:
+        finished = set([parse_job_file_name(file_name)[0] for file_name in list_jobs(queue_folder, "done") + list_jobs(queue_folder, "failed")])
+        if all([job_id in finished for job_id in job_ids]):
+            break
+        requeue_stale_jobs(queue_folder, stale_timeout, max_attempts)
+        time.sleep(poll_interval)
+
+    n_of_failed = len([job_id for job_id in job_ids if os.path.isfile(os.path.join(queue_folder, "failed", "%s.job" % (job_id)))])
+    if n_of_failed > 0:
+        print ("----------------------------------------------------------------------------------------")
+        print ("ERROR: %d jobs failed. Errors are in %s" % (n_of_failed, os.path.join(queue_folder, "failed")))
+        print ("----------------------------------------------------------------------------------------")
+
+    return collect_results(queue_folder, job_ids)
+
+
+def map_jobs(queue_folder, function, all_image_data, n_of_processes, heartbeat_interval=heartbeat_interval_default,
+             stale_timeout=stale_timeout_default, max_attempts=3, poll_interval=poll_interval_default):
+
+    """
+    As pool.map(function, all_image_data), through the queue: submits the jobs, starts n_of_processes local workers
+    (workers on other nodes can join), and waits for the results
+    """
+
+    start_time = time.time()
+    job_ids    = submit(queue_folder, function, all_image_data)
+
+    workers = []
+    for i in range(0, n_of_processes):
+        worker = multiprocessing.Process(target=run_worker, args=(queue_folder, None, heartbeat_interval, stale_timeout,
+                                                                  max_attempts, poll_interval, True))
+        worker.start()
+        workers.append(worker)
+
+    results = wait_for_jobs(queue_folder, job_ids, poll_interval, stale_timeout, max_attempts)
+    for worker in workers:
+        worker.join()
+
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+    return results
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# COMMAND LINE --------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def main(argv=None):
+
+    parser     = argparse.ArgumentParser(prog="python -m pykneer.job_queue", description="pyKNEEr job queue on a shared file system")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    command = subparsers.add_parser("worker", help="run jobs until the queue is empty")
+    command.add_argument("queue_folder")
+    command.add_argument("--worker-id",          default=None)
+    command.add_argument("--heartbeat-interval", type=float, default=heartbeat_interval_default)
+    command.add_argument("--stale-timeout",      type=float, default=stale_timeout_default)
+    command.add_argument("--max-attempts",       type=int,   default=3)
+    command.add_argument("--poll-interval",      type=float, default=poll_interval_default)
+    command.add_argument("--no-wait",            action="store_true", help="exit when there are no pending jobs")
+
+    command = subparsers.add_parser("status", help="print the number of jobs in each state")
+    command.add_argument("queue_folder")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "worker":
+        run_worker(args.queue_folder, args.worker_id, args.heartbeat_interval, args.stale_timeout, args.max_attempts,
+                   args.poll_interval, not args.no_wait)
+    elif args.command == "status":
+        status = queue_status(args.queue_folder)
+        for subfolder in ["pending", "running", "done", "failed"]:
+            print ("%-8s %d" % (subfolder, status[subfolder]))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+# Serena Bonaretti, 2018
+
+"""
+Module with the on-demand image access used by the interactive visualizations.
+Images are not read as a whole when a viewer is created. Slices are extracted when the slider asks for them:
+    - uncompressed .mha/.mhd images: the sagittal slice is extracted by the SimpleITK reader, so only the voxels of the slice are decoded in memory.
+      Voxels of a sagittal slice are not contiguous on disk, so the operating system can still read most of the file pages
+    - other images (compressed .mha, masks cropped by write_mask, .nii, ...) are read once and kept in a small cache of volumes
+Decoded slices are kept in a least-recently-used cache shared by all images, with a bounded memory size.
+The viewers of a cohort show one subject at a time, and the images of a subject are accessed only when the subject is selected.
+
+Functions:
+    - read_meta_header
+    - lazy_image (class)
+    - find_mask_slices
+    - browse_subjects
+"""
+
+import collections
+import os
+import numpy as np
+import SimpleITK as sitk
+
+# pyKNEER imports 
+# ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
+if __package__ is None or __package__ == '':
+    # uses current directory visibility
+    import sitk_functions  as sitkf
+else:
+    # uses current package visibility
+    from . import sitk_functions  as sitkf
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# CACHES --------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+# decoded sagittal slices, shared by all images. Key: (file_name, slice_ID)
+slice_cache           = collections.OrderedDict()
+slice_cache_max_bytes = 256 * 1024 * 1024
+slice_cache_bytes     = [0] # in a list to modify it inside functions
+
+# volumes of images that cannot be memory-mapped. Key: file_name
+volume_cache     = collections.OrderedDict()
+volume_cache_max = 2
+
+# from MetaImage element types to numpy types
+meta_types = {"MET_CHAR"   : "i1",
+              "MET_UCHAR"  : "u1",
+              "MET_SHORT"  : "i2",
+              "MET_USHORT" : "u2",
+              "MET_INT"    : "i4",
+              "MET_UINT"   : "u4",
+              "MET_FLOAT"  : "f4",
+              "MET_DOUBLE" : "f8"}
+
+
+def read_meta_header(file_name):
+
+    """
+    Reads the text header of a .mha or .mhd image
+    Returns a dictionary with the header fields and the offset in bytes of the data in the .mha file
+    """
+
+    header = {}
+    offset = 0
+    with open(file_name, "rb") as file:
+        for line in file:
+            offset = offset + len(line)
+            line   = line.decode("latin-1").strip()
+            if "=" not in line:
+                # not a MetaImage header
+                return None, 0
+            key, value  = line.split("=", 1)
+            header[key.strip()] = value.strip()
+            # ElementDataFile is always the last field of the header
+            if key.strip() == "ElementDataFile":
+                return header, offset
+            # avoid reading large binary files which are not MetaImages
+            if offset > 65536:
+                break
+
+    return None, 0
+
+
+def add_to_slice_cache(key, slice_py):
+
+    # add the new slice
+    slice_cache[key]     = slice_py
+    slice_cache_bytes[0] = slice_cache_bytes[0] + slice_py.nbytes
+
+    # remove the least recently used slices until memory is within the limit
+    while slice_cache_bytes[0] > slice_cache_max_bytes and len(slice_cache) > 1:
+        old_key, old_slice   = slice_cache.popitem(last=False)
+        slice_cache_bytes[0] = slice_cache_bytes[0] - old_slice.nbytes
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# LAZY IMAGE ----------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+class lazy_image:
+
+    """
+    Image read on demand. It behaves like the numpy array returned by sitk.GetArrayFromImage() for:
+        - shape
+        - img[:,:,slice_ID], which returns a sagittal slice
+        - any other indexing, which reads the whole image (memory-mapped for uncompressed .mha/.mhd images)
+    """
+
+    def __init__(self, file_name):
+
+        self.file_name = os.path.abspath(file_name)
+        self.mmap      = None
+
+        # try to memory-map the data using the header offset
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension == ".mha" or extension == ".mhd":
+            self.mmap = self.memory_map()
+
+        if self.mmap is not None:
+            self.shape = self.mmap.shape
+            self.dtype = self.mmap.dtype
+        else:
+            # read only the header (masks cropped by sitkf.write_mask have the size of the full image, as when read)
+            size       = sitkf.read_image_geometry(self.file_name)["size"]
+            self.shape = (size[2], size[1], size[0])
+            self.dtype = None
+
+    def memory_map(self):
+
+        # read header
+        header, offset = read_meta_header(self.file_name)
+        if header is None:
+            return None
+
+        # check that the data are a single uncompressed block of a single channel 3D image
+        if header.get("CompressedData", "False").lower() == "true":
+            return None
+        if "pykneer_full_size" in header:
+            return None
+        if header.get("NDims", "") != "3" or header.get("ElementNumberOfChannels", "1") != "1":
+            return None
+        if header.get("ElementType", "") not in meta_types:
+            return None
+        data_file = header["ElementDataFile"]
+        if data_file == "LIST" or "%" in data_file or " " in data_file:
+            return None
+
+        # data file and offset
+        if data_file != "LOCAL":
+            data_file = os.path.join(os.path.dirname(self.file_name), data_file)
+            offset    = 0
+        else:
+            data_file = self.file_name
+        if int(header.get("HeaderSize", "0")) > 0:
+            offset = offset + int(header["HeaderSize"])
+
+        # data type with byte order
+        byte_order = header.get("BinaryDataByteOrderMSB", header.get("ElementByteOrderMSB", "False"))
+        if byte_order.lower() == "true":
+            dtype = np.dtype(">" + meta_types[header["ElementType"]])
+        else:
+            dtype = np.dtype("<" + meta_types[header["ElementType"]])
+
+        # shape in numpy order (z,y,x)
+        size  = [int(s) for s in header["DimSize"].split()]
+        shape = (size[2], size[1], size[0])
+        if os.path.getsize(data_file) < offset + dtype.itemsize * size[0] * size[1] * size[2]:
+            return None
+
+        return np.memmap(data_file, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+    def volume(self):
+
+        # memory-mapped data
+        if self.mmap is not None:
+            return self.mmap
+
+        # volume already in memory
+        if self.file_name in volume_cache:
+            volume_cache.move_to_end(self.file_name)
+            return volume_cache[self.file_name]
+
+        # read the whole image (read_mask restores cropped masks and reads any other image as it is)
+        # and keep only the most recent volumes in memory
+        img_py = sitk.GetArrayFromImage(sitkf.read_mask(self.file_name))
+        volume_cache[self.file_name] = img_py
+        while len(volume_cache) > volume_cache_max:
+            volume_cache.popitem(last=False)
+
+        return img_py
+
+    def read_slice(self, slice_ID):
+
+        # extract the sagittal slice in the reader (size 0 removes the x dimension), as img[:,:,slice_ID]
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(self.file_name)
+        reader.SetExtractIndex([slice_ID, 0, 0])
+        reader.SetExtractSize([0, self.shape[1], self.shape[0]])
+
+        return sitk.GetArrayFromImage(reader.Execute())
+
+    def get_slice(self, slice_ID):
+
+        """
+        Returns the sagittal slice img[:,:,slice_ID] from the cache or from the file
+        """
+
+        key = (self.file_name, slice_ID)
+        if key in slice_cache:
+            slice_cache.move_to_end(key)
+            return slice_cache[key]
+
+        if slice_ID < 0 or slice_ID >= self.shape[2]:
+            raise IndexError("slice %d is out of the image (%d sagittal slices)" % (slice_ID, self.shape[2]))
+        if self.mmap is not None:
+            slice_py = self.read_slice(slice_ID)
+        else:
+            # copy the slice so that it does not keep a reference to the whole volume
+            slice_py = np.array(self.volume()[:,:,slice_ID])
+        add_to_slice_cache(key, slice_py)
+
+        return slice_py
+
+    def sagittal_extent(self):
+
+        """
+        Returns a boolean array with True for the sagittal slices that are not empty, as np.any(img, axis=(0,1))
+        """
+
+        # memory-mapped data are reduced by numpy in blocks, without loading the volume in memory
+        if self.mmap is not None:
+            return np.any(self.mmap, axis=(0,1))
+
+        # masks cropped by write_mask: only the cropped part is read
+        if self.file_name not in volume_cache:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(self.file_name)
+            reader.ReadImageInformation()
+            if reader.HasMetaDataKey("pykneer_full_size"):
+                crop_index = int(reader.GetMetaData("pykneer_crop_index").split()[0])
+                cropped_py = sitk.GetArrayFromImage(reader.Execute())
+                not_empty  = np.zeros(self.shape[2], dtype=bool)
+                not_empty[crop_index:crop_index+cropped_py.shape[2]] = np.any(cropped_py, axis=(0,1))
+                return not_empty
+
+        return np.any(self.volume(), axis=(0,1))
+
+    def __getitem__(self, key):
+
+        # sagittal slice
+        if isinstance(key, tuple) and len(key) == 3 and key[0] == slice(None) and key[1] == slice(None) \
+           and isinstance(key[2], (int, np.integer)):
+            slice_ID = int(key[2])
+            if slice_ID < 0:
+                slice_ID = slice_ID + self.shape[2]
+            return self.get_slice(slice_ID)
+
+        # any other indexing
+        return np.asarray(self.volume()[key])
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# SLICES FOR VISUALIZATION --------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def find_mask_slices(mask_py):
+
+    """
+    Finds the first and last sagittal slices containing the mask (or map), and three slices at 1/4, 2/4, and 3/4 of the mask extent
+    mask_py can be a numpy array or a lazy_image
+    Returns first_value, last_value, and slice_ID, or None, None, None (with an error message) if the mask is empty or on one side only
+    """
+
+    # sagittal slices containing the mask
+    if isinstance(mask_py, lazy_image):
+        not_empty = mask_py.sagittal_extent()
+    else:
+        not_empty = np.any(mask_py, axis=(0,1))
+    size = len(not_empty)
+
+    # get the first slice of the mask in the sagittal direction
+    first_half = np.nonzero(not_empty[0:int(size/2)])[0]
+    # get the last slice of the mask in the sagittal direction
+    last_half  = np.nonzero(not_empty[int(size/2)+1:size])[0]
+    if len(first_half) == 0 or len(last_half) == 0:
+        print ("-------------------------------------------------------------------------------------------------------")
+        print ("ERROR: The mask does not extend across the middle sagittal slice")
+        print ("-------------------------------------------------------------------------------------------------------")
+        return None, None, None
+    first_value = int(first_half[0])
+    last_value  = int(last_half[-1]) + int(size/2) + 1
+
+    slice_step = int ((last_value-first_value)/4)
+    slice_ID   = (first_value + slice_step, first_value + 2*slice_step, first_value + 3*slice_step)
+
+    return first_value, last_value, slice_ID
+
+
+def browse_subjects(subject_names, show_subject):
+
+    """
+    Viewer of a cohort: a menu selects the subject, and show_subject(i) returns the widgets of the i-th subject
+    show_subject is called only when the subject is selected, so images of the other subjects are not accessed.
+    If show_subject returns None (e.g. empty mask), only its messages are shown
+    """
+
+    from IPython.display import display
+    from ipywidgets import Dropdown, Layout, Output, VBox
+
+    menu   = Dropdown(options=[(subject_names[i], i) for i in range(0, len(subject_names))],
+                      value=0,
+                      description="Image",
+                      layout=Layout(width='400px'))
+    output = Output()
+
+    def show(subject_ID):
+        output.clear_output()
+        with output:
+            box = show_subject(subject_ID)
+            if box is not None:
+                display(box)
+
+    menu.observe(lambda change: show(change["new"]), names="value")
+    show(0)
+
+    return VBox([menu, output])
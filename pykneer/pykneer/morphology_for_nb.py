@@ -8,6 +8,7 @@ There are two morphology measurements:
         - separation of articular and subcondral cartilage surfaces
         - thickness measurement: so far only the nearest neigbor algorithm is implemented
     - volume: calculated as the number of voxels == 1 multiplied by the image resolution
+Thickness and volume can also be computed in one step per image (compute_morphology), which saves all the results in one binary file
 
 For each measurements there are:
     - calculation
@@ -21,28 +22,32 @@ pool.map() takes care of sending one single element of the list all_image_data (
 
 """
 
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import multiprocessing
 from functools import partial
 import numpy as np
 import os
-import pandas as pd
 import SimpleITK as sitk
 import time
 import math
 
+# plotting (matplotlib), tables (pandas), and widgets (ipywidgets) are imported in the functions that use them,
+# so that the processes of multiprocessing.Pool() start faster
+
 # pyKNEER imports 
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
 if __package__ is None or __package__ == '':
     # uses current directory visibility
+    import instrumentation as instr
     import pykneer_io as io
     import morphology_functions as mf
+    import sitk_functions as sitkf
 
 else:
     # uses current package visibility
+    from . import instrumentation as instr
     from . import pykneer_io as io
     from . import morphology_functions as mf
+    from . import sitk_functions as sitkf
 
 
 
@@ -51,18 +56,44 @@ else:
 #import vtk_pts_functions as vtkf # Installation of VTK downgrades some python packages causing issues - not used for now
 
 
+# ---------------------------------------------------------------------------------------------------------------------------
+# READING RESULTS -----------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def load_morphology(image_data, key):
+
+    """
+    Loads a result of the morphology computation (e.g. key = "bone_cart_flat" or "thickness")
+    Results are read from the binary file written by compute_morphology, if present and more recent than the .txt file
+    (and computed with the same thickness algorithm). Otherwise they are read from the .txt file image_data[key + "_name"]
+    """
+
+    bundle_file_name = image_data["morphology_folder"] + image_data["morphology_bundle_name"]
+    txt_file_name    = image_data["morphology_folder"] + image_data[key + "_name"]
+
+    if os.path.isfile(bundle_file_name):
+        if not os.path.isfile(txt_file_name) or os.path.getmtime(bundle_file_name) >= os.path.getmtime(txt_file_name):
+            with np.load(bundle_file_name) as bundle:
+                if not key.startswith("thickness") or bundle["algorithm"] == image_data["algorithm"]:
+                    return bundle[key]
+
+    return io.read_txt_to_np_array(txt_file_name)
+
+
+
 # ---------------------------------------------------------------------------------------------------------------------------
 # CARTILAGE THICKNESS -------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
 
 # --- SEPARATING AND VISUALIZING ARTICULAR AND SUBCHONDRAL SURFACES ---------------------------------------------------------
 
+@instr.timed
 def separate_cartilage_surfaces_s(image_data):
 
     print (image_data["mask_name"])
 
     # read image
-    mask = sitk.ReadImage(image_data["input_folder"] + image_data["mask_name"])
+    mask = sitkf.read_mask(image_data["input_folder"] + image_data["mask_name"])
 
     # get contour points and separate them in bone cartilage and articular cartilage
     arti_cart_mm, bone_cart_mm = mf.separate_cartilage(mask)
@@ -90,6 +121,8 @@ def separate_cartilage_surfaces(all_image_data, n_of_processes):
 
 def show_cartilage_surfaces(all_image_data):
 
+    import matplotlib.pyplot as plt
+
     # subplots' n. of columns and rows
     n_of_columns = 3
     n_of_rows    = math.ceil(len(all_image_data) / n_of_columns)
@@ -103,8 +136,8 @@ def show_cartilage_surfaces(all_image_data):
     for i in range(0, len(all_image_data)):
 
         # load the data
-        bone_cart = io.read_txt_to_np_array(all_image_data[i]["morphology_folder"] + all_image_data[i]["bone_cart_flat_name"])
-        arti_cart = io.read_txt_to_np_array(all_image_data[i]["morphology_folder"] + all_image_data[i]["arti_cart_flat_name"])
+        bone_cart = load_morphology(all_image_data[i], "bone_cart_flat")
+        arti_cart = load_morphology(all_image_data[i], "arti_cart_flat")
         print (all_image_data[i]["mask_name"])
 
         # scatter plot
@@ -147,6 +180,7 @@ def algorithm(all_image_data, algo_ID):
         all_image_data[i]["thickness_flat_name"] =  mask_name_root + "_thickness_flat_" + str( all_image_data[i]["algorithm"]) + ".txt"
 
 
+@instr.timed
 def calculate_thickness_s(image_data):
 
     print (image_data["mask_name"])
@@ -190,6 +224,8 @@ def calculate_thickness(all_image_data, n_of_processes):
 
 def show_thickness_maps(all_image_data):
 
+    import matplotlib.pyplot as plt
+
     # subplots' n. of columns and rows
     n_of_columns = 3
     n_of_rows    = math.ceil(len(all_image_data) / n_of_columns)
@@ -204,8 +240,8 @@ def show_thickness_maps(all_image_data):
 
         # load the data
         if all_image_data[i]["algorithm"] == 1:
-            surface   = io.read_txt_to_np_array(all_image_data[i]["morphology_folder"] + all_image_data[i]["bone_cart_flat_name"])
-            thickness = io.read_txt_to_np_array(all_image_data[i]["morphology_folder"] + all_image_data[i]["thickness_flat_name"])
+            surface   = load_morphology(all_image_data[i], "bone_cart_flat")
+            thickness = load_morphology(all_image_data[i], "thickness_flat")
             thickness = np.extract(thickness==thickness, thickness) # from array of arrays to array of numbers
 
         print (all_image_data[i]["mask_name"])
@@ -245,11 +281,13 @@ def show_thickness_maps(all_image_data):
 
 def show_thickness_graph(all_image_data):
 
+    import matplotlib.pyplot as plt
+
     # calculate average and standard deviation
     average = []
     std_dev = []
     for i in range(0, len(all_image_data)):
-        thickness = io.read_txt_to_np_array(all_image_data[i]["morphology_folder"] + all_image_data[i]["thickness_name"])
+        thickness = load_morphology(all_image_data[i], "thickness")
         average.append(np.average(thickness))
         std_dev.append(np.std(thickness))
 
@@ -282,6 +320,8 @@ def show_thickness_graph(all_image_data):
 
 def show_thickness_table(all_image_data, output_file_name):
 
+    import pandas as pd
+
     # read and calculate values for table
     image_names = []
     average     = []
@@ -292,7 +332,7 @@ def show_thickness_table(all_image_data, output_file_name):
         image_root, image_ext = os.path.splitext(all_image_data[i]["thickness_name"])
         image_names.append(image_root)
         # read thickness file
-        thickness = io.read_txt_to_np_array(all_image_data[i]["morphology_folder"] + all_image_data[i]["thickness_name"])
+        thickness = load_morphology(all_image_data[i], "thickness")
         # calculate thickness and standard deviation
         average.append(np.average(thickness))
         std_dev.append(np.std(thickness))
@@ -324,44 +364,120 @@ def show_thickness_table(all_image_data, output_file_name):
 # ---------------------------------------------------------------------------------------------------------------------------
 
 
-def calculate_volume(all_image_data):
+@instr.timed
+def calculate_volume_s(image_data):
 
-    volume_mm = []
+    print (image_data["mask_name"])
 
-    for i in range (0, len(all_image_data)):
+    # count the voxels of each label
+    mask_file_name  = image_data["input_folder"] + image_data["mask_name"]
+    counts, spacing = mf.count_labels(mask_file_name)
+    voxel_volume    = spacing[0] * spacing[1] * spacing[2]
+
+    # one row per label (the mask modification time is used to update the table only for new or changed masks)
+    image_root, image_ext = os.path.splitext(image_data["mask_name"])
+    rows = []
+    for label in range(1, len(counts)):
+        if counts[label] != 0:
+            rows.append({"subjects"     : image_root,
+                         "input_folder" : image_data["input_folder"],
+                         "mask_name"    : image_data["mask_name"],
+                         "mask_mtime"  : os.stat(mask_file_name).st_mtime_ns,
+                         "label"       : label,
+                         "n_of_voxels" : counts[label],
+                         "volume"      : counts[label] * voxel_volume})
+    # empty mask
+    if len(rows) == 0:
+        rows.append({"subjects" : image_root, "input_folder" : image_data["input_folder"], "mask_name" : image_data["mask_name"],
+                     "mask_mtime" : os.stat(mask_file_name).st_mtime_ns,
+                     "label" : 0, "n_of_voxels" : 0, "volume" : 0.0})
+
+    return rows
+
+def read_volume_table(all_image_data):
+
+    import pandas as pd
+
+    # read the table of the cohort (empty if not computed yet, or if written without the mask folders)
+    table_file_name = all_image_data[0]["morphology_folder"] + all_image_data[0]["volume_table_name"]
+    table = None
+    if os.path.isfile(table_file_name):
+        table = pd.read_csv(table_file_name)
+    if table is None or "input_folder" not in table:
+        table = pd.DataFrame(columns=["subjects", "input_folder", "mask_name", "mask_mtime", "label", "n_of_voxels", "volume"])
 
-        print (all_image_data[i]["mask_name"])
+    return table
 
-        # read image
-        mask = sitk.ReadImage(all_image_data[i]["input_folder"] + all_image_data[i]["mask_name"])
-        # sitk to numpy
-        mask_py = sitk.GetArrayFromImage(mask)
+def is_mask_row(table, image_data):
 
-        # get number of white voxels
-        n_of_voxels = np.count_nonzero(mask_py)
+    # rows of the mask (masks with the same name can be in different folders)
+    return (table["input_folder"] == image_data["input_folder"]) & (table["mask_name"] == image_data["mask_name"])
 
-        # calculate volume in mm
-        volume_mm = n_of_voxels * mask.GetSpacing()[0] * mask.GetSpacing()[1] * mask.GetSpacing()[2]
+def is_volume_in_table(table, image_data):
 
-        # save to file
-        file = open(all_image_data[i]["morphology_folder"] + all_image_data[i]["volume_name"], "w")
-        file.write("%0.2f " % volume_mm )
-        file.close()
+    # the mask is in the table and was not modified after its volume was computed
+    mask_file_name = image_data["input_folder"] + image_data["mask_name"]
+    rows = table[is_mask_row(table, image_data)]
+    return len(rows) > 0 and np.all(rows["mask_mtime"] == os.stat(mask_file_name).st_mtime_ns)
+
+def calculate_volume(all_image_data, n_of_processes=1):
+
+    """
+    Calculates the volume of each label of the masks and saves all the volumes in one table (image_data["volume_table_name"])
+    Only new or modified masks are computed; the volumes of the other masks in the table are kept
+    """
+
+    import pandas as pd
+
+    start_time = time.time()
+
+    # masks that are not in the table or have been modified
+    table       = read_volume_table(all_image_data)
+    to_compute  = [image_data for image_data in all_image_data if not is_volume_in_table(table, image_data)]
+
+    # compute volumes
+    if len(to_compute) > 0:
+        pool = multiprocessing.Pool(processes=n_of_processes)
+        all_rows = pool.map(calculate_volume_s, to_compute)
+        # replace the rows of the computed masks
+        for image_data in to_compute:
+            table = table[~is_mask_row(table, image_data)]
+        table = pd.concat([table, pd.DataFrame([row for rows in all_rows for row in rows])], ignore_index=True)
+
+    # save table (written to a temporary file first, so that the table is never half-written)
+    table_file_name = all_image_data[0]["morphology_folder"] + all_image_data[0]["volume_table_name"]
+    table.to_csv(table_file_name + ".tmp", index=False)
+    os.replace(table_file_name + ".tmp", table_file_name)
+
+    print ("-> Volume computed for %d masks (%d already in the table)" % (len(to_compute), len(all_image_data) - len(to_compute)))
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
 
-    print ("-> Volume computed")
+
+def read_volumes(all_image_data):
+
+    # volume of each mask (all labels): from the volume table, or from the results of compute_morphology or of older versions
+    table   = read_volume_table(all_image_data)
+    volumes = []
+    for i in range (0, len(all_image_data)):
+        if is_volume_in_table(table, all_image_data[i]):
+            volumes.append(np.sum(table["volume"][is_mask_row(table, all_image_data[i])]))
+        else:
+            volumes.append(float(np.ravel(load_morphology(all_image_data[i], "volume"))[0]))
+
+    return np.asarray(volumes)
 
 
 def show_volume_graph (all_image_data):
 
+    import matplotlib.pyplot as plt
+
     # figure size
     figure_width  = 18
     figure_length = 8
     plt.rcParams['figure.figsize'] = [figure_width, figure_length] # figsize=() seems to be ineffective on notebooks
 
     # read volumes
-    volumes = np.full((len(all_image_data),1),0)
-    for i in range (0, len(all_image_data)):
-        volumes[i] = io.read_txt_to_np_array(all_image_data[i]["morphology_folder"] + all_image_data[i]["volume_name"])
+    volumes = read_volumes(all_image_data)
 
     # plot
     fig     = plt.figure() # cannot call figures inside the for loop because python has a max of 20 figures (nOfImages can be larger)
@@ -384,6 +500,8 @@ def show_volume_graph (all_image_data):
 
 def show_volume_table(all_image_data, output_file_name):
 
+    import pandas as pd
+
     # extract image names
     image_names = []
     for i in range(0, len(all_image_data)):
@@ -391,10 +509,7 @@ def show_volume_table(all_image_data, output_file_name):
         image_names.append(image_root)
 
     # read volumes
-    volumes = np.full((len(all_image_data),1),0)
-    for i in range (0, len(all_image_data)):
-        volumes[i] = io.read_txt_to_np_array(all_image_data[i]["morphology_folder"] + all_image_data[i]["volume_name"])
-    volumes = np.extract(volumes==volumes, volumes)
+    volumes = read_volumes(all_image_data)
 
     # create table
     table = pd.DataFrame(
@@ -421,6 +536,93 @@ def show_volume_table(all_image_data, output_file_name):
 
 
 
+# ---------------------------------------------------------------------------------------------------------------------------
+# THICKNESS AND VOLUME IN ONE STEP ------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+@instr.timed
+def compute_morphology_s(image_data):
+
+    print (image_data["mask_name"])
+
+    # read mask (once for surfaces and volume)
+    mask = sitkf.read_mask(image_data["input_folder"] + image_data["mask_name"])
+
+    # get contour points and separate them in bone cartilage and articular cartilage
+    arti_cart_mm, bone_cart_mm = mf.separate_cartilage(mask)
+
+    # flatten surfaces for visualization
+    bone_cart_flat, bone_phi = mf.flatten_point_cloud(bone_cart_mm)
+    arti_cart_flat, arti_phi = mf.flatten_point_cloud(arti_cart_mm)
+
+    # thickness
+    if image_data["algorithm"] == 1:
+        # calculate NN distance at the bone surface
+        thickness_mm = mf.nearest_neighbor_thickness (bone_cart_mm, arti_cart_mm)
+    elif image_data["algorithm"] == 2:
+        # calculate NN distance at the articular cartilage surface
+        thickness_mm = mf.nearest_neighbor_thickness (arti_cart_mm, bone_cart_mm)
+    elif image_data["algorithm"] == 3:
+        # calculate using potential lines
+        print ("coming soon")
+        return
+    else:
+        print ("Use a number between 1 and 3")
+        return
+    # rearrange thicknesses for flattened surfaces for visualization
+    thickness_flat = mf.flatten_thickness(thickness_mm, bone_phi)
+
+    # volume from the mask already in memory
+    n_of_voxels = np.count_nonzero(sitk.GetArrayViewFromImage(mask))
+    volume_mm   = n_of_voxels * mask.GetSpacing()[0] * mask.GetSpacing()[1] * mask.GetSpacing()[2]
+
+    # write the same .txt files as the step-by-step functions
+    if image_data["txt_flag"] == 1:
+        io.write_np_array_to_txt(bone_cart_mm,   image_data["morphology_folder"] + image_data["bone_cart_name"])
+        io.write_np_array_to_txt(arti_cart_mm,   image_data["morphology_folder"] + image_data["arti_cart_name"])
+        io.write_np_array_to_txt(bone_cart_flat, image_data["morphology_folder"] + image_data["bone_cart_flat_name"])
+        io.write_np_array_to_txt(arti_cart_flat, image_data["morphology_folder"] + image_data["arti_cart_flat_name"])
+        io.write_np_array_to_txt(bone_phi,       image_data["morphology_folder"] + image_data["bone_phi_name"])
+        io.write_np_array_to_txt(arti_phi,       image_data["morphology_folder"] + image_data["arti_phi_name"])
+        io.write_np_array_to_txt(thickness_mm,   image_data["morphology_folder"] + image_data["thickness_name"])
+        io.write_np_array_to_txt(thickness_flat, image_data["morphology_folder"] + image_data["thickness_flat_name"])
+        file = open(image_data["morphology_folder"] + image_data["volume_name"], "w")
+        file.write("%0.2f " % volume_mm )
+        file.close()
+
+    # write all results in one binary file (after the .txt files, so that load_morphology reads the bundle)
+    np.savez(image_data["morphology_folder"] + image_data["morphology_bundle_name"],
+             bone_cart      = bone_cart_mm,
+             arti_cart      = arti_cart_mm,
+             bone_cart_flat = bone_cart_flat,
+             arti_cart_flat = arti_cart_flat,
+             bone_phi       = bone_phi,
+             arti_phi       = arti_phi,
+             thickness      = thickness_mm,
+             thickness_flat = thickness_flat,
+             volume         = volume_mm,
+             algorithm      = image_data["algorithm"])
+
+def compute_morphology(all_image_data, algo_ID, n_of_processes, txt_flag=0):
+
+    """
+    Separates the cartilage surfaces, flattens them, and computes thickness (with the algorithm algo_ID) and volume for each mask
+    Results are saved in one binary file per mask. With txt_flag = 1, they are also saved in the .txt files used by the step-by-step functions
+    """
+
+    # add the used algorithm and the export flag to the image information
+    algorithm(all_image_data, algo_ID)
+    for i in range (0,len(all_image_data)):
+        all_image_data[i]["txt_flag"] = txt_flag
+
+    start_time = time.time()
+    pool = multiprocessing.Pool(processes=n_of_processes)
+    pool.map(compute_morphology_s, all_image_data)
+    print ("-> Thickness and volume computed")
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+
+
 # ---------------------------------------------------------------------------------------------------------------
 # VTK FUNCTIONS
 # Installation of VTK downgrades some python packages causing issues - not used for now
@@ -9,20 +9,21 @@ They are separeted in three groups:
         flatten_point_cloud calls rotate_to_x and flatten_surface
     - Function to associate thickness to 2D surface after flattening: 
         flatten_thickness
+    - Functions to label cartilage subregions using the flattening geometry:
+        cartilage_subregions calls separate_cartilage, cylinder_frame, and angle_threshold
     - Functions to calculate cartilage thickness:
         - nearest_neighbor_thickness calls find_closest_point
+    - Function to calculate cartilage volume:
+        - count_labels
 """
 
 import numpy     as np
 import SimpleITK as sitk
-import skimage   as ski
-from skimage.measure import find_contours
-
-from scipy import optimize
-from scipy import ndimage as ndi
 
 import time
 
+# scipy and skimage are imported in the functions that use them, so that the module is imported faster
+
 
 # pyKNEER imports 
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
@@ -33,10 +34,14 @@ if __package__ is None or __package__ == '':
     sys.path.append(os.path.dirname(os.path.realpath(__file__)))
     #cyl_fitting_dir = os.path.dirname(os.path.realpath(__file__)) + "cylinder_fitting"
     from cylinder_fitting import fit
+    import lazy_image_io  as lio
+    import sitk_functions as sitkf
 
 else:
     # uses current package visibility
     from .cylinder_fitting import fit
+    from . import lazy_image_io  as lio
+    from . import sitk_functions as sitkf
 
 
 
@@ -56,6 +61,7 @@ def f(c, x, y):
     return Ri - Ri.mean()
 
 def leastsq_circle(x,y): # from: https://gist.github.com/lorenzoriano/6799568
+    from scipy import optimize
     # coordinates of the barycenter
     x_m = np.mean(x)
     y_m = np.mean(y)
@@ -138,6 +144,9 @@ def separate_cartilage_slice(x_c, y_c, x, y):
 
 def separate_cartilage (mask):
 
+    from scipy import ndimage as ndi
+    from skimage.measure import find_contours
+
     min_area             = 15
     slice_with_contour_S = []
     bone_cart            = []
@@ -154,7 +163,7 @@ def separate_cartilage (mask):
         slice = mask_py[:,:,i]
 
         # if slice contains the label (i.e. 1 in binary image)
-        if sum(sum(slice)) != 0:
+        if np.count_nonzero(slice) != 0: # (sum() of uint8 masks overflows)
 
             # contours containers
             contour_S = []                # list:    each cell of the list contains a contour (for the slices with several regions)
@@ -178,7 +187,7 @@ def separate_cartilage (mask):
 
                 else:
                     # get region contour
-                    contour = ski.measure.find_contours(temp_slice, 0.5)
+                    contour = find_contours(temp_slice, 0.5)
 
                     # add region contour separately for region (to discriminate bone and articular cartilage)
                     contour_S.append(contour)
@@ -304,9 +313,14 @@ def rotation_matrix(phi, theta, psi):
     return A
 
 
-def rotate_to_x(point_cloud):
+def cylinder_frame(point_cloud):
+
+    """
+    Calculates the reference frame of the cylinder fitting the point cloud
+    Returns the cylinder center C_fit and the rotation matrices M1 and M2 that bring the cylinder axis to the x-axis
+    (a point p is rotated as M2 * M1 * (p - C_fit))
+    """
 
-    
     # fit to a cylinder
     step = 10
     w_fit, C_fit, r_fit, fit_err = fit(point_cloud[1:np.size(point_cloud,0):step,:])
@@ -314,14 +328,7 @@ def rotate_to_x(point_cloud):
     # cyl-axis has to be positive for homogeneity
     w_fit = np.abs(w_fit)
 
-    # translate point cloud to origin
-    point_cloud = point_cloud - C_fit # do this before the following step, where C_fit becomes the origin
-
-    # translate cyl-axis to origin
-    C_fit = C_fit - C_fit
-    w_fit = w_fit - C_fit
-
-    # rotatate cyl-axis and point cloud to the x-axis
+    # rotatate cyl-axis to the x-axis
     # -- vectors
     vector = np.copy(w_fit)    # vector I want to rotate to the x-axis
     versor = np.array([1,0,0]) # x-axis
@@ -337,10 +344,6 @@ def rotate_to_x(point_cloud):
     M1 = rotation_matrix(phi, theta, psi)
     # Apply rotation cyl-axis
     vector_out_1 = np.dot(M1,vector)
-    # Apply rotation to point_cloud
-    point_cloud_out_1 = np.copy(point_cloud)
-    for i in range(np.size(point_cloud,0)):
-        point_cloud_out_1[i,:] = np.dot(M1,point_cloud[i,:])
 
     # -- second rotation
     # angles
@@ -350,16 +353,45 @@ def rotate_to_x(point_cloud):
     psi   = 0
     # Rotation matrix
     M2 = rotation_matrix(phi, theta, psi)
-    # Apply rotation cyl-axis
-    #vector_out_2 = np.dot(M2,vector_out_1)
-    # Apply rotation to point_cloud
-    point_cloud_out_2 = np.copy(point_cloud_out_1)
-    for i in range(np.size(point_cloud_out_1,0)):
-        point_cloud_out_2[i,:] = np.dot(M2,point_cloud_out_2[i,:])
+
+    return C_fit, M1, M2
+
+
+def rotate_to_x(point_cloud):
+
+    # get cylinder center and rotations
+    C_fit, M1, M2 = cylinder_frame(point_cloud)
+
+    # translate point cloud to origin
+    point_cloud = point_cloud - C_fit
+
+    # -- first and second rotation
+    # Apply rotations to all points at once (points are rows, so they are multiplied by the transposed matrices)
+    point_cloud_out_1 = np.dot(point_cloud, M1.T)
+    point_cloud_out_2 = np.dot(point_cloud_out_1, M2.T)
 
     return point_cloud_out_2
 
 
+def angle_threshold(y):
+
+    """
+    Calculates the angle below which angles are moved by 360 degrees to make the cartilage continuous (it can be cut in half in the flattening)
+    """
+
+    # get the histogram of y
+    counts, bins = np.histogram(y, 100, density=True)
+    # get where there are emtpy
+    zero_counts = np.where(counts == 0) # tuple
+    zero_counts = zero_counts[0] # np array
+    # find the central bin among the empty ones
+    middle_zero = zero_counts[round(len(zero_counts)/2)]
+    # get the corresponding value
+    t = int(bins[middle_zero])
+
+    return t
+
+
 def flatten_surface(pts):
 
     '''
@@ -380,25 +412,14 @@ def flatten_surface(pts):
     # calculate the angles on the sagittal plane
     phi = np.arctan2(pts[:,2], pts[:,1])
     # bin the angles to their closest 2.decimal
-    phi = np.round(phi,2)
-    # extract the bins
-    phi_unique = np.unique(phi)
-
-    # allocate flattened point cloud
-    x = np.full((1,1),1)
-    x = np.extract(x==x, x)
-    y = np.full((1,1),1)
-    y = np.extract(y==y, y)
-
-    # extract the coordinates in x and z
-    for a in range (0, len(phi_unique)):
-        x_bin = np.extract(phi == phi_unique[a], pts[:,0])
-        y_bin = np.full((len(x_bin),1), phi_unique[a])
-        y_bin = np.extract(y_bin==y_bin, y_bin)
-        x = np.hstack((x,x_bin))
-        y = np.hstack((y,y_bin))
-    x = np.delete(x,0,0)
-    y = np.delete(y,0,0)
+    phi = np.ravel(np.round(phi,2))
+    # sort the points by angle bin, keeping the original order of the points within each bin
+    phi_unique, phi_inverse = np.unique(phi, return_inverse=True)
+    order = np.argsort(phi_inverse, kind="stable")
+
+    # extract the coordinates in x and the angle bins
+    x = pts[order,0].astype(float)
+    y = phi[order]
 
     # make cartilage continuous (it can be cut in half in the flattening)
     # calculate difference between current point and following one (derivative) to get where the cartilage is broken in two
@@ -420,16 +441,7 @@ def flatten_surface(pts):
 #    y[0:t] = y[0:t]+2*np.pi
 
     # make cartilage continuous (it can be cut in half in the flattening)
-    # get the histogram of y
-    #counts, bins, patches = plt.hist(y, 100, density=True, facecolor='g', alpha=0.5)
-    counts, bins = np.histogram(y, 100, density=True)
-    # get where there are emtpy
-    zero_counts = np.where(counts == 0) # tuple
-    zero_counts = zero_counts[0] # np array
-    # find the central bin among the empty ones
-    middle_zero = zero_counts[round(len(zero_counts)/2)]
-    # get the corresponding value
-    t = int(bins[middle_zero])
+    t = angle_threshold(y)
     # add 360degrees to the values below the threshold
     y[y<t] = y[y<t] + 2*np.pi
 
@@ -455,23 +467,106 @@ def flatten_point_cloud(pts_in):
 
 def flatten_thickness(thickness_in, phi):
 
-    # extract the bins
-    phi_unique = np.unique(phi)
-
-    thickness_out = np.full((1,1),1)
-    thickness_out = np.extract(thickness_out==thickness_out, thickness_out)
+    # sort the thickness by angle bin, keeping the original order within each bin (as in flatten_surface)
+    # (phi read from file is a column, n x 1: with numpy >= 2 the inverse of np.unique has the shape of its input)
+    phi_unique, phi_inverse = np.unique(np.ravel(phi), return_inverse=True)
+    order = np.argsort(np.ravel(phi_inverse), kind="stable")
 
     # resample the thickness
-    for a in range (0, len(phi_unique)):
-        thickness_bin = np.extract(phi == phi_unique[a], thickness_in)
-        thickness_out = np.hstack((thickness_out,thickness_bin))
-
-    thickness_out = np.delete(thickness_out,0,0)
+    thickness_out = np.ravel(thickness_in)[order].astype(float)
 
     return thickness_out
 
 
 
+# ---------------------------------------------------------------------------------------------------------------------------
+# FUNCTIONS TO LABEL CARTILAGE SUBREGIONS -----------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def subregion_names():
+
+    """
+    Returns the names of the cartilage subregions. The label of a subregion is its position in the list + 1 (0 is background)
+    Subregions are: medial/lateral x anterior/central/posterior x deep/superficial
+    """
+
+    names = []
+    for ml in ["medial", "lateral"]:
+        for apc in ["anterior", "central", "posterior"]:
+            for ds in ["deep", "superficial"]:
+                names.append(ml + "_" + apc + "_" + ds)
+
+    return names
+
+
+def cartilage_subregions(mask):
+
+    """
+    Creates a label map of the cartilage subregions using the flattening geometry
+    Assumption: the knee is in the orientation given by the preprocessing (RAI and right knees flipped to left)
+    Steps:
+    1. Separate bone and articular cartilage surfaces and fit the cylinder to the bone cartilage (as in flatten_point_cloud)
+    2. Rotate all the mask voxels to the cylinder frame
+    3. Medial/lateral: voxels are split at the middle of the bone cartilage along the cylinder axis (lateral for larger x)
+    4. Anterior/central/posterior: the angle phi (binned as in flatten_surface) of the bone cartilage is split in three equal ranges.
+       Posterior is the range whose voxels are more posterior in the image
+    5. Deep/superficial: voxels closer to the bone cartilage surface are deep, voxels closer to the articular cartilage surface are superficial
+    The labels are the ones of subregion_names()
+    """
+
+    from scipy.spatial import cKDTree
+
+    # separate cartilage surfaces (output order as in morphology_for_nb)
+    arti_cart, bone_cart = separate_cartilage(mask)
+
+    # cylinder frame on the bone cartilage
+    C_fit, M1, M2 = cylinder_frame(bone_cart)
+    M = np.dot(M2, M1)
+
+    # coordinates of the mask voxels in mm (same convention as the points of separate_cartilage)
+    mask_py  = sitk.GetArrayFromImage(mask)
+    spacing  = mask.GetSpacing()
+    index    = np.nonzero(mask_py)
+    voxels   = np.column_stack((index[1] * spacing[1], index[0] * spacing[2], index[2] * spacing[0]))
+
+    # rotate voxels and bone cartilage to the cylinder frame
+    voxels_rot = np.dot(voxels    - C_fit, M.T)
+    bone_rot   = np.dot(bone_cart - C_fit, M.T)
+
+    # medial/lateral
+    x_middle = (np.min(bone_rot[:,0]) + np.max(bone_rot[:,0])) / 2
+    ml       = (voxels_rot[:,0] > x_middle).astype(np.uint8)
+
+    # anterior/central/posterior - angles binned and made continuous as in flatten_surface
+    bone_phi = np.round(np.arctan2(bone_rot[:,2], bone_rot[:,1]), 2)
+    t        = angle_threshold(bone_phi)
+    bone_phi[bone_phi < t] = bone_phi[bone_phi < t] + 2*np.pi
+    phi      = np.round(np.arctan2(voxels_rot[:,2], voxels_rot[:,1]), 2)
+    phi[phi < t] = phi[phi < t] + 2*np.pi
+    phi_step = (np.max(bone_phi) - np.min(bone_phi)) / 3
+    apc      = np.clip(np.floor((phi - np.min(bone_phi)) / phi_step), 0, 2).astype(np.uint8)
+    # the angle can increase from anterior to posterior or viceversa, so flip if the first range is the posterior one (larger y in the image)
+    if np.mean(index[1][apc == 0]) > np.mean(index[1][apc == 2]):
+        apc = 2 - apc
+
+    # deep/superficial
+    bone_distance, i = cKDTree(bone_cart).query(voxels)
+    arti_distance, i = cKDTree(arti_cart).query(voxels)
+    ds               = (arti_distance < bone_distance).astype(np.uint8)
+
+    # label map
+    labels_py        = np.zeros(mask_py.shape, dtype=np.uint8)
+    labels_py[index] = 1 + ml*6 + apc*2 + ds
+
+    # back to SimpleITK
+    labels = sitk.GetImageFromArray(labels_py)
+    labels.SetSpacing  (mask.GetSpacing())
+    labels.SetOrigin   (mask.GetOrigin())
+    labels.SetDirection(mask.GetDirection())
+
+    return labels
+
+
 # ---------------------------------------------------------------------------------------------------------------------------
 # FUNCTIONS TO CALCULATE CARTILAGE THICKNESS --------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
@@ -499,3 +594,54 @@ def nearest_neighbor_thickness (bone_cart, arti_cart):
         bone_cart_thickness[i] = find_closest_point(bone_cart[i,:], arti_cart)
 
     return bone_cart_thickness
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# FUNCTION TO CALCULATE CARTILAGE VOLUME ------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def count_labels(mask_file_name, n_of_slices=16):
+
+    """
+    Counts the voxels of each label of a mask with one bincount per slab of n_of_slices slices
+    Uncompressed masks are memory-mapped, so only one slab at a time is in memory. Compressed masks are read as a whole
+    Masks that are not integer or that have negative values are counted as binary (label 1 for all the non-zero voxels).
+    The choice is made once for the whole mask (signed masks are read once more to find their minimum)
+    Returns the number of voxels per label (index = label) and the voxel spacing
+    """
+
+    # voxel spacing from the header
+    spacing = sitkf.read_image_geometry(mask_file_name)["spacing"]
+
+    # memory-mapped mask or whole mask
+    mask_py = lio.lazy_image(mask_file_name)
+    if mask_py.mmap is not None:
+        mask_py = mask_py.mmap
+    else:
+        mask_py = sitk.GetArrayFromImage(sitkf.read_mask(mask_file_name))
+
+    # labels or binary mask
+    binary_flag = not np.issubdtype(mask_py.dtype, np.integer)
+    if np.issubdtype(mask_py.dtype, np.signedinteger):
+        for z in range(0, mask_py.shape[0], n_of_slices):
+            if np.min(mask_py[z:z+n_of_slices]) < 0:
+                binary_flag = True
+                break
+
+    # count the voxels slab by slab
+    counts = np.zeros(1, dtype=np.int64)
+    for z in range(0, mask_py.shape[0], n_of_slices):
+        slab   = np.asarray(mask_py[z:z+n_of_slices]).ravel()
+        labels = slab[slab != 0]
+        if binary_flag:
+            slab_counts = np.array([0, len(labels)])
+        else:
+            slab_counts = np.bincount(labels, minlength=1)
+        slab_counts[0] = len(slab) - len(labels)
+        # add to the counts of the previous slabs
+        if len(slab_counts) > len(counts):
+            counts = np.concatenate((counts, np.zeros(len(slab_counts) - len(counts), dtype=np.int64)))
+        counts[0:len(slab_counts)] = counts[0:len(slab_counts)] + slab_counts
+
+    return counts, spacing
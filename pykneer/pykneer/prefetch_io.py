@@ -0,0 +1,180 @@
+# Serena Bonaretti, 2018
+
+"""
+Module with the prefetching reads and the asynchronous writes of the functions _s.
+map_with_prefetch replaces pool.map(function_s, all_image_data): each process gets a chunk of consecutive images, and while
+function_s computes an image, a background thread reads the input files of the next image (and writes the outputs of the
+previous one). The time of a step gets close to max(I/O, computation) instead of their sum.
+Functions _s read with read_image and read_mask, and write with write_image. Outside of map_with_prefetch (e.g. when a
+function _s is called directly) reads and writes are the same as sitk.ReadImage, sitkf.read_mask, and sitk.WriteImage.
+
+Functions:
+    - prefetch
+    - read_image
+    - read_mask
+    - write_image
+    - wait_for_writes
+    - chunk_size
+    - map_with_prefetch
+"""
+
+import concurrent.futures
+import multiprocessing
+import SimpleITK as sitk
+
+# pyKNEER imports
+# ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
+if __package__ is None or __package__ == '':
+    # uses current directory visibility
+    import sitk_functions as sitkf
+else:
+    # uses current package visibility
+    from . import sitk_functions as sitkf
+
+
+# state of each process (threads are created in the processes of multiprocessing.Pool(), when first used)
+reader_threads = None
+writer_threads = None
+prefetched     = {} # file name -> future with the image
+pending_writes = [] # futures of the writes
+pipelined      = False
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# READ ----------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def prefetch(file_names):
+
+    """
+    Starts reading the files in a background thread. The images are returned by the next read_image or read_mask of the same files
+    """
+
+    global reader_threads
+
+    if reader_threads is None:
+        reader_threads = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    for file_name in file_names:
+        if file_name not in prefetched:
+            prefetched[file_name] = reader_threads.submit(sitk.ReadImage, file_name)
+
+
+def read_image(file_name):
+
+    """
+    As sitk.ReadImage, using the prefetched image if there is one (an error of the prefetch is raised here)
+    """
+
+    future = prefetched.pop(file_name, None)
+    if future is not None:
+        return future.result()
+
+    return sitk.ReadImage(file_name)
+
+
+def read_mask(file_name, pixel_type=None):
+
+    """
+    As sitkf.read_mask, using the prefetched image if there is one
+    """
+
+    return sitkf.restore_mask(read_image(file_name), pixel_type)
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# WRITE ---------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def write_and_continue(image, file_name, compression_flag, after_write):
+
+    sitk.WriteImage(image, file_name, compression_flag)
+    if after_write is not None:
+        after_write()
+
+
+def write_image(image, file_name, compression_flag=False, after_write=None):
+
+    """
+    As sitk.WriteImage. In map_with_prefetch the image is written in a background thread, and after_write (e.g. saving a thumbnail
+    that needs the written file) runs after the write. Writes are completed before map_with_prefetch returns
+    """
+
+    global writer_threads
+
+    if not pipelined:
+        write_and_continue(image, file_name, compression_flag, after_write)
+        return
+    if writer_threads is None:
+        writer_threads = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    pending_writes.append(writer_threads.submit(write_and_continue, image, file_name, compression_flag, after_write))
+
+
+def wait_for_writes():
+
+    """
+    Waits for the background writes (an error of a write is raised here)
+    """
+
+    while len(pending_writes) > 0:
+        pending_writes.pop(0).result()
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# MAP -----------------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def run_chunk(arguments):
+
+    # runs function on consecutive images, reading the inputs of the next image during the computation of the current one
+    global pipelined
+
+    function, input_files, chunk = arguments
+    results   = []
+    pipelined = True
+    try:
+        for i in range(0, len(chunk)):
+            if i + 1 < len(chunk):
+                prefetch(input_files(chunk[i+1]))
+            results.append(function(chunk[i]))
+        wait_for_writes()
+    finally:
+        pipelined = False
+        # images prefetched and not read, and writes not waited for (e.g. after an error), so that the next chunk of this process starts clean
+        prefetched.clear()
+        concurrent.futures.wait(pending_writes)
+        del pending_writes[:]
+
+    return results
+
+
+def chunk_size(n_of_images, n_of_processes):
+
+    """
+    Number of consecutive images per chunk: about four chunks per process for load balancing, and at least two images to prefetch.
+    With less than two images per process, one chunk per process, so that all the processes run (chunks of one image are not prefetched)
+    """
+
+    if n_of_images < 2 * n_of_processes:
+        return max(1, -(-n_of_images // n_of_processes))
+
+    return max(2, -(-n_of_images // (4 * n_of_processes)))
+
+
+def map_with_prefetch(function, input_files, all_image_data, n_of_processes):
+
+    """
+    As pool.map(function, all_image_data), with prefetching of the input files (input_files(image_data) returns their names)
+    and asynchronous writes. Returns the results of function, in the order of all_image_data
+    """
+
+    # chunks of consecutive images
+    size      = chunk_size(len(all_image_data), n_of_processes)
+    chunks    = [all_image_data[i:i+size] for i in range(0, len(all_image_data), size)]
+    arguments = [(function, input_files, chunk) for chunk in chunks]
+
+    pool    = multiprocessing.Pool(processes=n_of_processes)
+    results = pool.map(run_chunk, arguments)
+    pool.close()
+    pool.join()
+
+    return [result for chunk_results in results for result in chunk_results]
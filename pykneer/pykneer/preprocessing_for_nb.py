@@ -10,28 +10,29 @@ pool.map() takes care of sending one single element of the list all_image_data (
 """
 
 import os
-import matplotlib.pyplot as plt
 import time
 import multiprocessing
 
-from ipywidgets import * # for displays
-from ipywidgets import HBox, VBox
-from ipywidgets import interactive
-from ipywidgets import Layout
-from ipywidgets import widgets as widgets
-
-
 import SimpleITK      as sitk
 
+# plotting (matplotlib), tables (pandas), and widgets (ipywidgets) are imported in the functions that use them,
+# so that the processes of multiprocessing.Pool() start faster
+
 # pyKNEER imports 
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
 if __package__ is None or __package__ == '':
     # uses current directory visibility
+    import instrumentation as instr
+    import lazy_image_io   as lio
     import sitk_functions  as sitkf
+    import thumbnail_cache as thc
 
 else:
     # uses current package visibility
+    from . import instrumentation as instr
+    from . import lazy_image_io   as lio
     from . import sitk_functions  as sitkf
+    from . import thumbnail_cache as thc
 
 
 
@@ -39,10 +40,26 @@ else:
 # READ DICOM IMAGES AND PRINT HEADER ----------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
 
+def write_dicom_header(meta_data_keys, meta_data, info_file_name):
+
+    # write header to file
+    file = open(info_file_name, "w")
+
+    for i in range(0,len(meta_data_keys)):
+        file.write(meta_data_keys[i] +  " " + meta_data[i] + "\n")
+
+    file.close()
+
+
+@instr.timed
 def read_dicom_stack_s(image_data):
 
+    # scan the dicom folder once (file names and header are kept for reading the stack and writing the header)
+    image_folder = image_data["original_folder"] + image_data["image_folder_file_name"]
+    scan         = sitkf.scan_dicom_folder(image_folder)
+
     # read dicom stack and put it in a 3D matrix
-    img = sitkf.read_dicom_stack(image_data["original_folder"] + image_data["image_folder_file_name"])
+    img = sitkf.read_dicom_stack(image_folder)
 
     # print out image information
     print("-> " + image_data["image_name_root"])
@@ -51,6 +68,9 @@ def read_dicom_stack_s(image_data):
     # save image to temp
     sitk.WriteImage(img, image_data["temp_file_name"])
 
+    # write header from the scan
+    write_dicom_header(scan["meta_data_keys"], scan["meta_data"], image_data["info_file_name"])
+
 def read_dicom_stack(all_image_data, n_of_processes):
 
     start_time = time.time()
@@ -61,18 +81,21 @@ def read_dicom_stack(all_image_data, n_of_processes):
 
 
 
+@instr.timed
 def print_dicom_header_s(image_data):
 
-    # read header
-    meta_data_keys, meta_data = sitkf.read_dicom_header(image_data["original_folder"] + image_data["image_folder_file_name"])
+    image_folder = image_data["original_folder"] + image_data["image_folder_file_name"]
 
-    # write header to file
-    file = open(image_data["info_file_name"], "w")
+    # the header is written by read_dicom_stack_s. Scan the folder again only if the header is missing or older than the folder
+    info_file_name = image_data["info_file_name"]
+    if os.path.isfile(info_file_name) and os.path.getmtime(info_file_name) >= os.path.getmtime(image_folder):
+        return
 
-    for i in range(0,len(meta_data_keys)):
-        file.write(meta_data_keys[i] +  " " + meta_data[i] + "\n")
+    # read header
+    meta_data_keys, meta_data = sitkf.read_dicom_header(image_folder)
 
-    file.close()
+    # write header to file
+    write_dicom_header(meta_data_keys, meta_data, info_file_name)
 
 def print_dicom_header(all_image_data, n_of_processes):
 
@@ -88,10 +111,10 @@ def print_dicom_header(all_image_data, n_of_processes):
 # SPATIAL PREPROCESSING -----------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
 
+@instr.timed
 def orientation_to_rai_s(image_data):
     '''
-    This function will be used when SimpleIKT includes the filter OrientImageFilter in the release
-    For now we use the ITK filter
+    Orientation is changed by permuting and flipping the image axes (see sitk_functions.orientation_to_rai)
     '''
     
     # read the image
@@ -113,6 +136,7 @@ def orientation_to_rai(all_image_data, n_of_processes):
 
 
 
+@instr.timed
 def flip_rl_s(image_data):
 
     # read the image
@@ -136,6 +160,7 @@ def flip_rl(all_image_data, n_of_processes):
 
 
 
+@instr.timed
 def origin_to_zero_s(image_data):
 
     # read the image
@@ -150,6 +175,9 @@ def origin_to_zero_s(image_data):
     # save image to *_orig.mha
     sitk.WriteImage(img, image_data["original_file_name"])
 
+    # save thumbnail for visualization
+    thc.save_image_thumbnail(image_data["original_file_name"], sitk.GetArrayViewFromImage(img))
+
     # delete temp image
     os.remove(image_data["temp_file_name"])
 
@@ -169,6 +197,7 @@ def origin_to_zero(all_image_data, n_of_processes):
 # INTENSITY PREPROCESSING ---------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
 
+@instr.timed
 def field_correction_s(image_data):
 
     start_time = time.time()
@@ -194,6 +223,7 @@ def field_correction(all_image_data, n_of_processes):
 
 
 
+@instr.timed
 def rescale_to_range_s(image_data):
 
     # read the image
@@ -215,6 +245,7 @@ def rescale_to_range(all_image_data, n_of_processes):
 
 
 
+@instr.timed
 def edge_preserving_smoothing_s(image_data):
 
     # read the image
@@ -226,6 +257,9 @@ def edge_preserving_smoothing_s(image_data):
     # save image to prep
     sitk.WriteImage(img, image_data["preprocessed_file_name"])
 
+    # save thumbnail for visualization
+    thc.save_image_thumbnail(image_data["preprocessed_file_name"], sitk.GetArrayViewFromImage(img))
+
     # delete temp image
     os.remove(image_data["temp_file_name"])
 
@@ -245,6 +279,8 @@ def edge_preserving_smoothing(all_image_data, n_of_processes):
 # ---------------------------------------------------------------------------------------------------------------------------
     
 def show_preprocessed_images (image_data, intensity_standardization, view_modality):
+
+    from ipywidgets import interactive
     
     if view_modality == 0:
         show_preprocessed_images_static(image_data,intensity_standardization)
@@ -260,6 +296,8 @@ def show_preprocessed_images (image_data, intensity_standardization, view_modali
 
 def show_preprocessed_images_static(all_image_data,intensity_standardization):
 
+    import matplotlib.pyplot as plt
+
     n_of_images   = len(all_image_data)
     img_LW        = 4
     figure_width  = img_LW * 2
@@ -277,16 +315,9 @@ def show_preprocessed_images_static(all_image_data,intensity_standardization):
         image_data     = all_image_data[i]
         orig_file_name = image_data["original_file_name"]
 
-        # read the images
-        img_orig = sitk.ReadImage(orig_file_name)
-
-        # convert images to numpy arrays
-        img_orig_py = sitk.GetArrayFromImage(img_orig)
-
-        # extract slice at 2/3 of the image size
-        size       = img_orig_py.shape
-        slice_ID   = round(size[2] / 3 * 2)
-        slice_orig = img_orig_py[:,:,slice_ID]
+        # get the slice at 2/3 of the image size from the thumbnail cache
+        thumbnail  = thc.get_image_thumbnail(orig_file_name)
+        slice_orig = thumbnail["slice"]
 
         # plot slice of original image in left axis
         if n_of_images == 1:
@@ -305,14 +336,8 @@ def show_preprocessed_images_static(all_image_data,intensity_standardization):
 
         if intensity_standardization==1:
 
-            # read the images
-            img_prep = sitk.ReadImage(prep_file_name)
-
-            # convert images to numpy arrays
-            img_prep_py = sitk.GetArrayFromImage(img_prep)
-
-            # extract slice at 2/3 of the image size
-            slice_prep = img_prep_py[:,:,slice_ID]
+            # get the slice at 2/3 of the image size from the thumbnail cache
+            slice_prep = thc.get_image_thumbnail(prep_file_name)["slice"]
 
             # plot slice of preprocessed image in right axis
             if n_of_images == 1:
@@ -334,6 +359,9 @@ def show_preprocessed_images_static(all_image_data,intensity_standardization):
             
 
 def browse_images_orig_only(img_orig_py, size, slice_ID, fig, ax1, image_data):
+
+    import matplotlib.pyplot as plt
+    from ipywidgets import HBox, VBox, interactive, Layout, widgets
     
     # function for slider 1
     def view_image_1(slider_1):
@@ -378,6 +406,9 @@ def browse_images_orig_only(img_orig_py, size, slice_ID, fig, ax1, image_data):
 
 
 def browse_images_orig_prep(img_orig_py, img_prep_py, size, slice_ID, fig, ax1, ax2, image_data):
+
+    import matplotlib.pyplot as plt
+    from ipywidgets import HBox, VBox, interactive, Layout, widgets
     
     # function for slider 
     def view_image_1(slider_1):
@@ -426,19 +457,18 @@ def browse_images_orig_prep(img_orig_py, img_prep_py, size, slice_ID, fig, ax1,
     return whole_box
 
 def show_preprocessed_images_interactive(all_image_data,intensity_standardization):   
+
+     import matplotlib.pyplot as plt
     
-     # display all images
-     for i in range(0, len(all_image_data)):
+     # create the figure of one image when it is selected
+     def show_subject(i):
                
          # --- for both cases ---    
          # get paths and file names of the current image
          orig_file_name = all_image_data[i]["original_file_name"]
     
-         # read the image
-         img_orig = sitk.ReadImage(orig_file_name)
-    
-         # convert image to numpy array
-         img_orig_py = sitk.GetArrayFromImage(img_orig)
+         # access the image on demand (slices are read from disk when displayed)
+         img_orig_py = lio.lazy_image(orig_file_name)
         
          # get slice id at 2/3 of the image size
          size       = img_orig_py.shape
@@ -453,11 +483,7 @@ def show_preprocessed_images_interactive(all_image_data,intensity_standardizatio
              plt.close() # do not show plots below this cell
              
              # show the image
-             if i == 0:
-                 finalBox = browse_images_orig_only(img_orig_py, size, slice_ID, fig, ax, all_image_data[i])
-             else:
-                 vBox = browse_images_orig_only(img_orig_py, size, slice_ID, fig, ax, all_image_data[i])
-                 finalBox = VBox([finalBox,vBox]);
+             return browse_images_orig_only(img_orig_py, size, slice_ID, fig, ax, all_image_data[i])
         
          # --- if also intensity preprocessing ---
          elif intensity_standardization == 1:
@@ -474,17 +500,11 @@ def show_preprocessed_images_interactive(all_image_data,intensity_standardizatio
              # get paths and file names of the current image
              prep_file_name = all_image_data[i]["preprocessed_file_name"]
             
-             # read the images
-             img_prep = sitk.ReadImage(prep_file_name)
-    
-             # convert image to numpy array
-             img_prep_py = sitk.GetArrayFromImage(img_prep)
+             # access the image on demand (slices are read from disk when displayed)
+             img_prep_py = lio.lazy_image(prep_file_name)
              
              # show the image
-             if i == 0:
-                 finalBox = browse_images_orig_prep(img_orig_py, img_prep_py, size, slice_ID, fig, ax1, ax2, all_image_data[i])
-             else:
-                 vBox = browse_images_orig_prep(img_orig_py, img_prep_py, size, slice_ID, fig, ax1, ax2, all_image_data[i])
-                 finalBox = VBox([finalBox,vBox]);
-                 
-     return finalBox
+             return browse_images_orig_prep(img_orig_py, img_prep_py, size, slice_ID, fig, ax1, ax2, all_image_data[i])
+
+     # one image at a time
+     return lio.browse_subjects([os.path.basename(image_data["original_file_name"]) for image_data in all_image_data], show_subject)
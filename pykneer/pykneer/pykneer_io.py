@@ -5,14 +5,22 @@ Module with functions to read/write .txt files in pykneer
 
 Functions:
     - folder_divider
+    - get_parameter_folder
+    - get_parameter_files
+    - get_elastix_folder
+    - sibling_folder
     - load_image_data_preprocessing
     - load_image_data_find_reference
     - load_image_data_segmentation
+    - link_longitudinal_visits
+    - load_image_data_segmentation_ma
     - add_names_to_image_data
     - load_image_data_segmentation_quality
     - load_image_data_morphology
     - load_image_data_EPG
     - load_image_data_fitting
+    - preprocessing_image_data, segmentation_image_data, segmentation_ma_image_data, segmentation_quality_image_data, morphology_image_data,
+      EPG_image_data, fitting_image_data
     - read_txt_to_np_array
     - write_np_array_to_txt
 """
@@ -20,7 +28,6 @@ Functions:
 
 import numpy as np
 import os
-import pkg_resources
 import platform
 import re
 
@@ -48,6 +55,109 @@ def folder_divider():
     return folder_div
 
 
+# parameter files and elastix folder are the same for all the images, so they are found once per process
+package_paths = {}
+
+def get_parameter_folder():
+
+    """
+    Returns the folder of the parameter files for elastix and transformix
+    """
+
+    if "parameter_folder" not in package_paths:
+        folder_div = folder_divider()
+        # if during development
+        if __package__ is None or __package__ == '':
+            parameter_folder = os.path.dirname(os.path.realpath(__file__)) + "/parameterFiles"
+        # if using package
+        else:
+            # imported here because it is slow to import
+            import pkg_resources
+            parameter_folder = pkg_resources.resource_filename('pykneer','parameterFiles') + folder_div
+        if not parameter_folder.endswith(folder_div):
+            parameter_folder = parameter_folder + folder_div
+        package_paths["parameter_folder"] = parameter_folder
+
+    return package_paths["parameter_folder"]
+
+
+def get_parameter_files():
+
+    """
+    Returns the parameter files for rigid, similarity, and spline registration (and their inverse and warm start),
+    or {} if a file is missing
+    """
+
+    if "parameter_files" not in package_paths:
+        parameter_folder = get_parameter_folder()
+        if not os.path.isdir(parameter_folder):
+            print("----------------------------------------------------------------------------------------")
+            print("ERROR: The parameter folder %s does not exist" % (parameter_folder) )
+            print("----------------------------------------------------------------------------------------")
+            return {}
+        # check if the folder contains all the parameter files
+        parameter_files = {}
+        parameter_files["param_file_rigid"]        = parameter_folder + "MR_param_rigid.txt"
+        parameter_files["i_param_file_rigid"]      = parameter_folder + "MR_iparam_rigid.txt"
+        parameter_files["param_file_similarity"]   = parameter_folder + "MR_param_similarity.txt"
+        parameter_files["i_param_file_similarity"] = parameter_folder + "MR_iparam_similarity.txt"
+        parameter_files["param_file_spline"]       = parameter_folder + "MR_param_spline.txt"
+        parameter_files["i_param_file_spline"]     = parameter_folder + "MR_iparam_spline.txt"
+        # longitudinal registrations initialized with the transformations of the previous visit (fewer resolutions and iterations)
+        parameter_files["param_file_rigid_warm"]   = parameter_folder + "MR_param_rigid_warm.txt"
+        parameter_files["param_file_spline_warm"]  = parameter_folder + "MR_param_spline_warm.txt"
+        for key in parameter_files.keys():
+            if not os.path.isfile(parameter_files[key]):
+                print("----------------------------------------------------------------------------------------")
+                print("ERROR: The file %s does not exist" % (parameter_files[key]) )
+                print("----------------------------------------------------------------------------------------")
+                return {}
+        package_paths["parameter_files"] = parameter_files
+
+    return package_paths["parameter_files"]
+
+
+def get_elastix_folder():
+
+    """
+    Returns the folder of elastix and transformix executables (from binaries in pykneer package)
+    """
+
+    if "elastix_folder" not in package_paths:
+        # imported here because it is slow to import
+        import pkg_resources
+        sys = platform.system()
+        if sys == "Linux":
+            dirpath = pkg_resources.resource_filename('pykneer','elastix/Linux/')
+        elif sys == "Windows":
+            dirpath = pkg_resources.resource_filename('pykneer','elastix\\Windows\\')
+        elif sys == "Darwin":
+            # For debugging - I am working on a MacOS
+            if __package__ is None or __package__ == '':
+                dirpath = os.path.dirname(os.path.realpath(__file__)) + "/elastix/Darwin/"
+            # if using package
+            else:
+                dirpath = pkg_resources.resource_filename('pykneer','elastix/Darwin/')
+        package_paths["elastix_folder"] = dirpath
+
+    return package_paths["elastix_folder"]
+
+
+def sibling_folder(folder, name):
+
+    """
+    Returns the folder called name next to folder (e.g. .../preprocessed/ for .../original/)
+    """
+
+    folder_div = folder_divider()
+
+    new_folder = os.path.split(folder)[0]     # remove the slash or backslash
+    new_folder = os.path.split(new_folder)[0] # remove the last folder
+    new_folder = new_folder + folder_div + name + folder_div
+
+    return new_folder
+
+
 # ---------------------------------------------------------------------------------------------------------------------------
 # PREPROCESSING -------------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
@@ -144,20 +254,7 @@ def load_image_data_preprocessing(input_file_name):
                 print("----------------------------------------------------------------------------------------")
                 return {}
 
-            # create the dictionary
-            image_data = {}
-            # add inputs
-            image_data["original_folder"]        = original_folder
-            image_data["preprocessed_folder"]    = preprocessed_folder
-            image_data["image_folder_file_name"] = image_folder_file_name
-            image_data["laterality"]             = laterality
-            # add outputs
-            image_name_root = image_folder_file_name.replace(folder_div, "_")
-            image_data["image_name_root"]        = image_name_root
-            image_data["temp_file_name"]         = preprocessed_folder + image_data["image_name_root"] + "_temp.mha"
-            image_data["original_file_name"]     = preprocessed_folder + image_data["image_name_root"] + "_orig.mha"
-            image_data["preprocessed_file_name"] = preprocessed_folder + image_data["image_name_root"] + "_prep.mha"
-            image_data["info_file_name"]         = preprocessed_folder + image_data["image_name_root"] + "_orig.txt"
+            image_data = preprocessing_image_data(original_folder, preprocessed_folder, image_folder_file_name, laterality)
 
             # print current file name
             print (image_data["image_name_root"])
@@ -426,35 +523,154 @@ def load_image_data_segmentation(registration_type, input_file_name):
                     print("----------------------------------------------------------------------------------------")
                     return {}
 
-                # current image in a struct to the registration class
-                reference_root, reference_ext = os.path.splitext(reference_name)
-                moving_root, moving_ext = os.path.splitext(moving_name)
-                image_data = {}
-                image_data["registration_type"]     = registration_type
-                image_data["cartilage"]             = cartilage
-                image_data["bone"]                  = bone
-                image_data["current_anatomy"]       = []
-                image_data["reference_folder"]      = reference_folder
-                image_data["reference_name"]        = reference_name
-                image_data["reference_root"]        = reference_root
-                image_data["moving_folder"]         = moving_folder
-                image_data["moving_name"]           = moving_name
-                image_data["moving_root"]           = moving_root
-                image_data["registered_folder"]     = registered_folder
-                image_data["segmented_folder"]      = segmented_folder
-
-                # add extra filenames and paths
-                image_data = add_names_to_image_data(image_data,1)
+                image_data = segmentation_image_data(registration_type, reference_folder, reference_name, moving_folder, moving_name,
+                                                     registered_folder, segmented_folder)
 
                 # send to the data list
                 all_image_data.append(image_data)
 
+    # follow-up visits are initialized with the registrations of the previous visit
+    if registration_type == "longitudinal":
+        link_longitudinal_visits(all_image_data)
+
     print ("-> image information loaded")
 
     # return all the info on the images to be segmented
     return all_image_data
 
 
+def link_longitudinal_visits(all_image_data):
+
+    """
+    In longitudinal segmentations, the reference is the baseline image of the knee, and the moving images after it are the visits
+    in temporal order. Adds to each visit its number (0 for the first one) and the registered folder of the previous visit,
+    whose transformations initialize the registrations of the visit (see run_registration in elastix_transformix.py)
+    """
+
+    last_visits = {}
+    for image_data in all_image_data:
+        reference_name = image_data["reference_folder"] + image_data["reference_name"]
+        if reference_name in last_visits:
+            previous = last_visits[reference_name]
+            image_data["visit"]                          = previous["visit"] + 1
+            image_data["previous_registered_sub_folder"] = previous["registered_sub_folder"]
+        last_visits[reference_name] = image_data
+
+
+def load_image_data_segmentation_ma(input_file_name):
+
+    """
+    Parses the input file of multi-atlas segmentation (segmentation_ma_for_nb.py). The file is as the one of segmentation.ipynb,
+    with all the atlases as reference images (r) and all the images to segment as moving images (m)
+    """
+
+    folder_div = folder_divider()
+
+    # ----------------------------------------------------------------------------------------------------------------------
+    # check if input file exists
+    if not os.path.exists(input_file_name):
+        print("----------------------------------------------------------------------------------------")
+        print("ERROR: The file  %s does not exist" % (input_file_name) )
+        print("----------------------------------------------------------------------------------------")
+        return {}
+
+    # ----------------------------------------------------------------------------------------------------------------------
+    # get input_file_name content
+    file_content=[]
+    for line in open(input_file_name):
+        file_content.append(line.rstrip("\n"))
+
+    # clear empty spaces at the end of strings (if human enters spaces by mistake)
+    for i in range(0,len(file_content)):
+        file_content[i] = file_content[i].rstrip()
+
+    # ----------------------------------------------------------------------------------------------------------------------
+    # get folders
+    # line 1 is folder of the atlases (images and masks)
+    atlas_folder = file_content[0]
+    if not atlas_folder.endswith(folder_div):
+        atlas_folder = atlas_folder + folder_div
+    if not os.path.isdir(atlas_folder):
+        print("----------------------------------------------------------------------------------------")
+        print("ERROR: The atlas folder %s does not exist" % (atlas_folder) )
+        print("----------------------------------------------------------------------------------------")
+        return {}
+
+    # line 2 is folder of the preprocessed (*_prep.mha) images, i.e. the moving image folder
+    moving_folder = file_content[1]
+    if not moving_folder.endswith(folder_div):
+        moving_folder = moving_folder + folder_div
+    if not os.path.isdir(moving_folder):
+        print("----------------------------------------------------------------------------------------")
+        print("ERROR: The preprocessed folder %s does not exist" % (moving_folder) )
+        print("----------------------------------------------------------------------------------------")
+        return {}
+
+    # create the registered and segmented folders
+    registered_folder = sibling_folder(moving_folder, "registered")
+    segmented_folder  = sibling_folder(moving_folder, "segmented")
+    for folder in [registered_folder, segmented_folder]:
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+            print("-> folder %s created" % (folder) )
+
+    # ----------------------------------------------------------------------------------------------------------------------
+    # get atlases and images
+    atlas_names  = []
+    moving_names = []
+
+    for i in range(2,len(file_content)):
+
+        current_line = file_content[i]
+
+        # if there are empty lines at the end of the file
+        if len(current_line) != 0:
+
+            # get image type (reference or moving)
+            image_type = current_line[0]
+            if image_type != "r" and image_type != "m":
+                print("----------------------------------------------------------------------------------------")
+                print("ERROR: Image type must be 'r' or 'm'")
+                print("----------------------------------------------------------------------------------------")
+                return {}
+
+            # check that the image and the masks of the atlas exist
+            image_name = current_line[2:len(current_line)]
+            if image_type == "r":
+                image_root, image_ext = os.path.splitext(image_name)
+                for file_name in [image_name, image_root + "_f.mha", image_root + "_fc.mha"]:
+                    if not os.path.isfile(atlas_folder + file_name):
+                        print("----------------------------------------------------------------------------------------")
+                        print("ERROR: The file %s does not exist" % (atlas_folder + file_name) )
+                        print("----------------------------------------------------------------------------------------")
+                        return {}
+                atlas_names.append(image_name)
+            # check that the moving image exists
+            elif image_type == "m":
+                if not os.path.isfile(moving_folder + image_name):
+                    print("----------------------------------------------------------------------------------------")
+                    print("ERROR: The file %s does not exist" % (moving_folder + image_name) )
+                    print("----------------------------------------------------------------------------------------")
+                    return {}
+                moving_names.append(image_name)
+
+    if len(atlas_names) == 0:
+        print("----------------------------------------------------------------------------------------")
+        print("ERROR: There are no atlases (lines starting with 'r')")
+        print("----------------------------------------------------------------------------------------")
+        return {}
+
+    # create a dictionary for each image
+    all_image_data = []
+    for moving_name in moving_names:
+        all_image_data.append(segmentation_ma_image_data(atlas_folder, atlas_names, moving_folder, moving_name, registered_folder, segmented_folder))
+
+    print ("-> image information loaded for " + str(len(all_image_data)) + " images and " + str(len(atlas_names)) + " atlases")
+
+    # return all the info on the images to be segmented
+    return all_image_data
+
+
 # ---------------------------------------------------------------------------------------------------------------------------
 # ADD NAMES -----------------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
@@ -509,6 +725,8 @@ def add_names_to_image_data(image_data,folderFlag):
     image_data[cartilage + "m_spline_name"]     = cartilage + "_splineMask.mha"
     image_data[cartilage + "mask"]              = cartilage + "_mask.mha"
     image_data[cartilage + "mask"]              = image_data["moving_root"] + "_" + cartilage + ".mha"
+    # output mask storage (0: full image; 1: cropped around the mask, restored to the full image by sitk_functions.read_mask)
+    image_data["mask_crop_flag"]                = 0
 
     # output transformation names
     image_data[bone + "rigid_transf_name"]         = "TransformParameters."  + bone + "_rigid.txt"
@@ -524,79 +742,19 @@ def add_names_to_image_data(image_data,folderFlag):
     image_data[cartilage + "i_spline_transf_name"] = "iTransformParameters." + cartilage + "_spline.txt"
     image_data[cartilage + "m_spline_transf_name"] = "mTransformParameters." + cartilage + "_spline.txt"
 
-    # parameter files 
-    # if during development
-    if __package__ is None or __package__ == '':
-        parameter_folder = os.path.dirname(os.path.realpath(__file__)) + "/parameterFiles"
-    # if using package
-    else:
-        parameter_folder = pkg_resources.resource_filename('pykneer','parameterFiles') + folder_div
-      
-    if not parameter_folder.endswith(folder_div):
-        parameter_folder = parameter_folder + folder_div
-    if not os.path.isdir(parameter_folder):
-        print("----------------------------------------------------------------------------------------")
-        print("ERROR: The parameter folder %s does not exist" % (parameter_folder) )
-        print("----------------------------------------------------------------------------------------")
-        return {}
-    # check if the folder contains all the parameter files
-    param_file_rigid        = parameter_folder + "MR_param_rigid.txt"
-    i_param_file_rigid      = parameter_folder + "MR_iparam_rigid.txt"
-    param_file_similarity   = parameter_folder + "MR_param_similarity.txt"
-    i_param_file_similarity = parameter_folder + "MR_iparam_similarity.txt"
-    param_file_spline       = parameter_folder + "MR_param_spline.txt"
-    i_param_file_spline     = parameter_folder + "MR_iparam_spline.txt"
-    if not os.path.isfile(param_file_rigid):
-        print("----------------------------------------------------------------------------------------")
-        print("ERROR: The file %s does not exist" % (param_file_rigid) )
-        print("----------------------------------------------------------------------------------------")
-        return {}
-    if not os.path.isfile(i_param_file_rigid):
-        print("----------------------------------------------------------------------------------------")
-        print("ERROR: The file %s does not exist" % (i_param_file_rigid) )
-        print("----------------------------------------------------------------------------------------")
-        return {}
-    if not os.path.isfile(param_file_similarity):
-        print("----------------------------------------------------------------------------------------")
-        print("ERROR: The file %s does not exist" % (param_file_similarity) )
-        print("----------------------------------------------------------------------------------------")
-        return {}
-    if not os.path.isfile(i_param_file_similarity):
-        print("----------------------------------------------------------------------------------------")
-        print("ERROR: The file %s does not exist" % (i_param_file_similarity) )
-        print("----------------------------------------------------------------------------------------")
-        return {}
-    if not os.path.isfile(param_file_spline):
-        print("----------------------------------------------------------------------------------------")
-        print("ERROR: The file %s does not exist" % (param_file_spline) )
-        print("----------------------------------------------------------------------------------------")
-        return {}
-    if not os.path.isfile(i_param_file_spline):
-        print("----------------------------------------------------------------------------------------")
-        print("ERROR: The file %s does not exist" % (i_param_file_spline) )
-        print("----------------------------------------------------------------------------------------")
+    # final metric of the registrations (used to check the warm start of longitudinal registrations)
+    image_data[bone + "rigid_metric_name"]         = "metric." + bone + "_rigid.txt"
+    image_data[bone + "spline_metric_name"]        = "metric." + bone + "_spline.txt"
+    image_data[cartilage + "spline_metric_name"]   = "metric." + cartilage + "_spline.txt"
+
+    # parameter files
+    parameter_files = get_parameter_files()
+    if len(parameter_files) == 0:
         return {}
-    # add parameter files to image_data
-    image_data["param_file_rigid"]        = param_file_rigid
-    image_data["i_param_file_rigid"]      = i_param_file_rigid
-    image_data["param_file_similarity"]   = param_file_similarity
-    image_data["i_param_file_similarity"] = i_param_file_similarity
-    image_data["param_file_spline"]       = param_file_spline
-    image_data["i_param_file_spline"]     = i_param_file_spline
+    image_data.update(parameter_files)
 
     # elastix path (from binaries in pykneer package)
-    sys = platform.system()
-    if sys == "Linux":
-        dirpath = pkg_resources.resource_filename('pykneer','elastix/Linux/')
-    elif sys == "Windows":
-        dirpath = pkg_resources.resource_filename('pykneer','elastix\\Windows\\')
-    elif sys == "Darwin":
-        # For debugging - I am working on a MacOS
-        if __package__ is None or __package__ == '':
-            dirpath = os.path.dirname(os.path.realpath(__file__)) + "/elastix/Darwin/"
-        # if using package
-        else:
-            dirpath = pkg_resources.resource_filename('pykneer','elastix/Darwin/')
+    dirpath = get_elastix_folder()
     image_data["elastix_folder"]            = dirpath
     image_data["complete_elastix_path"]     = dirpath + "elastix"
     image_data["complete_transformix_path"] = dirpath + "transformix"
@@ -693,12 +851,7 @@ def load_image_data_segmentation_quality(input_file_name):
                     print("----------------------------------------------------------------------------------------")
                     return {}
 
-                # put pair in a list
-                image_data = {}
-                image_data["segmented_folder"]         = segmented_folder
-                image_data["ground_truth_folder"]      = ground_truth_folder
-                image_data["segmented_name"]           = segmented_name
-                image_data["ground_truth_name"]        = ground_truth_name
+                image_data = segmentation_quality_image_data(segmented_folder, ground_truth_folder, segmented_name, ground_truth_name)
 
                 # send to the data list
                 all_image_data.append(image_data)
@@ -778,25 +931,7 @@ def load_image_data_morphology(input_file_name):
                 print("----------------------------------------------------------------------------------------")
                 return {}
 
-            # create the dictionary
-            image_data = {}
-            # input names
-            image_data["input_folder"]        = input_folder
-            image_data["mask_name"]           = mask_name
-            # output names
-            mask_name_root, mask_name_ext       = os.path.splitext(mask_name)
-            image_data["bone_cart_name"]      = mask_name_root + "_bone_cart.txt"
-            image_data["arti_cart_name"]      = mask_name_root + "_arti_cart.txt"
-            image_data["thickness_name"]      = []
-            image_data["thickness_flat_name"] = []
-            image_data["algorithm"]           = []
-            image_data["volume_name"]         = mask_name_root + "_volume.txt"
-            image_data["morphology_folder"]   = morphology_folder
-            # for visualization
-            image_data["bone_cart_flat_name"] = mask_name_root + "_bone_cart_flat.txt"
-            image_data["arti_cart_flat_name"] = mask_name_root + "_arti_cart_flat.txt"
-            image_data["bone_phi_name"]       = mask_name_root + "_bone_phi.txt"
-            image_data["arti_phi_name"]       = mask_name_root + "_arti_phi.txt"
+            image_data = morphology_image_data(input_folder, morphology_folder, mask_name)
 
             # send to the whole data array
             all_image_data.append(image_data)
@@ -929,22 +1064,7 @@ def load_image_data_EPG(input_file_name):
                     print("----------------------------------------------------------------------------------------")
                     return {}
 
-                # create the dictionary
-                image_data = {}
-                # add folders
-                image_data["preprocessed_folder"]   = preprocessed_folder
-                image_data["segmented_folder"]      = segmented_folder
-                image_data["relaxometry_folder"]    = relaxometry_folder
-                # add input file names
-                image_data["i1_file_name"]          = i1_file_name
-                image_data["i2_file_name"]          = i2_file_name
-                image_data["mask_file_name"]        = mask_file_name
-                image_data["info_file_name"]        = info_file_name
-                # add output file names
-                image_data["t2_map_file_name"]      = image_name_root + "_T2map.mha"
-                image_data["t2_map_mask_file_name"] = image_name_root + "_T2map_masked.mha"
-                # others
-                image_data["image_name_root"]       = image_name_root
+                image_data = EPG_image_data(preprocessed_folder, segmented_folder, relaxometry_folder, i1_file_name, i2_file_name, mask_file_name)
 
                 print (image_data["image_name_root"])
 
@@ -1097,79 +1217,8 @@ def load_image_data_fitting(input_file_name, method_flag, registrationFlag):
                     return {}
 
 
-                # create the dictionary
-                image_data = {}
-
-                # folders
-                image_data["preprocessed_folder"]    = preprocessed_folder
-                image_data["segmented_folder"]       = segmented_folder
-                image_data["relaxometry_folder"]     = relaxometry_folder
-
-                # input file names
-                image_data["acquisition_file_names"] = acquisition_file_names
-                image_data["info_file_names"]        = info_file_names
-                image_data["bone_mask_file_name"]    = bone_mask_file_name
-                image_data["cart_mask_file_name"]    = cart_mask_file_name
-
-                # fitting type
-                image_data["method_flag"]            = method_flag
-
-                # output file names
-                image_name_root, image_ext           = os.path.splitext(acquisition_file_names[0])
-                if registrationFlag == 1:
-                    if method_flag == 0: # linear fitting
-                        image_data["map_file_name"] = image_name_root + "_map_lin_aligned.mha"
-                    elif method_flag == 1: # exponential fitting
-                        image_data["map_file_name"] = image_name_root + "_map_exp_aligned.mha"
-                else:
-                    if method_flag == 0: # linear fitting
-                        image_data["map_file_name"] = image_name_root + "_map_lin.mha"
-                    elif method_flag == 1: # exponential fitting
-                        image_data["map_file_name"] = image_name_root + "_map_exp.mha"
-
-                # alignment: fixed variables for elastix_transformix.py
-                image_data["current_anatomy"]        = 'femurCart' #### to be parametrized in a later release
-                bone                               = "f"         #### to be parametrized in a later release
-                image_data["bone"]                  = bone
-                image_data["dilate_radius"]          = 15
-                registered_folder = os.path.split(preprocessed_folder)[0] # remove the slash or backslash
-                registered_folder = os.path.split(registered_folder)[0] # remove "original"
-                registered_folder = registered_folder + folder_div + "registered" + folder_div
-                image_data["registered_folder"]      = registered_folder
-                # parameter files 
-                # if during development
-                if __package__ is None or __package__ == '':
-                    parameter_folder = os.path.dirname(os.path.realpath(__file__)) + "/parameterFiles"
-                # if using package
-                else:
-                    parameter_folder = pkg_resources.resource_filename('pykneer','parameterFiles') + folder_div
-                image_data["parameter_folder"]       = parameter_folder
-                image_data["param_file_rigid"]       = "MR_param_rigid.txt"
-
-                # elastix path (from binaries in pykneer package)
-                sys = platform.system()
-                if sys == "Linux":
-                    dirpath = pkg_resources.resource_filename('pykneer','elastix/Linux/')
-                elif sys == "Windows":
-                    dirpath = pkg_resources.resource_filename('pykneer','elastix\\Windows\\')
-                elif sys == "Darwin":
-                    # For debugging - I am working on a MacOS
-                    if __package__ is None or __package__ == '':
-                        dirpath = os.path.dirname(os.path.realpath(__file__)) + "/elastix/Darwin/"
-                    # if using package
-                    else:
-                        dirpath = pkg_resources.resource_filename('pykneer','elastix/Darwin/')
-                image_data["elastix_folder"]           = dirpath
-                image_data["complete_elastix_path"]     = dirpath + "elastix"
-                # alignment: image-dependent variables for elastix_transformix.py
-                image_data["reference_name"]                = image_data["acquisition_file_names"][0]
-                reference_root, image_ext                   = os.path.splitext(image_data["reference_name"] )
-                image_data["reference_root"]                = reference_root
-                image_data["mask_file_name"]                 = image_data["bone_mask_file_name"]
-                image_data[bone + "mask_file_name"]          = image_data["bone_mask_file_name"]
-                image_data[bone + "dil_mask_file_name"]       = image_data["reference_root"] + "_" + bone + "_" + str(image_data["dilate_radius"]) + ".mha"
-                image_data[bone + "levelset_mask_file_name"] = image_data["reference_root"] + "_" + bone + "_levelSet.mha"
-                image_data["moving_folder"]                 = image_data["preprocessed_folder"]
+                image_data = fitting_image_data(preprocessed_folder, segmented_folder, relaxometry_folder, acquisition_file_names, info_file_names,
+                                                bone_mask_file_name, cart_mask_file_name, method_flag, registrationFlag)
 
                 # send to the data dictionary
                 all_image_data.append(image_data)
@@ -1186,6 +1235,251 @@ def load_image_data_fitting(input_file_name, method_flag, registrationFlag):
     return all_image_data
 
 
+# ---------------------------------------------------------------------------------------------------------------------------
+# NAMES OF EACH IMAGE -------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+# Functions used by the load_image_data_* functions and by cohort_manifest.py (they do not check that files exist)
+
+def preprocessing_image_data(original_folder, preprocessed_folder, image_folder_file_name, laterality):
+
+    """
+    Creates image_data of one image of preprocessing.ipynb
+    """
+
+    folder_div = folder_divider()
+
+    # create the dictionary
+    image_data = {}
+    # add inputs
+    image_data["original_folder"]        = original_folder
+    image_data["preprocessed_folder"]    = preprocessed_folder
+    image_data["image_folder_file_name"] = image_folder_file_name
+    image_data["laterality"]             = laterality
+    # add outputs
+    image_name_root = image_folder_file_name.replace(folder_div, "_")
+    image_data["image_name_root"]        = image_name_root
+    image_data["temp_file_name"]         = preprocessed_folder + image_data["image_name_root"] + "_temp.mha"
+    image_data["original_file_name"]     = preprocessed_folder + image_data["image_name_root"] + "_orig.mha"
+    image_data["preprocessed_file_name"] = preprocessed_folder + image_data["image_name_root"] + "_prep.mha"
+    image_data["info_file_name"]         = preprocessed_folder + image_data["image_name_root"] + "_orig.txt"
+
+    return image_data
+
+
+def segmentation_image_data(registration_type, reference_folder, reference_name, moving_folder, moving_name, registered_folder, segmented_folder):
+
+    """
+    Creates image_data of one image of segmentation.ipynb
+    """
+
+    # In the future, extensions for all knee cartilages
+    bone      = "f"
+    cartilage = "fc"
+
+    # current image in a struct to the registration class
+    reference_root, reference_ext = os.path.splitext(reference_name)
+    moving_root, moving_ext = os.path.splitext(moving_name)
+    image_data = {}
+    image_data["registration_type"]     = registration_type
+    image_data["cartilage"]             = cartilage
+    image_data["bone"]                  = bone
+    image_data["current_anatomy"]       = []
+    image_data["reference_folder"]      = reference_folder
+    image_data["reference_name"]        = reference_name
+    image_data["reference_root"]        = reference_root
+    image_data["moving_folder"]         = moving_folder
+    image_data["moving_name"]           = moving_name
+    image_data["moving_root"]           = moving_root
+    image_data["registered_folder"]     = registered_folder
+    image_data["segmented_folder"]      = segmented_folder
+    # previous visit of the same knee (longitudinal, see link_longitudinal_visits)
+    image_data["visit"]                          = 0
+    image_data["previous_registered_sub_folder"] = ""
+
+    # add extra filenames and paths
+    image_data = add_names_to_image_data(image_data,1)
+
+    return image_data
+
+
+def segmentation_ma_image_data(atlas_folder, atlas_names, moving_folder, moving_name, registered_folder, segmented_folder):
+
+    """
+    Creates image_data of one image of multi-atlas segmentation. The names of the fused masks are the ones of segmentation.ipynb
+    """
+
+    # In the future, extensions for all knee cartilages
+    bone      = "f"
+    cartilage = "fc"
+
+    moving_root, moving_ext = os.path.splitext(moving_name)
+    image_data = {}
+    image_data["cartilage"]             = cartilage
+    image_data["bone"]                  = bone
+    image_data["current_anatomy"]       = []
+    image_data["atlas_folder"]          = atlas_folder
+    image_data["atlas_names"]           = list(atlas_names) # all the atlases
+    image_data["selected_atlas_names"]  = []                # atlases used for the image (see segmentation_ma_for_nb.preselect_atlases)
+    image_data["atlas_weights"]         = []
+    image_data["moving_folder"]         = moving_folder
+    image_data["moving_name"]           = moving_name
+    image_data["moving_root"]           = moving_root
+    image_data["registered_folder"]     = registered_folder
+    image_data["segmented_folder"]      = segmented_folder
+    # fused masks
+    image_data[bone + "mask"]           = moving_root + "_" + bone + ".mha"
+    image_data[cartilage + "mask"]      = moving_root + "_" + cartilage + ".mha"
+    image_data["mask_crop_flag"]        = 0
+
+    return image_data
+
+
+def segmentation_quality_image_data(segmented_folder, ground_truth_folder, segmented_name, ground_truth_name):
+
+    """
+    Creates image_data of one image of segmentation_quality.ipynb
+    """
+
+    # put pair in a list
+    image_data = {}
+    image_data["segmented_folder"]         = segmented_folder
+    image_data["ground_truth_folder"]      = ground_truth_folder
+    image_data["segmented_name"]           = segmented_name
+    image_data["ground_truth_name"]        = ground_truth_name
+
+    return image_data
+
+
+def morphology_image_data(input_folder, morphology_folder, mask_name):
+
+    """
+    Creates image_data of one image of morphology.ipynb
+    """
+
+    # create the dictionary
+    image_data = {}
+    # input names
+    image_data["input_folder"]        = input_folder
+    image_data["mask_name"]           = mask_name
+    # output names
+    mask_name_root, mask_name_ext       = os.path.splitext(mask_name)
+    image_data["bone_cart_name"]      = mask_name_root + "_bone_cart.txt"
+    image_data["arti_cart_name"]      = mask_name_root + "_arti_cart.txt"
+    image_data["thickness_name"]      = []
+    image_data["thickness_flat_name"] = []
+    image_data["algorithm"]           = []
+    image_data["volume_name"]         = mask_name_root + "_volume.txt"
+    image_data["volume_table_name"]   = "volume_table.csv" # one table for all the masks in the morphology folder
+    image_data["morphology_folder"]   = morphology_folder
+    # for visualization
+    image_data["bone_cart_flat_name"] = mask_name_root + "_bone_cart_flat.txt"
+    image_data["arti_cart_flat_name"] = mask_name_root + "_arti_cart_flat.txt"
+    image_data["bone_phi_name"]       = mask_name_root + "_bone_phi.txt"
+    image_data["arti_phi_name"]       = mask_name_root + "_arti_phi.txt"
+    # all results in one binary file (see morphology_for_nb.compute_morphology)
+    image_data["morphology_bundle_name"] = mask_name_root + "_morphology.npz"
+
+    return image_data
+
+
+def EPG_image_data(preprocessed_folder, segmented_folder, relaxometry_folder, i1_file_name, i2_file_name, mask_file_name):
+
+    """
+    Creates image_data of one image of relaxometry_EPG.ipynb
+    """
+
+    image_name_root, image_ext = os.path.splitext(i1_file_name)
+    info_file_name             = image_name_root + ".txt"
+
+    # create the dictionary
+    image_data = {}
+    # add folders
+    image_data["preprocessed_folder"]   = preprocessed_folder
+    image_data["segmented_folder"]      = segmented_folder
+    image_data["relaxometry_folder"]    = relaxometry_folder
+    # add input file names
+    image_data["i1_file_name"]          = i1_file_name
+    image_data["i2_file_name"]          = i2_file_name
+    image_data["mask_file_name"]        = mask_file_name
+    image_data["info_file_name"]        = info_file_name
+    # add output file names
+    image_data["t2_map_file_name"]      = image_name_root + "_T2map.mha"
+    image_data["t2_map_mask_file_name"] = image_name_root + "_T2map_masked.mha"
+    # others
+    image_data["image_name_root"]       = image_name_root
+
+    return image_data
+
+
+def fitting_image_data(preprocessed_folder, segmented_folder, relaxometry_folder, acquisition_file_names, info_file_names,
+                       bone_mask_file_name, cart_mask_file_name, method_flag, registrationFlag):
+
+    """
+    Creates image_data of one image of relaxometry_fitting.ipynb
+    """
+
+    folder_div = folder_divider()
+
+    # create the dictionary
+    image_data = {}
+
+    # folders
+    image_data["preprocessed_folder"]    = preprocessed_folder
+    image_data["segmented_folder"]       = segmented_folder
+    image_data["relaxometry_folder"]     = relaxometry_folder
+
+    # input file names
+    image_data["acquisition_file_names"] = acquisition_file_names
+    image_data["info_file_names"]        = info_file_names
+    image_data["bone_mask_file_name"]    = bone_mask_file_name
+    image_data["cart_mask_file_name"]    = cart_mask_file_name
+
+    # fitting type
+    image_data["method_flag"]            = method_flag
+
+    # output file names
+    image_name_root, image_ext           = os.path.splitext(acquisition_file_names[0])
+    if registrationFlag == 1:
+        if method_flag == 0: # linear fitting
+            image_data["map_file_name"] = image_name_root + "_map_lin_aligned.mha"
+        elif method_flag == 1: # exponential fitting
+            image_data["map_file_name"] = image_name_root + "_map_exp_aligned.mha"
+    else:
+        if method_flag == 0: # linear fitting
+            image_data["map_file_name"] = image_name_root + "_map_lin.mha"
+        elif method_flag == 1: # exponential fitting
+            image_data["map_file_name"] = image_name_root + "_map_exp.mha"
+
+    # alignment: fixed variables for elastix_transformix.py
+    image_data["current_anatomy"]        = 'femurCart' #### to be parametrized in a later release
+    bone                               = "f"         #### to be parametrized in a later release
+    image_data["bone"]                  = bone
+    image_data["dilate_radius"]          = 15
+    registered_folder = os.path.split(preprocessed_folder)[0] # remove the slash or backslash
+    registered_folder = os.path.split(registered_folder)[0] # remove "original"
+    registered_folder = registered_folder + folder_div + "registered" + folder_div
+    image_data["registered_folder"]      = registered_folder
+    # parameter files
+    image_data["parameter_folder"]       = get_parameter_folder()
+    image_data["param_file_rigid"]       = "MR_param_rigid.txt"
+
+    # elastix path (from binaries in pykneer package)
+    dirpath = get_elastix_folder()
+    image_data["elastix_folder"]           = dirpath
+    image_data["complete_elastix_path"]     = dirpath + "elastix"
+    # alignment: image-dependent variables for elastix_transformix.py
+    image_data["reference_name"]                = image_data["acquisition_file_names"][0]
+    reference_root, image_ext                   = os.path.splitext(image_data["reference_name"] )
+    image_data["reference_root"]                = reference_root
+    image_data["mask_file_name"]                 = image_data["bone_mask_file_name"]
+    image_data[bone + "mask_file_name"]          = image_data["bone_mask_file_name"]
+    image_data[bone + "dil_mask_file_name"]       = image_data["reference_root"] + "_" + bone + "_" + str(image_data["dilate_radius"]) + ".mha"
+    image_data[bone + "levelset_mask_file_name"] = image_data["reference_root"] + "_" + bone + "_levelSet.mha"
+    image_data["moving_folder"]                 = image_data["preprocessed_folder"]
+
+    return image_data
+
+
 # ---------------------------------------------------------------------------------------------------------------------------
 # .TXT FILES  ---------------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
@@ -10,6 +10,7 @@ For each group there are functions to:
     - calculate fitting
     - show map, graph, and table of values
 For exponential and linear fitting, there is the option to rigidly register images acquired at different echo times 
+For both groups, statistics can be calculated in cartilage subregions (medial/lateral, anterior/central/posterior, deep/superficial)
     
 Functions are in pairs for parallelization. Example:
 align_acquisitions launches align_acquisitions_s as many times as the length of all_image_data (subtituting a for loop).
@@ -18,33 +19,39 @@ pool.map() takes care of sending one single element of the list all_image_data (
 """
 
 from datetime import datetime
-import matplotlib.pyplot as plt
 import multiprocessing
 import numpy as np
 import os
-import pandas as pd
 import platform
 import SimpleITK as sitk
 import shutil
 import time
 
-from ipywidgets import * # for display
-from ipywidgets import HBox, VBox
-from ipywidgets import interactive
-from ipywidgets import Layout
-from ipywidgets import widgets as widgets
-
+# plotting (matplotlib), tables (pandas), and widgets (ipywidgets) are imported in the functions that use them,
+# so that the processes of multiprocessing.Pool() start faster
 
 # pyKNEER imports 
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
 if __package__ is None or __package__ == '':
     # uses current directory visibility
+    import instrumentation       as instr
+    import lazy_image_io         as lio
     import relaxometry_functions as rf
+    import morphology_functions  as mf
+    import prefetch_io           as pio
+    import sitk_functions        as sitkf
+    import thumbnail_cache       as thc
     import elastix_transformix
 
 else:
     # uses current package visibility
+    from . import instrumentation       as instr
+    from . import lazy_image_io         as lio
     from . import relaxometry_functions as rf
+    from . import morphology_functions  as mf
+    from . import prefetch_io           as pio
+    from . import sitk_functions        as sitkf
+    from . import thumbnail_cache       as thc
     from . import elastix_transformix
 
 
@@ -54,6 +61,7 @@ else:
 
 # --- OPTIONAL ALIGNMENT ----------------------------------------------------------------------------------------------------
 
+@instr.timed
 def align_acquisitions_s(image_data):
     """
     Function for images acquired subsequently, at different echo times.
@@ -176,6 +184,7 @@ def align_acquisitions(all_image_data, n_of_processes):
 
 
 # --- CALCULATE FITTING -----------------------------------------------------------------------------------------------------
+@instr.timed
 def calculate_fitting_maps_s(image_data):
 
 
@@ -202,8 +211,8 @@ def calculate_fitting_maps_s(image_data):
             if "0018|0081" in line:
                 tsl.append(float(line[10:len(line)]))
 
-    # read the mask
-    mask = sitk.ReadImage(segmented_folder + mask_file_name)
+    # read the mask (prefetched in calculate_fitting_maps)
+    mask = pio.read_mask(segmented_folder + mask_file_name)
     # from SimpleITK to numpy
     mask_py = sitk.GetArrayFromImage(mask)
     # rotate mask to be compatible with flat bone surface for visualization later
@@ -220,7 +229,7 @@ def calculate_fitting_maps_s(image_data):
 
     for a in range(0, len(acquisition_file_names)):
         # read image
-        img = sitk.ReadImage(preprocessed_folder + acquisition_file_names[a])
+        img = pio.read_image(preprocessed_folder + acquisition_file_names[a])
         # from SimpleITK to numpy
         img_py = sitk.GetArrayFromImage(img)
         # rotate images to be compatible with flat bone surface for visualization later
@@ -257,8 +266,17 @@ def calculate_fitting_maps_s(image_data):
     fitting_map.SetDirection(mask.GetDirection())
     fitting_map = sitk.Cast(fitting_map,sitk.sitkInt16)
 
-    # write map
-    sitk.WriteImage(fitting_map, (map_folder + map_file_name))
+    # write map (in background in calculate_fitting_maps) and save thumbnail for visualization
+    pio.write_image(fitting_map, (map_folder + map_file_name), True, # compressed
+                    lambda: thc.save_overlay_thumbnail(preprocessed_folder + acquisition_file_names[0], map_folder + map_file_name, None, sitk.GetArrayViewFromImage(fitting_map)))
+
+def fitting_input_files(image_data):
+
+    # images read by calculate_fitting_maps_s
+    file_names = [image_data["preprocessed_folder"] + file_name for file_name in image_data["acquisition_file_names"]]
+    file_names.append(image_data["segmented_folder"] + image_data["cart_mask_file_name"])
+
+    return file_names
 
 def calculate_fitting_maps(all_image_data, n_of_processes):
 
@@ -269,8 +287,7 @@ def calculate_fitting_maps(all_image_data, n_of_processes):
         print ('-> using exponential fitting ')
 
     start_time = time.time()
-    pool = multiprocessing.Pool(processes=n_of_processes)
-    pool.map(calculate_fitting_maps_s, all_image_data)
+    pio.map_with_prefetch(calculate_fitting_maps_s, fitting_input_files, all_image_data, n_of_processes)
     print ("-> Fitting maps calculated")
     print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
 
@@ -278,6 +295,8 @@ def calculate_fitting_maps(all_image_data, n_of_processes):
 
 # --- VISUALIZE FITTING -----------------------------------------------------------------------------------------------------
 def show_fitting_maps (image_data, view_modality):
+
+    from ipywidgets import interactive
     
     if view_modality == 0:
         show_fitting_maps_static(image_data)
@@ -292,6 +311,8 @@ def show_fitting_maps (image_data, view_modality):
 
 def show_fitting_maps_static(all_image_data):
 
+    import matplotlib.pyplot as plt
+
     n_of_images  = len(all_image_data)
     img_LW       = 6
     figure_width = img_LW * 3
@@ -313,31 +334,12 @@ def show_fitting_maps_static(all_image_data):
         map_file_name       = all_image_data[i]["map_file_name"]
         image_name_root, image_ext = os.path.splitext(i1_file_name)
 
-        # read images
-        img  = sitk.ReadImage(preprocessed_folder + i1_file_name)
-        map_ = sitk.ReadImage(map_folder + map_file_name)
-
-        # images from simpleitk to numpy
-        img_py = sitk.GetArrayFromImage(img)
-        map_py = sitk.GetArrayFromImage(map_)
-
-
-        # extract slices at 2/5, 3/5 and 4/3 of the image size
-        size = np.size(map_py,2)
-        # get the first slice of the mask in the sagittal direction
-        for b in range(0,int(size/2)):
-            slice = map_py[:,:,b]
-            if np.sum(slice) != 0:
-                first_value = b
-                break
-        # get the last slice of the mask in the sagittal direction
-        for b in range(size-1,int(size/2),-1):
-            slice = map_py[:,:,b]
-            if np.sum(slice) != 0:
-                last_value = b
-                break
-        slice_step = int ((last_value-first_value)/4)
-        slice_ID   = (first_value + slice_step, first_value + 2*slice_step, first_value + 3*slice_step)
+        # get slices at 1/4, 2/4, and 3/4 of the map extent from the thumbnail cache
+        thumbnail = thc.get_overlay_thumbnail(preprocessed_folder + i1_file_name, map_folder + map_file_name)
+        if thumbnail is None:
+            axis_index = axis_index + 3
+            continue
+        slice_ID  = thumbnail["slice_ID"]
 
         # show slices with maps
         for a in range (0,len(slice_ID)):
@@ -346,8 +348,8 @@ def show_fitting_maps_static(all_image_data):
             ax1 = fig.add_subplot(n_of_rows,n_of_columns,axis_index)
 
             # get slices
-            slice_img_py = img_py[:,:,slice_ID[a]]
-            slice_map_py = map_py[:,:,slice_ID[a]]
+            slice_img_py = thumbnail["image_slices"][a]
+            slice_map_py = thumbnail["overlay_slices"][a]
             slice_map_masked = np.ma.masked_where(slice_map_py == 0, slice_map_py)
 
             # show image
@@ -363,6 +365,9 @@ def show_fitting_maps_static(all_image_data):
 
 
 def browse_images(moving_py, mask_py, ax_i, fig, moving_root, last_value, sliceID):
+
+    import matplotlib.pyplot as plt
+    from ipywidgets import HBox, VBox, interactive, Layout, widgets
     
     # The code in this function has to be separate. If code directly into show_segmented_images, when using widgets, they update the last image
     
@@ -428,7 +433,10 @@ def browse_images(moving_py, mask_py, ax_i, fig, moving_root, last_value, sliceI
 
 def show_fitting_maps_interactive(all_image_data):
 
-    for i in range(0, len(all_image_data)):
+    import matplotlib.pyplot as plt
+
+    # create the figure of one image when it is selected
+    def show_subject(i):
 
         # get paths and file names of the current image
         preprocessed_folder = all_image_data[i]["preprocessed_folder"]
@@ -437,31 +445,14 @@ def show_fitting_maps_interactive(all_image_data):
         map_file_name       = all_image_data[i]["map_file_name"]
         image_name_root, image_ext = os.path.splitext(i1_file_name)
 
-        # read images
-        img  = sitk.ReadImage(preprocessed_folder + i1_file_name)
-        map_ = sitk.ReadImage(map_folder + map_file_name)
+        # access images on demand (slices are read from disk when displayed)
+        img_py = lio.lazy_image(preprocessed_folder + i1_file_name)
+        map_py = lio.lazy_image(map_folder + map_file_name)
 
-        # images from simpleitk to numpy
-        img_py = sitk.GetArrayFromImage(img)
-        map_py = sitk.GetArrayFromImage(map_)
-
-
-        # extract slices at 2/5, 3/5 and 4/3 of the image size
-        size = np.size(map_py,2)
-        # get the first slice of the mask in the sagittal direction
-        for b in range(0,int(size/2)):
-            slice = map_py[:,:,b]
-            if np.sum(slice) != 0:
-                first_value = b
-                break
-        # get the last slice of the mask in the sagittal direction
-        for b in range(size-1,int(size/2),-1):
-            slice = map_py[:,:,b]
-            if np.sum(slice) != 0:
-                last_value = b
-                break
-        slice_step = int ((last_value-first_value)/4)
-        slice_ID   = (first_value + slice_step, first_value + 2*slice_step, first_value + 3*slice_step)
+        # extract slices at 1/4, 2/4, and 3/4 of the map extent in the sagittal direction
+        first_value, last_value, slice_ID = lio.find_mask_slices(map_py)
+        if slice_ID is None:
+            return None
 
         # create figure
         plt.rcParams['figure.figsize'] = [20, 15]  
@@ -487,18 +478,17 @@ def show_fitting_maps_interactive(all_image_data):
             
         # interactive image
         ax_i = ax[0]
-        if i == 0:
-            final_box = browse_images(img_py, map_py, ax_i, fig, image_name_root, last_value, slice_ID)
-        else:
-            new_box = browse_images(img_py, map_py, ax_i, fig, image_name_root, last_value, slice_ID)
-            final_box = VBox([final_box,new_box]);   
-            
-    return final_box
+        return browse_images(img_py, map_py, ax_i, fig, image_name_root, last_value, slice_ID)
+
+    # one image at a time
+    return lio.browse_subjects([os.path.splitext(image_data["acquisition_file_names"][0])[0] for image_data in all_image_data], show_subject)
 
 
 
 def show_fitting_graph(all_image_data):
 
+    import matplotlib.pyplot as plt
+
     # calculate average and standard deviation
     average = []
     std_dev  = []
@@ -548,6 +538,8 @@ def show_fitting_graph(all_image_data):
 
 def show_fitting_table(all_image_data, output_file_name):
 
+    import pandas as pd
+
     # read and calculate values for table
     image_names = []
     average     = []
@@ -600,6 +592,7 @@ def show_fitting_table(all_image_data, output_file_name):
 # T2 USING EPG MODELING FROM DESS ACQUISITIONS ------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
 
+@instr.timed
 def calculate_t2_maps_s(image_data):
 
 
@@ -629,34 +622,43 @@ def calculate_t2_maps_s(image_data):
         if "0018|1314" in line:
             alpha_deg_L     = float(line[10:len(line)]) #alpha_deg_L = flipAngle
 
-    # read images
-    img_1L = sitk.ReadImage(preprocessed_folder + i1_file_name)
-    img_2L = sitk.ReadImage(preprocessed_folder + i2_file_name)
-    mask   = sitk.ReadImage(segmented_folder    + mask_file_name)
+    # read images (prefetched in calculate_t2_maps)
+    img_1L = pio.read_image(preprocessed_folder + i1_file_name)
+    img_2L = pio.read_image(preprocessed_folder + i2_file_name)
+    mask   = pio.read_mask (segmented_folder    + mask_file_name)
 
     # compute T2 map
     t2_map = rf.calculate_t2_maps_from_dess(img_1L, img_2L, repetition_time, echo_time, alpha_deg_L)
 
-    # write T2 map
-    sitk.WriteImage(t2_map, relaxometry_folder + t2_map_file_name)
+    # write T2 map (in background in calculate_t2_maps)
+    pio.write_image(t2_map, relaxometry_folder + t2_map_file_name, True) # compressed
 
     # mask T2 map
     masked_map = rf.mask_map(t2_map, mask)
 
-    # write masked T2 map
-    sitk.WriteImage(masked_map, relaxometry_folder + t2_map_mask_file_name)
+    # write masked T2 map and save thumbnail for visualization
+    pio.write_image(masked_map, relaxometry_folder + t2_map_mask_file_name, True, # compressed
+                    lambda: thc.save_overlay_thumbnail(preprocessed_folder + i1_file_name, relaxometry_folder + t2_map_mask_file_name, sitk.GetArrayViewFromImage(img_1L), sitk.GetArrayViewFromImage(masked_map)))
+
+def t2_input_files(image_data):
+
+    # images read by calculate_t2_maps_s
+    return [image_data["preprocessed_folder"] + image_data["i1_file_name"],
+            image_data["preprocessed_folder"] + image_data["i2_file_name"],
+            image_data["segmented_folder"]    + image_data["mask_file_name"]]
 
 def calculate_t2_maps(all_image_data, n_of_processes):
 
     start_time = time.time()
-    pool = multiprocessing.Pool(processes=n_of_processes)
-    pool.map(calculate_t2_maps_s, all_image_data)
+    pio.map_with_prefetch(calculate_t2_maps_s, t2_input_files, all_image_data, n_of_processes)
     print ("-> T2 maps calculated")
     print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
 
 
 
 def show_t2_maps (image_data, view_modality):
+
+    from ipywidgets import interactive
     
     if view_modality == 0:
         show_t2_maps_static(image_data)
@@ -672,6 +674,8 @@ def show_t2_maps (image_data, view_modality):
 
 def show_t2_maps_static(all_image_data):
 
+    import matplotlib.pyplot as plt
+
     n_of_images   = len(all_image_data)
     img_LW        = 6
     figure_width  = img_LW * 3
@@ -694,32 +698,12 @@ def show_t2_maps_static(all_image_data):
         t2_map_mask_file_name = all_image_data[i]["t2_map_mask_file_name"]
         image_name_root       = all_image_data[i]["image_name_root"]
 
-        # read images
-        img = sitk.ReadImage(preprocessed_folder + i1_file_name)
-        map = sitk.ReadImage(relaxometry_folder  + t2_map_mask_file_name)
-
-        # images from simpleitk to numpy
-        img_py = sitk.GetArrayFromImage(img)
-        map_py = sitk.GetArrayFromImage(map)
-
-
-        # extract slices at 2/5, 3/5, and 4/5 of the image size
-        size = np.size(map_py,2)
-        # get the first slice of the mask in the sagittal direction
-        for b in range(0,int(size/2)):
-            slice = map_py[:,:,b]
-            if np.sum(slice) != 0:
-                first_value = b
-                break
-        # get the last slice of the mask in the sagittal direction
-        for b in range(size-1,int(size/2),-1):
-            slice = map_py[:,:,b]
-            if np.sum(slice) != 0:
-                last_value = b
-                break
-
-        slice_step = int ((last_value-first_value)/4)
-        slice_ID   = (first_value + slice_step, first_value + 2*slice_step, first_value + 3*slice_step)
+        # get slices at 1/4, 2/4, and 3/4 of the map extent from the thumbnail cache
+        thumbnail = thc.get_overlay_thumbnail(preprocessed_folder + i1_file_name, relaxometry_folder + t2_map_mask_file_name)
+        if thumbnail is None:
+            axis_index = axis_index + 3
+            continue
+        slice_ID  = thumbnail["slice_ID"]
 
         for a in range (0,len(slice_ID)):
 
@@ -727,8 +711,8 @@ def show_t2_maps_static(all_image_data):
             ax1 = fig.add_subplot(n_of_rows,n_of_columns,axis_index)
 
             # get slices
-            slice_img_py = img_py[:,:,slice_ID[a]]
-            slice_map_py = map_py[:,:,slice_ID[a]]
+            slice_img_py = thumbnail["image_slices"][a]
+            slice_map_py = thumbnail["overlay_slices"][a]
             slice_map_masked = np.ma.masked_where(slice_map_py == 0, slice_map_py)
 
             # show image
@@ -745,7 +729,10 @@ def show_t2_maps_static(all_image_data):
 
 def show_t2_maps_interactive(all_image_data):
 
-    for i in range(0, len(all_image_data)):
+    import matplotlib.pyplot as plt
+
+    # create the figure of one image when it is selected
+    def show_subject(i):
 
         # get paths and file names of the current image
         preprocessed_folder   = all_image_data[i]["preprocessed_folder"]
@@ -754,32 +741,14 @@ def show_t2_maps_interactive(all_image_data):
         t2_map_mask_file_name = all_image_data[i]["t2_map_mask_file_name"]
         image_name_root       = all_image_data[i]["image_name_root"]
 
-        # read images
-        img = sitk.ReadImage(preprocessed_folder + i1_file_name)
-        map = sitk.ReadImage(relaxometry_folder  + t2_map_mask_file_name)
+        # access images on demand (slices are read from disk when displayed)
+        img_py = lio.lazy_image(preprocessed_folder + i1_file_name)
+        map_py = lio.lazy_image(relaxometry_folder  + t2_map_mask_file_name)
 
-        # images from simpleitk to numpy
-        img_py = sitk.GetArrayFromImage(img)
-        map_py = sitk.GetArrayFromImage(map)
-
-
-        # extract slices at 2/5, 3/5, and 4/5 of the image size
-        size = np.size(map_py,2)
-        # get the first slice of the mask in the sagittal direction
-        for b in range(0,int(size/2)):
-            slice = map_py[:,:,b]
-            if np.sum(slice) != 0:
-                first_value = b
-                break
-        # get the last slice of the mask in the sagittal direction
-        for b in range(size-1,int(size/2),-1):
-            slice = map_py[:,:,b]
-            if np.sum(slice) != 0:
-                last_value = b
-                break
-
-        slice_step = int ((last_value-first_value)/4)
-        slice_ID   = (first_value + slice_step, first_value + 2*slice_step, first_value + 3*slice_step)
+        # extract slices at 1/4, 2/4, and 3/4 of the map extent in the sagittal direction
+        first_value, last_value, slice_ID = lio.find_mask_slices(map_py)
+        if slice_ID is None:
+            return None
 
         # create figure
         plt.rcParams['figure.figsize'] = [20, 15]  
@@ -805,17 +774,16 @@ def show_t2_maps_interactive(all_image_data):
             
         # interactive image
         ax_i = ax[0]
-        if i == 0:
-            final_box = browse_images(img_py, map_py, ax_i, fig, image_name_root, last_value, slice_ID)
-        else:
-            new_box = browse_images(img_py, map_py, ax_i, fig, image_name_root, last_value, slice_ID)
-            final_box = VBox([final_box,new_box]);   
-            
-    return final_box
+        return browse_images(img_py, map_py, ax_i, fig, image_name_root, last_value, slice_ID)
+
+    # one image at a time
+    return lio.browse_subjects([image_data["image_name_root"] for image_data in all_image_data], show_subject)
 
 
 def show_t2_graph(all_image_data):
 
+    import matplotlib.pyplot as plt
+
     # calculate average and standard deviation
     average = []
     std_dev  = []
@@ -865,6 +833,8 @@ def show_t2_graph(all_image_data):
 
 def show_t2_table(all_image_data, output_file_name):
 
+    import pandas as pd
+
     # read and calculate values for table
     image_names = []
     average     = []
@@ -916,5 +886,92 @@ def show_t2_table(all_image_data, output_file_name):
 
 
 
+# ---------------------------------------------------------------------------------------------------------------------------
+# STATISTICS IN CARTILAGE SUBREGIONS ----------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
 
-    
+@instr.timed
+def calculate_regional_statistics_s(image_data):
+
+    """
+    Calculates average, standard deviation, and percentiles of the map in each cartilage subregion and in the whole cartilage
+    Works for both exponential and linear fitting maps and for T2 maps from EPG modeling
+    Returns a table with one row per subregion
+    """
+
+    import pandas as pd
+
+    percentiles = [25, 50, 75]
+
+    # get fileNames
+    if "map_file_name" in image_data: # exponential and linear fitting
+        map_file_name         = image_data["relaxometry_folder"] + image_data["map_file_name"]
+        mask_file_name        = image_data["segmented_folder"]   + image_data["cart_mask_file_name"]
+        image_root, image_ext = os.path.splitext(image_data["map_file_name"])
+    else: # T2 from EPG modeling
+        map_file_name         = image_data["relaxometry_folder"] + image_data["t2_map_mask_file_name"]
+        mask_file_name        = image_data["segmented_folder"]   + image_data["mask_file_name"]
+        image_root            = image_data["image_name_root"]
+
+    print (image_root)
+
+    # read the map and the mask
+    map_py = sitk.GetArrayFromImage(sitk.ReadImage(map_file_name))
+    mask   = sitkf.read_mask(mask_file_name)
+
+    # label map of the subregions
+    labels    = mf.cartilage_subregions(mask)
+    labels_py = sitk.GetArrayFromImage(labels)
+    names     = mf.subregion_names()
+
+    # statistics in the subregions and in the whole cartilage
+    count, average, std_dev, percentile_values = rf.regional_statistics(map_py, labels_py, len(names), percentiles)
+    count_all, average_all, std_dev_all, percentile_values_all = rf.regional_statistics(map_py, labels_py > 0, 1, percentiles)
+
+    # create table
+    table = pd.DataFrame(
+        {
+            "subjects"    : image_root,
+            "region"      : names + ["all"],
+            "n_of_voxels" : np.append(count,   count_all),
+            "average"     : np.append(average, average_all),
+            "std_dev"     : np.append(std_dev, std_dev_all)
+        }
+    )
+    for p in range(0, len(percentiles)):
+        table["percentile_" + str(percentiles[p])] = np.append(percentile_values[p], percentile_values_all[p])
+
+    return table
+
+def calculate_regional_statistics(all_image_data, n_of_processes):
+
+    import pandas as pd
+
+    start_time = time.time()
+    pool = multiprocessing.Pool(processes=n_of_processes)
+    all_tables = pool.map(calculate_regional_statistics_s, all_image_data)
+    print ("-> Regional statistics calculated")
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+    # one table for all subjects
+    table = pd.concat(all_tables, ignore_index=True)
+
+    return table
+
+
+def show_regional_table(table, output_file_name):
+
+    import pandas as pd
+
+    table.index = np.arange(1,len(table)+1) # First ID column starting from 1
+    table = table.round(2) #show 2 decimals
+
+    # show all the lines of the table
+    data_dimension = table.shape # get number of rows
+    pd.set_option("display.max_rows",data_dimension[0]) # show all the rows
+
+    # save table as csv
+    table.to_csv(output_file_name,  index = False)
+    print("Table saved as: " + output_file_name)
+
+    return table
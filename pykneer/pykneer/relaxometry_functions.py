@@ -6,14 +6,15 @@ They are separeted in:
     - Functions to calculate linear fitting
     - Functions to calculate exponential fitting
     - Functions to calculate T2 using EPG modeling
+    - Functions to calculate statistics in cartilage subregions
 """
 
 import math
 import numpy     as np
-import scipy as sp
-import scipy.optimize
 import SimpleITK as sitk
 
+# scipy is imported in the function that uses it, so that the module is imported faster
+
 
 #    #small example for testing
 #    # linear fitting
@@ -102,6 +103,8 @@ def calculate_fitting_maps_exp(tsl, list_of_arrays):
     list_of_arrays is a list of n arrays, where each array contains an image (transformed from matrix to array)
     '''
 
+    import scipy.optimize
+
     # initialize the parameters for the function exp_func
     A_0 = 10  # parameters used in exp_func
     K_0 = 0.1 # parameters used in exp_func
@@ -129,7 +132,7 @@ def calculate_fitting_maps_exp(tsl, list_of_arrays):
             #param_bounds = ((0.00001, -np.inf),(np.inf, np.inf)) # ((lower_bound_A_0, lower_bound_K_0), (upper_bound_A_0, upper_bound_K_0))
             #param_exp, param_cov = sp.optimize.curve_fit(exp_func, tsl, y, bounds=param_bounds, method = 'dogbox')
             # it is
-            param_exp, param_cov = sp.optimize.curve_fit(exp_func, tsl, y)
+            param_exp, param_cov = scipy.optimize.curve_fit(exp_func, tsl, y)
 
         except RuntimeError:
             #print("Error - curve_fit failed for values: " +  str(array1[i]) + " " +  str(array2[i]) + " " + str(array3[i]) + " " + str(array4[i]) +
@@ -245,3 +248,55 @@ def mask_map(T2_map, mask):
     masked_map = sitk.Cast(masked_map,sitk.sitkInt16)
 
     return masked_map
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# STATISTICS IN CARTILAGE SUBREGIONS ----------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def regional_statistics(map_py, labels_py, n_of_labels, percentiles):
+
+    '''
+    function to calculate average, standard deviation, and percentiles of a map in each label of a label map in one pass
+    map_py and labels_py are numpy arrays of the same size. Labels go from 1 to n_of_labels (0 is background)
+    percentiles is a list of percentiles (between 0 and 100). Percentiles are linearly interpolated as in np.percentile
+    As in the tables of whole cartilage, voxels where the map is 0 are not considered
+    Returns count, average, std_dev (arrays of length n_of_labels) and percentile_values (n_of_percentiles x n_of_labels)
+    Labels without voxels have count 0 and nan statistics
+    '''
+
+    # get only labelled and non zero values
+    map_py    = np.ravel(map_py)
+    labels_py = np.ravel(labels_py)
+    index     = np.where((labels_py > 0) & (map_py != 0))
+    values    = map_py[index].astype(float)
+    labels    = labels_py[index].astype(np.intp)
+
+    # count, sum, and sum of squares per label
+    count   = np.bincount(labels,                 minlength=n_of_labels+1)[1:]
+    total   = np.bincount(labels, weights=values,    minlength=n_of_labels+1)[1:]
+    total_2 = np.bincount(labels, weights=values**2, minlength=n_of_labels+1)[1:]
+
+    # average and standard deviation (population, as np.std)
+    with np.errstate(invalid='ignore', divide='ignore'): # labels without voxels
+        average  = total / count
+        variance = total_2 / count - average**2
+    variance[variance < 0] = 0 # rounding errors
+    std_dev  = np.sqrt(variance)
+
+    # percentiles: sort values by label and then by value, so that each label is a contiguous sorted segment
+    order  = np.lexsort((values, labels))
+    values = values[order]
+    start  = np.concatenate(([0], np.cumsum(count)[:-1]))
+    percentile_values = np.full((len(percentiles), n_of_labels), np.nan)
+    has_values = count > 0
+    for p in range(0, len(percentiles)):
+        # position of the percentile in each segment
+        position = start[has_values] + percentiles[p] / 100 * (count[has_values] - 1)
+        lower    = np.floor(position).astype(np.intp)
+        upper    = np.ceil (position).astype(np.intp)
+        weight   = position - lower
+        percentile_values[p, has_values] = values[lower] * (1 - weight) + values[upper] * weight
+
+    return count, average, std_dev, percentile_values
@@ -0,0 +1,441 @@
+# Serena Bonaretti, 2018
+
+"""
+Module with the functions of multi-atlas segmentation. Each image is segmented with the k atlases most similar to it,
+and the k warped masks are fused into one mask.
+
+There are four steps:
+    - preselecting atlases: atlases and images are downsampled to a small grid of normalized intensities (the atlas index,
+      computed once and saved in the atlas folder). The similarity of an image to all the atlases (normalized cross correlation)
+      is one matrix product, so only k << N atlases are registered to each image
+    - preparing atlases: the masks of the preselected atlases are dilated and transformed to level sets (as the reference in
+      segmentation_sa_for_nb.py)
+    - segmenting with atlases: each pair of image and preselected atlas is segmented as "newsubject" with the functions of
+      segmentation_sa_for_nb.py. All the pairs run in parallel
+    - fusing labels: the warped masks are fused by majority voting or by voting weighted by the atlas similarity
+
+The preselected atlases and their similarities are saved in registered/<image>_atlases.txt, so that the later steps can run
+in another session (e.g. pykneer segmentation_ma --stages fuse_labels). The fused masks have the same names as the masks of segmentation_sa_for_nb.py, so they can be visualized with show_segmented_images
+and used by morphology and relaxometry. The masks of each atlas are in the folder registered/<atlas>/
+
+Functions:
+    - image_features
+    - load_atlas_index
+    - build_atlas_index
+    - preselect_atlases
+    - load_selected_atlases
+    - atlas_image_data
+    - prepare_atlases
+    - segment_with_atlases
+    - fuse_masks
+    - fuse_labels
+"""
+
+import multiprocessing
+import numpy as np
+import os
+import SimpleITK as sitk
+import time
+
+# pyKNEER imports
+# ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
+if __package__ is None or __package__ == '':
+    # uses current directory visibility
+    import instrumentation        as instr
+    import elastix_transformix
+    import prefetch_io            as pio
+    import pykneer_io             as io
+    import segmentation_sa_for_nb as sa
+    import sitk_functions         as sitkf
+    import thumbnail_cache        as thc
+else:
+    # uses current package visibility
+    from . import instrumentation        as instr
+    from . import elastix_transformix
+    from . import prefetch_io            as pio
+    from . import pykneer_io             as io
+    from . import segmentation_sa_for_nb as sa
+    from . import sitk_functions         as sitkf
+    from . import thumbnail_cache        as thc
+
+
+# atlas index (in the atlas folder) and size of the downsampled images (sitk order)
+atlas_index_file_name = "atlas_index.npz"
+index_size            = (24, 24, 24)
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# ATLAS INDEX ---------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def image_features(file_name, size=index_size):
+
+    """
+    Downsamples the image to a grid of size voxels covering the whole image (after smoothing, to avoid aliasing) and normalizes
+    the intensities to zero mean and unit norm, so that the normalized cross correlation of two images is the dot product of their features
+    """
+
+    img     = sitk.Cast(sitk.ReadImage(file_name), sitk.sitkFloat32)
+    factor  = [img.GetSize()[a] / float(size[a]) for a in range(0, 3)]
+    spacing = [img.GetSpacing()[a] * factor[a] for a in range(0, 3)]
+
+    # first voxel of the grid is the center of the first block of factor voxels
+    origin = img.TransformContinuousIndexToPhysicalPoint([(factor[a] - 1) / 2.0 for a in range(0, 3)])
+    img    = sitk.SmoothingRecursiveGaussian(img, [s / 2.0 for s in spacing])
+    img    = sitk.Resample(img, list(size), sitk.Transform(), sitk.sitkLinear, origin, spacing, img.GetDirection(), 0.0, sitk.sitkFloat32)
+
+    # normalize
+    features = sitk.GetArrayFromImage(img).ravel()
+    features = features - np.mean(features)
+    norm     = np.linalg.norm(features)
+    if norm > 0:
+        features = features / norm
+
+    return features.astype(np.float32)
+
+
+def file_stamp(file_name):
+
+    # modification time and size, to know if the features of an atlas must be computed again
+    status = os.stat(file_name)
+    return [status.st_mtime_ns, status.st_size]
+
+
+def load_atlas_index(file_name):
+
+    """
+    Loads the atlas index written by build_atlas_index. Returns None if it does not exist
+    """
+
+    if not os.path.isfile(file_name):
+        return None
+
+    with np.load(file_name) as f:
+        index = {}
+        index["atlas_names"] = [str(name) for name in f["atlas_names"]]
+        index["stamps"]      = f["stamps"].tolist()
+        index["features"]    = f["features"]
+        index["size"]        = tuple(f["size"].tolist())
+
+    return index
+
+
+def build_atlas_index(all_image_data, n_of_processes):
+
+    """
+    Computes the features of the atlases (see image_features) and saves them in atlas_index.npz in the atlas folder
+    Features of the atlases that did not change since the previous index are not computed again
+    """
+
+    start_time      = time.time()
+    atlas_folder    = all_image_data[0]["atlas_folder"]
+    atlas_names     = all_image_data[0]["atlas_names"]
+    index_file_name = atlas_folder + atlas_index_file_name
+
+    # features in the previous index
+    stamps   = [file_stamp(atlas_folder + atlas_name) for atlas_name in atlas_names]
+    features = [None] * len(atlas_names)
+    index    = load_atlas_index(index_file_name)
+    if index is not None and index["size"] == tuple(index_size):
+        previous = dict(zip(index["atlas_names"], range(0, len(index["atlas_names"]))))
+        for a in range(0, len(atlas_names)):
+            p = previous.get(atlas_names[a])
+            if p is not None and index["stamps"][p] == stamps[a]:
+                features[a] = index["features"][p]
+
+    # features of new or modified atlases
+    missing = [a for a in range(0, len(atlas_names)) if features[a] is None]
+    if len(missing) > 0:
+        pool = multiprocessing.Pool(processes=n_of_processes)
+        missing_features = pool.map(image_features, [atlas_folder + atlas_names[a] for a in missing])
+        pool.close()
+        pool.join()
+        for a in range(0, len(missing)):
+            features[missing[a]] = missing_features[a]
+
+    # write the index (to a temporary file first, so that an interrupted write does not leave a broken index)
+    temp_file_name = index_file_name + ".tmp.npz"
+    np.savez(temp_file_name, atlas_names=np.array(atlas_names), stamps=np.array(stamps, dtype=np.int64),
+             features=np.array(features, dtype=np.float32), size=np.array(index_size))
+    os.replace(temp_file_name, index_file_name)
+
+    print ("-> Atlas index of %d atlases (%d computed)" % (len(atlas_names), len(missing)))
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# PRESELECTING ATLASES ------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def preselect_atlases(all_image_data, n_of_atlases, n_of_processes):
+
+    """
+    Selects the n_of_atlases atlases with the highest normalized cross correlation to each image, using the atlas index
+    (built or updated if it is missing or if it does not contain the atlases). An image is not selected as atlas of itself
+    """
+
+    start_time      = time.time()
+    atlas_folder    = all_image_data[0]["atlas_folder"]
+    atlas_names     = all_image_data[0]["atlas_names"]
+    index_file_name = atlas_folder + atlas_index_file_name
+
+    index = load_atlas_index(index_file_name)
+    if index is None or index["atlas_names"] != atlas_names or index["size"] != tuple(index_size):
+        build_atlas_index(all_image_data, n_of_processes)
+        index = load_atlas_index(index_file_name)
+
+    # features of the images
+    pool = multiprocessing.Pool(processes=n_of_processes)
+    image_features_all = pool.map(image_features, [image_data["moving_folder"] + image_data["moving_name"] for image_data in all_image_data])
+    pool.close()
+    pool.join()
+
+    # similarity of all images to all atlases
+    scores = np.dot(np.array(image_features_all), index["features"].T)
+    for i in range(0, len(all_image_data)):
+        for a in range(0, len(atlas_names)):
+            if atlas_names[a] == all_image_data[i]["moving_name"]:
+                scores[i, a] = -np.inf
+
+    # best atlases (in decreasing similarity)
+    n_of_atlases = min(n_of_atlases, len(atlas_names))
+    for i in range(0, len(all_image_data)):
+        best = np.argsort(-scores[i])[0:n_of_atlases]
+        best = [a for a in best if np.isfinite(scores[i, a])]
+        all_image_data[i]["selected_atlas_names"] = [atlas_names[a] for a in best]
+        all_image_data[i]["atlas_weights"]        = [float(scores[i, a]) for a in best]
+        write_selected_atlases(all_image_data[i])
+
+    print ("-> %d atlases selected for each image" % (n_of_atlases))
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+
+def selected_atlases_file_name(image_data):
+
+    # preselected atlases of one image and their similarities
+    return image_data["registered_folder"] + image_data["moving_root"] + "_atlases.txt"
+
+
+def write_selected_atlases(image_data):
+
+    f = open(selected_atlases_file_name(image_data), "w")
+    for a in range(0, len(image_data["selected_atlas_names"])):
+        f.write("%s %.6f\n" % (image_data["selected_atlas_names"][a], image_data["atlas_weights"][a]))
+    f.close()
+
+
+def load_selected_atlases(all_image_data):
+
+    """
+    Reads the atlases saved by preselect_atlases for the images without selected atlases (e.g. when the steps run in separate sessions)
+    Returns False if the atlases of an image were not preselected
+    """
+
+    for image_data in all_image_data:
+        if len(image_data["selected_atlas_names"]) > 0:
+            continue
+        file_name = selected_atlases_file_name(image_data)
+        if not os.path.isfile(file_name):
+            print("----------------------------------------------------------------------------------------")
+            print("ERROR: The atlases of %s are not preselected. Run preselect_atlases first" % (image_data["moving_name"]) )
+            print("----------------------------------------------------------------------------------------")
+            return False
+        for line in open(file_name):
+            values = line.split()
+            if len(values) == 2:
+                image_data["selected_atlas_names"].append(values[0])
+                image_data["atlas_weights"].append(float(values[1]))
+
+    return True
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# SEGMENTING WITH ATLASES ---------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def atlas_folder_name(image_data, atlas_name):
+
+    # folder of the registrations and of the masks of one atlas
+    atlas_root, atlas_ext = os.path.splitext(atlas_name)
+    return image_data["registered_folder"] + atlas_root + io.folder_divider()
+
+
+def atlas_image_data(image_data, atlas_name):
+
+    """
+    Creates the image_data of segmentation_sa_for_nb.py ("newsubject") to segment the image with one atlas
+    """
+
+    folder     = atlas_folder_name(image_data, atlas_name)
+    pair_data  = io.segmentation_image_data("newsubject", image_data["atlas_folder"], atlas_name, image_data["moving_folder"],
+                                            image_data["moving_name"], folder, folder)
+    if len(pair_data) > 0:
+        pair_data["mask_crop_flag"] = image_data["mask_crop_flag"]
+
+    return pair_data
+
+
+@instr.timed
+def prepare_atlas_s(image_data):
+
+    # as segmentation_sa_for_nb.prepare_reference, for one atlas
+    image_data["current_anatomy"] = image_data["bone"]
+    elastix_transformix.bone().prepare_reference(image_data)
+    image_data["current_anatomy"] = image_data["cartilage"]
+    elastix_transformix.cartilage().prepare_reference(image_data)
+
+def prepare_atlases(all_image_data, n_of_processes):
+
+    """
+    Dilates the masks of the preselected atlases and transforms them to level sets (once per atlas)
+    """
+
+    if not load_selected_atlases(all_image_data):
+        return
+
+    start_time = time.time()
+    atlas_data = {}
+    for image_data in all_image_data:
+        for atlas_name in image_data["selected_atlas_names"]:
+            if atlas_name not in atlas_data:
+                atlas_data[atlas_name] = atlas_image_data(image_data, atlas_name)
+
+    pool = multiprocessing.Pool(processes=n_of_processes)
+    pool.map(prepare_atlas_s, list(atlas_data.values()))
+    pool.close()
+    pool.join()
+    print ("-> %d atlases prepared" % (len(atlas_data)))
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+
+@instr.timed
+def segment_with_atlas_s(image_data):
+
+    """
+    Segments the image with one atlas as segmentation.ipynb ("newsubject"). Returns the time of the segmentation
+    """
+
+    start_time = time.time()
+    sa.register_bone_to_reference_s      (image_data)
+    sa.invert_bone_transformations_s     (image_data)
+    sa.warp_bone_mask_s                  (image_data)
+    sa.register_cartilage_to_reference_s (image_data)
+    sa.invert_cartilage_transformations_s(image_data)
+    sa.warp_cartilage_mask_s             (image_data)
+
+    return time.time() - start_time
+
+def segment_with_atlases(all_image_data, n_of_processes):
+
+    """
+    Segments each image with each of its preselected atlases. All the pairs of image and atlas run in parallel
+    The time of each segmentation is in image_data["atlas_times"] (in the order of the selected atlases)
+    """
+
+    if not load_selected_atlases(all_image_data):
+        return
+
+    start_time = time.time()
+    all_pair_data = []
+    for image_data in all_image_data:
+        for atlas_name in image_data["selected_atlas_names"]:
+            all_pair_data.append(atlas_image_data(image_data, atlas_name))
+
+    sa.read_moving_geometries(all_pair_data)
+    pool  = multiprocessing.Pool(processes=n_of_processes)
+    times = pool.map(segment_with_atlas_s, all_pair_data)
+    pool.close()
+    pool.join()
+
+    # times of each image
+    p = 0
+    for image_data in all_image_data:
+        n_of_atlases              = len(image_data["selected_atlas_names"])
+        image_data["atlas_times"] = times[p:p+n_of_atlases]
+        p = p + n_of_atlases
+
+    print ("-> Segmentation with %d pairs of image and atlas completed" % (len(all_pair_data)))
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# FUSING LABELS -------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def fuse_masks(masks, weights=None):
+
+    """
+    Fuses binary masks with the same geometry: a voxel is in the fused mask if the (weighted) votes of the masks are more than half of the total
+    Without weights, this is majority voting (ties are background). Votes are summed one mask at a time over the whole image
+    """
+
+    if weights is None:
+        weights = np.ones(len(masks))
+    weights = np.asarray(weights, dtype=np.float32)
+
+    votes = np.zeros(sitk.GetArrayViewFromImage(masks[0]).shape, dtype=np.float32)
+    for a in range(0, len(masks)):
+        votes += weights[a] * (sitk.GetArrayViewFromImage(masks[a]) > 0)
+
+    fused = sitk.GetImageFromArray((votes > 0.5 * np.sum(weights)).astype(np.uint8))
+    fused.CopyInformation(masks[0])
+
+    return fused
+
+
+def warped_mask_name(image_data, atlas_name, anatomy):
+
+    # mask warped from one atlas (as segmentation_image_data names it in the folder of the atlas)
+    return atlas_folder_name(image_data, atlas_name) + image_data["moving_root"] + "_" + anatomy + ".mha"
+
+
+def fusion_weights(image_data):
+
+    # majority voting or similarity of the atlases (negative similarities do not vote)
+    if image_data["fusion_method"] == "weighted":
+        weights = np.maximum(np.array(image_data["atlas_weights"]), 0.0)
+        if np.sum(weights) > 0:
+            return weights
+    return np.ones(len(image_data["selected_atlas_names"]))
+
+
+@instr.timed
+def fuse_labels_s(image_data):
+
+    weights = fusion_weights(image_data)
+
+    for anatomy in [image_data["bone"], image_data["cartilage"]]:
+        masks = [pio.read_mask(warped_mask_name(image_data, atlas_name, anatomy), sitk.sitkUInt8) for atlas_name in image_data["selected_atlas_names"]]
+        mask  = fuse_masks(masks, weights)
+        output_file_name = image_data["segmented_folder"] + image_data[anatomy + "mask"]
+        sitkf.write_mask(mask, output_file_name, image_data["mask_crop_flag"])
+
+    # save thumbnail for visualization
+    thc.save_overlay_thumbnail(image_data["moving_folder"] + image_data["moving_name"], output_file_name, overlay_py=sitk.GetArrayViewFromImage(mask))
+
+def fusion_input_files(image_data):
+
+    # warped masks read by fuse_labels_s
+    return [warped_mask_name(image_data, atlas_name, anatomy) for anatomy in [image_data["bone"], image_data["cartilage"]]
+                                                              for atlas_name in image_data["selected_atlas_names"]]
+
+def fuse_labels(all_image_data, fusion_method, n_of_processes):
+
+    """
+    Fuses the masks warped from the preselected atlases. fusion_method is "majority" or "weighted" (by atlas similarity)
+    """
+
+    if fusion_method != "majority" and fusion_method != "weighted":
+        print("----------------------------------------------------------------------------------------")
+        print("ERROR: The fusion method must be 'majority' or 'weighted'")
+        print("----------------------------------------------------------------------------------------")
+        return
+    if not load_selected_atlases(all_image_data):
+        return
+
+    start_time = time.time()
+    for image_data in all_image_data:
+        image_data["fusion_method"] = fusion_method
+    pio.map_with_prefetch(fuse_labels_s, fusion_input_files, all_image_data, n_of_processes)
+    print ("-> Label fusion completed")
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
@@ -1,21 +1,26 @@
 # Serena Bonaretti, 2018
 
 from datetime import datetime
-import matplotlib.pyplot as plt
 import numpy as np
 import os
-import pandas as pd
 import SimpleITK as sitk
+import time
 
+# plotting (matplotlib), tables (pandas), and widgets (ipywidgets) are imported in the functions that use them,
+# so that the processes of multiprocessing.Pool() start faster
 
 # pyKNEER imports 
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
 if __package__ is None or __package__ == '':
     # uses current directory visibility
+    import instrumentation as instr
+    import prefetch_io     as pio
     import sitk_functions  as sitkf
 
 else:
     # uses current package visibility
+    from . import instrumentation as instr
+    from . import prefetch_io     as pio
     from . import sitk_functions  as sitkf
 
 # ---------------------------------------------------------------------------------------------------------------------------
@@ -35,9 +40,11 @@ def compute_overlap(all_image_data):
         segmented_file_name    = all_image_data[i]["segmented_folder"]    + all_image_data[i]["segmented_name"]
         ground_truth_file_name = all_image_data[i]["ground_truth_folder"] + all_image_data[i]["ground_truth_name"]
 
-        # read images
-        segmented_mask    = sitk.ReadImage(segmented_file_name)
-        ground_truth_mask = sitk.ReadImage(ground_truth_file_name)
+        # read images (and start reading the images of the next subject)
+        if i + 1 < len(all_image_data):
+            pio.prefetch(quality_input_files(all_image_data[i+1]))
+        segmented_mask    = pio.read_mask(segmented_file_name)
+        ground_truth_mask = pio.read_mask(ground_truth_file_name)
 
         # measure overlap
         dice, jacc, vols = sitkf.overlap_measures(segmented_mask, ground_truth_mask)
@@ -50,6 +57,8 @@ def compute_overlap(all_image_data):
 
 def overlap_coeff_graph(all_image_data, dice_coeff, jacc_coeff, vol_simil):
 
+    import matplotlib.pyplot as plt
+
     # figure size
     figure_width = 18
     figure_length   = 8
@@ -95,6 +104,8 @@ def overlap_coeff_graph(all_image_data, dice_coeff, jacc_coeff, vol_simil):
 
 def overlap_coeff_table(all_image_data, dice_coeff, jacc_coeff, vol_simil, output_file_name):
 
+    import pandas as pd
+
     # extract image names
     image_names = []
     for i in range(0, len(all_image_data)):
@@ -143,25 +154,15 @@ def compute_surface_distance(all_image_data):
         ground_truth_file_name = all_image_data[i]["ground_truth_folder"] + all_image_data[i]["ground_truth_name"]
 
         # read images
-        segmented_mask    = sitk.ReadImage(segmented_file_name, sitk.sitkUInt8)
-        ground_truth_mask = sitk.ReadImage(ground_truth_file_name, sitk.sitkUInt8)
+        segmented_mask    = sitkf.read_mask(segmented_file_name, sitk.sitkUInt8)
+        ground_truth_mask = sitkf.read_mask(ground_truth_file_name, sitk.sitkUInt8)
                 
         # in some cases spacing of coupled images can be different at a late digits because of approximations in the pipeline
         # if this happens, round to the fourth digit
-        if (segmented_mask.GetSpacing()[0] != ground_truth_mask.GetSpacing()[0] or \
-            segmented_mask.GetSpacing()[1] != ground_truth_mask.GetSpacing()[1] or \
-            segmented_mask.GetSpacing()[2] != ground_truth_mask.GetSpacing()[2] ):
-            spacing    = []
-            spacing.append(round(segmented_mask.GetSpacing()[0], 4))
-            spacing.append(round(segmented_mask.GetSpacing()[1], 4))
-            spacing.append(round(segmented_mask.GetSpacing()[2], 4))
-            segmented_mask.SetSpacing(spacing)
-            spacing    = []
-            spacing.append(round(ground_truth_mask.GetSpacing()[0], 4))
-            spacing.append(round(ground_truth_mask.GetSpacing()[1], 4))
-            spacing.append(round(ground_truth_mask.GetSpacing()[2], 4))
-            ground_truth_mask.SetSpacing(spacing)
-                        
+        if segmented_mask.GetSpacing() != ground_truth_mask.GetSpacing():
+            segmented_mask    = sitkf.round_spacing(segmented_mask)
+            ground_truth_mask = sitkf.round_spacing(ground_truth_mask)
+
         # measure average and standard deviation of surface distances
         mean_distance, stddev_distance = sitkf.mask_euclidean_distance(segmented_mask, ground_truth_mask)
         mean_distances.append(mean_distance)
@@ -172,6 +173,8 @@ def compute_surface_distance(all_image_data):
 
 def surface_distance_graph(all_image_data, mean_distances, stddev_distances):
 
+    import matplotlib.pyplot as plt
+
     # figure size
     figure_width = 18
     figure_length   = 8
@@ -208,6 +211,8 @@ def surface_distance_graph(all_image_data, mean_distances, stddev_distances):
     
 def surface_distance_table(all_image_data, mean_distances, stddev_distances, output_file_name):
 
+    import pandas as pd
+
     # extract image names
     image_names = []
     for i in range(0, len(all_image_data)):
@@ -236,3 +241,207 @@ def surface_distance_table(all_image_data, mean_distances, stddev_distances, out
     print("Table saved as: " + output_file_name)
 
     return table
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# FUNCTIONS TO CALCULATE ALL QUALITY MEASURES IN ONE PASS -------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+@instr.timed
+def compute_quality_s(image_data):
+
+    """
+    Reads the segmented and ground truth masks once and calculates overlap coefficients and surface distances
+    Surface distances are in the same units as in compute_surface_distance
+    """
+
+    # get file names
+    segmented_file_name    = image_data["segmented_folder"]    + image_data["segmented_name"]
+    ground_truth_file_name = image_data["ground_truth_folder"] + image_data["ground_truth_name"]
+
+    # read images (prefetched in compute_quality)
+    segmented_mask    = pio.read_mask(segmented_file_name, sitk.sitkUInt8)
+    ground_truth_mask = pio.read_mask(ground_truth_file_name, sitk.sitkUInt8)
+
+    # in some cases spacing of coupled images can be different at a late digits because of approximations in the pipeline
+    # if this happens, round to the fourth digit (as in compute_surface_distance)
+    if segmented_mask.GetSpacing() != ground_truth_mask.GetSpacing():
+        segmented_mask    = sitkf.round_spacing(segmented_mask)
+        ground_truth_mask = sitkf.round_spacing(ground_truth_mask)
+
+    # measure overlap
+    dice, jacc, vols = sitkf.overlap_measures_py(sitk.GetArrayViewFromImage(segmented_mask), sitk.GetArrayViewFromImage(ground_truth_mask))
+
+    # measure surface distances
+    distances = sitkf.surface_distances(segmented_mask, ground_truth_mask)
+
+    quality = {}
+    quality["dice_coeff"]              = dice
+    quality["jaccard_coeff"]           = jacc
+    quality["volume_similarity"]       = vols
+    quality["mean_distances"]          = np.mean(distances)
+    quality["stddev_distances"]        = np.std(distances)
+    quality["hausdorff_distances"]     = np.max(distances)
+    quality["percentile_95_distances"] = np.percentile(distances, 95)
+
+    return quality
+
+def quality_input_files(image_data):
+
+    # masks read by compute_quality_s and compute_overlap
+    return [image_data["segmented_folder"]    + image_data["segmented_name"],
+            image_data["ground_truth_folder"] + image_data["ground_truth_name"]]
+
+def compute_quality(all_image_data, n_of_processes):
+
+    import pandas as pd
+
+    start_time = time.time()
+    all_quality = pio.map_with_prefetch(compute_quality_s, quality_input_files, all_image_data, n_of_processes)
+    print ("-> Segmentation quality calculated")
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+    # extract image names
+    image_names = []
+    for i in range(0, len(all_image_data)):
+        image_root, image_ext = os.path.splitext(all_image_data[i]["segmented_name"])
+        image_names.append(image_root)
+
+    # one row per subject
+    quality = pd.DataFrame(all_quality)
+    quality.insert(0, "subjects", image_names)
+
+    return quality
+
+
+def quality_table(quality, output_file_name):
+
+    import pandas as pd
+
+    # format table
+    table = quality.copy()
+    table.index = np.arange(1,len(table)+1) # First ID column starting from 1
+    table = table.round(2) #show 2 decimals
+    # show all the lines of the table
+    data_dimension = table.shape # get number of rows
+    pd.set_option("display.max_rows",data_dimension[0]) # show all the rows
+
+    # save table as csv
+    table.to_csv(output_file_name,  index = False)
+    print("Table saved as: " + output_file_name)
+
+    return table
+
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# FUNCTIONS TO CALCULATE VOLUME OVERLAP OF SEVERAL STRUCTURES ---------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def anatomy_file_name(file_name, anatomy):
+
+    """
+    Substitutes the anatomy suffix of a mask file name (e.g. YR04_01_DESS_prep_fc.mha with anatomy "t" becomes YR04_01_DESS_prep_t.mha)
+    """
+
+    file_name_root, file_ext = os.path.splitext(file_name)
+    file_name_root = file_name_root[0:file_name_root.rfind("_")+1] + anatomy
+
+    return file_name_root + file_ext
+
+
+@instr.timed
+def compute_overlap_multilabel_s(image_data):
+
+    anatomies = image_data["anatomies"]
+
+    # read each mask once
+    segmented_masks    = []
+    ground_truth_masks = []
+    for anatomy in anatomies:
+        segmented_masks.append   (pio.read_mask(image_data["segmented_folder"]    + anatomy_file_name(image_data["segmented_name"],    anatomy), sitk.sitkUInt8))
+        ground_truth_masks.append(pio.read_mask(image_data["ground_truth_folder"] + anatomy_file_name(image_data["ground_truth_name"], anatomy), sitk.sitkUInt8))
+
+    # combine masks in label images
+    segmented_labels,    n_of_overlapping_voxels_s = sitkf.masks_to_labels(segmented_masks)
+    ground_truth_labels, n_of_overlapping_voxels_g = sitkf.masks_to_labels(ground_truth_masks)
+
+    # masks that overlap: each anatomy is measured on its own masks (in the label images, the overlap belongs to one anatomy only)
+    if n_of_overlapping_voxels_s != 0 or n_of_overlapping_voxels_g != 0:
+        print ("WARNING: masks of " + image_data["segmented_name"] + " overlap (" + str(n_of_overlapping_voxels_s) + " and " + str(n_of_overlapping_voxels_g) +
+               " voxels). Each anatomy is measured on its own mask")
+        dice = []
+        jacc = []
+        vols = []
+        for a in range(0, len(anatomies)):
+            measures = sitkf.overlap_measures_py(sitk.GetArrayViewFromImage(segmented_masks[a]), sitk.GetArrayViewFromImage(ground_truth_masks[a]))
+            dice.append(measures[0])
+            jacc.append(measures[1])
+            vols.append(measures[2])
+        return dice, jacc, vols
+
+    # measure overlap for all labels
+    dice, jacc, vols = sitkf.multi_label_overlap_measures(segmented_labels, ground_truth_labels, len(anatomies))
+
+    return dice, jacc, vols
+
+def multilabel_input_files(image_data):
+
+    # masks read by compute_overlap_multilabel_s
+    file_names = []
+    for anatomy in image_data["anatomies"]:
+        file_names.append(image_data["segmented_folder"]    + anatomy_file_name(image_data["segmented_name"],    anatomy))
+        file_names.append(image_data["ground_truth_folder"] + anatomy_file_name(image_data["ground_truth_name"], anatomy))
+
+    return file_names
+
+def compute_overlap_multilabel(all_image_data, anatomies, n_of_processes):
+
+    """
+    Calculates overlap coefficients for several structures (e.g. anatomies = ["f", "fc", "t", "tc", "p", "pc"])
+    File names of the structures are obtained by substituting the anatomy suffix of segmented_name and ground_truth_name
+    Returns a table with one row per subject and structure
+    """
+
+    import pandas as pd
+
+    # add anatomies to the image data of each subject
+    all_image_data_anatomies = []
+    for i in range(0, len(all_image_data)):
+        image_data = dict(all_image_data[i])
+        image_data["anatomies"] = anatomies
+        all_image_data_anatomies.append(image_data)
+
+    start_time = time.time()
+    all_overlaps = pio.map_with_prefetch(compute_overlap_multilabel_s, multilabel_input_files, all_image_data_anatomies, n_of_processes)
+    print ("-> Overlap calculated")
+    print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
+
+    # one row per subject and anatomy
+    image_names = []
+    anatomy     = []
+    dice_coeff  = []
+    jacc_coeff  = []
+    vol_simil   = []
+    for i in range(0, len(all_image_data)):
+        image_root, image_ext = os.path.splitext(all_image_data[i]["segmented_name"])
+        dice, jacc, vols = all_overlaps[i]
+        for a in range(0, len(anatomies)):
+            image_names.append(image_root)
+            anatomy.append(anatomies[a])
+            dice_coeff.append(dice[a])
+            jacc_coeff.append(jacc[a])
+            vol_simil.append(vols[a])
+
+    table = pd.DataFrame(
+        {
+            "subjects"          : image_names,
+            "anatomy"           : anatomy,
+            "dice_coeff"        : dice_coeff,
+            "jaccard_coeff"     : jacc_coeff,
+            "volume_similarity" : vol_simil
+        }
+    )
+
+    return table
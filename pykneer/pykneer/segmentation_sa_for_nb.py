@@ -13,6 +13,7 @@ The last two steps have three inner steps:
     - warp reference mask to moving image using inverted transformation. The bone warping is not needed for cartilage segmentation. It is executed just for check in case of segmentation failure.
     
 The atlas-based segmentation is based on elastix and transformix, called in the file elastix_transformix.py 
+In longitudinal segmentation, the visits of a knee are registered one after the other, and each visit starts from the transformations of the previous one
 There is a function
 
 Functions are in pairs for parallelization. Example:
@@ -21,30 +22,31 @@ pool.map() takes care of sending one single element of the list all_image_data (
 
 """
 
-import matplotlib.pyplot as plt
 import multiprocessing
 import numpy as np
 import SimpleITK      as sitk
 import time
 
-from ipywidgets import * # for display
-from ipywidgets import HBox, VBox
-from ipywidgets import interactive
-from ipywidgets import Layout
-from ipywidgets import widgets as widgets
-
+# plotting (matplotlib), tables (pandas), and widgets (ipywidgets) are imported in the functions that use them,
+# so that the processes of multiprocessing.Pool() start faster
 
 # pyKNEER imports 
 # ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
 if __package__ is None or __package__ == '':
     # uses current directory visibility
+    import instrumentation as instr
     import elastix_transformix
+    import lazy_image_io   as lio
     import sitk_functions  as sitkf
+    import thumbnail_cache as thc
 
 else:
     # uses current package visibility
+    from . import instrumentation as instr
     from . import elastix_transformix
+    from . import lazy_image_io   as lio
     from . import sitk_functions  as sitkf
+    from . import thumbnail_cache as thc
 
 
 # ---------------------------------------------------------------------------------------------------------------------------
@@ -100,10 +102,37 @@ def prepare_reference(all_image_data):
 
 
 
+def visits(all_image_data):
+
+    """
+    Splits all_image_data by visit (see link_longitudinal_visits in pykneer_io.py), so that the registrations of a visit start after
+    the ones of the previous visit, whose transformations they use as initialization. Images of other registration types are one group
+    """
+
+    n_of_visits = max([image_data.get("visit", 0) for image_data in all_image_data] + [0]) + 1
+    if n_of_visits == 1:
+        return [all_image_data]
+
+    return [[image_data for image_data in all_image_data if image_data["visit"] == v] for v in range(0, n_of_visits)]
+
+
+def read_moving_geometries(all_image_data):
+
+    """
+    Reads the geometries of the moving images (header only) before the processes are created, so that the processes
+    of the warping steps get them from sitkf.read_image_geometry without reading the images again
+    """
+
+    for image_data in all_image_data:
+        sitkf.read_image_geometry(image_data["moving_folder"] + image_data["moving_name"])
+
+
+
 # ---------------------------------------------------------------------------------------------------------------------------
 # SEGMENTING BONE -----------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
 
+@instr.timed
 def register_bone_to_reference_s(image_data):
 
 #    print ("-> Registering " + image_data["moving_root"])
@@ -130,12 +159,14 @@ def register_bone_to_reference(all_image_data, n_of_processes):
     # print
     start_time = time.time()
     pool = multiprocessing.Pool(processes=n_of_processes)
-    pool.map(register_bone_to_reference_s, all_image_data)
+    for visit_image_data in visits(all_image_data):
+        pool.map(register_bone_to_reference_s, visit_image_data)
     print ("-> Registration completed")
     print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
 
 
 
+@instr.timed
 def invert_bone_transformations_s(image_data):
 
 #    print ("-> Inverting transformation of " + image_data["moving_root"])
@@ -165,6 +196,7 @@ def invert_bone_transformations(all_image_data, n_of_processes):
 
 
 
+@instr.timed
 def warp_bone_mask_s(image_data):
 
 #    print ("-> Warping bone mask of " + image_data["moving_root"])
@@ -173,11 +205,11 @@ def warp_bone_mask_s(image_data):
     image_data["current_anatomy"] = image_data["bone"]
     bone = elastix_transformix.bone()
 
-    # get moving image properties (size and spacing for modify_transformation(rigid) and transformix)
-    moving_name  = image_data["moving_folder"] + image_data["moving_name"]
-    moving_image = sitk.ReadImage(moving_name)
-    image_data["image_size"]      = moving_image.GetSize()
-    image_data["image_spacing"]   = moving_image.GetSpacing()
+    # get moving image properties (size and spacing for modify_transformation(rigid) and transformix) from the header only
+    moving_name     = image_data["moving_folder"] + image_data["moving_name"]
+    moving_geometry = sitkf.read_image_geometry(moving_name)
+    image_data["image_size"]      = moving_geometry["size"]
+    image_data["image_spacing"]   = moving_geometry["spacing"]
 
     # modify transformations for mask warping
     if image_data["registration_type"] == "newsubject":
@@ -210,12 +242,12 @@ def warp_bone_mask_s(image_data):
     output_file_name = image_data["segmented_folder"]        + image_data[anatomy + "mask"]
     mask = sitk.ReadImage(input_file_name)
     mask = sitkf.levelset2binary(mask)
-    mask = sitk.Cast(mask,sitk.sitkInt16) # cast to int16 to reduce file size
-    sitk.WriteImage(mask, output_file_name)
+    sitkf.write_mask(mask, output_file_name, image_data["mask_crop_flag"]) # unsigned char and compressed to reduce file size
 
 def warp_bone_mask(all_image_data, n_of_processes):
 
     start_time = time.time()
+    read_moving_geometries(all_image_data)
     pool = multiprocessing.Pool(processes=n_of_processes)
     pool.map(warp_bone_mask_s, all_image_data)
     print ("-> Warping completed")
@@ -226,6 +258,7 @@ def warp_bone_mask(all_image_data, n_of_processes):
 # ---------------------------------------------------------------------------------------------------------------------------
 # SEGMENTING CARTILAGE ------------------------------------------------------------------------------------------------------
 # ---------------------------------------------------------------------------------------------------------------------------
+@instr.timed
 def register_cartilage_to_reference_s(image_data):
 
 #    print ("-> Registering " + image_data["moving_root"])
@@ -244,12 +277,14 @@ def register_cartilage_to_reference(all_image_data, n_of_processes):
 
     start_time = time.time()
     pool = multiprocessing.Pool(processes=n_of_processes)
-    pool.map(register_cartilage_to_reference_s, all_image_data)
+    for visit_image_data in visits(all_image_data):
+        pool.map(register_cartilage_to_reference_s, visit_image_data)
     print ("-> Registration completed")
     print ("-> The total time was %.2f seconds (about %d min)" % ((time.time() - start_time), (time.time() - start_time)/60))
 
 
 
+@instr.timed
 def invert_cartilage_transformations_s(image_data):
 
 #    print ("-> Inverting transformation of " + image_data["moving_root"])
@@ -276,6 +311,7 @@ def invert_cartilage_transformations(all_image_data, n_of_processes):
 
 
 
+@instr.timed
 def warp_cartilage_mask_s(image_data):
 
 #    print ("-> Warping cartilage mask of " + image_data["moving_root"])
@@ -284,11 +320,11 @@ def warp_cartilage_mask_s(image_data):
     image_data["current_anatomy"] = image_data["cartilage"]
     cartilage = elastix_transformix.cartilage()
 
-    # get moving image properties (size and spacing for transformix)
-    moving_name  = image_data["moving_folder"] + image_data["moving_name"]
-    moving_image = sitk.ReadImage(moving_name)
-    image_data["image_size"]      = moving_image.GetSize()
-    image_data["image_spacing"]   = moving_image.GetSpacing()
+    # get moving image properties (size and spacing for transformix) from the header only
+    moving_name     = image_data["moving_folder"] + image_data["moving_name"]
+    moving_geometry = sitkf.read_image_geometry(moving_name)
+    image_data["image_size"]      = moving_geometry["size"]
+    image_data["image_spacing"]   = moving_geometry["spacing"]
 
     if image_data["registration_type"] == "newsubject":
 
@@ -320,12 +356,15 @@ def warp_cartilage_mask_s(image_data):
     output_file_name = image_data["segmented_folder"]        + image_data[anatomy + "mask"]
     mask = sitk.ReadImage(input_file_name)
     mask = sitkf.levelset2binary(mask)
-    mask = sitk.Cast(mask,sitk.sitkInt16) # cast to int16 to reduce file size
-    sitk.WriteImage(mask, output_file_name)
+    sitkf.write_mask(mask, output_file_name, image_data["mask_crop_flag"]) # unsigned char and compressed to reduce file size
+
+    # save thumbnail for visualization
+    thc.save_overlay_thumbnail(moving_name, output_file_name, overlay_py=sitk.GetArrayViewFromImage(mask))
 
 def warp_cartilage_mask(all_image_data, n_of_processes):
 
     start_time = time.time()
+    read_moving_geometries(all_image_data)
     pool = multiprocessing.Pool(processes=n_of_processes)
     pool.map(warp_cartilage_mask_s, all_image_data)
     print ("-> Warping completed")
@@ -338,6 +377,8 @@ def warp_cartilage_mask(all_image_data, n_of_processes):
 # ---------------------------------------------------------------------------------------------------------------------------
 
 def show_segmented_images (image_data, view_modality):
+
+    from ipywidgets import interactive
     
     if view_modality == 0:
         show_segmented_images_static(image_data)
@@ -353,6 +394,8 @@ def show_segmented_images (image_data, view_modality):
 
 def show_segmented_images_static(all_image_data): 
 
+    import matplotlib.pyplot as plt
+
     n_of_images  = len(all_image_data)
     img_LW       = 4
     figure_width = img_LW * 3
@@ -375,31 +418,12 @@ def show_segmented_images_static(all_image_data):
         mask_file_name                = image_data["segmented_folder"] + image_data[anatomy + "mask"]
         moving_root                   = image_data["moving_root"]
 
-        # read the images
-        moving = sitk.ReadImage(moving_file_name)
-        mask   = sitk.ReadImage(mask_file_name)
-
-        # images from simpleitk to numpy
-        moving_py = sitk.GetArrayFromImage(moving)
-        mask_py   = sitk.GetArrayFromImage(mask)
-
-        # extract slices at 2/5, 3/5, and 4/5 of the image size
-        size = np.size(mask_py,2)
-        # get the first slice of the mask in the sagittal direction
-        for b in range(0,int(size/2)):
-            slice = mask_py[:,:,b]
-            if np.sum(slice) != 0:
-                first_value = b
-                break
-        # get the last slice of the mask in the sagittal direction
-        for b in range(size-1,int(size/2),-1):
-            slice = mask_py[:,:,b]
-            if np.sum(slice) != 0:
-                last_value = b
-                break
-
-        slice_step = int ((last_value-first_value)/4)
-        sliceID = (first_value + slice_step, first_value + 2*slice_step, first_value + 3*slice_step)
+        # get slices at 1/4, 2/4, and 3/4 of the mask extent from the thumbnail cache
+        thumbnail = thc.get_overlay_thumbnail(moving_file_name, mask_file_name)
+        if thumbnail is None:
+            axis_index = axis_index + 3
+            continue
+        sliceID   = thumbnail["slice_ID"]
 
         for a in range (0,len(sliceID)):
 
@@ -407,8 +431,8 @@ def show_segmented_images_static(all_image_data):
             ax1 = fig.add_subplot(n_of_rows,n_of_columns,axis_index)
 
             # get slices
-            slice_moving_py   = moving_py[:,:,sliceID[a]]
-            slice_mask_py     = mask_py[:,:,sliceID[a]]
+            slice_moving_py   = thumbnail["image_slices"][a]
+            slice_mask_py     = thumbnail["overlay_slices"][a]
             slice_mask_masked = np.ma.masked_where(slice_mask_py == 0, slice_mask_py)
 
             # show image
@@ -422,6 +446,9 @@ def show_segmented_images_static(all_image_data):
 
 
 def browse_images(moving_py, mask_py, ax_i, fig, moving_root, last_value, sliceID):
+
+    import matplotlib.pyplot as plt
+    from ipywidgets import HBox, VBox, interactive, Layout, widgets
     
     # The code in this function has to be separate. If code directly into show_segmented_images, when using widgets, they update the last image
     
@@ -473,9 +500,11 @@ def browse_images(moving_py, mask_py, ax_i, fig, moving_root, last_value, sliceI
     return whole_box
 
 def show_segmented_images_interactive(all_image_data):
-    
-    # for each image
-    for i in range(0, len(all_image_data)):
+
+    import matplotlib.pyplot as plt
+
+    # create the figure of one image when it is selected
+    def show_subject(i):
 
         # get paths and file names of the current image
         image_data                    = all_image_data[i]
@@ -485,31 +514,14 @@ def show_segmented_images_interactive(all_image_data):
         mask_file_name                = image_data["segmented_folder"] + image_data[anatomy + "mask"]
         moving_root                   = image_data["moving_root"]
 
-        # read the images
-        moving = sitk.ReadImage(moving_file_name)
-        mask   = sitk.ReadImage(mask_file_name)
-
-        # images from simpleitk to numpy
-        moving_py = sitk.GetArrayFromImage(moving)
-        mask_py   = sitk.GetArrayFromImage(mask)
-
-        # extract slices at 2/5, 3/5, and 4/5 of the image size
-        size = np.size(mask_py,2)
-        # get the first slice of the mask in the sagittal direction
-        for b in range(0,int(size/2)):
-            slice = mask_py[:,:,b]
-            if np.sum(slice) != 0:
-                first_value = b
-                break
-        # get the last slice of the mask in the sagittal direction
-        for b in range(size-1,int(size/2),-1):
-            slice = mask_py[:,:,b]
-            if np.sum(slice) != 0:
-                last_value = b
-                break
-
-        slice_step = int ((last_value-first_value)/4)
-        sliceID = (first_value + slice_step, first_value + 2*slice_step, first_value + 3*slice_step)
+        # access images on demand (slices are read from disk when displayed)
+        moving_py = lio.lazy_image(moving_file_name)
+        mask_py   = lio.lazy_image(mask_file_name)
+
+        # extract slices at 1/4, 2/4, and 3/4 of the mask extent in the sagittal direction
+        first_value, last_value, sliceID = lio.find_mask_slices(mask_py)
+        if sliceID is None:
+            return None
 
         # create figure
         plt.rcParams['figure.figsize'] = [20, 15]  
@@ -536,13 +548,10 @@ def show_segmented_images_interactive(all_image_data):
             
         # interactive image
         ax_i = ax[0]
-        if i == 0:
-            final_box = browse_images(moving_py, mask_py, ax_i, fig, moving_root, last_value, sliceID)
-        else:
-            new_box = browse_images(moving_py, mask_py, ax_i, fig, moving_root, last_value, sliceID)
-            final_box = VBox([final_box,new_box]);   
-            
-    return final_box
+        return browse_images(moving_py, mask_py, ax_i, fig, moving_root, last_value, sliceID)
+
+    # one image at a time
+    return lio.browse_subjects([image_data["moving_root"] for image_data in all_image_data], show_subject)
         
         
 
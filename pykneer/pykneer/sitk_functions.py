@@ -4,8 +4,10 @@
 Mix of image processing functions mainly using SimpleITK and ITK:
     - print_image_info
     - print_image_info_ITK
+    - scan_dicom_folder
     - read_dicom_stack
     - read_dicom_header
+    - read_image_geometry
     - orientation_to_rai
     - flip_rl
     - origin_to_zero
@@ -14,15 +16,25 @@ Mix of image processing functions mainly using SimpleITK and ITK:
     - edge_preserving_smoothing
     - dilate_mask
     - binary2levelset
+    - crop_levelset
     - levelset2binary
+    - write_mask
+    - read_mask
+    - restore_mask
+    - round_spacing
     - overlap_measures
-    - distance_measure
-    - surface_distance_measures
+    - overlap_measures_py
+    - masks_to_labels
+    - multi_label_overlap_measures
+    - hausdorff_distance
+    - bounding_box
+    - surface_distances
+    - mask_euclidean_distance
 """
 
+import os
 import numpy as np
 import SimpleITK as sitk
-import itk
 
 
 
@@ -48,162 +60,186 @@ def print_image_info_ITK(img_itk):
         print (    "%.2f %.2f %.2f" % (img_itk.GetDirection().GetVnlMatrix().get(i,0), img_itk.GetDirection().GetVnlMatrix().get(i,1), img_itk.GetDirection().GetVnlMatrix().get(i,2)))
 
 
-def read_dicom_stack(image_folder):
+# dicom folders already scanned by the current process (folder name: file names and header)
+dicom_scans = {}
 
-    # read dicom series
-    reader      = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(image_folder)
-    reader.SetFileNames(dicom_names)
-    img         = reader.Execute()
+def scan_dicom_folder(image_folder):
+
+    """
+    Scans a dicom folder once and keeps the file names of the (first) series and the header of its first slice
+    The header is read without reading the pixels. Following calls with the same folder use the stored scan
+    """
+
+    if image_folder not in dicom_scans:
+
+        # get file names of the dicom slices in the folder (sorted by slice position)
+        series_file_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(image_folder)
+
+        # read the header of one slice
+        reader = sitk.ImageFileReader()
+        #reader.LoadPrivateTagsOn()
+        reader.SetFileName(series_file_names[0])
+        reader.ReadImageInformation()
+
+        # get metaDataKeys and metaData
+        meta_data_keys = reader.GetMetaDataKeys()
+        meta_data      = []
+        for k in range (0,len(meta_data_keys)):
+            meta_data.append(reader.GetMetaData(meta_data_keys[k]))
+
+        scan = {}
+        scan["file_names"]     = series_file_names
+        scan["meta_data_keys"] = meta_data_keys
+        scan["meta_data"]      = meta_data
+        dicom_scans[image_folder] = scan
+
+    return dicom_scans[image_folder]
+
+
+def read_dicom_stack(image_folder, n_of_threads=4):
+
+    """
+    Reads the dicom series using the file names of scan_dicom_folder. Slices are read in parallel with a thread pool
+    Geometry is the one of ImageSeriesReader: in-plane direction and origin from the first slice,
+    slice direction and spacing from the positions of the first and last slices
+    Unlike ImageSeriesReader, slices with a pixel type different from the first slice are not truncated
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    dicom_names = scan_dicom_folder(image_folder)["file_names"]
+
+    # one slice, nothing to assemble
+    if len(dicom_names) == 1:
+        return sitk.ReadImage(dicom_names[0])
+
+    # read slices
+    with ThreadPoolExecutor(max_workers=n_of_threads) as executor:
+        slices = list(executor.map(sitk.ReadImage, dicom_names))
+
+    # pixel type of the stack: slices can have different types (e.g. float for slices with their own rescale slope)
+    # in that case the stack takes the type that contains all of them, so values are not truncated
+    first_slice = slices[0]
+    pixel_types = set([sitk.GetArrayViewFromImage(slice).dtype for slice in slices])
+    pixel_type  = np.result_type(*pixel_types)
+    if len(pixel_types) > 1:
+        print ("-> Slices of %s have different pixel types, stack read as %s" % (image_folder, pixel_type))
+
+    # put slices in a 3D matrix
+    img_py      = np.empty((len(slices),) + sitk.GetArrayViewFromImage(first_slice).shape[1:], dtype=pixel_type)
+    for a in range (0,len(slices)):
+        img_py[a] = sitk.GetArrayViewFromImage(slices[a])[0]
+
+    # slice direction and spacing
+    offset       = np.array(slices[-1].GetOrigin()) - np.array(first_slice.GetOrigin())
+    slice_step   = np.linalg.norm(offset) / (len(slices)-1)
+    slice_normal = offset / np.linalg.norm(offset)
+    direction    = np.array(first_slice.GetDirection()).reshape(3,3)
+    direction[:,2] = slice_normal
+
+    # back to SimpleITK
+    img = sitk.GetImageFromArray(img_py)
+    img.SetSpacing  ([first_slice.GetSpacing()[0], first_slice.GetSpacing()[1], slice_step])
+    img.SetOrigin   (first_slice.GetOrigin())
+    img.SetDirection(direction.flatten().tolist())
 
     return img
 
 
 def read_dicom_header(image_folder):
 
-    # get file names of the dicom slices in the folder
-    series_IDs        = sitk.ImageSeriesReader.GetGDCMSeriesIDs(image_folder)
-    series_file_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(image_folder, series_IDs[0])
+    # get the header of the first slice from the scan of the folder
+    scan = scan_dicom_folder(image_folder)
 
-    # read the header of one slice (not selecting a specific slice)
+    return scan["meta_data_keys"], scan["meta_data"]
+
+
+# geometries already read by the current process (absolute file name: modification time, file size, and geometry)
+# processes of multiprocessing.Pool() created after a read get the geometries of the parent process
+image_geometries = {}
+
+def read_image_geometry(file_name):
+
+    """
+    Reads size, spacing, origin, and direction of an image from its header only (no voxels)
+    For masks cropped by write_mask, size and origin are the ones of the full image restored by read_mask
+    Geometries are kept per file and read again only when the file is modified (different modification time or size)
+    """
+
+    file_name = os.path.abspath(file_name)
+    status    = os.stat(file_name)
+
+    stored = image_geometries.get(file_name)
+    if stored is not None and stored[0] == status.st_mtime_ns and stored[1] == status.st_size:
+        return dict(stored[2])
+
+    # read the header
     reader = sitk.ImageFileReader()
-    #reader.LoadPrivateTagsOn()
-    reader.SetFileName(series_file_names[0])
-    img = reader.Execute()
+    reader.SetFileName(file_name)
+    reader.ReadImageInformation()
+
+    geometry = {}
+    geometry["size"]      = reader.GetSize()
+    geometry["spacing"]   = reader.GetSpacing()
+    geometry["origin"]    = reader.GetOrigin()
+    geometry["direction"] = reader.GetDirection()
 
-    # get metaDataKeys and metaData
-    meta_data_keys = img.GetMetaDataKeys()
-    meta_data     = []
-    for k in range (0,len(meta_data_keys)):
-        meta_data.append(img.GetMetaData( img.GetMetaDataKeys()[k]))
+    # full image of a cropped mask (as in restore_mask): origin is the position of the voxel -crop_index
+    if reader.HasMetaDataKey("pykneer_full_size"):
+        crop_index = np.array([int(value) for value in reader.GetMetaData("pykneer_crop_index").split()])
+        direction  = np.array(geometry["direction"]).reshape(3,3)
+        geometry["size"]   = tuple([int(value) for value in reader.GetMetaData("pykneer_full_size").split()])
+        geometry["origin"] = tuple([float(value) for value in np.array(geometry["origin"]) - direction.dot(np.array(geometry["spacing"]) * crop_index)])
 
-    return meta_data_keys, meta_data
+    image_geometries[file_name] = (status.st_mtime_ns, status.st_size, geometry)
+
+    return dict(geometry)
 
 
 
 def orientation_to_rai(img):
 
-    # this function is implemented using ITK since SimpleITK has not implemented the filter "OrientImageFilter" yet
-    # the ITK orientation system is from this blog post: https://itk.org/pipermail/insight-users/2017-May/054606.html
-    # comparison ITK - simpleITK filters: https://itk.org/SimpleITKDoxygen/html/Filter_Coverage.html
-    # see also: https://github.com/fedorov/lidc-idri-conversion/blob/master/seg/seg_converter.py
-
-    # change image name
-    img_sitk = img
-
-    # get characteristics of simpleITK image
-    size_in_sitk      = img_sitk.GetSize()
-    spacing_in_sitk   = img_sitk.GetSpacing()
-    origin_in_sitk    = img_sitk.GetOrigin()
-    direction_in_sitk = img_sitk.GetDirection()
-
-    # allocate ITK image (type and size)
-    Dimension   = 3
-    PixelType   = itk.F
-    ImageTypeIn = itk.Image[PixelType, Dimension]
-    img_itk = ImageTypeIn.New()
-    sizeIn_itk = itk.Size[Dimension]()
-    for i in range (0,Dimension):
-        sizeIn_itk[i] = size_in_sitk[i]
-    region = itk.ImageRegion[Dimension]()
-    region.SetSize(sizeIn_itk)
-    img_itk.SetRegions(region)
-    img_itk.Allocate()
-
-    # pass image from simpleITK to numpy
-    img_py  = sitk.GetArrayFromImage(img_sitk)
-
-    # pass image from numpy to ITK
-    img_itk = itk.GetImageViewFromArray(img_py)
-
-    # pass characteristics from simpleITK image to ITK image (except size, assigned in allocation)
-    spacing_in_itk = itk.Vector[itk.F, Dimension]()
-    for i in range (0,Dimension):
-        spacing_in_itk[i] = spacing_in_sitk[i]
-    img_itk.SetSpacing(spacing_in_itk)
-
-    origin_in_itk  = itk.Point[itk.F, Dimension]()
-    for i in range (0,Dimension):
-        origin_in_itk[i]  = origin_in_sitk[i]
-    img_itk.SetOrigin(origin_in_itk)
-
-    # old way of assigning direction (until ITK 4.13)
-#     direction_in_itk = itk.Matrix[itk.F,3,3]()
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(0,0,direction_in_sitk[0]) # r,c,value
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(0,1,direction_in_sitk[1])
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(0,2,direction_in_sitk[2])
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(1,0,direction_in_sitk[3]) # r,c,value
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(1,1,direction_in_sitk[4])
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(1,2,direction_in_sitk[5])
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(2,0,direction_in_sitk[6]) # r,c,value
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(2,1,direction_in_sitk[7])
-#     direction_in_itk = img_itk.GetDirection().GetVnlMatrix().set(2,2,direction_in_sitk[8])
-
-    direction_in_itk = np.eye(3)
-    direction_in_itk[0][0] = direction_in_sitk[0]
-    direction_in_itk[0][1] = direction_in_sitk[1]
-    direction_in_itk[0][2] = direction_in_sitk[2]
-    direction_in_itk[1][0] = direction_in_sitk[3]
-    direction_in_itk[1][1] = direction_in_sitk[4]
-    direction_in_itk[1][2] = direction_in_sitk[5]
-    direction_in_itk[2][0] = direction_in_sitk[6]
-    direction_in_itk[2][1] = direction_in_sitk[7]
-    direction_in_itk[2][2] = direction_in_sitk[8]
-    img_itk.SetDirection(itk.matrix_from_array(direction_in_itk))
-
-    # make sure image is float for the orientation filter (GetImageViewFromArray sets it to unsigned char)
-    ImageTypeIn_afterPy = type(img_itk)
-    ImageTypeOut        = itk.Image[itk.F, 3]
-    CastFilterType      = itk.CastImageFilter[ImageTypeIn_afterPy, ImageTypeOut]
-    castFilter          = CastFilterType.New()
-    castFilter.SetInput(img_itk)
-    castFilter.Update()
-    img_itk             = castFilter.GetOutput()
-
-    # define ITK orientation system  (from the blog post: https://itk.org/pipermail/insight-users/2017-May/054606.html)
-    ITK_COORDINATE_UNKNOWN   = 0
-    ITK_COORDINATE_Right     = 2
-    ITK_COORDINATE_Left      = 3
-    ITK_COORDINATE_Posterior = 4
-    ITK_COORDINATE_Anterior  = 5
-    ITK_COORDINATE_Inferior  = 8
-    ITK_COORDINATE_Superior  = 9
-    ITK_COORDINATE_PrimaryMinor   = 0
-    ITK_COORDINATE_SecondaryMinor = 8
-    ITK_COORDINATE_TertiaryMinor  = 16
-    ITK_COORDINATE_ORIENTATION_RAI = ( ITK_COORDINATE_Right    << ITK_COORDINATE_PrimaryMinor ) \
-                                   + ( ITK_COORDINATE_Anterior << ITK_COORDINATE_SecondaryMinor ) \
-                                   + ( ITK_COORDINATE_Inferior << ITK_COORDINATE_TertiaryMinor )
-
-    # change orientation to RAI
-    OrientType = itk.OrientImageFilter[ImageTypeOut,ImageTypeOut]
-    filter     = OrientType.New()
-    filter.UseImageDirectionOn()
-    filter.SetDesiredCoordinateOrientation(ITK_COORDINATE_ORIENTATION_RAI)
-    filter.SetInput(img_itk)
-    filter.Update()
-    img_itk    = filter.GetOutput()
-
-    # get characteristics of ITK image
-    spacing_out_itk   = img_itk.GetSpacing()
-    origin_out_itk    = img_itk.GetOrigin()
-
-    # pass image from itk to numpy
-    img_py = itk.GetArrayViewFromImage(img_itk)
+    """
+    Changes the image orientation to RAI (as ITK OrientImageFilter with ITK_COORDINATE_ORIENTATION_RAI) and sets the direction to identity
+    The axis permutation and the flips are obtained from the direction cosines (each image axis goes to the closest physical axis)
+    and applied to the numpy view of the image, so the voxels are copied only once and the pixel type is preserved
+    """
 
-    # pass image from numpy to simpleitk
-    img = sitk.GetImageFromArray(img_py)
+    # direction cosines (the columns are the image axes in physical space)
+    direction = np.array(img.GetDirection()).reshape(3,3)
+    size      = img.GetSize()
+    spacing   = img.GetSpacing()
 
-    # pass characteristics from ITK image to simpleITK image (except size, implicitely passed)
-    spacing = []
-    for i in range (0, Dimension):
-        spacing.append(spacing_out_itk[i])
-    img.SetSpacing(spacing)
+    # physical axis closest to each image axis and its verse
+    axis_to_physical = np.argmax(np.abs(direction), axis=0)
+    verse            = np.sign(direction[axis_to_physical, [0,1,2]])
+    # image axis that goes to each physical axis
+    physical_to_axis = np.argsort(axis_to_physical)
+
+    # permute and flip the numpy view (numpy axes are in reversed order: z,y,x)
+    img_py = sitk.GetArrayViewFromImage(img)
+    img_py = np.transpose(img_py, [2-physical_to_axis[2], 2-physical_to_axis[1], 2-physical_to_axis[0]])
+    for a in range (0,3):
+        if verse[physical_to_axis[a]] < 0:
+            img_py = np.flip(img_py, 2-a)
+
+    # the new origin is the voxel that becomes the first one
+    first_voxel = []
+    for a in range (0,3):
+        if verse[a] > 0:
+            first_voxel.append(0)
+        else:
+            first_voxel.append(size[a]-1)
+    origin = img.TransformIndexToPhysicalPoint(first_voxel)
+
+    # pass image from numpy to simpleitk
+    img_out = sitk.GetImageFromArray(img_py)
 
-    origin = []
-    for i in range (0, Dimension):
-        origin.append(origin_out_itk[i])
-    img.SetOrigin(origin)
+    spacing_out = []
+    for a in range (0,3):
+        spacing_out.append(spacing[physical_to_axis[a]])
+    img_out.SetSpacing(spacing_out)
+    img_out.SetOrigin(origin)
 
     direction = []
     direction.append(1.0)
@@ -215,9 +251,9 @@ def orientation_to_rai(img):
     direction.append(0.0)
     direction.append(0.0)
     direction.append(1.0)
-    img.SetDirection(direction)
+    img_out.SetDirection(direction)
 
-    return img
+    return img_out
 
 
 def flip_rl(img, flag):
@@ -256,6 +292,9 @@ def field_correction(img):
 
     # Parameters and pipeline from ksrt by Shan-Niethammer, UNC (translated to python)
 
+    # N4 works on float images
+    img = sitk.Cast(img, sitk.sitkFloat32)
+
     # creating Otsu mask
     otsu = sitk.OtsuThresholdImageFilter()
     otsu.SetInsideValue(0)
@@ -348,43 +387,183 @@ def edge_preserving_smoothing(img):
     return img
 
 
-def dilate_mask(mask,  radius):
+def dilate_mask(mask, radius, method="distance_map"):
 
-    # dilate reference binary mask
-    mask     = sitk.Cast(mask,sitk.sitkUInt16) # make sure that input of BinaryDilate is int
-    print (mask.GetPixelIDTypeAsString())
-    # mask_dil = sitk.BinaryDilate(mask,radius) # this does not work anymore, not sure why - changed to BinaryDilateImageFilter in version 0.6
-    # mask_dil = sitk.BinaryDilate(mask,3)
-    dilate_filter = sitk.BinaryDilateImageFilter()
-    dilate_filter.SetKernelRadius(radius)
-    mask_dil = dilate_filter.Execute(mask)
+    """
+    Dilates a binary mask by radius voxels and returns it as unsigned char
+    Methods:
+        - "distance_map": voxels whose distance from the mask is less than radius + 0.5 voxels. The distance map is calculated
+          on the bounding box of the mask plus radius voxels, and its time does not depend on the radius
+        - "kernel": BinaryDilateImageFilter with a ball kernel of radius voxels. Time increases with the kernel volume
+    The ball kernel contains the voxels closer than radius + 0.5 voxels to its center, so the two methods give the same mask.
+    On synthetic cartilage masks with radius from 1 to 15 voxels the two masks had no different voxels. Differences
+    can only occur for voxels at a distance of exactly radius + 0.5 voxels (rounding of the kernel)
+    """
+
+    if method == "kernel":
+        mask = sitk.Cast(mask,sitk.sitkUInt16) # make sure that input of BinaryDilate is int
+        # mask_dil = sitk.BinaryDilate(mask,radius) # this does not work anymore, not sure why - changed to BinaryDilateImageFilter in version 0.6
+        dilate_filter = sitk.BinaryDilateImageFilter()
+        dilate_filter.SetKernelRadius(radius)
+        mask_dil = dilate_filter.Execute(mask)
+        return sitk.Cast(mask_dil, sitk.sitkUInt8)
+
+    if method != "distance_map":
+        print ("----------------------------------------------------------------------------------------")
+        print ("ERROR: The dilation method %s is not supported. Use 'distance_map' or 'kernel'" % (method))
+        print ("----------------------------------------------------------------------------------------")
+        return None
+
+    # binary mask
+    mask     = sitk.Cast(mask != 0, sitk.sitkUInt8)
+    mask_dil = sitk.Image(mask.GetSize(), sitk.sitkUInt8)
+    mask_dil.CopyInformation(mask)
+
+    # crop to the region that can be reached by the dilation
+    index, size = bounding_box([mask], radius + 1)
+    if index is None:
+        return mask_dil
+    mask_roi = sitk.RegionOfInterest(mask, size, index)
+
+    # squared distance from the mask in voxels (inside the mask it is negative)
+    distance = sitk.SignedMaurerDistanceMap(mask_roi, insideIsPositive=False, squaredDistance=True, useImageSpacing=False)
+    dil_roi  = sitk.Cast(distance <= (radius + 0.5) ** 2, sitk.sitkUInt8)
+
+    # put the dilated region back in the full image
+    mask_dil = sitk.Paste(mask_dil, dil_roi, dil_roi.GetSize(), [0, 0, 0], index)
 
     return mask_dil
 
 
-def binary2levelset(mask):
+# value of the level set far from the contour (AntiAliasBinary), also used as DefaultPixelValue when warping level sets
+levelset_outside_value = -4.0
+
+
+def binary2levelset(mask, margin=5, crop_flag=1):
+
+    """
+    Transforms a binary mask to a level set: positive inside the mask, negative outside, and -4 far from the contour
+    The level set is calculated on the bounding box of the mask plus margin voxels (5 voxels give the same values as on the full image)
+    If crop_flag is 1, the cropped level set is returned, with the origin at the first voxel of the box. Transformix gives the
+    DefaultPixelValue -4 to the points outside the box, so the warped level set is the same as with the full image.
+    If crop_flag is 0, the level set is returned at full size
+    """
+
+    # make sure that input of AntiAliasBinary is int
+    mask = sitk.Cast(mask,sitk.sitkInt16)
+
+    # crop to the mask
+    index, size = bounding_box([mask], margin)
+    if index is None:
+        mask_LS = sitk.Cast(mask, sitk.sitkFloat32) + levelset_outside_value
+        return mask_LS
+    mask_roi = sitk.RegionOfInterest(mask, size, index)
+
+    # transform reference binary mask to levelset mask (float is enough for the level set and halves the file size)
+    mask_LS = sitk.Cast(sitk.AntiAliasBinary(mask_roi), sitk.sitkFloat32)
 
-    # transform reference binary mask to levelset mask
-    mask    = sitk.Cast(mask,sitk.sitkInt16) # make sure that input of AntiAliasBinary is int
-    mask_LS = sitk.AntiAliasBinary(mask)
+    # put the level set back in a full image
+    if crop_flag == 0:
+        full_LS = sitk.Image(mask.GetSize(), sitk.sitkFloat32) + levelset_outside_value
+        full_LS.CopyInformation(mask)
+        mask_LS = sitk.Paste(full_LS, mask_LS, mask_LS.GetSize(), [0, 0, 0], index)
 
     return mask_LS
 
 
+def crop_levelset(mask_LS, margin=3):
+
+    """
+    Crops a warped level set to the narrow band around the contour (values different from -4) plus margin voxels.
+    The origin of the cropped level set is the physical position of the first voxel of the band
+    """
+
+    band = mask_LS > levelset_outside_value + 0.001
+    index, size = bounding_box([band], margin)
+    if index is None:
+        return mask_LS
+
+    return sitk.RegionOfInterest(mask_LS, size, index)
+
+
 def levelset2binary(mask_LS_itk):
 
-    # transform moving level set mask to binary mask
-    mask_LS_np  = sitk.GetArrayFromImage(mask_LS_itk)
-    mask_B_np   = mask_LS_np > 0.0      # bool
-    mask_B_np   = mask_B_np.astype(int) #int
-    mask_B_itk  = sitk.GetImageFromArray(mask_B_np)
-    mask_B_itk.SetSpacing  (mask_LS_itk.GetSpacing())
-    mask_B_itk.SetOrigin   (mask_LS_itk.GetOrigin())
-    mask_B_itk.SetDirection(mask_LS_itk.GetDirection())
+    # transform moving level set mask to binary mask (unsigned char, with the geometry of the level set)
+    mask_B_itk = sitk.Cast(mask_LS_itk > 0.0, sitk.sitkUInt8)
 
     return mask_B_itk
 
 
+def write_mask(mask, file_name, crop_flag=0, margin=1):
+
+    """
+    Writes a binary (or label) mask as unsigned char with compression
+    If crop_flag is 1, the mask is cropped to its bounding box plus margin voxels. The origin of the cropped mask is the physical position
+    of the first voxel of the box, and size and index of the full image are stored in the header, so that read_mask can restore the full image
+    """
+
+    # one byte per voxel (compression makes the zeros around the mask almost free)
+    mask = sitk.Cast(mask, sitk.sitkUInt8)
+
+    # crop to the mask
+    if crop_flag == 1:
+        index, size = bounding_box([mask], margin)
+        if index is not None:
+            full_size = mask.GetSize()
+            mask      = sitk.RegionOfInterest(mask, size, index)
+            mask.SetMetaData("pykneer_full_size",  "%d %d %d" % (full_size[0], full_size[1], full_size[2]))
+            mask.SetMetaData("pykneer_crop_index", "%d %d %d" % (index[0], index[1], index[2]))
+
+    sitk.WriteImage(mask, file_name, True)
+
+
+def read_mask(file_name, pixel_type=None):
+
+    """
+    Reads a mask written by write_mask (or any other mask). Cropped masks are restored to the full image
+    pixel_type is an optional SimpleITK pixel type for the output (e.g. sitk.sitkUInt8)
+    """
+
+    return restore_mask(sitk.ReadImage(file_name), pixel_type)
+
+
+def restore_mask(mask, pixel_type=None):
+
+    """
+    Restores a cropped mask (read from a file written by write_mask) to the full image
+    """
+
+    # restore the full image
+    if mask.HasMetaDataKey("pykneer_full_size"):
+        full_size  = [int(value) for value in mask.GetMetaData("pykneer_full_size").split()]
+        crop_index = [int(value) for value in mask.GetMetaData("pykneer_crop_index").split()]
+        full_mask  = sitk.Image(full_size, mask.GetPixelID())
+        full_mask.SetSpacing  (mask.GetSpacing())
+        full_mask.SetDirection(mask.GetDirection())
+        # origin of the full image: position of the voxel -crop_index in the cropped image
+        full_mask.SetOrigin   (mask.TransformContinuousIndexToPhysicalPoint([-float(a) for a in crop_index]))
+        mask = sitk.Paste(full_mask, mask, mask.GetSize(), [0,0,0], crop_index)
+
+    if pixel_type is not None:
+        mask = sitk.Cast(mask, pixel_type)
+
+    return mask
+
+
+def round_spacing(mask, n_of_digits=4):
+
+    # makes sure that masks have spacing approximated at the same decimal
+    # in some cases spacing of coupled images can be different at a late digits because of approximations in the pipeline
+    # (error: Inputs do not occupy the same physical space)
+    spacing = []
+    spacing.append(round(mask.GetSpacing()[0], n_of_digits))
+    spacing.append(round(mask.GetSpacing()[1], n_of_digits))
+    spacing.append(round(mask.GetSpacing()[2], n_of_digits))
+    mask.SetSpacing(spacing)
+
+    return mask
+
+
 def overlap_measures(mask_1, mask_2):
 
     # make sure the masks have the same type
@@ -392,19 +571,8 @@ def overlap_measures(mask_1, mask_2):
     mask_2 = sitk.Cast(mask_2,sitk.sitkInt8)
 
     # makes sure that the masks have spacing approximated at the same decimal
-    # (error: Inputs do not occupy the same physical space)
-    spacing_1    = mask_1.GetSpacing() # it's a tuple
-    spacing_1    = list(spacing_1)
-    spacing_1[0] = round(spacing_1[0], 4)
-    spacing_1[1] = round(spacing_1[1], 4)
-    spacing_1[2] = round(spacing_1[2], 4)
-    mask_1.SetSpacing(spacing_1)
-    spacing_2    = mask_2.GetSpacing() # it's a tuple
-    spacing_2    = list(spacing_2)
-    spacing_2[0] = round(spacing_2[0], 4)
-    spacing_2[1] = round(spacing_2[1], 4)
-    spacing_2[2] = round(spacing_2[2], 4)
-    mask_2.SetSpacing(spacing_2)
+    mask_1 = round_spacing(mask_1)
+    mask_2 = round_spacing(mask_2)
 
     # calculate dice coefficient, jaccard coefficient, and volume similarity
     filter    = sitk.LabelOverlapMeasuresImageFilter()
@@ -416,6 +584,97 @@ def overlap_measures(mask_1, mask_2):
     return dice_coeff, jacc_coeff, vol_simil
 
 
+def overlap_measures_py(mask_1_py, mask_2_py):
+
+    """
+    Same as overlap_measures, but computed on numpy arrays of binary masks (non zero voxels are the label)
+    Definitions are the ones of LabelOverlapMeasuresImageFilter (mask_1 is the source and mask_2 is the target)
+    Two empty masks are identical: dice and jaccard coefficients are 1 and volume similarity is 0
+    """
+
+    # voxel counts
+    mask_1_py     = mask_1_py != 0
+    mask_2_py     = mask_2_py != 0
+    n_of_voxels_1 = np.count_nonzero(mask_1_py)
+    n_of_voxels_2 = np.count_nonzero(mask_2_py)
+    intersection  = np.count_nonzero(mask_1_py & mask_2_py)
+    union         = n_of_voxels_1 + n_of_voxels_2 - intersection
+    if union == 0:
+        return 1.0, 1.0, 0.0
+
+    # calculate dice coefficient, jaccard coefficient, and volume similarity
+    dice_coeff = 2.0 * intersection / (n_of_voxels_1 + n_of_voxels_2)
+    jacc_coeff = intersection / union
+    vol_simil  = 2.0 * (n_of_voxels_1 - n_of_voxels_2) / (n_of_voxels_1 + n_of_voxels_2)
+
+    return dice_coeff, jacc_coeff, vol_simil
+
+
+def masks_to_labels(masks):
+
+    """
+    Combines binary masks in one label image, where the voxels of masks[a] have label a+1
+    If masks overlap, the voxels in the overlap get the label of the last mask, so the label image is exact only when the number
+    of overlapping voxels (returned) is zero
+    """
+
+    labels_py = np.zeros(sitk.GetArrayViewFromImage(masks[0]).shape, dtype=np.uint8)
+    n_of_overlapping_voxels = 0
+    for a in range(0, len(masks)):
+        mask_py = sitk.GetArrayViewFromImage(masks[a]) != 0
+        n_of_overlapping_voxels = n_of_overlapping_voxels + np.count_nonzero(mask_py & (labels_py != 0))
+        labels_py[mask_py] = a + 1
+
+    # back to SimpleITK
+    labels = sitk.GetImageFromArray(labels_py)
+    labels.SetSpacing  (masks[0].GetSpacing())
+    labels.SetOrigin   (masks[0].GetOrigin())
+    labels.SetDirection(masks[0].GetDirection())
+
+    return labels, n_of_overlapping_voxels
+
+
+def multi_label_overlap_measures(labels_1, labels_2, n_of_labels):
+
+    """
+    Same as overlap_measures, but for label images. The filter is executed once and queried for each label (from 1 to n_of_labels)
+    Labels missing from one or both images are not queried: they are measured from the voxel counts as in overlap_measures_py
+    Outputs are lists with one value per label
+    """
+
+    # make sure the label images have the same type
+    labels_1 = sitk.Cast(labels_1,sitk.sitkUInt8)
+    labels_2 = sitk.Cast(labels_2,sitk.sitkUInt8)
+
+    # makes sure that the label images have spacing approximated at the same decimal
+    labels_1 = round_spacing(labels_1)
+    labels_2 = round_spacing(labels_2)
+
+    # calculate dice coefficient, jaccard coefficient, and volume similarity
+    filter    = sitk.LabelOverlapMeasuresImageFilter()
+    filter.Execute(labels_1, labels_2)
+    dice_coeff = []
+    jacc_coeff = []
+    vol_simil  = []
+
+    # voxels of each label in the two images
+    counts_1 = np.bincount(sitk.GetArrayViewFromImage(labels_1).ravel(), minlength=n_of_labels+1)
+    counts_2 = np.bincount(sitk.GetArrayViewFromImage(labels_2).ravel(), minlength=n_of_labels+1)
+
+    for label in range(1, n_of_labels+1):
+        if counts_1[label] == 0 and counts_2[label] == 0:
+            dice, jacc, vols = 1.0, 1.0, 0.0
+        elif counts_1[label] == 0 or counts_2[label] == 0:
+            dice, jacc, vols = 0.0, 0.0, 2.0 * (counts_1[label] - counts_2[label]) / (counts_1[label] + counts_2[label])
+        else:
+            dice, jacc, vols = filter.GetDiceCoefficient(label), filter.GetJaccardCoefficient(label), filter.GetVolumeSimilarity(label)
+        dice_coeff.append(dice)
+        jacc_coeff.append(jacc)
+        vol_simil.append (float(vols))
+
+    return dice_coeff, jacc_coeff, vol_simil
+
+
 def hausdorff_distance(mask_1, mask_2):
 
     # calculate Hausdorff distance
@@ -426,61 +685,115 @@ def hausdorff_distance(mask_1, mask_2):
     return hausdorff_distance
 
 
-def mask_euclidean_distance(mask_1,mask_2):
+def bounding_box(masks, margin):
+
+    """
+    Calculates the bounding box of the union of the masks, enlarged by margin voxels and limited to the image extent
+    Input:
+        masks: list of masks with the same size
+        margin: number of voxels added on each side
+    Outputs:
+        index and size of the bounding box (in SimpleITK order, as for sitk.RegionOfInterest). If all the masks are empty, index is None
+    """
+
+    # union of the masks
+    union_py = sitk.GetArrayViewFromImage(masks[0]) != 0
+    for a in range(1, len(masks)):
+        union_py = union_py | (sitk.GetArrayViewFromImage(masks[a]) != 0)
+
+    if not union_py.any():
+        return None, None
+
+    # extent in each numpy direction (z,y,x)
+    lower = []
+    upper = []
+    for axis in range(0, 3):
+        other_axes = tuple([a for a in range(0, 3) if a != axis])
+        non_zero   = np.nonzero(np.any(union_py, axis=other_axes))[0]
+        lower.append(max(int(non_zero[0]) - margin, 0))
+        upper.append(min(int(non_zero[-1]) + margin, union_py.shape[axis] - 1))
+
+    # from numpy order (z,y,x) to SimpleITK order (x,y,z)
+    index = [lower[2], lower[1], lower[0]]
+    size  = [upper[2] - lower[2] + 1, upper[1] - lower[1] + 1, upper[0] - lower[0] + 1]
+
+    return index, size
+
+
+def surface_distances(mask_1, mask_2, method="distance_map", margin=2):
 
     """
     Code modified from the SimpleITK example notebook: http://insightsoftwareconsortium.github.io/SimpleITK-Notebooks/Python_html/34_Segmentation_Evaluation.html
     Steps of the function:
+    - Crop both masks to the bounding box of their union plus margin voxels. Distances and contours do not change, as all the contours are in the box
     - In mask_1, calculate the distances between each point of the mask and the mask contour, to obtain a map of distances. Do the same for mask_2.
-    - Multiply the map of distances of mask_1 and the contour of mask_2. This is an implicit way to extract the distances corresponding to the contour of mask_2 from mask_1 distance map. Do the same for mask_2.
-    - Convert the masked maps to numpy
-    - Extract all the points that are not zero, and pad the difference between this last array and the number of points with zeros (there could be some distances == 0)
-
+    - Extract the distances of the mask_1 distance map at the contour voxels of mask_2. Do the same for mask_2.
+    With method="kd_tree", distances are calculated from the contour voxels of one mask to the closest contour voxel of the other mask
+    using a KD-tree, without distance maps (faster for very thin structures). Values are close to, but not the same as, the ones of the distance maps
 
     Input:
         mask_1 and mask 2: two masks to compare (usually one is a newly segmented mask and the other is a ground truth mask)
-    Outputs:
-        average surface distance, root mean square distance, and maximum distance
+        method: "distance_map" or "kd_tree"
+        margin: voxels added around the bounding box (at least 1)
+    Output:
+        numpy array with the distances from the contour of mask_2 to mask_1 followed by the distances from the contour of mask_1 to mask_2
     """
 
-    # Use the absolute values of the distance map to compute the surface distances (distance map sign, outside or inside
-    # relationship, is irrelevant)
-    mask_1_distance_map = sitk.Abs(sitk.SignedMaurerDistanceMap(mask_1, squaredDistance=False))
-    mask_1_surface = sitk.LabelContour(mask_1)
+    # crop the masks around the structures
+    index, size = bounding_box([mask_1, mask_2], max(margin, 1))
+    if index is not None:
+        mask_1 = sitk.RegionOfInterest(mask_1, size, index)
+        mask_2 = sitk.RegionOfInterest(mask_2, size, index)
+
+    # contours
+    mask_1_surface    = sitk.LabelContour(mask_1)
+    mask_2_surface    = sitk.LabelContour(mask_2)
+    mask_1_surface_py = sitk.GetArrayViewFromImage(mask_1_surface) != 0
+    mask_2_surface_py = sitk.GetArrayViewFromImage(mask_2_surface) != 0
+
+    if method == "kd_tree":
 
-    # Symmetric surface distance measures
-    mask_2_distance_map = sitk.Abs(sitk.SignedMaurerDistanceMap(mask_2, squaredDistance=False))
-    mask_2_surface = sitk.LabelContour(mask_2)
+        from scipy.spatial import cKDTree
 
-    # Multiply the binary surface segmentations with the distance maps. The resulting distance
-    # maps contain non-zero values only on the surface (they can also contain zero on the surface)
-    m1_to_m2_distance_map = mask_1_distance_map*sitk.Cast(mask_2_surface, sitk.sitkFloat32)
-    m2_to_m1_distance_map = mask_2_distance_map*sitk.Cast(mask_1_surface, sitk.sitkFloat32)
+        # contour voxel coordinates (voxel units, as the distance maps)
+        mask_1_points = np.argwhere(mask_1_surface_py)
+        mask_2_points = np.argwhere(mask_2_surface_py)
 
-    statistics_image_filter = sitk.StatisticsImageFilter()
+        # closest point distances
+        m1_to_m2_distances, i = cKDTree(mask_1_points).query(mask_2_points)
+        m2_to_m1_distances, i = cKDTree(mask_2_points).query(mask_1_points)
 
-    # Get the number of pixels in the mask_1 surface by counting all pixels that are 1
-    statistics_image_filter.Execute(mask_1_surface)
-    num_mask_1_surface_pixels = int(statistics_image_filter.GetSum())
+    else:
 
-    # Get the number of pixels in the mask_2 surface by counting all pixels that are 1
-    statistics_image_filter.Execute(mask_2_surface)
-    num_mask_2_surface_pixels = int(statistics_image_filter.GetSum())
+        # Use the absolute values of the distance map to compute the surface distances (distance map sign, outside or inside
+        # relationship, is irrelevant)
+        mask_1_distance_map = sitk.Abs(sitk.SignedMaurerDistanceMap(mask_1, squaredDistance=False))
+        mask_2_distance_map = sitk.Abs(sitk.SignedMaurerDistanceMap(mask_2, squaredDistance=False))
 
-    # Get all non-zero distances and then add zero distances if required.
-    m1_to_m2_distance_map_arr = sitk.GetArrayViewFromImage(m1_to_m2_distance_map)
-    m1_to_m2_distances = list(m1_to_m2_distance_map_arr[m1_to_m2_distance_map_arr!=0])
-    m1_to_m2_distances = m1_to_m2_distances + list(np.zeros(num_mask_2_surface_pixels - len(m1_to_m2_distances)))
+        # Get the distances at the surface voxels (distances can be zero on the surface)
+        m1_to_m2_distances = sitk.GetArrayViewFromImage(mask_1_distance_map)[mask_2_surface_py]
+        m2_to_m1_distances = sitk.GetArrayViewFromImage(mask_2_distance_map)[mask_1_surface_py]
 
-    m2_to_m1_distance_map_arr = sitk.GetArrayViewFromImage(m2_to_m1_distance_map)
-    m2_to_m1_distances = list(m2_to_m1_distance_map_arr[m2_to_m1_distance_map_arr!=0])
-    m2_to_m1_distances = m2_to_m1_distances + list(np.zeros(num_mask_1_surface_pixels - len(m2_to_m1_distances)))
+    all_surface_distances = np.concatenate((m1_to_m2_distances, m2_to_m1_distances)).astype(np.float64)
+
+    return all_surface_distances
+
+
+def mask_euclidean_distance(mask_1,mask_2, method="distance_map"):
+
+    """
+    Input:
+        mask_1 and mask 2: two masks to compare (usually one is a newly segmented mask and the other is a ground truth mask)
+        method: "distance_map" or "kd_tree" (see surface_distances)
+    Outputs:
+        average and standard deviation of the surface distances computed by surface_distances
+    """
 
-    all_surface_distances = m1_to_m2_distances + m2_to_m1_distances
+    all_surface_distances = surface_distances(mask_1, mask_2, method)
 
     # average surface distance
     mean_distance = np.mean(all_surface_distances)
-    # maximum distance
+    # standard deviation
     stddev_distance = np.std(all_surface_distances)
 
     return mean_distance, stddev_distance
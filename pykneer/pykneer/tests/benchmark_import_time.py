@@ -0,0 +1,97 @@
+# Serena Bonaretti, 2019
+
+"""
+Benchmark of the import time of pyKNEEr modules
+Each import runs in a new python process (cold start, as for the processes of multiprocessing.Pool() with spawn),
+and the median over the repeats is reported. The script also checks that the modules used by the workers do not import
+the slow dependencies used only for plotting, tables, and widgets (matplotlib, pandas, ipywidgets, pkg_resources)
+
+Usage (from the folder tests):
+    python benchmark_import_time.py
+    python benchmark_import_time.py --repeats 10
+The exit code is 1 when a worker module imports a slow dependency
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+
+# pyKNEEr package folder (the parent of this folder is the package pykneer)
+package_parent_folder = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# modules to import
+modules = ["pykneer",
+           "pykneer.sitk_functions",
+           "pykneer.morphology_functions",
+           "pykneer.relaxometry_functions",
+           "pykneer.preprocessing_for_nb",
+           "pykneer.segmentation_sa_for_nb",
+           "pykneer.segmentation_ma_for_nb",
+           "pykneer.morphology_for_nb",
+           "pykneer.relaxometry_for_nb",
+           "pykneer.segmentation_quality_for_nb"]
+
+# dependencies that only the visualization functions need
+slow_dependencies = ["matplotlib", "pandas", "ipywidgets", "pkg_resources", "scipy.optimize", "skimage"]
+
+# code run in the new process
+import_code = """
+import json, sys, time
+start_time = time.perf_counter()
+import %s
+import_time = time.perf_counter() - start_time
+print (json.dumps({"time_s" : import_time, "n_of_modules" : len(sys.modules), "loaded" : [m for m in %r if m in sys.modules]}))
+"""
+
+
+def import_time(module, n_of_repeats):
+
+    times = []
+    for r in range(0, n_of_repeats):
+        env    = dict(os.environ, PYTHONPATH=package_parent_folder + os.pathsep + os.environ.get("PYTHONPATH", ""))
+        output = subprocess.run([sys.executable, "-c", import_code % (module, slow_dependencies)],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, env=env)
+        if output.returncode != 0:
+            return {"module" : module, "error" : output.stderr.strip().split("\n")[-1]}
+        result = json.loads(output.stdout.strip().split("\n")[-1])
+        times.append(result["time_s"])
+
+    result["module"] = module
+    result["time_s"] = float(np.median(times))
+
+    return result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Import time of pyKNEEr modules")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    # the modules _functions are the ones used by the workers: they must not load the slow dependencies
+    n_of_failures = 0
+    print ("%-40s %10s %10s  %s" % ("module", "time [s]", "modules", "slow dependencies loaded"))
+    for module in modules:
+        result = import_time(module, args.repeats)
+        if "error" in result:
+            print ("%-40s %10s %10s  ERROR: %s" % (module, "-", "-", result["error"]))
+            n_of_failures = n_of_failures + 1
+            continue
+        print ("%-40s %10.3f %10d  %s" % (module, result["time_s"], result["n_of_modules"], ", ".join(result["loaded"])))
+        if len(result["loaded"]) > 0 and (module == "pykneer" or module.endswith("_functions")):
+            n_of_failures = n_of_failures + 1
+
+    if n_of_failures > 0:
+        print ("-> %d modules import slow dependencies or cannot be imported" % n_of_failures)
+        return 1
+    print ("-> No slow dependencies imported by the worker modules")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# Serena Bonaretti, 2019
+
+"""
+Benchmark of multi-atlas segmentation: accuracy versus runtime for several numbers of preselected atlases and fusion methods
+Each image is segmented once with its max(--atlases) most similar atlases. The masks of the first k atlases are then fused
+for each k and fusion method, and compared to the ground truth with the quality measures of segmentation_quality_for_nb.py
+Needs elastix, the atlases, and the ground truth masks (input files as segmentation_ma.ipynb and segmentation_quality.ipynb)
+
+Usage (from the folder tests):
+    python benchmark_multi_atlas.py image_list_ma.txt image_list_quality.txt
+    python benchmark_multi_atlas.py image_list_ma.txt image_list_quality.txt --atlases 1 3 5 7 --fusion weighted -n 8
+The ground truth masks are matched to the fused masks by name (segmented_name in the quality input file). The runtime of an
+image is the share of the preselection, plus the time of its k segmentations, plus the share of the fusion (in process time, without parallelization)
+"""
+
+import argparse
+import collections
+import copy
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# pyKNEEr modules from the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import pykneer_io                  as io
+import segmentation_ma_for_nb      as ma
+import segmentation_quality_for_nb as sq
+
+
+def fused_image_data(all_image_data, n_of_atlases, fusion_method):
+
+    # image data restricted to the first n_of_atlases atlases, with the fused masks in their own folder
+    all_fused_data = copy.deepcopy(all_image_data)
+    for image_data in all_fused_data:
+        image_data["selected_atlas_names"] = image_data["selected_atlas_names"][0:n_of_atlases]
+        image_data["atlas_weights"]        = image_data["atlas_weights"][0:n_of_atlases]
+        image_data["atlas_times"]          = image_data["atlas_times"][0:n_of_atlases]
+        image_data["segmented_folder"]     = image_data["segmented_folder"] + "k%d_%s" % (n_of_atlases, fusion_method) + io.folder_divider()
+        if not os.path.isdir(image_data["segmented_folder"]):
+            os.makedirs(image_data["segmented_folder"])
+
+    return all_fused_data
+
+
+def quality_of_fused_masks(all_fused_data, all_quality_data):
+
+    # quality of the fused masks that have a ground truth
+    qualities = []
+    for quality_data in all_quality_data:
+        for image_data in all_fused_data:
+            if quality_data["segmented_name"] in [image_data[image_data["bone"] + "mask"], image_data[image_data["cartilage"] + "mask"]]:
+                quality_data = dict(quality_data, segmented_folder=image_data["segmented_folder"])
+                qualities.append(sq.compute_quality_s(quality_data))
+
+    return qualities
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="pyKNEEr multi-atlas segmentation: accuracy versus runtime")
+    parser.add_argument("input_file_name",         help="input file of multi-atlas segmentation (as segmentation_ma.ipynb)")
+    parser.add_argument("quality_input_file_name", help="input file of segmentation quality (as segmentation_quality.ipynb)")
+    parser.add_argument("--atlases",   nargs="+", type=int, default=[1, 3, 5])
+    parser.add_argument("--fusion",    nargs="+", default=["majority", "weighted"], choices=["majority", "weighted"])
+    parser.add_argument("-n",          type=int, default=1, help="number of processes")
+    parser.add_argument("--output",    default="", help="json file for the results")
+    args = parser.parse_args()
+
+    all_image_data   = io.load_image_data_segmentation_ma(args.input_file_name)
+    all_quality_data = io.load_image_data_segmentation_quality(args.quality_input_file_name)
+    if len(all_image_data) == 0 or len(all_quality_data) == 0:
+        return 1
+    n_of_images = len(all_image_data)
+
+    # segmentation with the largest number of atlases (the first k atlases are the k most similar ones)
+    start_time = time.time()
+    ma.preselect_atlases(all_image_data, max(args.atlases), args.n)
+    preselection_time = time.time() - start_time
+    ma.prepare_atlases     (all_image_data, args.n)
+    ma.segment_with_atlases(all_image_data, args.n)
+
+    # fusion and quality for each number of atlases and fusion method
+    results = collections.OrderedDict()
+    for n_of_atlases in sorted(args.atlases):
+        for fusion_method in args.fusion:
+            all_fused_data = fused_image_data(all_image_data, n_of_atlases, fusion_method)
+            start_time = time.time()
+            ma.fuse_labels(all_fused_data, fusion_method, args.n)
+            fusion_time = time.time() - start_time
+            qualities   = quality_of_fused_masks(all_fused_data, all_quality_data)
+            if len(qualities) == 0:
+                print ("ERROR: No ground truth mask has the name of a fused mask")
+                return 1
+            image_times = [(preselection_time + fusion_time) / n_of_images + np.sum(image_data["atlas_times"]) for image_data in all_fused_data]
+            results["k%d/%s" % (n_of_atlases, fusion_method)] = {
+                "n_of_atlases"     : n_of_atlases,
+                "fusion_method"    : fusion_method,
+                "dice_mean"        : float(np.mean([quality["dice_coeff"]     for quality in qualities])),
+                "dice_std"         : float(np.std ([quality["dice_coeff"]     for quality in qualities])),
+                "distance_mean_mm" : float(np.mean([quality["mean_distances"] for quality in qualities])),
+                "time_per_image_s" : float(np.mean(image_times)),
+                "n_of_masks"       : len(qualities)}
+
+    # table
+    print ("")
+    print ("%-8s %-9s %14s %14s %18s" % ("atlases", "fusion", "Dice", "distance [mm]", "time/image [s]"))
+    for key in results:
+        result = results[key]
+        print ("%-8d %-9s %7.3f +/- %.3f %14.3f %18.1f" % (result["n_of_atlases"], result["fusion_method"], result["dice_mean"],
+                                                          result["dice_std"], result["distance_mean_mm"], result["time_per_image_s"]))
+
+    if args.output != "":
+        with open(args.output, "w") as file:
+            json.dump({"n_of_images" : n_of_images, "results" : results}, file, indent=2)
+        print ("-> Results saved as: " + args.output)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
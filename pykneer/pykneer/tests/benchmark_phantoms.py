@@ -0,0 +1,189 @@
+# Serena Bonaretti, 2019
+
+"""
+Module with synthetic knee-like images for the benchmarks in benchmark_pipeline.py
+Images are generated (no download needed) in the orientation given by the preprocessing: sagittal slices along x (numpy axis 2)
+The phantom has:
+    - a femur: cylinder with the axis along x
+    - a femoral cartilage: shell around the posterior and distal part of the femur
+    - background noise and a smooth intensity bias (for the field correction)
+Functions:
+    - phantom_size
+    - knee_image
+    - cartilage_mask
+    - perturbed_mask
+    - multi_echo_images
+    - dess_images
+    - write_dicom_series
+"""
+
+import os
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+
+# image sizes in numpy order (z, y, x) - x is the sagittal direction
+sizes = {"small"  : ( 48,  64,  32),
+         "medium" : ( 96, 128,  64),
+         "large"  : (160, 256, 128)}
+
+# voxel spacing of all sizes is scaled so that the phantom has the same physical size (mm)
+field_of_view = (120.0, 160.0, 100.0)
+
+
+def phantom_size(size_name):
+
+    # shape and spacing (sitk order) for a size name
+    shape   = sizes[size_name]
+    spacing = (field_of_view[2] / shape[2], field_of_view[1] / shape[1], field_of_view[0] / shape[0])
+
+    return shape, spacing
+
+
+def femur_geometry(shape):
+
+    # distance from the femur axis (along x) and angle around it, in voxels of the yz-plane
+    z, y   = np.mgrid[0:shape[0], 0:shape[1]]
+    cz, cy = shape[0] * 0.55, shape[1] * 0.5
+    radius = np.hypot((z - cz) / shape[0], (y - cy) / shape[1]) # normalized to the image size
+    angle  = np.arctan2(z - cz, y - cy)
+
+    return radius, angle
+
+
+def to_image(array_py, spacing):
+
+    img = sitk.GetImageFromArray(array_py)
+    img.SetSpacing(spacing)
+
+    return img
+
+
+def cartilage_mask(size_name):
+
+    """
+    Binary mask (UInt8) of the femoral cartilage: shell of the femur cylinder, open anteriorly, with medial and lateral ends
+    """
+
+    shape, spacing = phantom_size(size_name)
+    radius, angle  = femur_geometry(shape)
+
+    # shell covering about 3/4 of the circle
+    shell = (radius >= 0.22) & (radius <= 0.26) & (angle < 1.6)
+
+    # medial and lateral ends of the cartilage
+    mask_py = np.zeros(shape, dtype=np.uint8)
+    x_start = int(shape[2] * 0.15)
+    x_end   = int(shape[2] * 0.85)
+    mask_py[:, :, x_start:x_end] = shell[:, :, None]
+
+    return to_image(mask_py, spacing)
+
+
+def perturbed_mask(size_name, shift=1):
+
+    """
+    Cartilage mask shifted by shift voxels along y and z (second segmentation for the quality metrics)
+    """
+
+    mask_py = sitk.GetArrayFromImage(cartilage_mask(size_name))
+    mask_py = np.roll(mask_py, shift, axis=0)
+    mask_py = np.roll(mask_py, shift, axis=1)
+    shape, spacing = phantom_size(size_name)
+
+    return to_image(mask_py, spacing)
+
+
+def knee_image(size_name, seed=0):
+
+    """
+    Int16 image with femur (bright), cartilage (intermediate), background noise, and a smooth intensity bias
+    """
+
+    rng            = np.random.default_rng(seed)
+    shape, spacing = phantom_size(size_name)
+    radius, angle  = femur_geometry(shape)
+
+    # tissues
+    img_py = np.full(shape, 80.0)
+    femur  = radius < 0.22
+    img_py[np.broadcast_to(femur[:, :, None], shape)] = 400.0
+    img_py[sitk.GetArrayFromImage(cartilage_mask(size_name)) == 1] = 250.0
+
+    # smooth bias along z and noise
+    bias   = 1.0 + 0.3 * np.linspace(-1, 1, shape[0])[:, None, None]
+    img_py = img_py * bias + rng.normal(0, 15, shape)
+    img_py[img_py < 0] = 0
+
+    return to_image(img_py.astype(np.int16), spacing)
+
+
+def multi_echo_images(size_name, echo_times=(10.0, 20.0, 40.0, 60.0), seed=0):
+
+    """
+    Images of a multi-echo acquisition: S = S0 * exp(-TE/T2) with T2 = 40 ms in cartilage and 20 ms elsewhere
+    Returns the list of Int16 images and the echo times
+    """
+
+    rng            = np.random.default_rng(seed)
+    shape, spacing = phantom_size(size_name)
+    s0             = sitk.GetArrayFromImage(knee_image(size_name, seed)).astype(float)
+    t2             = np.full(shape, 20.0)
+    t2[sitk.GetArrayFromImage(cartilage_mask(size_name)) == 1] = 40.0
+
+    images = []
+    for te in echo_times:
+        echo_py = s0 * np.exp(-te / t2) + rng.normal(0, 2, shape)
+        echo_py[echo_py < 1] = 1
+        images.append(to_image(echo_py.astype(np.int16), spacing))
+
+    return images, list(echo_times)
+
+
+def dess_images(size_name, seed=0):
+
+    """
+    The two echoes of a DESS acquisition (the second echo is attenuated more in cartilage)
+    """
+
+    images, echo_times = multi_echo_images(size_name, (5.0, 30.0), seed)
+
+    return images[0], images[1]
+
+
+def write_dicom_series(img, folder):
+
+    """
+    Writes img as a DICOM series (one file per slice along z) with the tags used by pyKNEEr
+    """
+
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    modification_time = time.strftime("%H%M%S")
+    modification_date = time.strftime("%Y%m%d")
+    direction         = img.GetDirection()
+    tags = [("0008|0031", modification_time),
+            ("0008|0021", modification_date),
+            ("0008|0008", "DERIVED\\SECONDARY"),
+            ("0020|000d", "1.2.826.0.1.3680043.2.1125.1" + modification_date + modification_time),
+            ("0020|000e", "1.2.826.0.1.3680043.2.1125.2" + modification_date + modification_time),
+            ("0020|0037", "\\".join(map(str, (direction[0], direction[3], direction[6], direction[1], direction[4], direction[7])))),
+            ("0008|103e", "pykneer benchmark"),
+            ("0018|0080", "20.0"),
+            ("0018|0081", "10.0"),
+            ("0018|1314", "25.0"),
+            ("0008|0060", "MR")]
+
+    for i in range(0, img.GetSize()[2]):
+        slice = img[:, :, i]
+        for key, value in tags:
+            slice.SetMetaData(key, value)
+        slice.SetMetaData("0020|0032", "\\".join(map(str, img.TransformIndexToPhysicalPoint((0, 0, i)))))
+        slice.SetMetaData("0020|0013", str(i))
+        writer.SetFileName(os.path.join(folder, "IM%04d.dcm" % i))
+        writer.Execute(slice)
@@ -0,0 +1,426 @@
+# Serena Bonaretti, 2019
+
+"""
+Benchmarks of the pyKNEEr functions on the synthetic images of benchmark_phantoms.py (no demo images or network needed)
+Each benchmark runs in its own process, so that time and memory (RSS) of one benchmark do not affect the others.
+Results are compared to the baseline in benchmark_baseline.json, which can come from another machine. Therefore:
+    - time is measured as ratio to the time of a calibration kernel (numpy and SimpleITK operations) run in the same process
+    - memory is measured as increase of the resident memory during the benchmark (peak minus memory before the benchmark),
+      which does not depend on the memory used by the imported libraries
+A benchmark is a regression when its time ratio or its memory increase is larger than the baseline multiplied by the tolerance.
+
+Usage (from the folder tests):
+    python benchmark_pipeline.py                          # all benchmarks, sizes small and medium, compare to baseline
+    python benchmark_pipeline.py --sizes small large      # other sizes
+    python benchmark_pipeline.py --filter morphology      # only benchmarks whose name contains "morphology"
+    python benchmark_pipeline.py --update-baseline        # save the current results as baseline
+    python benchmark_pipeline.py --repeats 10             # more repeats (at least 5)
+    python benchmark_pipeline.py --output results.json    # save the current results
+The exit code is 1 when there is at least one regression (for continuous integration)
+
+Benchmarks:
+    - preprocessing: sitk_functions.orientation_to_rai, field_correction, rescale_to_range, edge_preserving_smoothing
+    - segmentation:  sitk_functions.dilate_mask, binary2levelset, levelset2binary,
+                     segmentation_ma_for_nb.image_features, fuse_masks
+    - morphology:    morphology_functions.separate_cartilage, flatten_point_cloud, nearest_neighbor_thickness
+    - relaxometry:   relaxometry_functions.calculate_fitting_maps_lin, calculate_fitting_maps_exp, calculate_t2_maps_from_dess
+    - quality:       sitk_functions.overlap_measures, surface_distances
+    - io:            sitk_functions.write_mask/read_mask, read_dicom_stack, pykneer_io.write_np_array_to_txt/read_txt_to_np_array
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+# pyKNEEr modules are in the parent folder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import sitk_functions        as sitkf
+import morphology_functions  as mf
+import relaxometry_functions as rf
+import pykneer_io            as io
+import segmentation_ma_for_nb as ma
+
+import benchmark_phantoms    as bp
+
+
+baseline_file_name = os.path.join(os.path.dirname(os.path.realpath(__file__)), "benchmark_baseline.json")
+
+# a benchmark is a regression when time ratio > time_tolerance * baseline + time_slack (and same for memory increase)
+time_tolerance   = 1.5
+time_slack       = 0.5  # calibration times - avoids false alarms for very fast benchmarks
+memory_tolerance = 1.3
+memory_slack     = 20.0 # MB
+
+# minimum of the repeats of each benchmark and of the calibration (the minimum time over fewer repeats is too noisy)
+min_repeats = 5
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# BENCHMARKS ----------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+# Each function prepares the data (not timed) and returns the function to time
+
+def preprocessing_orientation_to_rai(size_name, work_folder):
+    img = bp.knee_image(size_name)
+    img.SetDirection((0,0,1, 1,0,0, 0,-1,0))
+    return lambda: sitkf.orientation_to_rai(img)
+
+def preprocessing_field_correction(size_name, work_folder):
+    img = bp.knee_image(size_name)
+    return lambda: sitkf.field_correction(img)
+
+def preprocessing_rescale_to_range(size_name, work_folder):
+    img = sitk.Cast(bp.knee_image(size_name), sitk.sitkFloat32)
+    return lambda: sitkf.rescale_to_range(img)
+
+def preprocessing_edge_preserving_smoothing(size_name, work_folder):
+    img = sitk.Cast(bp.knee_image(size_name), sitk.sitkFloat32)
+    return lambda: sitkf.edge_preserving_smoothing(img)
+
+def segmentation_dilate_mask(size_name, work_folder):
+    # radius of the reference dilation in prepare_reference
+    mask = bp.cartilage_mask(size_name)
+    return lambda: sitkf.dilate_mask(mask, 15)
+
+def segmentation_binary2levelset(size_name, work_folder):
+    mask = bp.cartilage_mask(size_name)
+    return lambda: sitkf.binary2levelset(mask)
+
+def segmentation_levelset2binary(size_name, work_folder):
+    mask_LS = sitkf.binary2levelset(bp.cartilage_mask(size_name), crop_flag=0)
+    return lambda: sitkf.levelset2binary(mask_LS)
+
+def segmentation_atlas_features(size_name, work_folder):
+    file_name = os.path.join(work_folder, "knee.mha")
+    sitk.WriteImage(bp.knee_image(size_name), file_name)
+    return lambda: ma.image_features(file_name)
+
+def segmentation_label_fusion(size_name, work_folder):
+    # masks warped from 5 atlases, fused with the weights of the atlas similarity
+    masks = [bp.perturbed_mask(size_name, shift) for shift in range(-2, 3)]
+    return lambda: ma.fuse_masks(masks, [0.9, 0.8, 0.7, 0.6, 0.5])
+
+def morphology_separate_cartilage(size_name, work_folder):
+    mask = bp.cartilage_mask(size_name)
+    return lambda: mf.separate_cartilage(mask)
+
+def morphology_flatten_point_cloud(size_name, work_folder):
+    arti_cart, bone_cart = mf.separate_cartilage(bp.cartilage_mask(size_name))
+    return lambda: mf.flatten_point_cloud(bone_cart)
+
+def morphology_nearest_neighbor_thickness(size_name, work_folder):
+    arti_cart, bone_cart = mf.separate_cartilage(bp.cartilage_mask(size_name))
+    return lambda: mf.nearest_neighbor_thickness(bone_cart, arti_cart)
+
+def masked_echo_arrays(size_name, n_of_voxels=None):
+    # values of the echoes in the cartilage, as in relaxometry_for_nb.calculate_fitting_maps_s
+    images, echo_times = bp.multi_echo_images(size_name)
+    mask_py = sitk.GetArrayFromImage(bp.cartilage_mask(size_name)).ravel()
+    index   = np.where(mask_py != 0)[0]
+    if n_of_voxels is not None:
+        index = index[0:n_of_voxels]
+    arrays  = [sitk.GetArrayFromImage(img).ravel()[index] for img in images]
+    return echo_times, arrays
+
+def relaxometry_fitting_lin(size_name, work_folder):
+    echo_times, arrays = masked_echo_arrays(size_name)
+    return lambda: rf.calculate_fitting_maps_lin(echo_times, list(arrays))
+
+def relaxometry_fitting_exp(size_name, work_folder):
+    # voxel-wise non-linear fitting: a fixed number of voxels for all sizes
+    echo_times, arrays = masked_echo_arrays(size_name, 300)
+    return lambda: rf.calculate_fitting_maps_exp(echo_times, list(arrays))
+
+def relaxometry_t2_dess(size_name, work_folder):
+    echo_1, echo_2 = bp.dess_images(size_name)
+    return lambda: rf.calculate_t2_maps_from_dess(echo_1, echo_2, 20.0, 5.0, 25.0)
+
+def quality_overlap_measures(size_name, work_folder):
+    mask_1 = bp.cartilage_mask(size_name)
+    mask_2 = bp.perturbed_mask(size_name)
+    return lambda: sitkf.overlap_measures(mask_1, mask_2)
+
+def quality_surface_distances(size_name, work_folder):
+    mask_1 = bp.cartilage_mask(size_name)
+    mask_2 = bp.perturbed_mask(size_name)
+    return lambda: sitkf.surface_distances(mask_1, mask_2)
+
+def io_write_read_mask(size_name, work_folder):
+    mask      = bp.cartilage_mask(size_name)
+    file_name = os.path.join(work_folder, "mask.mha")
+    def run():
+        sitkf.write_mask(mask, file_name, 1)
+        sitkf.read_mask(file_name)
+    return run
+
+def io_read_dicom_stack(size_name, work_folder):
+    folder = os.path.join(work_folder, "dicom")
+    bp.write_dicom_series(bp.knee_image(size_name), folder)
+    def run():
+        sitkf.dicom_scans.clear() # read from disk every time
+        sitkf.read_dicom_stack(folder)
+    return run
+
+def io_txt_arrays(size_name, work_folder):
+    arti_cart, bone_cart = mf.separate_cartilage(bp.cartilage_mask(size_name))
+    file_name = os.path.join(work_folder, "points.txt")
+    def run():
+        io.write_np_array_to_txt(bone_cart, file_name)
+        io.read_txt_to_np_array(file_name)
+    return run
+
+benchmarks = collections.OrderedDict([
+    ("preprocessing_orientation_to_rai",        preprocessing_orientation_to_rai),
+    ("preprocessing_field_correction",          preprocessing_field_correction),
+    ("preprocessing_rescale_to_range",          preprocessing_rescale_to_range),
+    ("preprocessing_edge_preserving_smoothing", preprocessing_edge_preserving_smoothing),
+    ("segmentation_dilate_mask",                segmentation_dilate_mask),
+    ("segmentation_binary2levelset",            segmentation_binary2levelset),
+    ("segmentation_levelset2binary",            segmentation_levelset2binary),
+    ("segmentation_atlas_features",             segmentation_atlas_features),
+    ("segmentation_label_fusion",               segmentation_label_fusion),
+    ("morphology_separate_cartilage",           morphology_separate_cartilage),
+    ("morphology_flatten_point_cloud",          morphology_flatten_point_cloud),
+    ("morphology_nearest_neighbor_thickness",   morphology_nearest_neighbor_thickness),
+    ("relaxometry_fitting_lin",                 relaxometry_fitting_lin),
+    ("relaxometry_fitting_exp",                 relaxometry_fitting_exp),
+    ("relaxometry_t2_dess",                     relaxometry_t2_dess),
+    ("quality_overlap_measures",                quality_overlap_measures),
+    ("quality_surface_distances",               quality_surface_distances),
+    ("io_write_read_mask",                      io_write_read_mask),
+    ("io_read_dicom_stack",                     io_read_dicom_stack),
+    ("io_txt_arrays",                           io_txt_arrays)])
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# MEASUREMENTS --------------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def current_rss_mb():
+
+    # resident memory of this process from /proc (Linux). Elsewhere, the peak reported by getrusage
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return peak / 1024 / 1024 # bytes on macOS
+        return peak / 1024 # kilobytes on Linux
+
+
+class rss_sampler(threading.Thread):
+
+    """
+    Samples the resident memory while the benchmark runs and keeps the peak
+    """
+
+    def __init__(self, interval=0.002):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.peak     = current_rss_mb()
+        self.running  = True
+
+    def run(self):
+        while self.running:
+            self.peak = max(self.peak, current_rss_mb())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.peak = max(self.peak, current_rss_mb())
+        return self.peak
+
+
+def calibration_kernel():
+
+    # fixed work on numpy and SimpleITK, the libraries used by the benchmarks
+    array_py = np.random.RandomState(0).rand(1000000)
+    np.sort(array_py)
+    img = sitk.GetImageFromArray(array_py.reshape(100, 100, 100).astype(np.float32))
+    sitk.SmoothingRecursiveGaussian(img, 2.0)
+
+
+def time_function(function, n_of_repeats):
+
+    # minimum time over the repeats (the least affected by other processes) and median
+    times = []
+    for r in range(0, n_of_repeats):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+
+    return min(times), float(np.median(times))
+
+
+def run_worker(name, size_name, n_of_repeats):
+
+    # speed of this machine, in the same process as the benchmark
+    calibration_time, calibration_median = time_function(calibration_kernel, n_of_repeats)
+
+    # prepare data in a temporary folder
+    work_folder = tempfile.mkdtemp(prefix="pykneer_benchmark_")
+    try:
+        function = benchmarks[name](size_name, work_folder)
+        rss_before = current_rss_mb()
+
+        # time the function and sample the memory
+        sampler = rss_sampler()
+        sampler.start()
+        benchmark_time, benchmark_median = time_function(function, n_of_repeats)
+        peak_rss = sampler.stop()
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    result = {"name"           : name,
+              "size"           : size_name,
+              "time_s"         : benchmark_time,
+              "time_median_s"  : benchmark_median,
+              "calibration_s"  : calibration_time,
+              "time_ratio"     : benchmark_time / calibration_time,
+              "n_of_repeats"   : n_of_repeats,
+              "rss_before_mb"  : rss_before,
+              "peak_rss_mb"    : peak_rss,
+              "rss_increase_mb": peak_rss - rss_before}
+    print (json.dumps(result))
+
+
+def run_benchmark(name, size_name, n_of_repeats, timeout):
+
+    # run the benchmark in a new process and read its result (last line of the output)
+    command = [sys.executable, os.path.realpath(__file__), "--worker", name, size_name, "--repeats", str(n_of_repeats)]
+    try:
+        output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, universal_newlines=True)
+    except subprocess.TimeoutExpired:
+        return {"name" : name, "size" : size_name, "error" : "timeout after %d s" % timeout}
+    if output.returncode != 0:
+        return {"name" : name, "size" : size_name, "error" : output.stderr.strip().split("\n")[-1]}
+
+    return json.loads(output.stdout.strip().split("\n")[-1])
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# COMPARISON TO BASELINE ----------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def compare_to_baseline(result, baseline):
+
+    # returns the status of the benchmark: "ok", "regression", "new" (not in the baseline), or "error"
+    if "error" in result:
+        return "error", ""
+    key = result["name"] + "/" + result["size"]
+    if key not in baseline:
+        return "new", ""
+    base = baseline[key]
+    if "time_ratio" not in base:
+        return "new", "(baseline without calibration, run --update-baseline)"
+
+    messages = []
+    if result["time_ratio"] > base["time_ratio"] * time_tolerance + time_slack:
+        messages.append("time %.2fx" % (result["time_ratio"] / base["time_ratio"]))
+    if result["rss_increase_mb"] > base["rss_increase_mb"] * memory_tolerance + memory_slack:
+        messages.append("memory +%.1f MB (baseline +%.1f MB)" % (result["rss_increase_mb"], base["rss_increase_mb"]))
+    if len(messages) > 0:
+        return "regression", ", ".join(messages)
+
+    return "ok", "time %.2fx" % (result["time_ratio"] / base["time_ratio"])
+
+
+def machine_info():
+
+    return {"platform"  : platform.platform(),
+            "processor" : platform.processor(),
+            "n_of_cpus" : os.cpu_count(),
+            "python"    : platform.python_version(),
+            "numpy"     : np.__version__,
+            "simpleitk" : sitk.Version_VersionString(),
+            "date"      : time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="pyKNEEr benchmarks on synthetic images")
+    parser.add_argument("--sizes",           nargs="+", default=["small", "medium"], choices=list(bp.sizes.keys()))
+    parser.add_argument("--filter",          default="",  help="run only benchmarks whose name contains this text")
+    parser.add_argument("--repeats",         type=int, default=min_repeats, help="repeats of each benchmark (at least %d)" % min_repeats)
+    parser.add_argument("--timeout",         type=int, default=600, help="maximum time per benchmark (s)")
+    parser.add_argument("--baseline",        default=baseline_file_name)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output",          default="", help="json file for the current results")
+    parser.add_argument("--worker",          nargs=2, metavar=("NAME", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.repeats < min_repeats:
+        print ("ERROR: The number of repeats must be at least %d" % min_repeats)
+        return 2
+
+    # inside the process of a single benchmark
+    if args.worker is not None:
+        run_worker(args.worker[0], args.worker[1], args.repeats)
+        return 0
+
+    # read baseline
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+
+    # run benchmarks
+    results       = collections.OrderedDict()
+    n_of_failures = 0
+    print ("%-42s %-7s %10s %8s %12s  %s" % ("benchmark", "size", "time [s]", "ratio", "+RSS [MB]", "status"))
+    for size_name in args.sizes:
+        for name in benchmarks:
+            if args.filter not in name:
+                continue
+            result = run_benchmark(name, size_name, args.repeats, args.timeout)
+            status, message = compare_to_baseline(result, baseline)
+            if status == "error":
+                print ("%-42s %-7s %10s %8s %12s  %s %s" % (name, size_name, "-", "-", "-", status, result["error"]))
+            else:
+                print ("%-42s %-7s %10.3f %8.2f %12.1f  %s %s" % (name, size_name, result["time_s"], result["time_ratio"],
+                                                                 result["rss_increase_mb"], status, message))
+            if status == "regression" or status == "error":
+                n_of_failures = n_of_failures + 1
+            results[name + "/" + size_name] = result
+            sys.stdout.flush()
+
+    # save results
+    output = {"machine" : machine_info(), "results" : results}
+    if args.output != "":
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+        print ("-> Results saved as: " + args.output)
+    if args.update_baseline:
+        # keep the baseline of benchmarks that were not run
+        for key in results:
+            if "error" not in results[key]:
+                baseline[key] = results[key]
+        output["results"] = collections.OrderedDict(sorted(baseline.items()))
+        with open(args.baseline, "w") as file:
+            json.dump(output, file, indent=2)
+        print ("-> Baseline saved as: " + args.baseline)
+        return 0
+
+    if n_of_failures > 0:
+        print ("-> %d benchmarks with regressions or errors" % n_of_failures)
+        return 1
+    print ("-> No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
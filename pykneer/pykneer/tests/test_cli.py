@@ -0,0 +1,87 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the options of cli.py that do not run the steps (--list-stages, --dry-run, --stages), with empty files as masks
+"""
+
+import json
+import os
+
+import pytest
+
+import test_general_functions as tgs
+import cli
+import cohort_manifest        as cm
+
+
+def write_morphology_input(folder, n_of_subjects):
+    # input file of morphology.ipynb and manifest with the same empty masks
+    segmented_folder = os.path.join(str(folder), "segmented") + os.sep
+    os.mkdir(segmented_folder)
+    cohort = cm.manifest(os.path.join(str(folder), "cohort.csv"), {"segmented_folder" : segmented_folder})
+    with open(os.path.join(str(folder), "image_list_morphology.txt"), "w") as f:
+        f.write(segmented_folder + "\n")
+        for i in range(0, n_of_subjects):
+            mask_name = "%02d_DESS_prep_fc.mha" % i
+            open(segmented_folder + mask_name, "w").close()
+            cohort.add_subject("%02d" % i, "new", mask_name=mask_name)
+            f.write(mask_name + "\n")
+    cohort.write()
+    return os.path.join(str(folder), "image_list_morphology.txt")
+
+
+# --- tests ---
+
+def test_list_stages(capsys):
+
+    # the input file is not read
+    assert cli.main(["morphology", "missing.txt", "--list-stages"]) == 0
+    assert capsys.readouterr().out.split() == ["separate_cartilage_surfaces", "calculate_thickness", "thickness_table",
+                                               "calculate_volume", "volume_table"]
+
+    assert cli.main(["preprocessing", "missing.txt", "--list-stages", "--intensity-standardization", "0"]) == 0
+    assert capsys.readouterr().out.split() == ["read_dicom_stack", "print_dicom_header", "orientation_to_rai", "flip_rl",
+                                               "origin_to_zero"]
+
+
+def test_dry_run(tmp_path, capsys, monkeypatch):
+
+    monkeypatch.chdir(str(tmp_path))
+    input_file_name = write_morphology_input(tmp_path, 3)
+    progress_file   = str(tmp_path / "progress.json")
+    assert cli.main(["morphology", input_file_name, "--dry-run", "--stages", "volume_table", "calculate_volume",
+                     "--progress", progress_file]) == 0
+
+    # steps in the pipeline order, and no step ran
+    output = capsys.readouterr().out
+    assert "-> Steps: calculate_volume, volume_table" in output
+    assert "-> Images (3): 00_DESS_prep_fc.mha, 01_DESS_prep_fc.mha, 02_DESS_prep_fc.mha" in output
+    assert "-> Step 1" not in output
+    assert not os.path.exists(str(tmp_path / "volume.csv"))
+    with open(progress_file) as f:
+        records = [json.loads(line) for line in f]
+    assert [record["event"] for record in records] == ["dry_run"]
+    assert records[0]["stages"] == ["calculate_volume", "volume_table"]
+
+
+def test_dry_run_of_manifest(tmp_path, capsys):
+
+    write_morphology_input(tmp_path, 5)
+    assert cli.main(["morphology", str(tmp_path / "cohort.csv"), "--dry-run", "--subjects", "03", "01"]) == 0
+    assert "-> Images (2): 03_DESS_prep_fc.mha, 01_DESS_prep_fc.mha" in capsys.readouterr().out
+
+    # the status is not changed
+    cohort = cm.load_manifest(str(tmp_path / "cohort.csv"))
+    assert len(cohort.select(status="new")) == 5
+
+
+def test_wrong_input(tmp_path, capsys):
+
+    input_file_name = write_morphology_input(tmp_path, 1)
+
+    assert cli.main(["morphology", input_file_name, "--stages", "calculate_thickness", "thickness"]) == 2
+    assert "ERROR: The step thickness does not exist" in capsys.readouterr().out
+    assert cli.main(["morphology", str(tmp_path / "missing.txt"), "--dry-run"]) == 2
+    assert cli.main(["morphology", input_file_name, "--dry-run", "--cores", "0"]) == 2
+    with pytest.raises(SystemExit):
+        cli.main(["morphology", input_file_name, "--thickness-algorithm", "3"])
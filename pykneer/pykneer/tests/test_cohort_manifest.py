@@ -0,0 +1,96 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the cohort manifest of cohort_manifest.py, with empty files as masks
+"""
+
+import os
+import time
+
+import pytest
+
+import test_general_functions as tgs
+import cohort_manifest        as cm
+import pykneer_io             as io
+
+
+def write_cohort(folder, n_of_subjects):
+    # folders and empty masks, manifest, and input file of morphology.ipynb with the same masks
+    segmented_folder = os.path.join(str(folder), "segmented") + os.sep
+    os.mkdir(segmented_folder)
+    cohort = cm.manifest(os.path.join(str(folder), "cohort.csv"), {"segmented_folder" : segmented_folder})
+    with open(os.path.join(str(folder), "image_list_morphology.txt"), "w") as f:
+        f.write(segmented_folder + "\n")
+        for i in range(0, n_of_subjects):
+            mask_name = "%04d_DESS_prep_fc.mha" % i
+            open(segmented_folder + mask_name, "w").close()
+            cohort.add_subject("%04d" % i, "segmentation" if i % 2 == 0 else "new", mask_name=mask_name)
+            f.write(mask_name + "\n")
+    cohort.write()
+    return cohort
+
+def load_time(folder, n_of_repeats=3):
+    # shortest load time over the repeats (the least affected by other processes)
+    times = []
+    for r in range(0, n_of_repeats):
+        start_time = time.perf_counter()
+        cohort     = cm.load_manifest(os.path.join(str(folder), "cohort.csv"))
+        times.append(time.perf_counter() - start_time)
+    return cohort, min(times)
+
+
+# --- tests ---
+
+def test_load_time_is_linear(tmp_path):
+
+    os.mkdir(str(tmp_path / "small"))
+    os.mkdir(str(tmp_path / "large"))
+    write_cohort(tmp_path / "small", 1000)
+    write_cohort(tmp_path / "large", 5000)
+    small_cohort, small_time = load_time(tmp_path / "small")
+    large_cohort, large_time = load_time(tmp_path / "large")
+
+    # 5 times more subjects: about 5 times longer (25 times if quadratic)
+    assert len(small_cohort.records) == 1000 and len(large_cohort.records) == 5000
+    assert large_time < 12 * small_time
+    print ("-> 1000 and 5000 subjects loaded in %.1f and %.1f ms" % (small_time * 1000, large_time * 1000))
+
+
+def test_select_by_id_and_status(tmp_path):
+
+    write_cohort(tmp_path, 10)
+    cohort = cm.load_manifest(str(tmp_path / "cohort.csv"))
+
+    assert [record.subject_id for record in cohort.select(["0003", "0001"])] == ["0003", "0001"]
+    assert len(cohort.select(status="new")) == 5
+    assert [record.subject_id for record in cohort.select(["0002", "0003"], status="segmentation")] == ["0002"]
+
+    # status changes are in the index and in the file
+    cohort.set_status(["0001", "0003"], "morphology")
+    cohort.write()
+    cohort = cm.load_manifest(str(tmp_path / "cohort.csv"))
+    assert [record.subject_id for record in cohort.select(status="morphology")] == ["0001", "0003"]
+    assert len(cohort.select(status="new")) == 3
+    assert cohort.folders["segmented_folder"].endswith("segmented" + os.sep)
+
+
+def test_image_data_as_input_file(tmp_path):
+
+    write_cohort(tmp_path, 20)
+    cohort = cm.load_manifest(str(tmp_path / "cohort.csv"))
+
+    # same image_data as the input file of the notebook
+    assert cohort.all_image_data("morphology") == io.load_image_data_morphology(str(tmp_path / "image_list_morphology.txt"))
+
+
+def test_missing_files(tmp_path):
+
+    write_cohort(tmp_path, 20)
+    cohort = cm.load_manifest(str(tmp_path / "cohort.csv"))
+    os.remove(str(tmp_path / "segmented" / "0007_DESS_prep_fc.mha"))
+
+    missing = cohort.missing_files("morphology")
+    assert len(missing) == 1 and missing[0].endswith("0007_DESS_prep_fc.mha")
+    assert cohort.all_image_data("morphology") == {}
+    # only the selected subjects are checked
+    assert len(cohort.all_image_data("morphology", cohort.select(["0001", "0002"]))) == 2
@@ -0,0 +1,96 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the cylinder fitting of cylinder_fitting/fitting.py (on arrays) against the previous implementation on lists of points,
+kept here as reference
+"""
+
+import numpy as np
+import pytest
+from scipy.optimize import minimize
+
+import test_general_functions as tgs
+from cylinder_fitting import fitting
+
+
+# --- reference: functions on lists of points (before the computation on arrays) ---
+
+def reference_A(Ys):
+    return sum(np.dot(np.reshape(Y, (3,1)), np.reshape(Y, (1, 3))) for Y in Ys)
+
+def reference_G(w, Xs):
+    n     = len(Xs)
+    P     = fitting.projection_matrix(w)
+    Ys    = [np.dot(P, X) for X in Xs]
+    A     = reference_A(Ys)
+    A_hat = fitting.calc_A_hat(A, fitting.skew_matrix(w))
+    u     = sum(np.dot(Y, Y) for Y in Ys) / n
+    v     = np.dot(A_hat, sum(np.dot(Y, Y) * Y for Y in Ys)) / np.trace(np.dot(A_hat, A))
+    return sum((np.dot(Y, Y) - u - 2 * np.dot(Y, v)) ** 2 for Y in Ys)
+
+def reference_C(w, Xs):
+    P     = fitting.projection_matrix(w)
+    Ys    = [np.dot(P, X) for X in Xs]
+    A     = reference_A(Ys)
+    A_hat = fitting.calc_A_hat(A, fitting.skew_matrix(w))
+    return np.dot(A_hat, sum(np.dot(Y, Y) * Y for Y in Ys)) / np.trace(np.dot(A_hat, A))
+
+def reference_r(w, Xs):
+    P = fitting.projection_matrix(w)
+    c = reference_C(w, Xs)
+    return np.sqrt(sum(np.dot(c - X, np.dot(P, c - X)) for X in Xs) / len(Xs))
+
+def reference_fit(data):
+    Xs_mean = sum(X for X in data) / len(data)
+    Xs      = [X - Xs_mean for X in data]
+    best_fit = None
+    for sp in [(0, 0), (np.pi / 2, 0), (np.pi / 2, np.pi / 2)]:
+        fitted = minimize(lambda x : reference_G(fitting.direction(x[0], x[1]), Xs), sp, method='Powell', tol=1e-6)
+        if best_fit is None or fitted.fun < best_fit.fun:
+            best_fit = fitted
+    w = fitting.direction(best_fit.x[0], best_fit.x[1])
+    return w, reference_C(w, Xs) + Xs_mean, reference_r(w, Xs), best_fit.fun
+
+
+def cylinder_points(n_of_points=200, seed=0):
+    # noisy points on a cylinder of radius 5 along an oblique axis through (1, 2, 3), as a list of points
+    random = np.random.RandomState(seed)
+    angles = random.uniform(0, 2 * np.pi, n_of_points)
+    height = random.uniform(-10, 10, n_of_points)
+    axis   = np.array([1.0, 2.0, 2.0]) / 3.0
+    u      = np.cross(axis, [1.0, 0.0, 0.0])
+    u      = u / np.linalg.norm(u)
+    v      = np.cross(axis, u)
+    points = np.array([1.0, 2.0, 3.0]) + np.outer(height, axis) + 5 * (np.outer(np.cos(angles), u) + np.outer(np.sin(angles), v))
+    return list(points + random.normal(0, 0.05, points.shape))
+
+
+# --- tests ---
+
+def test_functions_as_reference():
+
+    data  = cylinder_points()
+    Xs, t = fitting.preprocess_data(data)
+    for theta, phi in [(0.3, 0.2), (1.2, -0.7), (np.pi / 2, np.pi / 2)]:
+        w = fitting.direction(theta, phi)
+        assert fitting.G(w, Xs) == pytest.approx(reference_G(w, list(Xs)), rel=1e-8)
+        assert np.allclose(fitting.C(w, Xs), reference_C(w, list(Xs)), rtol=1e-8, atol=1e-10)
+        assert fitting.r(w, Xs) == pytest.approx(reference_r(w, list(Xs)), rel=1e-8)
+
+
+def test_fit_as_reference():
+
+    data = cylinder_points()
+    w, c, radius, error = fitting.fit(data)
+    w_ref, c_ref, radius_ref, error_ref = reference_fit(data)
+
+    # direction up to the sign
+    assert min(np.linalg.norm(w - w_ref), np.linalg.norm(w + w_ref)) < 1e-8
+    assert np.allclose(c, c_ref, atol=1e-8)
+    assert radius == pytest.approx(radius_ref, rel=1e-8)
+    assert error  == pytest.approx(error_ref,  rel=1e-6, abs=1e-10)
+
+    # the fitted cylinder is the one of the points
+    assert abs(np.dot(w, np.array([1.0, 2.0, 2.0]) / 3.0)) == pytest.approx(1.0, abs=1e-4)
+    assert radius == pytest.approx(5.0, abs=0.05)
+    assert np.linalg.norm(np.cross(c - np.array([1.0, 2.0, 3.0]), w)) < 0.05
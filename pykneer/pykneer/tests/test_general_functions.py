@@ -2,10 +2,17 @@
 
 """
 Module with general functions used in the other test_* modules
+Importing it makes the pyKNEEr modules of the parent folder importable, for the tests that call them directly
 """
 
+import os
+import sys
+
+import numpy as np
 import SimpleITK as sitk
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
 def compare_txt_files (file_name_1, file_name_2): 
     """
     compares the content of two txt files
@@ -51,4 +58,33 @@ def compare_images (file_name_1, file_name_2):
     if sum(sum(sum(difference))) == 0:
         return 0
     else:
-        return 1
\ No newline at end of file
+        return 1
+
+
+def array_to_image (array_py, spacing=(0.5, 0.6, 0.7)):
+    """
+    converts a numpy array (z,y,x) to a SimpleITK image with the given spacing
+    """
+
+    img = sitk.GetImageFromArray(array_py)
+    img.SetSpacing(spacing)
+    return img
+
+
+def write_array (array_py, file_name, spacing=(0.5, 0.6, 0.7)):
+    """
+    writes a numpy array as image and returns the file name
+    """
+
+    sitk.WriteImage(array_to_image(array_py, spacing), str(file_name))
+    return str(file_name)
+
+
+def box_mask (shape, start, end, spacing=(0.5, 0.6, 0.7)):
+    """
+    binary mask (UInt8) of the size shape (z,y,x) with ones from start to end (excluded)
+    """
+
+    mask_py = np.zeros(shape, dtype=np.uint8)
+    mask_py[start[0]:end[0], start[1]:end[1], start[2]:end[2]] = 1
+    return array_to_image(mask_py, spacing)
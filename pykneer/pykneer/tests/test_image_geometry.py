@@ -0,0 +1,72 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the header-only geometry reads of read_image_geometry in sitk_functions.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions as tgs
+import sitk_functions         as sitkf
+
+
+def write_rotated_image(file_name, shape):
+    # image with origin and direction different from the default ones
+    img = tgs.array_to_image(np.zeros(shape, dtype=np.int16))
+    img.SetOrigin   ((10.0, -20.0, 30.0))
+    img.SetDirection((0.0, 1.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 1.0))
+    sitk.WriteImage(img, file_name)
+    return img
+
+
+# --- tests ---
+
+def test_geometry_as_read_image(tmp_path):
+
+    file_name = str(tmp_path / "image.mha")
+    img       = write_rotated_image(file_name, (4, 5, 6))
+    geometry  = sitkf.read_image_geometry(file_name)
+
+    assert geometry["size"]      == img.GetSize()
+    assert geometry["spacing"]   == img.GetSpacing()
+    assert geometry["origin"]    == img.GetOrigin()
+    assert geometry["direction"] == img.GetDirection()
+
+
+def test_geometry_of_cropped_mask(tmp_path):
+
+    # cropped mask: same geometry as the full mask restored by read_mask
+    file_name = str(tmp_path / "mask.mha")
+    img       = write_rotated_image(file_name, (12, 14, 16))
+    mask_py   = np.zeros((12, 14, 16), dtype=np.uint8)
+    mask_py[5:8, 3:6, 9:11] = 1
+    mask      = sitk.GetImageFromArray(mask_py)
+    mask.CopyInformation(img)
+    sitkf.write_mask(mask, file_name, 1)
+
+    geometry = sitkf.read_image_geometry(file_name)
+    restored = sitkf.read_mask(file_name)
+    assert sitk.ReadImage(file_name).GetSize() != restored.GetSize()
+    assert geometry["size"] == restored.GetSize()
+    assert np.allclose(geometry["origin"], restored.GetOrigin())
+
+
+def test_geometry_is_read_again_when_file_changes(tmp_path):
+
+    file_name = str(tmp_path / "image.mha")
+    write_rotated_image(file_name, (4, 5, 6))
+    assert sitkf.read_image_geometry(file_name)["size"] == (6, 5, 4)
+
+    # the stored geometry is used while the file does not change
+    stored = sitkf.image_geometries[os.path.abspath(file_name)]
+    sitkf.image_geometries[os.path.abspath(file_name)] = (stored[0], stored[1], dict(stored[2], size=(1, 1, 1)))
+    assert sitkf.read_image_geometry(file_name)["size"] == (1, 1, 1)
+
+    # a new image with the same name is read again
+    write_rotated_image(file_name, (7, 8, 9))
+    os.utime(file_name, ns=(stored[0] + 10**9, stored[0] + 10**9))
+    assert sitkf.read_image_geometry(file_name)["size"] == (9, 8, 7)
@@ -0,0 +1,122 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the timing log of instrumentation.py with small decorated functions and python subprocesses in place of elastix
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+import test_general_functions as tgs
+import instrumentation        as instr
+
+
+@instr.timed
+def small_s(image_data):
+    return image_data["image_name_root"]
+
+@instr.timed
+def failing_s(image_data):
+    raise ValueError("no image")
+
+@instr.timed
+def outer_s(image_data):
+    small_s(image_data)
+    return small_s(image_data)
+
+@instr.timed
+def allocate_s(image_data, n_of_mb):
+    # subprocess that allocates and touches n_of_mb MB, and keeps them while it sleeps
+    script = "import time; a = bytearray(%d * 1024 * 1024); a[::4096] = b'1' * len(a[::4096]); time.sleep(0.2)" % n_of_mb
+    return instr.run_subprocess([sys.executable, "-c", script])
+
+
+def read_records(file_name):
+    with open(file_name) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def timing_log(tmp_path, monkeypatch):
+    # log file in PYKNEER_TIMING_LOG, as set by set_timing_log
+    file_name = str(tmp_path / "timing.log")
+    monkeypatch.setenv(instr.timing_log_variable, file_name)
+    return file_name
+
+
+# --- tests ---
+
+def test_records_of_timed_functions(timing_log):
+
+    assert small_s({"image_name_root" : "01"}) == "01"
+    with pytest.raises(ValueError):
+        failing_s({"image_name_root" : "02"})
+
+    records = read_records(timing_log)
+    assert [record["stage"]   for record in records] == ["test_instrumentation.small", "test_instrumentation.failing"]
+    assert [record["subject"] for record in records] == ["01", "02"]
+    assert [record["status"]  for record in records] == ["ok", "ValueError: no image"]
+    for key in ["host", "pid", "start", "wall_s", "cpu_s", "children_cpu_s", "peak_rss_mb", "peak_rss_since_start",
+                "children_peak_rss_mb", "nested"]:
+        assert key in records[0]
+    assert records[0]["pid"] == os.getpid() and records[0]["nested"] is False
+    assert records[0]["children_peak_rss_mb"] is None
+
+
+def test_no_records_without_log(tmp_path, monkeypatch):
+
+    monkeypatch.delenv(instr.timing_log_variable, raising=False)
+    assert small_s({"image_name_root" : "01"}) == "01"
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_nested_calls(timing_log):
+
+    outer_s({"image_name_root" : "01"})
+
+    # inner calls are written first, and only the outer call reset the peak memory
+    records = read_records(timing_log)
+    assert [record["stage"]  for record in records] == ["test_instrumentation.small"] * 2 + ["test_instrumentation.outer"]
+    assert [record["nested"] for record in records] == [True, True, False]
+    assert records[2]["wall_s"] >= records[0]["wall_s"] + records[1]["wall_s"]
+    assert instr.running_calls() == []
+
+
+@pytest.mark.skipif(not hasattr(os, "wait4"), reason="subprocesses are measured with os.wait4")
+def test_memory_of_each_subprocess(timing_log):
+
+    assert allocate_s({"image_name_root" : "01"}, 200).returncode == 0
+    allocate_s({"image_name_root" : "02"}, 1)
+    assert instr.run_subprocess([sys.executable, "-c", "import sys; sys.exit(3)"]).returncode == 3
+
+    # the peak of the second call does not include the first subprocess
+    records = read_records(timing_log)
+    assert records[0]["children_peak_rss_mb"] > 200
+    assert records[1]["children_peak_rss_mb"] < 100
+    assert records[0]["children_cpu_s"] > 0
+
+
+def test_summary_and_stragglers(timing_log):
+
+    for subject in ["01", "02", "03"]:
+        small_s({"image_name_root" : subject})
+    with pytest.raises(ValueError):
+        failing_s({"image_name_root" : "04"})
+    # a slow image
+    for wall_s, subject in [(1.0, "05"), (1.1, "06"), (0.9, "07"), (5.0, "08")]:
+        instr.write_record(timing_log, {"stage" : "segmentation.slow", "subject" : subject, "wall_s" : wall_s, "cpu_s" : wall_s,
+                                        "children_cpu_s" : 0.0, "peak_rss_mb" : 10.0, "status" : "ok"})
+
+    summary = instr.timing_summary(timing_log)
+    assert list(summary["stage"])       == ["test_instrumentation.small", "test_instrumentation.failing", "segmentation.slow"]
+    assert list(summary["n_of_images"]) == [3, 1, 4]
+    assert list(summary["n_of_errors"]) == [0, 1, 0]
+    assert summary["slowest_subject"].iloc[2] == "08"
+    assert summary["total_wall_s"].iloc[2]    == pytest.approx(8.0)
+
+    stragglers = instr.find_stragglers(timing_log)
+    assert list(stragglers["subject"]) == ["08"]
+    assert stragglers["times_median"].iloc[0] == pytest.approx(5.0 / 1.05, abs=0.01)
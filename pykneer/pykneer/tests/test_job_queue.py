@@ -0,0 +1,114 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the job queue of job_queue.py, with local processes as nodes
+"""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import test_general_functions as tgs
+import job_queue              as jq
+
+
+def double_s(image_data):
+    # one file per run, to count how many times each job runs
+    open(os.path.join(image_data["run_folder"], "%s_%d" % (image_data["image_name_root"], os.getpid())), "w").close()
+    time.sleep(0.05)
+    image_data["value"] = image_data["value"] * 2
+    return image_data
+
+def failing_s(image_data):
+    raise ValueError("wrong image " + image_data["image_name_root"])
+
+def knees(run_folder, n_of_images):
+    return [{"image_name_root" : "knee_%02d" % i, "value" : i, "run_folder" : str(run_folder)} for i in range(0, n_of_images)]
+
+
+# --- tests ---
+
+def test_map_jobs_with_several_workers(tmp_path):
+
+    all_image_data = knees(tmp_path, 12)
+    results        = jq.map_jobs(str(tmp_path / "queue"), double_s, all_image_data, 4, poll_interval=0.1)
+
+    # results are in the order of all_image_data, and each job ran once
+    assert [image_data["value"] for image_data in results] == [2 * i for i in range(0, 12)]
+    assert len([f for f in os.listdir(str(tmp_path)) if f.startswith("knee_")]) == 12
+    assert jq.queue_status(str(tmp_path / "queue")) == {"pending" : 0, "running" : 0, "done" : 12, "failed" : 0}
+
+
+def test_submit_again_skips_done_jobs(tmp_path):
+
+    queue_folder   = str(tmp_path / "queue")
+    all_image_data = knees(tmp_path, 3)
+    job_ids        = jq.submit(queue_folder, double_s, all_image_data)
+    jq.run_worker(queue_folder, "node_1", poll_interval=0.1)
+
+    # same submission: no new pending jobs
+    assert jq.submit(queue_folder, double_s, all_image_data) == job_ids
+    assert jq.queue_status(queue_folder)["pending"] == 0
+
+
+def test_stale_job_is_requeued(tmp_path):
+
+    queue_folder = str(tmp_path / "queue")
+    job_ids      = jq.submit(queue_folder, double_s, knees(tmp_path, 2))
+
+    # a node claims a job and dies (no heartbeat)
+    running_file_name = jq.claim_job(queue_folder, "dead_node")
+    os.utime(running_file_name, (time.time() - 60, time.time() - 60))
+
+    # another node requeues it and runs all the jobs
+    assert jq.run_worker(queue_folder, "node_2", stale_timeout=30, poll_interval=0.1) == 2
+    results = jq.collect_results(queue_folder, job_ids)
+    assert [image_data["value"] for image_data in results] == [0, 2]
+    assert any(["dead_node" in open(os.path.join(queue_folder, "failed", f)).read() for f in os.listdir(os.path.join(queue_folder, "failed"))])
+
+
+def test_heartbeat_keeps_job_running(tmp_path):
+
+    queue_folder = str(tmp_path / "queue")
+    jq.submit(queue_folder, double_s, knees(tmp_path, 1))
+    running_file_name = jq.claim_job(queue_folder, "node_1")
+    os.utime(running_file_name, (time.time() - 60, time.time() - 60))
+
+    beat = jq.heartbeat(running_file_name, 0.05)
+    beat.start()
+    time.sleep(0.3)
+    beat.stop()
+
+    assert jq.requeue_stale_jobs(queue_folder, stale_timeout=30) == 0
+    assert jq.queue_status(queue_folder)["running"] == 1
+
+
+def test_failing_job_stops_after_max_attempts(tmp_path):
+
+    queue_folder = str(tmp_path / "queue")
+    job_ids      = jq.submit(queue_folder, failing_s, knees(tmp_path, 1))
+    jq.run_worker(queue_folder, "node_1", max_attempts=2, poll_interval=0.1)
+
+    assert jq.queue_status(queue_folder) == {"pending" : 0, "running" : 0, "done" : 0, "failed" : 1}
+    assert jq.collect_results(queue_folder, job_ids) == [None]
+    error_file_names = [f for f in os.listdir(os.path.join(queue_folder, "failed")) if f.endswith(".err")]
+    assert len(error_file_names) == 2
+    assert "wrong image knee_00" in open(os.path.join(queue_folder, "failed", error_file_names[0])).read()
+
+
+def test_several_nodes_claim_each_job_once(tmp_path):
+
+    queue_folder = str(tmp_path / "queue")
+    jq.submit(queue_folder, double_s, knees(tmp_path, 20))
+
+    # nodes as separate processes on the same queue folder
+    nodes = [multiprocessing.Process(target=jq.run_worker, args=(queue_folder, "node_%d" % n, 1, 30, 3, 0.1)) for n in range(0, 4)]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join()
+
+    assert jq.queue_status(queue_folder)["done"] == 20
+    assert len([f for f in os.listdir(str(tmp_path)) if f.startswith("knee_")]) == 20
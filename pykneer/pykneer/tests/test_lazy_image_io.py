@@ -0,0 +1,62 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the on-demand slices of lazy_image_io.py against the arrays of the whole images
+"""
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions as tgs
+import lazy_image_io          as lio
+import sitk_functions         as sitkf
+
+
+# --- tests ---
+
+def test_sagittal_slices_as_array(tmp_path):
+
+    array_py = np.random.RandomState(0).randint(0, 1000, (7, 8, 9)).astype(np.int16)
+    tgs.write_array(array_py, str(tmp_path / "image.mha"))
+    img_py   = lio.lazy_image(str(tmp_path / "image.mha"))
+
+    # slices are extracted by the reader, and the volume is not read
+    assert img_py.mmap is not None and img_py.shape == array_py.shape
+    for k in range(0, array_py.shape[2]):
+        assert np.array_equal(img_py[:,:,k], array_py[:,:,k])
+    assert np.array_equal(img_py[:,:,-1], array_py[:,:,-1])
+    assert img_py.file_name not in lio.volume_cache
+    with pytest.raises(IndexError):
+        img_py[:,:,9]
+
+
+def test_mask_slices_of_cropped_mask(tmp_path):
+
+    mask = tgs.box_mask((10, 12, 14), (2, 3, 4), (8, 9, 10))
+    sitkf.write_mask(mask, str(tmp_path / "mask.mha"), 1)
+    mask_py = lio.lazy_image(str(tmp_path / "mask.mha"))
+
+    # same slices as the array, without restoring the full mask
+    assert lio.find_mask_slices(mask_py) == lio.find_mask_slices(sitk.GetArrayFromImage(mask))
+    assert mask_py.file_name not in lio.volume_cache
+    assert np.array_equal(mask_py[:,:,6], sitk.GetArrayFromImage(mask)[:,:,6])
+
+
+def test_mask_slices_of_empty_mask(capsys):
+
+    assert lio.find_mask_slices(np.zeros((4, 5, 6), dtype=np.uint8)) == (None, None, None)
+    assert "ERROR" in capsys.readouterr().out
+
+
+def test_browse_subjects_shows_selected_subject_only():
+
+    shown = []
+    def show_subject(i):
+        shown.append(i)
+        return None
+
+    box = lio.browse_subjects(["a", "b", "c"], show_subject)
+    assert shown == [0]
+    box.children[0].value = 2
+    assert shown == [0, 2]
@@ -0,0 +1,58 @@
+# Serena Bonaretti, 2019
+
+"""
+Test that the level sets of sitk_functions.py computed on the narrow band around the contour are the same as on the whole image
+"""
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions as tgs
+import benchmark_phantoms     as bp
+import sitk_functions         as sitkf
+
+
+def full_levelset(mask):
+    # level set on the whole image, as before cropping
+    return sitk.GetArrayFromImage(sitk.Cast(sitk.AntiAliasBinary(sitk.Cast(mask, sitk.sitkInt16)), sitk.sitkFloat32))
+
+def to_full_image(mask_LS, mask):
+    # cropped level set back in the image grid, with -4 outside the crop (as transformix with DefaultPixelValue -4)
+    return sitk.GetArrayFromImage(sitk.Resample(mask_LS, mask, sitk.Transform(), sitk.sitkLinear, sitkf.levelset_outside_value))
+
+
+# --- tests ---
+
+@pytest.mark.parametrize("mask", [bp.cartilage_mask("small"),
+                                  tgs.box_mask((20, 24, 28), (0, 5, 6), (8, 20, 27))]) # touches the image border
+def test_binary2levelset_as_full_image(mask):
+
+    expected = full_levelset(mask)
+
+    assert np.allclose(sitk.GetArrayFromImage(sitkf.binary2levelset(mask, crop_flag=0)), expected, atol=1e-6)
+    cropped = sitkf.binary2levelset(mask)
+    assert np.prod(cropped.GetSize()) < np.prod(mask.GetSize())
+    assert np.allclose(to_full_image(cropped, mask), expected, atol=1e-6)
+
+
+def test_crop_levelset_keeps_the_band():
+
+    mask    = bp.cartilage_mask("small")
+    mask_LS = sitkf.binary2levelset(mask, crop_flag=0)
+    cropped = sitkf.crop_levelset(mask_LS)
+
+    assert np.prod(cropped.GetSize()) < np.prod(mask_LS.GetSize())
+    assert np.allclose(to_full_image(cropped, mask), sitk.GetArrayFromImage(mask_LS), atol=1e-6)
+    # the binary mask from the cropped level set is the original mask
+    binary = sitk.Resample(sitkf.levelset2binary(cropped), mask, sitk.Transform(), sitk.sitkNearestNeighbor, 0)
+    assert np.array_equal(sitk.GetArrayFromImage(binary), sitk.GetArrayFromImage(mask))
+
+
+def test_levelset_of_empty_mask():
+
+    mask_LS = sitkf.binary2levelset(tgs.box_mask((4, 5, 6), (0, 0, 0), (0, 0, 0)))
+
+    assert mask_LS.GetSize() == (6, 5, 4)
+    assert np.all(sitk.GetArrayFromImage(mask_LS) == sitkf.levelset_outside_value)
+    assert sitkf.crop_levelset(mask_LS).GetSize() == (6, 5, 4)
@@ -0,0 +1,137 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the warm start of longitudinal registrations of elastix_transformix.py, with a script in place of elastix that writes
+the iteration file with a given metric
+"""
+
+import os
+import stat
+import sys
+
+import pytest
+
+import test_general_functions as tgs
+import elastix_transformix
+import pykneer_io             as io
+import segmentation_sa_for_nb as sa
+
+
+# script used as elastix: writes the iteration file and the result with the metric of the warm start or of the full registration
+elastix_script = """#!%s
+import os, sys
+arguments = sys.argv[1:]
+output_folder = arguments[arguments.index("-out") + 1]
+metric = os.environ["WARM_METRIC"] if "-t0" in arguments else os.environ["FULL_METRIC"]
+with open(os.path.join(output_folder, "IterationInfo.0.R0.txt"), "w") as f:
+    f.write("1:ItNr\\t2:Metric\\n")
+    for i in range(0, 20):
+        f.write("%%d\\t%%s\\n" %% (i, metric))
+open(os.path.join(output_folder, "result.0.mha"), "w").close()
+with open(os.path.join(output_folder, "runs.txt"), "a") as f:
+    f.write(" ".join(arguments) + "\\n")
+""" % (sys.executable)
+
+
+def visit_image_data(folder, visit, previous_folder):
+    registered_sub_folder = os.path.join(str(folder), "visit_%d" % visit) + os.sep
+    os.mkdir(registered_sub_folder)
+    image_data = {"registration_type"              : "longitudinal",
+                  "current_anatomy"                : "f",
+                  "moving_root"                    : "knee_FU%d" % visit,
+                  "registered_sub_folder"          : registered_sub_folder,
+                  "previous_registered_sub_folder" : previous_folder,
+                  "elastix_folder"                 : str(folder) + os.sep,
+                  "frigid_transf_name"             : "TransformParameters.f_rigid.txt",
+                  "frigid_metric_name"             : "metric.f_rigid.txt",
+                  "param_file_rigid_warm"          : "MR_param_rigid_warm.txt"}
+    return image_data
+
+
+def register(image_data):
+    elastix_name = os.path.join(image_data["elastix_folder"], "elastix")
+    cmd = [elastix_name, "-out", image_data["registered_sub_folder"]]
+    elastix_transformix.bone().run_registration(image_data, "rigid", cmd, "MR_param_rigid.txt")
+    # transformation of the visit (renamed by bone.rigid())
+    open(image_data["registered_sub_folder"] + image_data["frigid_transf_name"], "w").close()
+    # command line arguments of the elastix runs
+    return open(image_data["registered_sub_folder"] + "runs.txt").read().splitlines()
+
+
+@pytest.fixture
+def elastix_folder(tmp_path):
+    elastix_name = str(tmp_path / "elastix")
+    with open(elastix_name, "w") as f:
+        f.write(elastix_script)
+    os.chmod(elastix_name, os.stat(elastix_name).st_mode | stat.S_IEXEC)
+    return tmp_path
+
+
+# --- tests ---
+
+def test_link_visits_and_group_them():
+
+    all_image_data = []
+    for knee in ["001", "002"]:
+        for visit in range(0, 3):
+            all_image_data.append({"reference_folder" : "reference/", "reference_name" : knee + "_BL_prep.mha",
+                                   "registered_sub_folder" : knee + "_FU%d/" % visit, "visit" : 0, "previous_registered_sub_folder" : ""})
+    io.link_longitudinal_visits(all_image_data)
+
+    assert [image_data["visit"] for image_data in all_image_data] == [0, 1, 2, 0, 1, 2]
+    assert all_image_data[2]["previous_registered_sub_folder"] == "001_FU1/"
+    assert all_image_data[3]["previous_registered_sub_folder"] == ""
+    assert [len(visit_image_data) for visit_image_data in sa.visits(all_image_data)] == [2, 2, 2]
+
+
+def test_read_final_metric(tmp_path):
+
+    folder = str(tmp_path) + os.sep
+    assert elastix_transformix.read_final_metric(folder) is None
+    with open(folder + "IterationInfo.0.R0.txt", "w") as f:
+        f.write("1:ItNr\t2:Metric\n0\t-0.1\n")
+    with open(folder + "IterationInfo.0.R1.txt", "w") as f:
+        f.write("1:ItNr\t2:Metric\t3a:Time\n" + "".join(["%d\t%.1f\t0.1\n" % (i, -0.1 * i) for i in range(0, 20)]))
+
+    # average of the last 10 iterations of the last resolution
+    assert elastix_transformix.read_final_metric(folder) == pytest.approx(-1.45)
+
+
+def test_warm_start_and_fallback(elastix_folder, monkeypatch):
+
+    monkeypatch.setenv("FULL_METRIC", "-0.50")
+
+    # first visit: full registration
+    monkeypatch.setenv("WARM_METRIC", "-0.52")
+    first = visit_image_data(elastix_folder, 0, "")
+    runs  = register(first)
+    assert len(runs) == 1 and "-t0" not in runs[0] and "MR_param_rigid.txt" in runs[0]
+
+    # second visit: warm start from the first visit, accepted
+    second = visit_image_data(elastix_folder, 1, first["registered_sub_folder"])
+    runs   = register(second)
+    assert len(runs) == 1 and "MR_param_rigid_warm.txt" in runs[0] and first["registered_sub_folder"] + "TransformParameters.f_rigid.txt" in runs[0]
+    assert open(second["registered_sub_folder"] + "metric.f_rigid.txt").read().split() == ["-0.520000", "warm", "-0.500000"]
+
+    # third visit: warm start worse than the second visit, registered from scratch
+    monkeypatch.setenv("WARM_METRIC", "-0.30")
+    third = visit_image_data(elastix_folder, 2, second["registered_sub_folder"])
+    runs  = register(third)
+    assert len(runs) == 2 and "-t0" in runs[0] and "-t0" not in runs[1]
+    assert open(third["registered_sub_folder"] + "metric.f_rigid.txt").read().split() == ["-0.500000", "full", "-0.500000"]
+
+
+def test_warm_starts_are_compared_to_the_full_registration(elastix_folder, monkeypatch):
+
+    # each warm start is 4% worse than the previous visit (accepted if compared to the previous visit only)
+    monkeypatch.setenv("FULL_METRIC", "-0.50")
+    previous_folder = ""
+    n_of_runs       = []
+    for visit in range(0, 3):
+        monkeypatch.setenv("WARM_METRIC", "%.4f" % (-0.50 * 0.96 ** visit))
+        image_data      = visit_image_data(elastix_folder, visit, previous_folder)
+        n_of_runs.append(len(register(image_data)))
+        previous_folder = image_data["registered_sub_folder"]
+
+    # the warm start of visit 2 is 7.8% worse than the full registration of visit 0, and visit 2 is registered from scratch
+    assert n_of_runs == [1, 1, 2]
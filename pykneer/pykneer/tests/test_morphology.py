@@ -5,6 +5,8 @@ Test the outputs of the pyKNEEr notebook morphology.ipynb
 To see print outs, from terminal run: pytest -s test_morphology.py
 """
 
+import os
+import pandas as pd
 import pytest
 import papermill as pm
 
@@ -26,6 +28,7 @@ phi_file_names            = ["morphology/01_DESS_01_prep_fc_arti_phi.txt",
 thickness_file_names      = ["morphology/01_DESS_01_prep_fc_thickness_1.txt"]
 thickness_flat_file_names = ["morphology/01_DESS_01_prep_fc_thickness_flat_1.txt"]
 volume_file_names         = ["morphology/01_DESS_01_prep_fc_volume.txt"]
+volume_table_file_name    = "morphology/volume_table.csv"
 
 
 #####################
@@ -120,14 +123,13 @@ def test_thickness_flat_files_identical (gt_folder, cv_folder, thickness_flat_fi
 @pytest.mark.parametrize("gt_folder, cv_folder, volume_file_names", [(gt_folder, cv_folder, volume_file_names)])
 def test_volume_files_identical (gt_folder, cv_folder, volume_file_names):
     
+    # volumes are saved in one table for all masks (volume_table_file_name), compared to the ground truth _volume.txt files
     print ("\n-> test_volume_files_identical")
+    table = pd.read_csv(cv_folder + volume_table_file_name)
     for i in range (0,len(volume_file_names)):
         print(volume_file_names[i])
         gt_input_file_name = gt_folder + volume_file_names[i] 
-        cv_input_file_name = cv_folder + volume_file_names[i] 
-    assert tgs.compare_txt_files (gt_input_file_name, cv_input_file_name) == 0
-
-
-
-
-
+        mask_name          = os.path.basename(volume_file_names[i]).replace("_volume.txt", ".mha")
+        gt_volume          = open(gt_input_file_name).read().strip()
+        cv_volume          = "%0.2f" % table["volume"][table["mask_name"] == mask_name].sum()
+        assert gt_volume == cv_volume
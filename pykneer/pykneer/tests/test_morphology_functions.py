@@ -0,0 +1,105 @@
+# Serena Bonaretti, 2019
+
+"""
+Test functions of morphology_functions.py on small arrays and on the phantom of benchmark_phantoms.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions as tgs
+import benchmark_phantoms     as bp
+import lazy_image_io          as lio
+import morphology_functions   as mf
+import pykneer_io             as io
+
+
+# --- tests ---
+
+def test_flatten_thickness_of_column_arrays(tmp_path):
+
+    # phi and thickness as read by calculate_thickness_s (columns, n x 1)
+    io.write_np_array_to_txt(np.array([0.3, 0.1, 0.2]), str(tmp_path / "phi.txt"))
+    phi = io.read_txt_to_np_array(str(tmp_path / "phi.txt"))
+    assert phi.shape == (3, 1)
+
+    assert mf.flatten_thickness([[1], [2], [3]], phi).tolist() == [2, 3, 1]
+    assert mf.flatten_thickness([1, 2, 3], [0.3, 0.1, 0.2]).tolist() == [2, 3, 1]
+
+
+def test_flatten_surface_keeps_the_order_within_bins():
+
+    # points on a circle around the x-axis, two points per angle
+    angles = np.array([0.5, -0.5, 0.5, 0.0])
+    pts    = np.column_stack(([1.0, 2.0, 3.0, 4.0], np.cos(angles), np.sin(angles)))
+    pts_out, phi = mf.flatten_surface(pts)
+
+    # x sorted by angle, then in the original order
+    assert pts_out[0].tolist() == [1.0, 3.0, 0.0, 2.0]
+    assert phi.shape == (4,)
+
+
+def test_cartilage_subregions_of_phantom():
+
+    # femoral cartilage of the phantom: shell around the femur axis (x), as in the preprocessed images
+    mask      = bp.cartilage_mask("small")
+    mask_py   = sitk.GetArrayFromImage(mask)
+    labels_py = sitk.GetArrayFromImage(mf.cartilage_subregions(mask))
+    names     = mf.subregion_names()
+
+    # all cartilage voxels are in one of the 12 subregions, and all subregions have voxels
+    assert np.array_equal(labels_py > 0, mask_py > 0)
+    assert np.all(np.bincount(labels_py.ravel(), minlength=len(names)+1)[1:] > 0)
+
+    # position of each subregion: average index and distance from the femur axis
+    z, y, x = np.nonzero(labels_py)
+    labels  = labels_py[z, y, x]
+    radius  = np.hypot(z - mask_py.shape[0] * 0.55, y - mask_py.shape[1] * 0.5)
+    def mean_of(values, part):
+        return np.mean(values[np.isin(labels, [names.index(name) + 1 for name in names if part in name])])
+
+    assert mean_of(x, "medial")   < mean_of(x, "lateral")
+    assert mean_of(y, "anterior") < mean_of(y, "posterior")
+    assert mean_of(radius, "deep") < mean_of(radius, "superficial")
+
+
+def labelled_mask_py(dtype=np.uint8):
+    # labels 1 and 3 in different slabs of 16 slices, and label 3 in the same slab of label 1
+    mask_py = np.zeros((40, 12, 14), dtype=dtype)
+    mask_py[2:30, 2:6, 3:9]   = 1
+    mask_py[10:38, 7:11, 3:9] = 3
+    return mask_py
+
+
+@pytest.mark.parametrize("compression_flag", [False, True])
+def test_count_labels_as_bincount(tmp_path, compression_flag):
+
+    mask_py   = labelled_mask_py()
+    file_name = str(tmp_path / "mask.mha")
+    sitk.WriteImage(tgs.array_to_image(mask_py), file_name, compression_flag)
+
+    counts, spacing = mf.count_labels(file_name, n_of_slices=16)
+    # uncompressed masks are memory-mapped, compressed are read as a whole
+    assert (lio.lazy_image(file_name).mmap is not None) == (not compression_flag)
+    assert counts.tolist() == np.bincount(mask_py.ravel()).tolist()
+    assert spacing == pytest.approx((0.5, 0.6, 0.7))
+
+
+def test_count_labels_of_negative_and_float_masks(tmp_path):
+
+    # negative values in one slab only: the whole mask is counted as binary
+    mask_py = labelled_mask_py(np.int16)
+    mask_py[35, 0, 0:8] = -1
+    counts, spacing = mf.count_labels(tgs.write_array(mask_py, tmp_path / "negative.mha"), n_of_slices=16)
+    assert counts.tolist() == [np.sum(mask_py == 0), np.sum(mask_py != 0)]
+
+    mask_py = labelled_mask_py(np.float32)
+    counts, spacing = mf.count_labels(tgs.write_array(mask_py, tmp_path / "float.mha"), n_of_slices=16)
+    assert counts.tolist() == [np.sum(mask_py == 0), np.sum(mask_py != 0)]
+
+    # empty mask
+    counts, spacing = mf.count_labels(tgs.write_array(np.zeros((4, 5, 6), dtype=np.uint8), tmp_path / "empty.mha"))
+    assert counts.tolist() == [4 * 5 * 6]
@@ -0,0 +1,155 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the steps of morphology_for_nb.py on small synthetic masks and on the phantom of benchmark_phantoms.py
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import test_general_functions as tgs
+import benchmark_phantoms     as bp
+import morphology_for_nb      as morph
+import pykneer_io             as io
+import sitk_functions         as sitkf
+
+
+def write_masks(folder, masks):
+    # masks (name, folder name, box end in z) in their folders, and image_data as load_image_data_morphology
+    morphology_folder = os.path.join(str(folder), "morphology") + os.sep
+    if not os.path.isdir(morphology_folder):
+        os.mkdir(morphology_folder)
+    all_image_data = []
+    for mask_name, folder_name, end in masks:
+        input_folder = os.path.join(str(folder), folder_name) + os.sep
+        if not os.path.isdir(input_folder):
+            os.mkdir(input_folder)
+        tgs.write_array(box_mask_py(end), input_folder + mask_name, spacing=(1.0, 1.0, 2.0))
+        all_image_data.append(io.morphology_image_data(input_folder, morphology_folder, mask_name))
+    return all_image_data
+
+def box_mask_py(end):
+    mask_py = np.zeros((12, 10, 10), dtype=np.uint8)
+    mask_py[2:end, 2:7, 3:8] = 1
+    return mask_py
+
+
+# --- tests ---
+
+def test_volume_table_of_masks_with_same_name(tmp_path):
+
+    all_image_data = write_masks(tmp_path, [("01_fc.mha", "visit_1", 4), ("01_fc.mha", "visit_2", 6)])
+    morph.calculate_volume(all_image_data)
+
+    # one row per mask, with the volume of each mask
+    table = pd.read_csv(str(tmp_path / "morphology" / "volume_table.csv"))
+    assert len(table) == 2
+    assert morph.read_volumes(all_image_data).tolist() == [2 * 25 * 2.0, 4 * 25 * 2.0]
+
+
+def test_volume_table_is_incremental(tmp_path, capsys):
+
+    all_image_data = write_masks(tmp_path, [("01_fc.mha", "segmented", 4), ("02_fc.mha", "segmented", 6)])
+    morph.calculate_volume(all_image_data)
+    morph.calculate_volume(all_image_data)
+    assert "-> Volume computed for 0 masks (2 already in the table)" in capsys.readouterr().out
+
+    # modified mask (new modification time): only its volume is computed again
+    file_name = all_image_data[1]["input_folder"] + all_image_data[1]["mask_name"]
+    tgs.write_array(box_mask_py(10), file_name, spacing=(1.0, 1.0, 2.0))
+    os.utime(file_name, ns=(os.stat(file_name).st_atime_ns, os.stat(file_name).st_mtime_ns + 10**9))
+    morph.calculate_volume(all_image_data)
+    assert "-> Volume computed for 1 masks (1 already in the table)" in capsys.readouterr().out
+    assert morph.read_volumes(all_image_data).tolist() == [2 * 25 * 2.0, 8 * 25 * 2.0]
+
+
+def test_volume_table_without_folders(tmp_path, capsys):
+
+    # table of a previous version (without input_folder): computed again
+    all_image_data = write_masks(tmp_path, [("01_fc.mha", "segmented", 4)])
+    mask_file_name = all_image_data[0]["input_folder"] + "01_fc.mha"
+    pd.DataFrame([{"subjects" : "01_fc", "mask_name" : "01_fc.mha", "mask_mtime" : os.stat(mask_file_name).st_mtime_ns,
+                   "label" : 1, "n_of_voxels" : 1, "volume" : 1.0}]).to_csv(str(tmp_path / "morphology" / "volume_table.csv"), index=False)
+    morph.calculate_volume(all_image_data)
+
+    assert "-> Volume computed for 1 masks (0 already in the table)" in capsys.readouterr().out
+    assert morph.read_volumes(all_image_data).tolist() == [2 * 25 * 2.0]
+
+
+def phantom_image_data(folder):
+    # femoral cartilage of the phantom, as mask of morphology.ipynb
+    all_image_data = write_masks(folder, [])
+    input_folder   = os.path.join(str(folder), "segmented") + os.sep
+    os.mkdir(input_folder)
+    sitkf.write_mask(bp.cartilage_mask("small"), input_folder + "01_fc.mha", 1)
+    return [io.morphology_image_data(input_folder, os.path.join(str(folder), "morphology") + os.sep, "01_fc.mha")]
+
+def txt_result(image_data, key):
+    return io.read_txt_to_np_array(image_data["morphology_folder"] + image_data[key + "_name"])
+
+def bundle_result(image_data, key):
+    with np.load(image_data["morphology_folder"] + image_data["morphology_bundle_name"]) as bundle:
+        return bundle[key]
+
+def set_mtime(file_name, mtime):
+    os.utime(file_name, (mtime, mtime))
+
+results = ["bone_cart", "arti_cart", "bone_cart_flat", "arti_cart_flat", "bone_phi", "arti_phi", "thickness", "thickness_flat"]
+
+
+def test_compute_morphology_as_steps(tmp_path):
+
+    # step by step (results in .txt files, with 2 decimals)
+    all_image_data = phantom_image_data(tmp_path)
+    morph.separate_cartilage_surfaces(all_image_data, 1)
+    morph.algorithm(all_image_data, 1)
+    morph.calculate_thickness(all_image_data, 1)
+    morph.calculate_volume(all_image_data, 1)
+
+    # in one step, also exported to .txt files in another folder
+    fused_data = [dict(all_image_data[0])]
+    fused_data[0]["morphology_folder"] = str(tmp_path / "fused") + os.sep
+    os.mkdir(fused_data[0]["morphology_folder"])
+    morph.compute_morphology(fused_data, 1, 1, txt_flag=1)
+
+    image_data = all_image_data[0]
+    for key in results:
+        bundle = bundle_result(fused_data[0], key)
+        assert np.ravel(bundle).shape == np.ravel(txt_result(image_data, key)).shape
+        # the step-by-step thickness is computed from the rounded surfaces
+        assert np.allclose(np.ravel(bundle), np.ravel(txt_result(image_data, key)), atol=0.02)
+        # exported .txt files are the same as the step-by-step ones (except thickness, computed from the surfaces not rounded)
+        if not key.startswith("thickness"):
+            assert np.array_equal(txt_result(fused_data[0], key), txt_result(image_data, key))
+    assert float(bundle_result(fused_data[0], "volume")) == pytest.approx(morph.read_volumes(all_image_data)[0])
+    assert float(np.ravel(txt_result(fused_data[0], "volume"))[0]) == pytest.approx(morph.read_volumes(all_image_data)[0], abs=0.01)
+
+
+def test_load_morphology_from_bundle_or_txt(tmp_path):
+
+    all_image_data = phantom_image_data(tmp_path)
+    image_data     = all_image_data[0]
+    morph.compute_morphology(all_image_data, 1, 1, txt_flag=1)
+    bundle_file_name = image_data["morphology_folder"] + image_data["morphology_bundle_name"]
+    txt_file_name    = image_data["morphology_folder"] + image_data["thickness_name"]
+
+    # bundle as recent as the .txt files: values of the bundle (not rounded)
+    assert np.array_equal(morph.load_morphology(image_data, "thickness"), bundle_result(image_data, "thickness"))
+    assert np.array_equal(morph.load_morphology(image_data, "bone_cart"), bundle_result(image_data, "bone_cart"))
+
+    # .txt file more recent than the bundle (e.g. written by calculate_thickness): values of the .txt file
+    set_mtime(bundle_file_name, os.path.getmtime(txt_file_name) - 10)
+    assert np.array_equal(morph.load_morphology(image_data, "thickness"), io.read_txt_to_np_array(txt_file_name))
+
+    # bundle with another thickness algorithm: thickness from the .txt file of the algorithm of image_data
+    morph.compute_morphology(all_image_data, 2, 1)
+    morph.algorithm(all_image_data, 1)
+    assert np.array_equal(morph.load_morphology(image_data, "thickness"), io.read_txt_to_np_array(txt_file_name))
+    assert np.array_equal(morph.load_morphology(image_data, "bone_cart"), bundle_result(image_data, "bone_cart"))
+
+    # without .txt files: values of the bundle
+    os.remove(image_data["morphology_folder"] + image_data["arti_phi_name"])
+    assert np.array_equal(morph.load_morphology(image_data, "arti_phi"), bundle_result(image_data, "arti_phi"))
@@ -0,0 +1,150 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the atlas index, the atlas preselection, and the label fusion of segmentation_ma_for_nb.py, with blobs as images
+"""
+
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions as tgs
+import cli
+import pykneer_io             as io
+import segmentation_ma_for_nb as ma
+import sitk_functions         as sitkf
+
+
+# --- variables ---
+
+shape   = (40, 48, 32) # numpy order
+centers = [(12, 14, 10), (20, 24, 16), (28, 34, 22), (16, 34, 10), (28, 14, 22)]
+
+
+def blob_image(center, seed):
+    # bright ellipsoid at center with noise
+    z, y, x = np.mgrid[0:shape[0], 0:shape[1], 0:shape[2]]
+    blob    = np.exp(-((z - center[0])**2 / 40.0 + (y - center[1])**2 / 60.0 + (x - center[2])**2 / 30.0))
+    noise   = np.random.RandomState(seed).normal(0, 0.05, shape)
+    return tgs.array_to_image((100 * (blob + noise)).astype(np.float32), (0.5, 0.4, 0.6))
+
+
+def write_atlases(folder):
+    # atlas images and the image to segment, which is close to the third atlas (folders as load_image_data_segmentation_ma)
+    atlas_folder  = os.path.join(str(folder), "reference") + os.sep
+    moving_folder = os.path.join(str(folder), "preprocessed") + os.sep
+    for sub_folder in ["reference", "preprocessed", "registered", "segmented"]:
+        os.mkdir(os.path.join(str(folder), sub_folder))
+    atlas_names = []
+    for a in range(0, len(centers)):
+        atlas_names.append("atlas_%d_prep.mha" % a)
+        sitk.WriteImage(blob_image(centers[a], a), atlas_folder + atlas_names[a])
+    sitk.WriteImage(blob_image((27, 33, 21), 100), moving_folder + "knee_prep.mha")
+    image_data = io.segmentation_ma_image_data(atlas_folder, atlas_names, moving_folder, "knee_prep.mha",
+                                               io.sibling_folder(moving_folder, "registered"), io.sibling_folder(moving_folder, "segmented"))
+    return [image_data]
+
+
+# --- tests ---
+
+def test_preselect_atlases(tmp_path, capsys):
+
+    all_image_data = write_atlases(tmp_path)
+    ma.preselect_atlases(all_image_data, 3, 2)
+
+    # most similar atlas first, and decreasing similarity
+    assert all_image_data[0]["selected_atlas_names"][0] == "atlas_2_prep.mha"
+    assert len(all_image_data[0]["selected_atlas_names"]) == 3
+    assert all_image_data[0]["atlas_weights"] == sorted(all_image_data[0]["atlas_weights"], reverse=True)
+    assert "(5 computed)" in capsys.readouterr().out
+
+    # the index is reused, and only modified atlases are computed again
+    ma.build_atlas_index(all_image_data, 2)
+    assert "(0 computed)" in capsys.readouterr().out
+    sitk.WriteImage(blob_image(centers[0], 7), all_image_data[0]["atlas_folder"] + "atlas_0_prep.mha")
+    ma.build_atlas_index(all_image_data, 2)
+    assert "(1 computed)" in capsys.readouterr().out
+
+
+def test_image_is_not_its_own_atlas(tmp_path):
+
+    all_image_data = write_atlases(tmp_path)
+    all_image_data[0]["atlas_names"].append("knee_prep.mha")
+    sitk.WriteImage(sitk.ReadImage(all_image_data[0]["moving_folder"] + "knee_prep.mha"), all_image_data[0]["atlas_folder"] + "knee_prep.mha")
+    ma.preselect_atlases(all_image_data, 2, 1)
+
+    assert all_image_data[0]["selected_atlas_names"][0] == "atlas_2_prep.mha"
+    assert "knee_prep.mha" not in all_image_data[0]["selected_atlas_names"]
+
+
+def test_fuse_masks():
+
+    masks_py = [np.zeros((2, 2, 3), dtype=np.uint8) for a in range(0, 3)]
+    masks_py[0][0, 0, :] = 1
+    masks_py[1][0, 0, 0:2] = 1
+    masks_py[2][0, 0, 0] = 1
+    masks = [sitk.GetImageFromArray(mask_py) for mask_py in masks_py]
+
+    # majority: at least 2 of 3 masks
+    fused_py = sitk.GetArrayFromImage(ma.fuse_masks(masks))
+    assert fused_py[0, 0].tolist() == [1, 1, 0] and np.sum(fused_py) == 2
+    # weighted: the first mask alone has more than half of the weights
+    fused_py = sitk.GetArrayFromImage(ma.fuse_masks(masks, [0.6, 0.2, 0.1]))
+    assert fused_py[0, 0].tolist() == [1, 1, 1]
+
+
+def test_fuse_labels(tmp_path):
+
+    all_image_data = write_atlases(tmp_path)
+    image_data     = all_image_data[0]
+    image_data["selected_atlas_names"] = ["atlas_2_prep.mha", "atlas_1_prep.mha", "atlas_4_prep.mha"]
+    image_data["atlas_weights"]        = [0.9, 0.5, 0.3]
+
+    # masks warped from the atlases: each atlas adds a slab
+    for a in range(0, 3):
+        mask = tgs.box_mask(shape, (10+a, 10, 10), (20, 20, 20), (0.5, 0.4, 0.6))
+        os.makedirs(ma.atlas_folder_name(image_data, image_data["selected_atlas_names"][a]))
+        for anatomy in ["f", "fc"]:
+            sitkf.write_mask(mask, ma.warped_mask_name(image_data, image_data["selected_atlas_names"][a], anatomy), 1)
+
+    ma.fuse_labels(all_image_data, "majority", 1)
+    fused_py = sitk.GetArrayFromImage(sitkf.read_mask(image_data["segmented_folder"] + "knee_prep_fc.mha"))
+    assert np.sum(fused_py) == 9 * 10 * 10
+    assert sitkf.read_mask(image_data["segmented_folder"] + "knee_prep_f.mha").GetSpacing() == (0.5, 0.4, 0.6)
+
+    # weighted: the first atlas has more than half of the weights
+    ma.fuse_labels(all_image_data, "weighted", 1)
+    fused_py = sitk.GetArrayFromImage(sitkf.read_mask(image_data["segmented_folder"] + "knee_prep_fc.mha"))
+    assert np.sum(fused_py) == 10 * 10 * 10
+
+
+def test_preselection_is_read_by_the_next_steps(tmp_path):
+
+    ma.preselect_atlases(write_atlases(tmp_path), 3, 1)
+
+    # same image in a new session (e.g. pykneer segmentation_ma --stages fuse_labels)
+    all_image_data = [io.segmentation_ma_image_data(str(tmp_path / "reference") + os.sep, ["atlas_%d_prep.mha" % a for a in range(0, len(centers))],
+                                                     str(tmp_path / "preprocessed") + os.sep, "knee_prep.mha",
+                                                     str(tmp_path / "registered") + os.sep, str(tmp_path / "segmented") + os.sep)]
+    assert ma.load_selected_atlases(all_image_data)
+    assert all_image_data[0]["selected_atlas_names"][0] == "atlas_2_prep.mha"
+    assert len(all_image_data[0]["atlas_weights"]) == 3
+
+
+def test_steps_without_preselection(tmp_path, capsys):
+
+    all_image_data = write_atlases(tmp_path)
+    ma.fuse_labels(all_image_data, "majority", 1)
+
+    assert "are not preselected" in capsys.readouterr().out
+    assert os.listdir(all_image_data[0]["segmented_folder"]) == []
+
+
+def test_cohort_manifest_is_rejected(tmp_path, capsys):
+
+    open(str(tmp_path / "cohort.csv"), "w").close()
+
+    assert cli.main(["segmentation_ma", str(tmp_path / "cohort.csv")]) == 2
+    assert "does not read cohort manifests" in capsys.readouterr().out
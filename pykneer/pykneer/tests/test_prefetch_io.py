@@ -0,0 +1,101 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the prefetching reads, the asynchronous writes, and the chunks of prefetch_io.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions as tgs
+import prefetch_io            as pio
+import sitk_functions         as sitkf
+
+
+def invert_s(image_data):
+    img = pio.read_image(image_data["input_file_name"])
+    pio.write_image(1 - img, image_data["output_file_name"], True,
+                    lambda: open(image_data["output_file_name"] + ".done", "w").close())
+    return image_data["value"]
+
+def invert_input_files(image_data):
+    return [image_data["input_file_name"]]
+
+def invert_and_fail_s(image_data):
+    invert_s(image_data)
+    raise ValueError("wrong image")
+
+
+def write_images(folder, n_of_images):
+    all_image_data = []
+    for i in range(0, n_of_images):
+        input_file_name = tgs.write_array(np.full((4, 5, 6), i % 2, dtype=np.uint8), os.path.join(str(folder), "image_%02d.mha" % i))
+        all_image_data.append({"input_file_name"  : input_file_name,
+                               "output_file_name" : os.path.join(str(folder), "inverted_%02d.mha" % i),
+                               "value"            : i})
+    return all_image_data
+
+
+# --- tests ---
+
+def test_map_with_prefetch(tmp_path):
+
+    all_image_data = write_images(tmp_path, 9)
+    results        = pio.map_with_prefetch(invert_s, invert_input_files, all_image_data, 2)
+
+    # results in order, and all writes (and what follows them) completed
+    assert results == list(range(0, 9))
+    for i in range(0, 9):
+        inverted = sitk.GetArrayFromImage(sitk.ReadImage(all_image_data[i]["output_file_name"]))
+        assert np.all(inverted == 1 - i % 2)
+        assert os.path.isfile(all_image_data[i]["output_file_name"] + ".done")
+
+
+def test_read_prefetched_image_and_mask(tmp_path):
+
+    all_image_data = write_images(tmp_path, 1)
+    mask           = sitk.GetImageFromArray(np.pad(np.ones((2, 2, 2), dtype=np.uint8), 3))
+    mask_file_name = str(tmp_path / "mask.mha")
+    sitkf.write_mask(mask, mask_file_name, 1)
+
+    pio.prefetch([all_image_data[0]["input_file_name"], mask_file_name])
+    img = pio.read_image(all_image_data[0]["input_file_name"])
+    assert img.GetSpacing() == (0.5, 0.6, 0.7)
+    # cropped masks are restored to the full image, as with sitkf.read_mask
+    assert np.array_equal(sitk.GetArrayFromImage(pio.read_mask(mask_file_name)), sitk.GetArrayFromImage(mask))
+    assert len(pio.prefetched) == 0
+
+
+def test_write_outside_map_is_synchronous(tmp_path):
+
+    all_image_data = write_images(tmp_path, 1)
+    invert_s(all_image_data[0])
+
+    assert os.path.isfile(all_image_data[0]["output_file_name"] + ".done")
+    assert len(pio.pending_writes) == 0
+
+
+def test_chunk_size():
+
+    # fewer than two images per process: all the processes run
+    assert pio.chunk_size(8, 8) == 1
+    assert pio.chunk_size(12, 8) == 2
+    assert pio.chunk_size(3, 4) == 1
+    # enough images: about four chunks per process, with at least two images
+    assert pio.chunk_size(16, 8) == 2
+    assert pio.chunk_size(100, 4) == 7
+
+
+def test_failed_chunk_leaves_no_pending_writes(tmp_path):
+
+    all_image_data = write_images(tmp_path, 2)
+    with pytest.raises(ValueError):
+        pio.run_chunk((invert_and_fail_s, invert_input_files, all_image_data))
+
+    # the write of the failed image completed, and the next chunk of the same process starts clean
+    assert len(pio.pending_writes) == 0 and len(pio.prefetched) == 0
+    assert os.path.isfile(all_image_data[0]["output_file_name"] + ".done")
+    assert pio.run_chunk((invert_s, invert_input_files, all_image_data[1:])) == [1]
@@ -0,0 +1,147 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the overlap measures and surface distances of sitk_functions.py and segmentation_quality_for_nb.py against the SimpleITK filters,
+with the cartilage phantom of benchmark_phantoms.py
+"""
+
+import os
+import warnings
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions      as tgs
+import benchmark_phantoms          as bp
+import segmentation_quality_for_nb as sq
+import sitk_functions              as sitkf
+
+
+def phantom_masks(shift=1):
+    # cartilage and shifted cartilage with unit spacing (surface distances are in voxels)
+    mask_1 = bp.cartilage_mask("small")
+    mask_2 = bp.perturbed_mask("small", shift)
+    mask_1.SetSpacing((1.0, 1.0, 1.0))
+    mask_2.SetSpacing((1.0, 1.0, 1.0))
+    return mask_1, mask_2
+
+
+# --- tests ---
+
+def test_overlap_measures_py_as_filter():
+
+    mask_1, mask_2 = phantom_masks()
+    measures_py    = sitkf.overlap_measures_py(sitk.GetArrayViewFromImage(mask_1), sitk.GetArrayViewFromImage(mask_2))
+
+    assert measures_py == pytest.approx(sitkf.overlap_measures(mask_1, mask_2))
+
+
+def test_overlap_measures_py_of_empty_masks():
+
+    empty_py = np.zeros((4, 5, 6), dtype=np.uint8)
+    full_py  = np.ones ((4, 5, 6), dtype=np.uint8)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert sitkf.overlap_measures_py(empty_py, empty_py) == (1.0, 1.0, 0.0)
+        assert sitkf.overlap_measures_py(full_py,  empty_py) == (0.0, 0.0, 2.0)
+
+
+def test_compute_quality_as_filters(tmp_path):
+
+    mask_1, mask_2 = phantom_masks(2)
+    sitkf.write_mask(mask_1, str(tmp_path / "knee_fc.mha"), 1)
+    # spacing of the ground truth different at a late digit (rounded as in compute_surface_distance)
+    mask_2.SetSpacing((1.0, 1.0, 1.0000001))
+    sitk.WriteImage(mask_2, str(tmp_path / "knee_fc_gt.mha"))
+    image_data = {"segmented_folder"    : str(tmp_path) + os.sep, "segmented_name"    : "knee_fc.mha",
+                  "ground_truth_folder" : str(tmp_path) + os.sep, "ground_truth_name" : "knee_fc_gt.mha"}
+    quality    = sq.compute_quality_s(image_data)
+
+    mask_2.SetSpacing((1.0, 1.0, 1.0))
+    overlap   = sitk.LabelOverlapMeasuresImageFilter()
+    overlap.Execute(mask_1, mask_2)
+    hausdorff = sitk.HausdorffDistanceImageFilter()
+    hausdorff.Execute(mask_1, mask_2)
+    assert quality["dice_coeff"]          == pytest.approx(overlap.GetDiceCoefficient())
+    assert quality["jaccard_coeff"]       == pytest.approx(overlap.GetJaccardCoefficient())
+    assert quality["volume_similarity"]   == pytest.approx(overlap.GetVolumeSimilarity())
+    assert quality["hausdorff_distances"] == pytest.approx(hausdorff.GetHausdorffDistance(), abs=1e-6)
+
+
+def test_surface_distances_of_cropped_masks():
+
+    mask_1, mask_2 = phantom_masks(2)
+    distances      = sitkf.surface_distances(mask_1, mask_2)
+
+    # distances on the whole image (without cropping to the bounding box)
+    distance_map_1 = sitk.GetArrayFromImage(sitk.Abs(sitk.SignedMaurerDistanceMap(mask_1, squaredDistance=False)))
+    distance_map_2 = sitk.GetArrayFromImage(sitk.Abs(sitk.SignedMaurerDistanceMap(mask_2, squaredDistance=False)))
+    surface_1      = sitk.GetArrayFromImage(sitk.LabelContour(mask_1)) != 0
+    surface_2      = sitk.GetArrayFromImage(sitk.LabelContour(mask_2)) != 0
+    full_distances = np.concatenate((distance_map_1[surface_2], distance_map_2[surface_1]))
+
+    assert np.allclose(distances, full_distances)
+
+
+def test_surface_distances_kd_tree_as_distance_map():
+
+    # same masks: all distances are zero with both methods
+    mask_1, mask_2 = phantom_masks(2)
+    assert np.all(sitkf.surface_distances(mask_1, mask_1, method="kd_tree") == 0)
+    assert np.all(sitkf.surface_distances(mask_1, mask_1) == 0)
+
+    # shifted masks: same number of distances and same maximum; distance maps measure to the contour between voxels,
+    # the KD-tree to the closest contour voxel, so single distances differ by less than one voxel
+    distances_map  = sitkf.surface_distances(mask_1, mask_2)
+    distances_tree = sitkf.surface_distances(mask_1, mask_2, method="kd_tree")
+    assert len(distances_map) == len(distances_tree)
+    assert np.max(distances_tree) == pytest.approx(np.max(distances_map), abs=1e-6)
+    assert np.max(np.abs(distances_tree - distances_map)) <= 1.0 + 1e-6
+    assert np.mean(distances_tree) == pytest.approx(np.mean(distances_map), abs=0.25)
+
+
+def multilabel_image_data(folder, segmented_masks, ground_truth_masks, anatomies):
+    # masks of each anatomy, named as compute_overlap_multilabel_s expects
+    for a in range(0, len(anatomies)):
+        sitk.WriteImage(segmented_masks[a],    os.path.join(str(folder), "knee_%s.mha"    % anatomies[a]))
+        sitk.WriteImage(ground_truth_masks[a], os.path.join(str(folder), "knee_gt_%s.mha" % anatomies[a]))
+    return {"segmented_folder"    : str(folder) + os.sep, "segmented_name"    : "knee_fc.mha",
+            "ground_truth_folder" : str(folder) + os.sep, "ground_truth_name" : "knee_gt_fc.mha", "anatomies" : anatomies}
+
+
+def test_multilabel_overlap_as_single_masks(tmp_path, capsys):
+
+    shape = (20, 20, 20)
+    # bone and cartilage that overlap in the segmentation (cartilage over the top of the bone)
+    segmented    = [tgs.box_mask(shape, (2, 2, 2),  (12, 15, 15)), tgs.box_mask(shape, (10, 2, 2), (14, 15, 15))]
+    ground_truth = [tgs.box_mask(shape, (2, 3, 2),  (11, 15, 15)), tgs.box_mask(shape, (11, 3, 2), (14, 15, 15))]
+    image_data   = multilabel_image_data(tmp_path, segmented, ground_truth, ["f", "fc"])
+    dice, jacc, vols = sq.compute_overlap_multilabel_s(image_data)
+
+    assert "Each anatomy is measured on its own mask" in capsys.readouterr().out
+    for a in range(0, 2):
+        expected = sitkf.overlap_measures(segmented[a], ground_truth[a])
+        assert (dice[a], jacc[a], vols[a]) == pytest.approx(expected)
+
+    # without overlap: one filter run on the label images, same values as the single masks
+    segmented[1]     = tgs.box_mask(shape, (12, 2, 2), (14, 15, 15))
+    image_data       = multilabel_image_data(tmp_path, segmented, ground_truth, ["f", "fc"])
+    dice, jacc, vols = sq.compute_overlap_multilabel_s(image_data)
+    for a in range(0, 2):
+        assert (dice[a], jacc[a], vols[a]) == pytest.approx(sitkf.overlap_measures(segmented[a], ground_truth[a]))
+
+
+def test_multilabel_overlap_of_missing_labels():
+
+    shape  = (10, 10, 10)
+    labels_1, n = sitkf.masks_to_labels([tgs.box_mask(shape, (1, 1, 1), (4, 4, 4)), tgs.box_mask(shape, (5, 5, 5), (7, 7, 7)),
+                                         tgs.box_mask(shape, (0, 0, 0), (0, 0, 0))])
+    labels_2, n = sitkf.masks_to_labels([tgs.box_mask(shape, (1, 1, 1), (4, 4, 4)), tgs.box_mask(shape, (0, 0, 0), (0, 0, 0)),
+                                         tgs.box_mask(shape, (0, 0, 0), (0, 0, 0))])
+    dice, jacc, vols = sitkf.multi_label_overlap_measures(labels_1, labels_2, 3)
+
+    # label 2 is only in the first image, label 3 is in none
+    assert dice == [1.0, 0.0, 1.0]
+    assert jacc == [1.0, 0.0, 1.0]
+    assert vols == [0.0, 2.0, 0.0]
@@ -0,0 +1,33 @@
+# Serena Bonaretti, 2019
+
+"""
+Test functions of relaxometry_functions.py on random arrays, against numpy
+"""
+
+import numpy as np
+import pytest
+
+import test_general_functions as tgs
+import relaxometry_functions  as rf
+
+
+# --- tests ---
+
+def test_regional_statistics_as_numpy():
+
+    random    = np.random.RandomState(0)
+    map_py    = random.uniform(10, 60, (6, 7, 8))
+    map_py[0] = 0 # voxels with map 0 are not considered
+    labels_py = random.randint(0, 4, (6, 7, 8)).astype(np.uint8)
+    labels_py[labels_py == 3] = 2 # label 3 without voxels
+    percentiles = [5, 50, 95]
+
+    count, average, std_dev, percentile_values = rf.regional_statistics(map_py, labels_py, 3, percentiles)
+
+    for label in range(1, 3):
+        values = map_py[(labels_py == label) & (map_py != 0)]
+        assert count[label-1] == len(values)
+        assert average[label-1] == pytest.approx(np.mean(values))
+        assert std_dev[label-1] == pytest.approx(np.std(values))
+        assert percentile_values[:, label-1] == pytest.approx(np.percentile(values, percentiles))
+    assert count[2] == 0 and np.isnan(average[2]) and np.all(np.isnan(percentile_values[:, 2]))
@@ -0,0 +1,168 @@
+# Serena Bonaretti, 2019
+
+"""
+Test functions of sitk_functions.py against SimpleITK filters, on small synthetic images and on the phantom of benchmark_phantoms.py
+"""
+
+import itertools
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions as tgs
+import benchmark_phantoms     as bp
+import sitk_functions         as sitkf
+
+
+def random_mask():
+    # sparse random voxels, some of them on the image border
+    mask_py = (np.random.RandomState(0).rand(20, 24, 28) > 0.995).astype(np.uint8)
+    mask_py[0, 5, 5] = 1
+    mask_py[19, 23, 27] = 1
+    return tgs.array_to_image(mask_py)
+
+
+def axes_directions():
+    # direction matrices with the image axes along the physical axes: 6 permutations x 8 verses
+    directions = []
+    for permutation in itertools.permutations([0, 1, 2]):
+        for verse in itertools.product([1, -1], repeat=3):
+            direction = np.zeros((3, 3))
+            for a in range(0, 3):
+                direction[permutation[a], a] = verse[a]
+            directions.append(direction)
+    return directions
+
+def rai_reference(img):
+    # RAI image with the voxels of img: grid starting at the corner with the smallest coordinates, read with nearest neighbor
+    size    = np.array(img.GetSize())
+    corners = [img.TransformIndexToPhysicalPoint([int(c) for c in corner * (size - 1)]) for corner in itertools.product([0, 1], repeat=3)]
+    axes    = np.argmax(np.abs(np.array(img.GetDirection()).reshape(3, 3)), axis=0)
+    reference = sitk.Image([int(size[np.argsort(axes)[a]]) for a in range(0, 3)], img.GetPixelID())
+    reference.SetSpacing([img.GetSpacing()[np.argsort(axes)[a]] for a in range(0, 3)])
+    reference.SetOrigin(np.min(corners, axis=0).tolist())
+    return sitk.Resample(img, reference, sitk.Transform(), sitk.sitkNearestNeighbor)
+
+
+# --- tests ---
+
+@pytest.mark.parametrize("mask", [bp.cartilage_mask("small"),
+                                  random_mask(),
+                                  tgs.box_mask((20, 24, 28), (0, 5, 6), (8, 20, 27))], # touches the image border
+                         ids=["phantom", "random", "border"])
+def test_dilate_mask_methods_are_equal(mask):
+
+    for radius in [1, 2, 3, 5, 8, 15]:
+        mask_distance = sitkf.dilate_mask(mask, radius)
+        mask_kernel   = sitkf.dilate_mask(mask, radius, method="kernel")
+        assert mask_distance.GetPixelID() == sitk.sitkUInt8 and mask_kernel.GetPixelID() == sitk.sitkUInt8
+        assert np.array_equal(sitk.GetArrayFromImage(mask_distance), sitk.GetArrayFromImage(mask_kernel)), "radius %d" % radius
+        assert mask_distance.GetSpacing() == mask.GetSpacing() and mask_distance.GetOrigin() == mask.GetOrigin()
+
+
+def test_dilate_empty_mask():
+
+    mask_dil = sitkf.dilate_mask(tgs.box_mask((4, 5, 6), (0, 0, 0), (0, 0, 0)), 3)
+    assert mask_dil.GetPixelID() == sitk.sitkUInt8 and mask_dil.GetSize() == (6, 5, 4)
+    assert np.all(sitk.GetArrayFromImage(mask_dil) == 0)
+    assert sitkf.dilate_mask(mask_dil, 3, method="other") is None
+
+
+def oblique_image():
+    # image with rotated axes and anisotropic spacing
+    array_py = np.random.RandomState(0).randint(0, 1000, (6, 7, 8)).astype(np.int16)
+    img      = tgs.array_to_image(array_py, spacing=(0.5, 0.6, 0.7))
+    img.SetOrigin((10.0, -5.0, 3.0))
+    img.SetDirection(sitk.VersorTransform((1.0, 2.0, 3.0), 0.4).GetMatrix())
+    return img
+
+def read_series(folder):
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(folder))
+    return reader.Execute()
+
+def write_float_slice(file_name, img_slice):
+    # slice stored as int16 with its own rescale slope and intercept, so it is read as float
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_name)
+    reader.ReadImageInformation()
+    float_slice = sitk.Cast(img_slice, sitk.sitkFloat32) * 0.25 + 0.1
+    for key in reader.GetMetaDataKeys():
+        if not key.startswith("0028"):
+            float_slice.SetMetaData(key, reader.GetMetaData(key))
+    for key, value in [("0028|1053", "0.25"), ("0028|1052", "0.1"), ("0028|0100", "16"), ("0028|0101", "16"),
+                       ("0028|0102", "15"), ("0028|0103", "1")]:
+        float_slice.SetMetaData(key, value)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    writer.SetFileName(file_name)
+    writer.Execute(float_slice)
+
+
+def test_read_dicom_stack_as_series_reader(tmp_path):
+
+    folder = str(tmp_path / "dicom")
+    bp.write_dicom_series(oblique_image(), folder)
+    img     = sitkf.read_dicom_stack(folder)
+    img_ref = read_series(folder)
+
+    assert img.GetPixelID() == img_ref.GetPixelID()
+    assert np.array_equal(sitk.GetArrayFromImage(img), sitk.GetArrayFromImage(img_ref))
+    assert np.allclose(img.GetSpacing(),   img_ref.GetSpacing(),   atol=1e-6)
+    assert np.allclose(img.GetOrigin(),    img_ref.GetOrigin(),    atol=1e-6)
+    assert np.allclose(img.GetDirection(), img_ref.GetDirection(), atol=1e-6)
+    # and as the written image
+    assert np.array_equal(sitk.GetArrayFromImage(img), sitk.GetArrayFromImage(oblique_image()))
+    assert np.allclose(img.GetDirection(), oblique_image().GetDirection(), atol=1e-5)
+
+
+def test_read_dicom_stack_of_slices_with_different_pixel_types(tmp_path, capsys):
+
+    folder = str(tmp_path / "dicom")
+    img    = oblique_image()
+    bp.write_dicom_series(img, folder)
+    write_float_slice(os.path.join(folder, "IM0002.dcm"), img[:,:,2])
+    img_stack = sitkf.read_dicom_stack(folder)
+
+    # the float slice is not truncated to the type of the first slice
+    assert "different pixel types" in capsys.readouterr().out
+    assert img_stack.GetPixelID() == sitk.sitkFloat64
+    img_py = sitk.GetArrayFromImage(img_stack)
+    assert np.allclose(img_py[2], sitk.GetArrayFromImage(img)[2] * 0.25 + 0.1, atol=1e-3)
+    assert np.array_equal(np.delete(img_py, 2, axis=0), np.delete(sitk.GetArrayFromImage(img), 2, axis=0))
+
+
+@pytest.mark.parametrize("direction", axes_directions())
+def test_orientation_to_rai(direction):
+
+    # a different size, spacing, and pixel type along each axis, so that permutations and flips are visible
+    pixel_type = [np.int16, np.float32, np.uint8][int(np.argmax(np.abs(direction[:,0])))]
+    array_py   = np.random.RandomState(0).randint(0, 200, (4, 5, 6)).astype(pixel_type)
+    img        = tgs.array_to_image(array_py, spacing=(0.5, 0.6, 0.7))
+    img.SetOrigin((10.0, -5.0, 3.0))
+    img.SetDirection(direction.flatten().tolist())
+
+    img_rai = sitkf.orientation_to_rai(img)
+    img_ref = rai_reference(img)
+    assert img_rai.GetPixelID() == img.GetPixelID()
+    assert np.array_equal(sitk.GetArrayFromImage(img_rai), sitk.GetArrayFromImage(img_ref))
+    assert img_rai.GetDirection() == (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+    assert np.allclose(img_rai.GetSpacing(), img_ref.GetSpacing())
+    assert np.allclose(img_rai.GetOrigin(),  img_ref.GetOrigin())
+    # voxels stay in the same physical position
+    index = (1, 2, 3)
+    point = img.TransformIndexToPhysicalPoint(index)
+    assert img_rai[img_rai.TransformPhysicalPointToIndex(point)] == img[index]
+
+
+def test_orientation_to_rai_of_oblique_image():
+
+    # axes rotated by a few degrees go to the closest physical axes, as the axes without rotation
+    img     = oblique_image()
+    img.SetDirection(sitk.VersorTransform((1.0, 0.0, 0.0), 0.05).GetMatrix())
+    img_rai = sitkf.orientation_to_rai(img)
+    img.SetDirection((1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+    assert np.array_equal(sitk.GetArrayFromImage(img_rai), sitk.GetArrayFromImage(img))
+    assert np.allclose(img_rai.GetSpacing(), img.GetSpacing())
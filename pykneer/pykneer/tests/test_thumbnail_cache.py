@@ -0,0 +1,106 @@
+# Serena Bonaretti, 2019
+
+"""
+Test the thumbnails of thumbnail_cache.py: reuse and invalidation of the cache, and slices against the ones of the whole images
+"""
+
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+import test_general_functions as tgs
+import lazy_image_io          as lio
+import thumbnail_cache        as thc
+import sitk_functions         as sitkf
+
+
+def write_image(folder, shape=(300, 280, 12), seed=0):
+    # image with slices larger than thumbnail_max_size, so that thumbnails are downsampled
+    array_py  = np.random.RandomState(seed).randint(0, 1000, shape).astype(np.int16)
+    file_name = os.path.join(str(folder), "01_DESS_prep.mha")
+    tgs.write_array(array_py, file_name)
+    return file_name, array_py
+
+def thumbnail_files(folder):
+    return sorted(os.listdir(os.path.join(str(folder), ".thumbnails")))
+
+def no_save(*args):
+    raise AssertionError("thumbnail computed again")
+
+
+# --- tests ---
+
+def test_image_thumbnail_is_reused(tmp_path, monkeypatch):
+
+    file_name, array_py = write_image(tmp_path)
+    thumbnail = thc.get_image_thumbnail(file_name)
+    assert int(thumbnail["slice_ID"]) == 8
+    assert np.array_equal(thumbnail["slice"], array_py[::2,::2,8])
+
+    # input not changed: thumbnail read from the cache
+    monkeypatch.setattr(thc, "save_image_thumbnail", no_save)
+    thumbnail_cached = thc.get_image_thumbnail(file_name)
+    for key in thumbnail:
+        assert np.array_equal(thumbnail_cached[key], thumbnail[key])
+    assert len(thumbnail_files(tmp_path)) == 1
+
+
+def test_image_thumbnail_of_modified_image(tmp_path):
+
+    file_name, array_py = write_image(tmp_path)
+    thc.get_image_thumbnail(file_name)
+    old_files = thumbnail_files(tmp_path)
+
+    # new modification time, same content: computed again, and the old thumbnail is removed
+    os.utime(file_name, ns=(os.stat(file_name).st_atime_ns, os.stat(file_name).st_mtime_ns + 10**9))
+    thc.get_image_thumbnail(file_name)
+    new_files = thumbnail_files(tmp_path)
+    assert len(new_files) == 1 and new_files != old_files
+
+    # new size, same modification time: computed again from the new image
+    mtime_ns = os.stat(file_name).st_mtime_ns
+    file_name, array_py = write_image(tmp_path, shape=(300, 280, 15), seed=1)
+    os.utime(file_name, ns=(mtime_ns, mtime_ns))
+    thumbnail = thc.get_image_thumbnail(file_name)
+    assert len(thumbnail_files(tmp_path)) == 1 and thumbnail_files(tmp_path) != new_files
+    assert np.array_equal(thumbnail["slice"], array_py[::2,::2,10])
+
+
+def test_thumbnail_without_cache_folder(tmp_path):
+
+    # .thumbnails cannot be created (a file with the same name): thumbnails are computed every time
+    file_name, array_py = write_image(tmp_path)
+    open(str(tmp_path / ".thumbnails"), "w").close()
+    for a in range(0, 2):
+        thumbnail = thc.get_image_thumbnail(file_name)
+        assert np.array_equal(thumbnail["slice"], array_py[::2,::2,8])
+    assert os.path.isfile(str(tmp_path / ".thumbnails"))
+    assert sorted(os.listdir(str(tmp_path))) == [".thumbnails", "01_DESS_prep.mha"]
+
+
+def test_overlay_thumbnail_as_slices_of_volumes(tmp_path, monkeypatch):
+
+    image_file_name, array_py = write_image(tmp_path)
+    mask      = tgs.box_mask((300, 280, 12), (40, 20, 3), (200, 250, 10), spacing=(1.0, 1.0, 1.0))
+    mask_file_name = str(tmp_path / "01_DESS_prep_fc.mha")
+    sitkf.write_mask(mask, mask_file_name, 1)
+    mask_py   = sitkf.read_mask(mask_file_name)
+    thumbnail = thc.get_overlay_thumbnail(image_file_name, mask_file_name)
+
+    # slices of the whole volumes
+    mask_py = sitk.GetArrayFromImage(mask_py)
+    first_value, last_value, slice_ID = lio.find_mask_slices(mask_py)
+    assert list(thumbnail["slice_ID"]) == list(slice_ID)
+    assert int(thumbnail["first_value"]) == first_value and int(thumbnail["last_value"]) == last_value
+    for a in range(0, len(slice_ID)):
+        assert np.array_equal(thumbnail["image_slices"][a],   thc.downsample_slice(array_py[:,:,slice_ID[a]]))
+        assert np.array_equal(thumbnail["overlay_slices"][a], thc.downsample_slice(mask_py [:,:,slice_ID[a]]))
+    assert thumbnail["image_slices"].shape[1:] == (150, 140)
+
+    # and from the cache
+    monkeypatch.setattr(thc, "save_overlay_thumbnail", no_save)
+    thumbnail_cached = thc.get_overlay_thumbnail(image_file_name, mask_file_name)
+    for key in thumbnail:
+        assert np.array_equal(thumbnail_cached[key], thumbnail[key])
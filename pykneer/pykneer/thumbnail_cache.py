@@ -0,0 +1,197 @@
+# Serena Bonaretti, 2018
+
+"""
+Module with the thumbnail cache used by the static visualizations.
+Thumbnails are the representative sagittal slices of an image (and of its mask or map overlay), downsampled to a small size.
+They are saved as a side product of the pipeline steps that write the images, in the folder .thumbnails next to the images.
+Each thumbnail is keyed by a hash of the input files (path, size, and modification time), so that a thumbnail is never used
+for images that were computed again. When a thumbnail is missing, it is computed from the images and saved for the next time.
+
+Functions:
+    - input_hash
+    - thumbnail_file_name
+    - downsample_slice
+    - save_image_thumbnail
+    - save_overlay_thumbnail
+    - get_image_thumbnail
+    - get_overlay_thumbnail
+"""
+
+import glob
+import hashlib
+import os
+import numpy as np
+
+# pyKNEER imports
+# ugly way to use relative vs. absolute imports when developing vs. when using package - cannot find a better way
+if __package__ is None or __package__ == '':
+    # uses current directory visibility
+    import lazy_image_io   as lio
+else:
+    # uses current package visibility
+    from . import lazy_image_io   as lio
+
+
+# maximum size of the thumbnail slices (in pixels)
+thumbnail_max_size = 256
+
+
+def input_hash(file_names):
+
+    """
+    Hash of the input files: path, size, and modification time of each file
+    """
+
+    sha = hashlib.sha1()
+    for file_name in file_names:
+        info = os.stat(file_name)
+        sha.update((os.path.abspath(file_name) + "|" + str(info.st_size) + "|" + str(info.st_mtime_ns) + "\n").encode("utf-8"))
+
+    return sha.hexdigest()[0:16]
+
+
+def thumbnail_file_name(file_names, kind):
+
+    """
+    Thumbnails are in the folder .thumbnails next to the last input file (the output of the pipeline step)
+    The file name contains the name of the last input file, the kind of thumbnail, and the hash of the input files
+    """
+
+    folder    = os.path.join(os.path.dirname(os.path.abspath(file_names[-1])), ".thumbnails")
+    root      = os.path.splitext(os.path.basename(file_names[-1]))[0]
+    file_name = os.path.join(folder, root + "_" + kind + "_" + input_hash(file_names) + ".npz")
+
+    return file_name
+
+
+def downsample_slice(slice_py, max_size=thumbnail_max_size):
+
+    # pick one pixel every step so that the largest side is not larger than max_size (nearest neighbor, keeps mask labels)
+    step = int(np.ceil(max(slice_py.shape) / max_size))
+    if step > 1:
+        slice_py = slice_py[::step,::step]
+
+    return np.ascontiguousarray(slice_py)
+
+
+def write_thumbnail(file_name, thumbnail):
+
+    # the cache is optional: if the folder is not writable, the thumbnail is recomputed the next time
+    try:
+        folder = os.path.dirname(file_name)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        # remove previous thumbnails of the same image (computed from older inputs)
+        for old_file_name in glob.glob(glob.escape(file_name[0:-len("_0123456789abcdef.npz")]) + "_*.npz"):
+            os.remove(old_file_name)
+
+        # write to a temporary file and rename, so that parallel processes never read half-written thumbnails
+        temp_file_name = file_name + ".%d.tmp" % os.getpid()
+        with open(temp_file_name, "wb") as file:
+            np.savez_compressed(file, **thumbnail)
+        os.replace(temp_file_name, file_name)
+    except OSError:
+        pass
+
+
+def read_thumbnail(file_name):
+
+    if not os.path.isfile(file_name):
+        return None
+    try:
+        with np.load(file_name) as data:
+            thumbnail = {key: data[key] for key in data.files}
+    except (OSError, ValueError):
+        return None
+
+    return thumbnail
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# IMAGE THUMBNAIL -----------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def save_image_thumbnail(image_file_name, img_py=None):
+
+    """
+    Saves the sagittal slice at 2/3 of the image size (as in show_preprocessed_images_static)
+    img_py is the numpy array of the image, if already in memory. Otherwise, only the slice is read from disk
+    """
+
+    if img_py is None:
+        img_py = lio.lazy_image(image_file_name)
+
+    # extract slice at 2/3 of the image size
+    size     = img_py.shape
+    slice_ID = round(size[2] / 3 * 2)
+
+    thumbnail = {"slice_ID" : np.array(slice_ID),
+                 "size"     : np.array(size),
+                 "slice"    : downsample_slice(img_py[:,:,slice_ID])}
+    write_thumbnail(thumbnail_file_name([image_file_name], "image"), thumbnail)
+
+    return thumbnail
+
+
+def get_image_thumbnail(image_file_name):
+
+    """
+    Returns the thumbnail of the image from the cache, or computes and saves it if missing
+    """
+
+    thumbnail = read_thumbnail(thumbnail_file_name([image_file_name], "image"))
+    if thumbnail is None:
+        thumbnail = save_image_thumbnail(image_file_name)
+
+    return thumbnail
+
+
+# ---------------------------------------------------------------------------------------------------------------------------
+# OVERLAY THUMBNAIL ---------------------------------------------------------------------------------------------------------
+# ---------------------------------------------------------------------------------------------------------------------------
+
+def save_overlay_thumbnail(image_file_name, overlay_file_name, img_py=None, overlay_py=None):
+
+    """
+    Saves three sagittal slices of the image and of the overlay (mask or map) at 1/4, 2/4, and 3/4 of the overlay extent
+    (as in show_segmented_images_static, show_fitting_maps_static, and show_t2_maps_static)
+    img_py and overlay_py are the numpy arrays of the images, if already in memory. Otherwise, only the slices are read from disk
+    """
+
+    if img_py is None:
+        img_py = lio.lazy_image(image_file_name)
+    if overlay_py is None:
+        overlay_py = lio.lazy_image(overlay_file_name)
+
+    # get slices
+    first_value, last_value, slice_ID = lio.find_mask_slices(overlay_py)
+    if slice_ID is None:
+        return None
+    image_slices   = []
+    overlay_slices = []
+    for a in range(0, len(slice_ID)):
+        image_slices.append  (downsample_slice(img_py[:,:,slice_ID[a]]))
+        overlay_slices.append(downsample_slice(overlay_py[:,:,slice_ID[a]]))
+
+    thumbnail = {"slice_ID"       : np.array(slice_ID),
+                 "first_value"    : np.array(first_value),
+                 "last_value"     : np.array(last_value),
+                 "image_slices"   : np.array(image_slices),
+                 "overlay_slices" : np.array(overlay_slices)}
+    write_thumbnail(thumbnail_file_name([image_file_name, overlay_file_name], "overlay"), thumbnail)
+
+    return thumbnail
+
+
+def get_overlay_thumbnail(image_file_name, overlay_file_name):
+
+    """
+    Returns the thumbnail of the image and its overlay from the cache, or computes and saves it if missing
+    """
+
+    thumbnail = read_thumbnail(thumbnail_file_name([image_file_name, overlay_file_name], "overlay"))
+    if thumbnail is None:
+        thumbnail = save_overlay_thumbnail(image_file_name, overlay_file_name)
+
+    return thumbnail
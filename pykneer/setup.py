@@ -25,6 +25,10 @@ setuptools.setup(
     package_data={'pykneer': ['parameterFiles/*.txt', 'elastix/Darwin/', 'elastix/Linux/','elastix/Windows/']
     },
     include_package_data=True,
+    # command line interface (pipeline steps without notebooks)
+    entry_points={
+        "console_scripts": ["pykneer = pykneer.cli:main"]
+    },
     # including tests
     setup_requires=["pytest-runner"],
     tests_require=["pytest"],